@@ -2,10 +2,15 @@ from fastapi import APIRouter, HTTPException, UploadFile, File, Form
 from fastapi.responses import FileResponse
 import os
 import tempfile
+import time
+from app.core import tracing
+from app.core.metrics import metrics
 from app.services.steganography import embed, extract
 
 router = APIRouter()
 
+steganography_seconds = metrics.histogram('steganography_seconds', '隐写嵌入/提取耗时', ('operation', 'status'))
+
 @router.post("/embed")
 async def embed_message(
     image: UploadFile = File(...),
@@ -39,7 +44,14 @@ async def embed_message(
             temp_output_path = temp_output.name
         
         # 执行嵌入操作
-        embed(temp_input_path, secret_message, password, temp_output_path)
+        started = time.perf_counter()
+        try:
+            with tracing.span(tracing.IMAGE):
+                embed(temp_input_path, secret_message, password, temp_output_path)
+        except Exception:
+            steganography_seconds.observe(time.perf_counter() - started, 'embed', 'error')
+            raise
+        steganography_seconds.observe(time.perf_counter() - started, 'embed', 'ok')
         
         # 清理输入临时文件
         os.unlink(temp_input_path)
@@ -88,7 +100,14 @@ async def extract_message(
             temp_file_path = temp_file.name
         
         # 执行提取操作
-        secret_message = extract(temp_file_path, password)
+        started = time.perf_counter()
+        try:
+            with tracing.span(tracing.IMAGE):
+                secret_message = extract(temp_file_path, password)
+        except Exception:
+            steganography_seconds.observe(time.perf_counter() - started, 'extract', 'error')
+            raise
+        steganography_seconds.observe(time.perf_counter() - started, 'extract', 'ok' if secret_message is not None else 'not_found')
         
         # 清理临时文件
         os.unlink(temp_file_path)
@@ -1,48 +1,53 @@
-from fastapi import APIRouter, Depends
+from fastapi import APIRouter, Depends, HTTPException
+from starlette.concurrency import run_in_threadpool
 from app.schemas.user import UserCreate, UserLogin, UserOut, ResponseModel, ForgotPasswordRequest, VerifyCodeRequest, ResetPasswordRequest
 from app.services.user_service import register_user, authenticate_user, search_users
 from app.services.password_reset_service import PasswordResetService
-from app.core.security import get_current_user, create_access_token
+from app.core.security import get_current_user, create_access_token, principal_cache
 from fastapi.security import OAuth2PasswordRequestForm
 from app.services import security_event_service
+from app.services.cpu_executor import cpu_executor
+from app.services.key_setup_service import key_setup_service
+from app.services.user_keys_service import rsa_keypair_pool
 
 router = APIRouter()
 
 @router.post('/auth/register')
-def register(user: UserCreate):
-    res = register_user(user)
+async def register(user: UserCreate):
+    res = await register_user(user)
     if res.get("success"):
-        security_event_service.log_event(res["data"]["user"].id, "register", f"用户注册: {user.username}")
+        await run_in_threadpool(security_event_service.log_event, res["data"]["user"].id, "register", f"用户注册: {user.username}")
     return res
 
+@router.get('/auth/key-setup/{job_id}')
+def get_key_setup_status(job_id: str, current_user: UserOut = Depends(get_current_user)):
+    """查询注册后后台密钥生成任务的状态"""
+    job = key_setup_service.get(job_id, int(current_user.id))
+    if job is None:
+        raise HTTPException(status_code=404, detail="任务不存在或已过期")
+    return {"success": True, "data": job.to_dict()}
+
 @router.post('/auth/login')
-def login(user: UserLogin):
-    res = authenticate_user(user)
+async def login(user: UserLogin):
+    res = await authenticate_user(user)
     if res.get("success"):
-        security_event_service.log_event(res["data"]["user"].id, "login", f"用户登录: {user.username}")
+        await run_in_threadpool(security_event_service.log_event, res["data"]["user"].id, "login", f"用户登录: {user.username}")
     return res
 
 @router.get('/auth/me', response_model=UserOut)
 def get_me(current_user: UserOut = Depends(get_current_user)):
-    # 从数据库获取最新的用户信息，确保头像等信息是最新的
-    from app.db.database import SessionLocal
-    from app.db.models import User
-    
-    db = SessionLocal()
-    try:
-        user = db.query(User).filter(User.id == int(current_user.id)).first()
-        if user:
-            return UserOut(
-                id=user.id,
-                username=user.username,
-                email=user.email,
-                avatar=user.avatar,
-                created_at=user.created_at,
-                updated_at=user.updated_at
-            )
-        return current_user
-    finally:
-        db.close()
+    # 头像等信息变化时认证缓存会失效，current_user即为最新的用户信息
+    return current_user
+
+@router.get('/auth/cache-stats')
+def get_principal_cache_stats(current_user: UserOut = Depends(get_current_user)):
+    """认证用户缓存的命中率等统计"""
+    return {"success": True, "data": principal_cache.stats()}
+
+@router.get('/auth/cpu-stats')
+def get_cpu_executor_stats(current_user: UserOut = Depends(get_current_user)):
+    """密码哈希、密钥生成等CPU任务的排队情况、各操作延迟和密钥池状态"""
+    return {"success": True, "data": {**cpu_executor.stats(), "keypair_pool": rsa_keypair_pool.stats()}}
 
 @router.post('/auth/logout')
 def logout():
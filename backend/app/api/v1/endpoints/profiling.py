@@ -0,0 +1,37 @@
+from fastapi import APIRouter, Depends, HTTPException, Query
+from fastapi.responses import PlainTextResponse
+from app.core.security import get_current_user
+from app.core.config import PROFILING_ADMINS, PROFILING_ENABLED, PROFILE_MAX_SECONDS, SLOW_REQUEST_MS
+from app.core.profiling import loop_lag_monitor, recent_slow_requests, sample_profile
+from app.schemas.user import UserOut
+
+router = APIRouter()
+
+def require_profiling_admin(current_user: UserOut = Depends(get_current_user)) -> UserOut:
+    """只有PROFILING_ADMINS中的用户可以访问性能分析接口"""
+    if current_user.username not in PROFILING_ADMINS:
+        raise HTTPException(status_code=403, detail="无权访问性能分析接口")
+    return current_user
+
+@router.get('/profiling/profile', response_class=PlainTextResponse)
+def run_profile(seconds: float = Query(5, gt=0, le=PROFILE_MAX_SECONDS, description="采样时长（秒）"),
+                interval_ms: float = Query(5, ge=1, le=100, description="采样间隔（毫秒）"),
+                include_idle: bool = Query(False, description="是否包含空闲等待中的线程"),
+                _: UserOut = Depends(require_profiling_admin)):
+    """对运行中的进程做限时采样，返回collapsed stack文本（flamegraph.pl / speedscope 可直接读取）"""
+    return PlainTextResponse(sample_profile(seconds, interval_ms / 1000, include_idle))
+
+@router.get('/profiling/slow-requests')
+def get_slow_requests(limit: int = Query(20, ge=1, le=100),
+                      _: UserOut = Depends(require_profiling_admin)):
+    """最近的慢请求及其span耗时明细（需要PROFILING_ENABLED）"""
+    return {"success": True, "data": {
+        "enabled": PROFILING_ENABLED,
+        "threshold_ms": SLOW_REQUEST_MS,
+        "requests": recent_slow_requests(limit)
+    }}
+
+@router.get('/profiling/loop-lag')
+def get_loop_lag(_: UserOut = Depends(require_profiling_admin)):
+    """事件循环延迟统计和最近一次阻塞时的调用栈"""
+    return {"success": True, "data": loop_lag_monitor.stats()}
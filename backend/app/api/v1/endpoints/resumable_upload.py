@@ -0,0 +1,61 @@
+from fastapi import APIRouter, Depends, Header, Request
+from app.core.security import get_current_user
+from app.schemas.user import UserOut
+from app.schemas.message import Message
+from app.schemas.upload import UploadSessionCreate
+from app.services.resumable_upload_service import resumable_upload_service
+
+router = APIRouter()
+
+@router.post("/upload/sessions")
+async def create_upload_session(body: UploadSessionCreate, current_user: UserOut = Depends(get_current_user)):
+    """创建断点续传上传会话"""
+    session = await resumable_upload_service.create_session(
+        user_id=int(current_user.id),
+        file_name=body.file_name,
+        file_size=body.file_size,
+        to_id=body.to_id,
+        file_type=body.file_type,
+        content_type=body.content_type,
+        chunk_size=body.chunk_size,
+        sha256=body.sha256,
+        message={
+            "content": body.content,
+            "encrypted": body.encrypted,
+            "method": body.method,
+            "destroy_after": body.destroy_after,
+            "hidding_message": body.hidding_message
+        }
+    )
+    return {"success": True, "data": session.to_status()}
+
+@router.get("/upload/sessions/{upload_id}")
+async def get_upload_session(upload_id: str, current_user: UserOut = Depends(get_current_user)):
+    """查询已收到的分片和字节区间"""
+    session = await resumable_upload_service.get_session(upload_id, int(current_user.id))
+    return {"success": True, "data": session.to_status()}
+
+@router.put("/upload/sessions/{upload_id}/chunks/{index}")
+async def put_upload_chunk(
+    upload_id: str,
+    index: int,
+    request: Request,
+    chunk_sha256: str = Header(..., alias="X-Chunk-SHA256"),
+    current_user: UserOut = Depends(get_current_user)
+):
+    """上传一个分片（请求体为分片原始字节，可重试、可乱序）"""
+    session = await resumable_upload_service.put_chunk(
+        upload_id, int(current_user.id), index, request.stream(), chunk_sha256
+    )
+    return {"success": True, "data": session.to_status()}
+
+@router.post("/upload/sessions/{upload_id}/complete", response_model=Message)
+async def complete_upload_session(upload_id: str, current_user: UserOut = Depends(get_current_user)):
+    """拼接分片并发送文件消息"""
+    return await resumable_upload_service.complete(upload_id, int(current_user.id))
+
+@router.delete("/upload/sessions/{upload_id}")
+async def abort_upload_session(upload_id: str, current_user: UserOut = Depends(get_current_user)):
+    """取消上传会话"""
+    await resumable_upload_service.abort(upload_id, int(current_user.id))
+    return {"success": True, "message": "上传已取消"}
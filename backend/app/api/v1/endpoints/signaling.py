@@ -1,31 +1,41 @@
-from fastapi import APIRouter, Depends
+from fastapi import APIRouter, Depends, HTTPException, Query
 from app.core.security import get_current_user
+from app.core.config import SIGNALING_LONG_POLL_MAX
 from app.schemas.user import UserOut
-from app.services import signaling_service
-from app.schemas.signaling import OfferRequest, AnswerRequest
-from pydantic import BaseModel
+from app.services.signaling_service import signaling_mailbox
+from app.services.call_registry import call_registry
+from app.schemas.signaling import OfferRequest, AnswerRequest, IceCandidateRequest
 
 router = APIRouter()
 
-class IceCandidateRequest(BaseModel):
-    targetUserId: int
-    candidate: dict
-
 @router.post('/signaling/offer')
-def send_offer(body: OfferRequest, current_user: UserOut = Depends(get_current_user)):
-    signaling_service.save_signaling_message(int(current_user.id), body.targetUserId, 'offer', body.offer)
-    return {"success": True, "message": "Offer发送成功"}
+async def send_offer(body: OfferRequest, current_user: UserOut = Depends(get_current_user)):
+    delivery = await signaling_mailbox.post(int(current_user.id), body.targetUserId, 'offer', body.offer)
+    return {"success": True, "message": "Offer发送成功", "delivery": delivery}
 
 @router.post('/signaling/answer')
-def send_answer(body: AnswerRequest, current_user: UserOut = Depends(get_current_user)):
-    signaling_service.save_signaling_message(int(current_user.id), body.targetUserId, 'answer', body.offer)
-    return {"success": True, "message": "Answer发送成功"}
+async def send_answer(body: AnswerRequest, current_user: UserOut = Depends(get_current_user)):
+    answer = body.answer if body.answer is not None else body.offer
+    if answer is None:
+        raise HTTPException(status_code=400, detail="缺少answer")
+    delivery = await signaling_mailbox.post(int(current_user.id), body.targetUserId, 'answer', answer)
+    return {"success": True, "message": "Answer发送成功", "delivery": delivery}
 
 @router.post('/signaling/ice-candidate')
-def send_ice(body: IceCandidateRequest, current_user: UserOut = Depends(get_current_user)):
-    signaling_service.save_signaling_message(int(current_user.id), body.targetUserId, 'ice-candidate', body.candidate)
-    return {"success": True, "message": "ICE Candidate发送成功"}
+async def send_ice(body: IceCandidateRequest, current_user: UserOut = Depends(get_current_user)):
+    delivery = await signaling_mailbox.post(int(current_user.id), body.targetUserId, 'ice-candidate', body.candidate)
+    return {"success": True, "message": "ICE Candidate发送成功", "delivery": delivery}
 
 @router.get('/signaling/pending')
-def get_pending(current_user: UserOut = Depends(get_current_user)):
-    return {"success": True, "data": signaling_service.get_pending_signaling(int(current_user.id))}
\ No newline at end of file
+async def get_pending(wait: float = Query(0, ge=0, le=SIGNALING_LONG_POLL_MAX, description="没有信令时最多等待的秒数（长轮询）"),
+                      current_user: UserOut = Depends(get_current_user)):
+    return {"success": True, "data": await signaling_mailbox.wait(int(current_user.id), wait)}
+
+@router.get('/signaling/call-stats')
+def get_call_stats(current_user: UserOut = Depends(get_current_user)):
+    """通话登记表、通话建立耗时直方图和信令邮箱统计"""
+    return {"success": True, "data": {
+        **call_registry.stats(),
+        "setup_latency_ms": call_registry.setup_latency(),
+        "mailbox": signaling_mailbox.stats()
+    }}
@@ -1,13 +1,20 @@
-from fastapi import APIRouter, UploadFile, File, Form, Depends, HTTPException
+from fastapi import APIRouter, UploadFile, File, Form, Depends, HTTPException, Query, Request
 from sqlalchemy.orm import Session
 from app.db.database import SessionLocal
 from app.schemas.message import MessageCreate, Message
 from app.services import message_service
 from app.core.security import get_current_user
 from app.schemas.user import UserOut
+from app.services.file_storage_service import (
+    save_upload_stream, validate_upload, max_upload_size, IMAGE_UPLOAD_DIR, FILE_UPLOAD_DIR
+)
+from app.services.blob_store import blob_store
+from app.services.image_variant_service import image_variant_service
+from app.services.static_file_service import stat_file, file_response
+from starlette.concurrency import run_in_threadpool
 import os
-import uuid
-from datetime import datetime
+import re
+import mimetypes
 from typing import Optional
 
 router = APIRouter()
@@ -19,16 +26,6 @@ def get_db():
     finally:
         db.close()
 
-# 确保上传目录存在
-# 使用绝对路径，基于当前文件位置
-# 从 /backend/app/api/v1/endpoints/upload.py 到 /backend/app/static
-BASE_DIR = os.path.dirname(os.path.dirname(os.path.dirname(os.path.dirname(os.path.abspath(__file__)))))
-IMAGE_UPLOAD_DIR = os.path.join(BASE_DIR, "static", "images")
-FILE_UPLOAD_DIR = os.path.join(BASE_DIR, "static", "files")
-os.makedirs(IMAGE_UPLOAD_DIR, exist_ok=True)
-os.makedirs(FILE_UPLOAD_DIR, exist_ok=True)
-# 图片和文件存储目录
-
 @router.post("/upload/image", response_model=Message)
 async def upload_image(
     file: UploadFile = File(...),
@@ -95,90 +92,26 @@ async def upload_file_internal(
     if not file or not file.filename:
         raise HTTPException(status_code=400, detail="请选择要上传的文件")
     
-    # 获取文件扩展名
-    file_extension = os.path.splitext(file.filename)[1].lower()
-    
-    # 根据文件类型进行验证
-    if file_type == "image":
-        # 验证图片文件类型
-        allowed_types = ['image/jpeg', 'image/jpg', 'image/png', 'image/gif', 'image/webp']
-        if not file.content_type or file.content_type not in allowed_types:
-            raise HTTPException(status_code=400, detail="只支持 JPEG、PNG、GIF、WebP 格式的图片文件")
-        
-        # 验证图片文件扩展名
-        allowed_extensions = ['.jpg', '.jpeg', '.png', '.gif', '.webp']
-        if file_extension not in allowed_extensions:
-            raise HTTPException(status_code=400, detail="文件扩展名不支持")
-    else:
-        # 通用文件类型验证
-        # 禁止上传可执行文件和脚本文件
-        forbidden_extensions = ['.exe', '.bat', '.cmd', '.sh', '.php', '.asp', '.aspx', '.js', '.vbs', '.ps1']
-        if file_extension in forbidden_extensions:
-            raise HTTPException(status_code=400, detail="不允许上传可执行文件或脚本文件")
-        
-        # 文件大小限制更严格
-        max_size = 20 * 1024 * 1024  # 20MB
-        if file.size and file.size > max_size:
-            raise HTTPException(status_code=400, detail=f"文件大小不能超过{max_size // (1024*1024)}MB")
+    # 校验文件类型并获取扩展名
+    file_extension = validate_upload(file.filename, file_type, file.content_type)
+    max_size = max_upload_size(file_type)
     
-    # 读取文件内容并验证大小
+    # 流式保存到临时文件（分块读取、超限立即中止），同时计算SHA-256，再放入内容寻址存储（相同内容由ingest去重）
     try:
-        content_data = await file.read()
-        file_size = len(content_data)
-        
-        # 根据文件类型设置大小限制
-        if file_type == "image":
-            max_size = 10 * 1024 * 1024  # 图片10MB
-        else:
-            max_size = 20 * 1024 * 1024  # 其他文件20MB
-            
-        if file_size > max_size:
-            raise HTTPException(status_code=400, detail=f"文件大小不能超过{max_size // (1024*1024)}MB")
-        
-        # 验证文件不为空
-        if file_size == 0:
-            raise HTTPException(status_code=400, detail="文件内容为空")
-            
+        stored = await save_upload_stream(file, blob_store.new_temp_path(), max_size)
+        deduplicated = await run_in_threadpool(blob_store.ingest, stored.path, stored.sha256, stored.size)
+        sha256 = stored.sha256
+        if file_type == "image" and not deduplicated:
+            # 后台预生成聊天列表使用的缩略图
+            image_variant_service.schedule(blob_store.path_for(sha256))
+    except HTTPException:
+        raise
     except Exception as e:
-        if isinstance(e, HTTPException):
-            raise e
-        raise HTTPException(status_code=500, detail=f"文件读取失败: {str(e)}")
-    
-    # 根据文件类型选择存储目录
-    if file_type == "image":
-        base_upload_dir = IMAGE_UPLOAD_DIR
-    else:
-        base_upload_dir = FILE_UPLOAD_DIR
-    
-    # 为当前用户创建专用目录
-    user_upload_dir = os.path.join(base_upload_dir, str(current_user.id))
-    os.makedirs(user_upload_dir, exist_ok=True)
-    
-    # 生成唯一文件名
-    unique_filename = f"{uuid.uuid4()}{file_extension}"
-    file_path = os.path.join(user_upload_dir, unique_filename)
-    
-    # 用于数据库存储的相对路径（包含用户ID目录）
-    relative_file_path = f"{current_user.id}/{unique_filename}"
-    
-    # 保存文件
-    try:
-        with open(file_path, "wb") as buffer:
-            buffer.write(content_data)
-        
-        # 验证文件是否成功保存
-        if not os.path.exists(file_path) or os.path.getsize(file_path) != file_size:
-            raise Exception("文件保存验证失败")
-            
-    except Exception as e:
-        # 清理可能创建的文件
-        if os.path.exists(file_path):
-            try:
-                os.remove(file_path)
-            except:
-                pass
         raise HTTPException(status_code=500, detail=f"文件保存失败: {str(e)}")
     
+    # 数据库中保存内容寻址文件名 <sha256><扩展名>
+    relative_file_path = blob_store.make_name(sha256, file_extension)
+    
     # 保存消息到数据库
     try:
         # 根据文件类型设置消息内容
@@ -197,7 +130,7 @@ async def upload_file_internal(
             to_id=to_id,
             content=auto_content,
             message_type=file_type,  # 使用传入的文件类型
-            file_path=relative_file_path,  # 保存包含用户ID的相对路径
+            file_path=relative_file_path,  # 保存内容寻址文件名
             file_name=file.filename,
             encrypted=encrypted,
             method=method,
@@ -210,140 +143,100 @@ async def upload_file_internal(
         return message
         
     except Exception as e:
-        # 如果数据库保存失败，删除已上传的文件
-        if os.path.exists(file_path):
-            try:
-                os.remove(file_path)
-            except:
-                pass
-        # 数据库保存失败，已删除文件
+        # 如果数据库保存失败，撤销本次引用（无其他引用的内容由后台回收）
+        blob_store.release_name(relative_file_path)
         raise HTTPException(status_code=500, detail=f"保存消息失败: {str(e)}")
 
+# 文件名格式（防止路径遍历攻击）：sha256.ext（内容寻址）、user_id/uuid.ext 或 uuid.ext
+IMAGE_FILENAME_RE = re.compile(r'^(?:\d+/)?[a-f0-9-]+\.(jpg|jpeg|png|gif|webp)$', re.IGNORECASE)
+FILE_FILENAME_RE = re.compile(r'^(?:\d+/)?[a-f0-9-]+\.[a-zA-Z0-9]+$', re.IGNORECASE)
+
+def _resolve_upload_path(filename: str, base_dir: str) -> str:
+    """把请求中的文件名映射为磁盘路径（文件名已通过格式校验，不含..）"""
+    # 内容寻址文件名（sha256.ext）直接映射到存储路径
+    blob_path = blob_store.resolve(filename)
+    if blob_path is not None:
+        return blob_path
+    # 旧格式：user_id/uuid.ext 或直接在上传目录下的 uuid.ext
+    return os.path.join(base_dir, filename)
+
 @router.get("/images/{filename:path}")
-async def get_image(filename: str):
-    """获取图片文件"""
-    from fastapi.responses import FileResponse
-    import re
-    import logging
+async def get_image(
+    filename: str,
+    request: Request,
+    w: Optional[int] = Query(default=None, ge=1),
+    placeholder: bool = Query(default=False)
+):
+    """获取图片文件
+
+    - w: 期望显示宽度，返回不小于该宽度的最近一档缩略图（支持WebP的客户端返回WebP）
+    - placeholder: 返回极小的模糊占位图，用于图片加载前显示
+
+    支持ETag/If-None-Match（304）和Range请求；内容寻址的图片永久缓存。
+    """
+    if not IMAGE_FILENAME_RE.match(filename):
+        raise HTTPException(status_code=400, detail="无效的文件名格式")
     
-    # 禁用此请求的访问日志
-    uvicorn_logger = logging.getLogger("uvicorn.access")
-    original_level = uvicorn_logger.level
-    uvicorn_logger.setLevel(logging.WARNING)
+    file_path = _resolve_upload_path(filename, IMAGE_UPLOAD_DIR)
+    stat_result = stat_file(file_path)
+    if stat_result is None:
+        raise HTTPException(status_code=404, detail="图片不存在")
     
-    try:
-        # 验证文件名格式（防止路径遍历攻击）
-        # 支持两种格式：user_id/uuid.ext 或 uuid.ext
-        if not re.match(r'^(?:\d+/)?[a-f0-9-]+\.(jpg|jpeg|png|gif|webp)$', filename, re.IGNORECASE):
-            raise HTTPException(status_code=400, detail="无效的文件名格式")
-        
-        # 构建文件路径（支持用户ID子目录）
-        if "/" in filename:
-            # 新格式：user_id/filename
-            file_path = os.path.join(IMAGE_UPLOAD_DIR, filename)
-        else:
-            # 兼容旧格式：直接在images目录下
-            file_path = os.path.join(IMAGE_UPLOAD_DIR, filename)
-        
-        # 安全检查：确保文件路径在允许的目录内
-        real_upload_dir = os.path.realpath(IMAGE_UPLOAD_DIR)
-        real_file_path = os.path.realpath(file_path)
-        if not real_file_path.startswith(real_upload_dir):
-            raise HTTPException(status_code=403, detail="访问被拒绝")
-        
-        # 检查文件是否存在
-        if not os.path.exists(file_path):
-            # 文件不存在
-            raise HTTPException(status_code=404, detail="图片不存在")
-        
-        # 检查是否为文件（不是目录）
-        if not os.path.isfile(file_path):
-            raise HTTPException(status_code=404, detail="图片不存在")
-        
-        # 获取文件的MIME类型
-        import mimetypes
-        content_type, _ = mimetypes.guess_type(file_path)
-        if not content_type or not content_type.startswith('image/'):
-            content_type = 'image/jpeg'  # 默认类型
-        
-        # 返回图片
-        return FileResponse(
-            file_path,
-            media_type=content_type,
-            headers={
-                "Cache-Control": "public, max-age=3600",  # 缓存1小时
-                "Content-Disposition": f"inline; filename={filename}"
-            }
-        )
-    except Exception as e:
-        # 返回图片失败
-        raise HTTPException(status_code=500, detail="图片读取失败")
-    finally:
-        # 恢复日志级别
-        uvicorn_logger.setLevel(original_level)
+    # 获取文件的MIME类型
+    content_type, _ = mimetypes.guess_type(filename)
+    if not content_type or not content_type.startswith('image/'):
+        content_type = 'image/jpeg'  # 默认类型
+    
+    sha256 = blob_store.parse_name(filename)
+    etag = f'"{sha256}"' if sha256 else None
+    headers = {"Content-Disposition": f"inline; filename={os.path.basename(filename)}"}
+    
+    # 缩略图或占位图：不存在时生成并缓存，无法生成（动图、原图更小等）时返回原图
+    variant_path = None
+    if placeholder:
+        variant_path = await image_variant_service.get_placeholder(file_path)
+        variant_type = "image/webp"
+    elif w is not None:
+        accepts_webp = "image/webp" in request.headers.get("accept", "")
+        variant_type = "image/webp" if accepts_webp else "image/jpeg"
+        variant_path = await image_variant_service.get_variant(file_path, w, "webp" if accepts_webp else "jpg")
+        headers["Vary"] = "Accept"
+    if variant_path:
+        variant_stat = stat_file(variant_path)
+        if variant_stat is not None:
+            # 缩略图的ETag在原图哈希后加上缩略图后缀
+            if sha256:
+                etag = f'"{sha256}{variant_path[len(file_path):]}"'
+            file_path, stat_result, content_type = variant_path, variant_stat, variant_type
+    
+    return file_response(
+        request, file_path, stat_result, content_type,
+        etag=etag, immutable=sha256 is not None, headers=headers
+    )
 
 @router.get("/files/{filename:path}")
-async def get_file(filename: str):
-    """获取文件"""
-    from fastapi.responses import FileResponse
-    import re
-    import logging
+async def get_file(filename: str, request: Request):
+    """获取文件
+
+    支持ETag/If-None-Match（304）和Range请求（断点续传下载）；内容寻址的文件永久缓存。
+    """
+    if not FILE_FILENAME_RE.match(filename):
+        raise HTTPException(status_code=400, detail="无效的文件名格式")
     
-    # 禁用此请求的访问日志
-    uvicorn_logger = logging.getLogger("uvicorn.access")
-    original_level = uvicorn_logger.level
-    uvicorn_logger.setLevel(logging.WARNING)
+    file_path = _resolve_upload_path(filename, FILE_UPLOAD_DIR)
+    stat_result = stat_file(file_path)
+    if stat_result is None:
+        raise HTTPException(status_code=404, detail="文件不存在")
     
-    try:
-        # 验证文件名格式（防止路径遍历攻击）
-        # 支持两种格式：user_id/uuid.ext 或 uuid.ext
-        if not re.match(r'^(?:\d+/)?[a-f0-9-]+\.[a-zA-Z0-9]+$', filename, re.IGNORECASE):
-            raise HTTPException(status_code=400, detail="无效的文件名格式")
-        
-        # 构建文件路径（支持用户ID子目录）
-        if "/" in filename:
-            # 新格式：user_id/filename
-            file_path = os.path.join(FILE_UPLOAD_DIR, filename)
-        else:
-            # 兼容旧格式：直接在images目录下
-            file_path = os.path.join(FILE_UPLOAD_DIR, filename)
-        
-        # 安全检查：确保文件路径在允许的目录内
-        real_upload_dir = os.path.realpath(FILE_UPLOAD_DIR)
-        real_file_path = os.path.realpath(file_path)
-        if not real_file_path.startswith(real_upload_dir):
-            raise HTTPException(status_code=403, detail="访问被拒绝")
-        
-        # 检查文件是否存在
-        if not os.path.exists(file_path):
-            raise HTTPException(status_code=404, detail="文件不存在")
-        
-        # 检查是否为文件（不是目录）
-        if not os.path.isfile(file_path):
-            raise HTTPException(status_code=404, detail="文件不存在")
-        
-        # 获取文件的MIME类型
-        import mimetypes
-        content_type, _ = mimetypes.guess_type(file_path)
-        if not content_type:
-            content_type = 'application/octet-stream'  # 默认二进制类型
-        
-        # 获取原始文件名（从路径中提取）
-        original_filename = os.path.basename(filename)
-        
-        # 返回文件
-        return FileResponse(
-            file_path,
-            media_type=content_type,
-            headers={
-                "Cache-Control": "public, max-age=3600",  # 缓存1小时
-                "Content-Disposition": f"attachment; filename={original_filename}"
-            }
-        )
-    except Exception as e:
-        if isinstance(e, HTTPException):
-            raise e
-        raise HTTPException(status_code=500, detail="文件读取失败")
-    finally:
-        # 恢复日志级别
-        uvicorn_logger.setLevel(original_level)
\ No newline at end of file
+    # 获取文件的MIME类型
+    content_type, _ = mimetypes.guess_type(filename)
+    if not content_type:
+        content_type = 'application/octet-stream'  # 默认二进制类型
+    
+    sha256 = blob_store.parse_name(filename)
+    return file_response(
+        request, file_path, stat_result, content_type,
+        etag=f'"{sha256}"' if sha256 else None,
+        immutable=sha256 is not None,
+        headers={"Content-Disposition": f"attachment; filename={os.path.basename(filename)}"}
+    )
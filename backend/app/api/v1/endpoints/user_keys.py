@@ -2,6 +2,7 @@ from fastapi import APIRouter, Depends, HTTPException, status
 from app.schemas.user import UserOut, ResponseModel
 from app.services.user_keys_service import UserKeysService
 from app.core.security import get_current_user
+from app.services.cpu_executor import cpu_executor
 from pydantic import BaseModel
 from typing import Optional
 
@@ -53,7 +54,8 @@ async def get_user_private_keys(
     """获取用户私钥信息（需要密码验证）"""
     try:
         user_id = int(current_user.id)
-        result = UserKeysService.get_user_private_keys(user_id, request.password)
+        # 解密私钥需要PBKDF2派生密钥，在CPU线程池中执行
+        result = await cpu_executor.run("pbkdf2_decrypt_private_key", UserKeysService.get_user_private_keys, user_id, request.password)
         
         if not result.get('success'):
             raise HTTPException(
@@ -67,6 +69,8 @@ async def get_user_private_keys(
             data=result['data']
         )
         
+    except HTTPException:
+        raise
     except ValueError:
         raise HTTPException(
             status_code=status.HTTP_400_BAD_REQUEST,
@@ -86,7 +90,8 @@ async def update_user_keys(
     """更新用户密钥"""
     try:
         user_id = int(current_user.id)
-        result = UserKeysService.update_user_keys(user_id, request.password)
+        # RSA密钥生成和私钥加密在CPU线程池中执行
+        result = await cpu_executor.run("update_user_keys", UserKeysService.update_user_keys, user_id, request.password)
         
         if not result.get('success'):
             raise HTTPException(
@@ -100,6 +105,8 @@ async def update_user_keys(
             data=result['data']
         )
         
+    except HTTPException:
+        raise
     except ValueError:
         raise HTTPException(
             status_code=status.HTTP_400_BAD_REQUEST,
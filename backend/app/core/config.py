@@ -3,6 +3,7 @@ from pathlib import Path
 
 # 项目根目录
 PROJECT_ROOT = Path(__file__).parent.parent.parent.parent
+APP_DIR = Path(__file__).parent.parent
 DATA_DIR = PROJECT_ROOT / "data"
 DATABASE_DIR = DATA_DIR / "database"
 UPLOADS_DIR = DATA_DIR / "uploads"
@@ -14,6 +15,124 @@ UPLOADS_DIR.mkdir(parents=True, exist_ok=True)
 LOGS_DIR.mkdir(parents=True, exist_ok=True)
 
 SECRET_KEY = os.getenv('SECRET_KEY', 'your_secret_key')
-DATABASE_URL = os.getenv('DATABASE_URL', f'sqlite:///{DATABASE_DIR}/chat8.db')
+# 默认使用backend/app目录下现有的chat8.db，可通过DATABASE_URL指向其他SQLite文件或PostgreSQL
+DATABASE_URL = os.getenv('DATABASE_URL', f'sqlite:///{APP_DIR}/chat8.db')
 ALGORITHM = 'HS256'
-ACCESS_TOKEN_EXPIRE_MINUTES = 60
\ No newline at end of file
+ACCESS_TOKEN_EXPIRE_MINUTES = 60
+
+# 上传配置
+UPLOAD_CHUNK_SIZE = int(os.getenv('UPLOAD_CHUNK_SIZE', 1024 * 1024))  # 流式上传每次读取/写入的块大小
+IMAGE_MAX_SIZE = int(os.getenv('IMAGE_MAX_SIZE', 10 * 1024 * 1024))  # 图片10MB
+FILE_MAX_SIZE = int(os.getenv('FILE_MAX_SIZE', 20 * 1024 * 1024))  # 其他文件20MB
+AVATAR_MAX_SIZE = int(os.getenv('AVATAR_MAX_SIZE', 5 * 1024 * 1024))  # 头像5MB
+
+# 断点续传配置
+RESUMABLE_FILE_MAX_SIZE = int(os.getenv('RESUMABLE_FILE_MAX_SIZE', 200 * 1024 * 1024))  # 分片上传的文件上限，不受内存限制
+RESUMABLE_DEFAULT_CHUNK_SIZE = int(os.getenv('RESUMABLE_DEFAULT_CHUNK_SIZE', 1024 * 1024))
+RESUMABLE_MAX_CHUNK_SIZE = int(os.getenv('RESUMABLE_MAX_CHUNK_SIZE', 8 * 1024 * 1024))
+RESUMABLE_SESSION_TTL = int(os.getenv('RESUMABLE_SESSION_TTL', 24 * 3600))  # 无活动多少秒后回收上传会话
+RESUMABLE_GC_INTERVAL = int(os.getenv('RESUMABLE_GC_INTERVAL', 600))
+RESUMABLE_MAX_SESSIONS_PER_USER = int(os.getenv('RESUMABLE_MAX_SESSIONS_PER_USER', 5))
+
+# 内容寻址存储配置
+BLOB_GC_INTERVAL = int(os.getenv('BLOB_GC_INTERVAL', 3600))
+BLOB_GC_GRACE = int(os.getenv('BLOB_GC_GRACE', 24 * 3600))  # 引用数降为0后保留多久再删除
+
+# 图片缩略图配置
+IMAGE_VARIANT_WIDTHS = tuple(int(w) for w in os.getenv('IMAGE_VARIANT_WIDTHS', '160,320,640').split(','))  # 预生成的缩略图宽度
+IMAGE_VARIANT_QUALITY = int(os.getenv('IMAGE_VARIANT_QUALITY', 80))
+IMAGE_VARIANT_WORKERS = int(os.getenv('IMAGE_VARIANT_WORKERS', 2))  # 缩略图生成线程数
+IMAGE_PLACEHOLDER_WIDTH = int(os.getenv('IMAGE_PLACEHOLDER_WIDTH', 16))  # 模糊占位图宽度
+
+# 认证用户缓存配置
+PRINCIPAL_CACHE_SIZE = int(os.getenv('PRINCIPAL_CACHE_SIZE', 10000))  # 最多缓存多少个token
+PRINCIPAL_CACHE_TTL = int(os.getenv('PRINCIPAL_CACHE_TTL', 300))  # 缓存秒数（不超过token剩余有效期）
+
+# CPU密集任务（密码哈希、密钥生成）线程池配置
+CPU_POOL_WORKERS = int(os.getenv('CPU_POOL_WORKERS', min(4, os.cpu_count() or 1)))
+CPU_POOL_MAX_PENDING = int(os.getenv('CPU_POOL_MAX_PENDING', 64))  # 排队+执行中的任务上限，超过后拒绝新请求
+KEY_SETUP_JOB_TTL = int(os.getenv('KEY_SETUP_JOB_TTL', 3600))  # 密钥生成任务状态保留秒数
+
+# 预生成RSA密钥对池配置
+KEYPAIR_POOL_SIZE = int(os.getenv('KEYPAIR_POOL_SIZE', 8))  # 池中保持的密钥对数量，0表示不预生成
+KEYPAIR_POOL_LOW_WATER = int(os.getenv('KEYPAIR_POOL_LOW_WATER', 2))  # 低于该数量时记录告警
+
+# libsignal Node模块路径（仅Kyber预密钥等Python端未实现的操作使用常驻Node辅助进程）
+LIBSIGNAL_NODE_PATH = os.getenv('LIBSIGNAL_NODE_PATH', str(PROJECT_ROOT / 'libsignal' / 'node'))  # 默认为项目根目录下的 libsignal/node
+NODE_WORKER_TIMEOUT = float(os.getenv('NODE_WORKER_TIMEOUT', 10))
+
+# 密钥材料缓存配置
+KEY_MATERIAL_CACHE_SIZE = int(os.getenv('KEY_MATERIAL_CACHE_SIZE', 4096))  # 进程内缓存的用户密钥数量
+LEGACY_KEYS_DIR = os.getenv('LEGACY_KEYS_DIR', str(APP_DIR.parent / 'user_keys'))  # 旧版本 user_{id}_keys.json 所在目录，数据库中没有的用户从这里导入
+
+# 消息批量解密配置
+DECRYPT_BATCH_PARALLEL_THRESHOLD = int(os.getenv('DECRYPT_BATCH_PARALLEL_THRESHOLD', 256))  # 单个会话超过该条数时分块并行解密，0表示不并行
+DECRYPT_BATCH_WORKERS = int(os.getenv('DECRYPT_BATCH_WORKERS', 4))  # 并行解密线程数
+
+# 数据库连接池配置
+DB_POOL_SIZE = int(os.getenv('DB_POOL_SIZE', 10))
+DB_MAX_OVERFLOW = int(os.getenv('DB_MAX_OVERFLOW', 20))
+DB_POOL_TIMEOUT = float(os.getenv('DB_POOL_TIMEOUT', 30))  # 等待空闲连接的秒数
+DB_POOL_RECYCLE = int(os.getenv('DB_POOL_RECYCLE', 1800))  # 连接最长复用秒数（仅非SQLite）
+DB_ECHO = os.getenv('DB_ECHO', '').lower() in ('1', 'true', 'yes')
+
+# SQLite连接参数（每个新连接执行的PRAGMA）
+SQLITE_JOURNAL_MODE = os.getenv('SQLITE_JOURNAL_MODE', 'WAL')  # WAL模式下读写互不阻塞
+SQLITE_SYNCHRONOUS = os.getenv('SQLITE_SYNCHRONOUS', 'NORMAL')  # WAL下NORMAL不会损坏数据库，只可能丢失最后的事务
+SQLITE_BUSY_TIMEOUT_MS = int(os.getenv('SQLITE_BUSY_TIMEOUT_MS', 5000))  # 遇到写锁时等待而不是立即报database is locked
+SQLITE_CACHE_SIZE_KB = int(os.getenv('SQLITE_CACHE_SIZE_KB', 20 * 1024))  # 每个连接的页缓存大小
+SQLITE_MMAP_SIZE = int(os.getenv('SQLITE_MMAP_SIZE', 256 * 1024 * 1024))  # 内存映射读取的字节数，0表示关闭
+
+# 异步路径访问数据库的线程池（WebSocket消息、在线状态、心跳）
+DB_EXECUTOR_WORKERS = int(os.getenv('DB_EXECUTOR_WORKERS', 8))  # 不应超过连接池大小 DB_POOL_SIZE + DB_MAX_OVERFLOW
+
+# 启动预热配置
+WARMUP_RECENT_DAYS = int(os.getenv('WARMUP_RECENT_DAYS', 7))  # 预热最近多少天内活跃的用户
+WARMUP_MAX_USERS = int(os.getenv('WARMUP_MAX_USERS', 2000))  # 预热好友关系和密钥材料的用户数上限
+WARMUP_MAX_PAIRS = int(os.getenv('WARMUP_MAX_PAIRS', 1000))  # 预热会话密钥的用户对数上限
+FRIEND_GRAPH_CACHE_SIZE = int(os.getenv('FRIEND_GRAPH_CACHE_SIZE', 10000))  # 缓存好友列表的用户数
+SESSION_KEY_CACHE_SIZE = int(os.getenv('SESSION_KEY_CACHE_SIZE', 4096))  # 缓存的已解封会话密钥数
+
+# 信令中转配置（内存邮箱）
+SIGNALING_TTL = int(os.getenv('SIGNALING_TTL', 60))  # 未取走的信令保留秒数
+SIGNALING_MAILBOX_SIZE = int(os.getenv('SIGNALING_MAILBOX_SIZE', 256))  # 每个用户最多排队的信令条数
+SIGNALING_LONG_POLL_MAX = int(os.getenv('SIGNALING_LONG_POLL_MAX', 30))  # 长轮询最长等待秒数
+
+# 通话信令配置
+CALL_SIGNALING_PROTOCOL = int(os.getenv('CALL_SIGNALING_PROTOCOL', 2))  # 1: 转发时附带offer/answer/candidate兼容字段；2: 只转发payload
+CALL_RING_TIMEOUT = int(os.getenv('CALL_RING_TIMEOUT', 60))  # 发出邀请后多少秒未应答视为失效
+CALL_TOMBSTONE_TTL = int(os.getenv('CALL_TOMBSTONE_TTL', 30))  # 通话结束后保留多少秒，用于丢弃迟到的信令
+
+# 日志配置
+LOG_LEVEL = os.getenv('LOG_LEVEL', 'INFO')
+LOG_LEVELS = os.getenv('LOG_LEVELS', '')  # 按模块设置级别，例如 "app.websocket=DEBUG,app.services.user_states_update=WARNING"
+LOG_JSON_FILE = os.getenv('LOG_JSON_FILE', 'app.jsonl')  # LOGS_DIR下的JSON日志文件名，为空则不写文件
+LOG_FILE_MAX_BYTES = int(os.getenv('LOG_FILE_MAX_BYTES', 20 * 1024 * 1024))
+LOG_FILE_BACKUPS = int(os.getenv('LOG_FILE_BACKUPS', 5))
+LOG_SAMPLE_EVERY = int(os.getenv('LOG_SAMPLE_EVERY', 100))  # 高频事件每N条记录1条
+
+# 指标接口配置（/metrics）
+METRICS_ENABLED = os.getenv('METRICS_ENABLED', 'true').lower() in ('1', 'true', 'yes')  # 关闭后/metrics返回404
+METRICS_TOKEN = os.getenv('METRICS_TOKEN', '')  # 设置后带 "Authorization: Bearer <METRICS_TOKEN>" 的请求可以拉取指标
+METRICS_ALLOWED_IPS = [item.strip() for item in os.getenv('METRICS_ALLOWED_IPS', '127.0.0.1,::1').split(',') if item.strip()]  # 不带令牌即可拉取指标的来源IP或网段
+
+# 性能分析配置
+PROFILING_ENABLED = os.getenv('PROFILING_ENABLED', '').lower() in ('1', 'true', 'yes')  # 记录每个请求的span耗时
+SLOW_REQUEST_MS = int(os.getenv('SLOW_REQUEST_MS', 500))  # 超过该耗时的请求连同span明细写入警告日志
+PROFILING_ADMINS = [name.strip() for name in os.getenv('PROFILING_ADMINS', '').split(',') if name.strip()]  # 可调用分析接口的用户名
+PROFILE_MAX_SECONDS = int(os.getenv('PROFILE_MAX_SECONDS', 30))  # 一次采样分析最长秒数
+LOOP_LAG_INTERVAL_MS = int(os.getenv('LOOP_LAG_INTERVAL_MS', 100))  # 事件循环延迟探测间隔
+LOOP_LAG_WARN_MS = int(os.getenv('LOOP_LAG_WARN_MS', 200))  # 事件循环被阻塞超过该毫秒数时告警，0表示关闭
+
+# 临时事件配置（正在输入、截屏提醒、在线状态：只保留最新状态，尽力而为投递）
+TYPING_MIN_INTERVAL_MS = int(os.getenv('TYPING_MIN_INTERVAL_MS', 1000))  # 同一发送方对同一接收方的输入状态最短推送间隔
+SCREENSHOT_MIN_INTERVAL_MS = int(os.getenv('SCREENSHOT_MIN_INTERVAL_MS', 2000))  # 截屏提醒最短推送间隔
+PRESENCE_MIN_INTERVAL_MS = int(os.getenv('PRESENCE_MIN_INTERVAL_MS', 1000))  # 在线状态变化最短推送间隔，窗口内只推最后的状态
+EPHEMERAL_QUEUE_SIZE = int(os.getenv('EPHEMERAL_QUEUE_SIZE', 64))  # 每个连接低优先级队列最多等待的临时事件数
+EPHEMERAL_IDLE_TTL = int(os.getenv('EPHEMERAL_IDLE_TTL', 60))  # 节流状态闲置多少秒后清理
+
+# 限流配置（令牌桶）
+RATE_LIMIT_ENABLED = os.getenv('RATE_LIMIT_ENABLED', 'true').lower() in ('1', 'true', 'yes')  # 是否启用限流
+RATE_LIMIT_BACKEND = os.getenv('RATE_LIMIT_BACKEND', 'memory')  # memory: 每个进程各自计数；sqlite: 多worker共用RATE_LIMIT_DB_PATH
+RATE_LIMIT_DB_PATH = os.getenv('RATE_LIMIT_DB_PATH', str(DATABASE_DIR / 'rate_limit.db'))  # 共享令牌桶的SQLite文件
+RATE_LIMITS = os.getenv('RATE_LIMITS', '')  # 覆盖默认限额，例如 "search=60/60,ws_message=20/10"（突发容量/装满秒数）
@@ -0,0 +1,135 @@
+import atexit
+import json
+import logging
+import logging.handlers
+import queue
+import sys
+import threading
+from datetime import datetime, timezone
+from typing import Dict, Optional
+from app.core.config import (
+    LOGS_DIR, LOG_LEVEL, LOG_LEVELS, LOG_JSON_FILE, LOG_FILE_MAX_BYTES, LOG_FILE_BACKUPS, LOG_SAMPLE_EVERY
+)
+
+# LogRecord自带的属性，其余属性视为通过extra传入的结构化字段
+_RECORD_ATTRS = set(vars(logging.LogRecord('', 0, '', 0, '', None, None))) | {'message', 'asctime'}
+_CONSOLE_FORMAT = '%(asctime)s %(levelname)s %(name)s: %(message)s'
+
+
+class JsonFormatter(logging.Formatter):
+    """每条日志输出一行JSON，extra传入的字段原样保留"""
+
+    def format(self, record: logging.LogRecord) -> str:
+        entry = {
+            "ts": datetime.fromtimestamp(record.created, timezone.utc).isoformat(),
+            "level": record.levelname,
+            "logger": record.name,
+            "msg": record.getMessage(),
+        }
+        for key, value in vars(record).items():
+            if key not in _RECORD_ATTRS and not key.startswith('_'):
+                entry[key] = value
+        if record.exc_text:
+            entry["exc"] = record.exc_text
+        elif record.exc_info:
+            entry["exc"] = self.formatException(record.exc_info)
+        return json.dumps(entry, ensure_ascii=False, default=str)
+
+
+class SamplingFilter(logging.Filter):
+    """对带 extra={"sample": 键} 的高频日志按键采样，每every条放行1条
+
+    放行的记录带有sampled字段，表示它代表的日志条数；不带sample的日志不受影响。
+    """
+
+    def __init__(self, every: int = LOG_SAMPLE_EVERY):
+        super().__init__()
+        self.every = max(1, every)
+        self._counts: Dict[str, int] = {}
+        self._lock = threading.Lock()
+
+    def filter(self, record: logging.LogRecord) -> bool:
+        key = getattr(record, 'sample', None)
+        if key is None or self.every == 1:
+            return True
+        with self._lock:
+            count = self._counts.get(key, 0) + 1
+            self._counts[key] = count % self.every
+        if count == 1:
+            record.sampled = self.every
+            return True
+        return False
+
+
+class LazyQueueHandler(logging.handlers.QueueHandler):
+    """只合并消息参数、格式化异常，其余格式化和I/O都在监听线程中完成"""
+
+    def prepare(self, record: logging.LogRecord) -> logging.LogRecord:
+        record.msg = record.getMessage()
+        record.args = None
+        if record.exc_info:
+            record.exc_text = logging.Formatter().formatException(record.exc_info)
+            record.exc_info = None
+        return record
+
+
+_listener: Optional[logging.handlers.QueueListener] = None
+_queue_handler: Optional[logging.Handler] = None
+
+
+def parse_levels(spec: str) -> Dict[str, str]:
+    """解析 "模块=级别,模块=级别" 形式的配置"""
+    levels = {}
+    for item in spec.split(','):
+        name, sep, level = item.partition('=')
+        if sep and name.strip() and level.strip():
+            levels[name.strip()] = level.strip().upper()
+    return levels
+
+
+def setup_logging(level: str = LOG_LEVEL, levels: str = LOG_LEVELS, json_file: str = LOG_JSON_FILE) -> None:
+    """配置应用日志（可重复调用，只生效一次）
+
+    所有日志先进入内存队列，由QueueListener在后台线程写控制台和LOGS_DIR下的JSON文件，
+    事件循环线程上只做级别判断和消息参数合并。
+    """
+    global _listener, _queue_handler
+    if _listener is not None:
+        return
+
+    handlers = []
+    console = logging.StreamHandler(sys.stderr)
+    console.setFormatter(logging.Formatter(_CONSOLE_FORMAT))
+    handlers.append(console)
+    if json_file:
+        file_handler = logging.handlers.RotatingFileHandler(
+            LOGS_DIR / json_file, maxBytes=LOG_FILE_MAX_BYTES, backupCount=LOG_FILE_BACKUPS, encoding='utf-8'
+        )
+        file_handler.setFormatter(JsonFormatter())
+        handlers.append(file_handler)
+
+    log_queue: "queue.SimpleQueue[logging.LogRecord]" = queue.SimpleQueue()
+    queue_handler = LazyQueueHandler(log_queue)
+    queue_handler.addFilter(SamplingFilter())
+
+    root = logging.getLogger()
+    root.setLevel(level.upper())
+    root.addHandler(queue_handler)
+    _queue_handler = queue_handler
+    for name, module_level in parse_levels(levels).items():
+        logging.getLogger(name).setLevel(module_level)
+
+    _listener = logging.handlers.QueueListener(log_queue, *handlers, respect_handler_level=True)
+    _listener.start()
+    atexit.register(shutdown_logging)
+
+
+def shutdown_logging() -> None:
+    """停止后台写日志线程，写出队列中剩余的日志"""
+    global _listener, _queue_handler
+    if _listener is not None:
+        logging.getLogger().removeHandler(_queue_handler)
+        listener, _listener, _queue_handler = _listener, None, None
+        listener.stop()
+        for handler in listener.handlers:
+            handler.close()
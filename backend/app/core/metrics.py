@@ -0,0 +1,339 @@
+import bisect
+import functools
+import math
+import re
+import threading
+import time
+from typing import Callable, Dict, List, Optional, Sequence, Tuple
+from app.core import tracing
+
+# 默认的耗时直方图桶上界（秒）
+DEFAULT_BUCKETS = (0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0)
+
+_NAME_RE = re.compile(r'[^a-zA-Z0-9_]')
+
+
+def _format_value(value: float) -> str:
+    if value == math.inf:
+        return '+Inf'
+    if isinstance(value, bool):
+        return '1' if value else '0'
+    if isinstance(value, int) or float(value).is_integer():
+        return str(int(value))
+    return repr(float(value))
+
+
+def _escape(value) -> str:
+    return str(value).replace('\\', '\\\\').replace('\n', '\\n').replace('"', '\\"')
+
+
+def _format_labels(names: Sequence[str], values: Sequence) -> str:
+    if not names:
+        return ''
+    return '{' + ','.join(f'{name}="{_escape(value)}"' for name, value in zip(names, values)) + '}'
+
+
+class _Metric:
+    kind = ''
+
+    def __init__(self, name: str, help_text: str, labelnames: Sequence[str] = ()):
+        self.name = name
+        self.help = help_text
+        self.labelnames = tuple(labelnames)
+        self._lock = threading.Lock()
+
+    def _key(self, labels: Tuple) -> Tuple:
+        if len(labels) != len(self.labelnames):
+            raise ValueError(f"{self.name} 需要标签 {self.labelnames}")
+        return tuple(str(value) for value in labels)
+
+    def header(self) -> List[str]:
+        return [f"# HELP {self.name} {self.help}", f"# TYPE {self.name} {self.kind}"]
+
+
+class Counter(_Metric):
+    """只增不减的计数器"""
+    kind = 'counter'
+
+    def __init__(self, name: str, help_text: str, labelnames: Sequence[str] = ()):
+        super().__init__(name, help_text, labelnames)
+        self._values: Dict[Tuple, float] = {}
+
+    def inc(self, *labels, amount: float = 1) -> None:
+        key = self._key(labels)
+        with self._lock:
+            self._values[key] = self._values.get(key, 0) + amount
+
+    def value(self, *labels) -> float:
+        with self._lock:
+            return self._values.get(self._key(labels), 0)
+
+    def render(self) -> List[str]:
+        with self._lock:
+            items = list(self._values.items())
+        return self.header() + [f"{self.name}{_format_labels(self.labelnames, key)} {_format_value(value)}"
+                                for key, value in items]
+
+
+class Gauge(_Metric):
+    """可增可减的当前值"""
+    kind = 'gauge'
+
+    def __init__(self, name: str, help_text: str, labelnames: Sequence[str] = ()):
+        super().__init__(name, help_text, labelnames)
+        self._values: Dict[Tuple, float] = {}
+
+    def set(self, value: float, *labels) -> None:
+        key = self._key(labels)
+        with self._lock:
+            self._values[key] = value
+
+    def inc(self, *labels, amount: float = 1) -> None:
+        key = self._key(labels)
+        with self._lock:
+            self._values[key] = self._values.get(key, 0) + amount
+
+    def dec(self, *labels, amount: float = 1) -> None:
+        self.inc(*labels, amount=-amount)
+
+    def value(self, *labels) -> float:
+        with self._lock:
+            return self._values.get(self._key(labels), 0)
+
+    def render(self) -> List[str]:
+        with self._lock:
+            items = list(self._values.items())
+        return self.header() + [f"{self.name}{_format_labels(self.labelnames, key)} {_format_value(value)}"
+                                for key, value in items]
+
+
+class _HistogramChild:
+    __slots__ = ('counts', 'sum', 'count')
+
+    def __init__(self, size: int):
+        self.counts = [0] * size
+        self.sum = 0.0
+        self.count = 0
+
+
+class Histogram(_Metric):
+    """固定桶直方图（单位为秒）"""
+    kind = 'histogram'
+
+    def __init__(self, name: str, help_text: str, labelnames: Sequence[str] = (), buckets: Sequence[float] = DEFAULT_BUCKETS):
+        super().__init__(name, help_text, labelnames)
+        self.buckets = tuple(sorted(buckets))
+        self._children: Dict[Tuple, _HistogramChild] = {}
+
+    def observe(self, value: float, *labels) -> None:
+        key = self._key(labels)
+        index = bisect.bisect_left(self.buckets, value)
+        with self._lock:
+            child = self._children.get(key)
+            if child is None:
+                child = self._children[key] = _HistogramChild(len(self.buckets) + 1)
+            child.counts[index] += 1
+            child.sum += value
+            child.count += 1
+
+    def time(self, *labels) -> "_Timer":
+        """计时上下文管理器：with histogram.time('label'): ..."""
+        return _Timer(self, labels)
+
+    def snapshot(self, *labels) -> dict:
+        """单个标签组合的汇总（次数、平均值和按桶估算的p50/p95，单位为秒）"""
+        with self._lock:
+            child = self._children.get(self._key(labels))
+            if child is None:
+                return {"count": 0, "avg": None, "p50": None, "p95": None}
+            counts, total, count = list(child.counts), child.sum, child.count
+        return {
+            "count": count,
+            "avg": total / count,
+            "p50": self._quantile(counts, count, 0.5),
+            "p95": self._quantile(counts, count, 0.95)
+        }
+
+    def label_values(self) -> List[Tuple]:
+        with self._lock:
+            return list(self._children)
+
+    def _quantile(self, counts: List[int], count: int, q: float) -> float:
+        target = q * count
+        seen = 0
+        for index, n in enumerate(counts):
+            seen += n
+            if seen >= target:
+                return self.buckets[index] if index < len(self.buckets) else math.inf
+        return math.inf
+
+    def render(self) -> List[str]:
+        with self._lock:
+            items = [(key, list(child.counts), child.sum, child.count) for key, child in self._children.items()]
+        lines = self.header()
+        bucket_names = self.labelnames + ('le',)
+        for key, counts, total, count in items:
+            cumulative = 0
+            for bound, n in zip(self.buckets + (math.inf,), counts):
+                cumulative += n
+                lines.append(f"{self.name}_bucket{_format_labels(bucket_names, key + (_format_value(bound),))} {cumulative}")
+            lines.append(f"{self.name}_sum{_format_labels(self.labelnames, key)} {_format_value(total)}")
+            lines.append(f"{self.name}_count{_format_labels(self.labelnames, key)} {count}")
+        return lines
+
+
+class _Timer:
+    __slots__ = ('histogram', 'labels', 'started')
+
+    def __init__(self, histogram: Histogram, labels: Tuple):
+        self.histogram = histogram
+        self.labels = labels
+
+    def __enter__(self):
+        self.started = time.perf_counter()
+        return self
+
+    def __exit__(self, *exc):
+        self.histogram.observe(time.perf_counter() - self.started, *self.labels)
+        return False
+
+
+def timed(histogram: Histogram, *labels, span: Optional[str] = None):
+    """函数耗时装饰器
+
+    指定span时同时把耗时记到当前请求的对应span类别上（见 app.core.tracing）。
+    """
+    def decorator(func):
+        @functools.wraps(func)
+        def wrapper(*args, **kwargs):
+            started = time.perf_counter()
+            try:
+                if span is None:
+                    return func(*args, **kwargs)
+                with tracing.span(span):
+                    return func(*args, **kwargs)
+            finally:
+                histogram.observe(time.perf_counter() - started, *labels)
+        return wrapper
+    return decorator
+
+
+def _flatten_stats(prefix: str, stats: dict, labels: Dict[str, str], out: List[Tuple[str, Dict[str, str], float]]) -> None:
+    for key, value in stats.items():
+        name = f"{prefix}_{_NAME_RE.sub('_', str(key))}"
+        if isinstance(value, bool):
+            out.append((name, labels, int(value)))
+        elif isinstance(value, (int, float)):
+            out.append((name, labels, value))
+        elif isinstance(value, dict) and value and all(isinstance(v, dict) for v in value.values()):
+            # 形如 {"操作名": {...}} 的分组统计，分组名作为标签
+            for group, group_stats in value.items():
+                _flatten_stats(name, group_stats, {**labels, "name": str(group)}, out)
+        elif isinstance(value, dict):
+            _flatten_stats(name, value, labels, out)
+
+
+class MetricsRegistry:
+    """进程内指标注册表，按Prometheus文本格式导出
+
+    热路径上的计数器和直方图只是加锁更新几个数字；
+    已有stats()的组件（缓存、线程池等）通过register_stats注册，只在导出时读取。
+    """
+
+    def __init__(self, namespace: str = 'chat8'):
+        self.namespace = namespace
+        self._metrics: Dict[str, _Metric] = {}
+        self._stats_sources: Dict[str, Callable[[], dict]] = {}
+        self._lock = threading.Lock()
+
+    def _register(self, cls, name: str, *args, **kwargs):
+        full_name = f"{self.namespace}_{name}"
+        with self._lock:
+            metric = self._metrics.get(full_name)
+            if metric is None:
+                metric = self._metrics[full_name] = cls(full_name, *args, **kwargs)
+            elif not isinstance(metric, cls):
+                raise ValueError(f"指标 {full_name} 已注册为其他类型")
+            return metric
+
+    def counter(self, name: str, help_text: str, labelnames: Sequence[str] = ()) -> Counter:
+        return self._register(Counter, name, help_text, labelnames)
+
+    def gauge(self, name: str, help_text: str, labelnames: Sequence[str] = ()) -> Gauge:
+        return self._register(Gauge, name, help_text, labelnames)
+
+    def histogram(self, name: str, help_text: str, labelnames: Sequence[str] = (),
+                  buckets: Sequence[float] = DEFAULT_BUCKETS) -> Histogram:
+        return self._register(Histogram, name, help_text, labelnames, buckets)
+
+    def register_stats(self, name: str, source: Callable[[], dict]) -> None:
+        """注册一个返回stats字典的组件，导出时数值字段展开为gauge"""
+        with self._lock:
+            self._stats_sources[name] = source
+
+    def _render_stats(self) -> List[str]:
+        with self._lock:
+            sources = list(self._stats_sources.items())
+        grouped: Dict[str, List[Tuple[Dict[str, str], float]]] = {}
+        for name, source in sources:
+            samples: List[Tuple[str, Dict[str, str], float]] = []
+            try:
+                _flatten_stats(f"{self.namespace}_{name}", source(), {}, samples)
+            except Exception as e:
+                samples = [(f"{self.namespace}_{name}_scrape_error", {"error": type(e).__name__}, 1)]
+            for metric_name, labels, value in samples:
+                grouped.setdefault(metric_name, []).append((labels, value))
+        lines = []
+        for metric_name, samples in grouped.items():
+            lines.append(f"# TYPE {metric_name} gauge")
+            for labels, value in samples:
+                lines.append(f"{metric_name}{_format_labels(tuple(labels), tuple(labels.values()))} {_format_value(value)}")
+        return lines
+
+    def render(self) -> str:
+        with self._lock:
+            metrics = list(self._metrics.values())
+        lines: List[str] = []
+        for metric in metrics:
+            lines.extend(metric.render())
+        lines.extend(self._render_stats())
+        return '\n'.join(lines) + '\n'
+
+
+class MetricsMiddleware:
+    """按路由模板统计HTTP请求耗时的ASGI中间件（不统计WebSocket）"""
+
+    def __init__(self, app, registry: Optional[MetricsRegistry] = None):
+        self.app = app
+        registry = registry or metrics
+        self.latency = registry.histogram(
+            'http_request_duration_seconds', 'HTTP请求耗时', ('method', 'route', 'status')
+        )
+        self.in_progress = registry.gauge('http_requests_in_progress', '正在处理的HTTP请求数')
+
+    async def __call__(self, scope, receive, send):
+        if scope['type'] != 'http':
+            await self.app(scope, receive, send)
+            return
+
+        status = [500]
+
+        async def send_wrapper(message):
+            if message['type'] == 'http.response.start':
+                status[0] = message['status']
+            await send(message)
+
+        started = time.perf_counter()
+        self.in_progress.inc()
+        try:
+            await self.app(scope, receive, send_wrapper)
+        finally:
+            self.in_progress.dec()
+            route = scope.get('route')
+            # 使用路由模板而不是实际路径，避免路径参数造成标签数量膨胀
+            route_path = getattr(route, 'path', None) or 'unmatched'
+            self.latency.observe(time.perf_counter() - started, scope['method'], route_path, status[0])
+
+
+# 全局指标注册表
+metrics = MetricsRegistry()
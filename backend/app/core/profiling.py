@@ -0,0 +1,237 @@
+"""
+运行时性能分析
+
+- ProfilingMiddleware：按请求记录各类span耗时（见 app.core.tracing），慢请求连同明细写入警告日志
+- sample_profile：对运行中的进程做限时采样，输出collapsed stack格式（可直接交给flamegraph.pl或speedscope）
+- LoopLagMonitor：持续测量事件循环延迟，回调阻塞超过阈值时告警并记录阻塞时的调用栈
+"""
+import asyncio
+import logging
+import math
+import os
+import sys
+import threading
+import time
+import traceback
+from collections import Counter as _Counter, deque
+from typing import Deque, Dict, List, Optional
+from fastapi import HTTPException
+from app.core import tracing
+from app.core.config import SLOW_REQUEST_MS, LOOP_LAG_INTERVAL_MS, LOOP_LAG_WARN_MS
+from app.core.metrics import metrics
+
+logger = logging.getLogger(__name__)
+
+_SLOW_REQUEST_LOG_SIZE = 100
+# 线程空闲等待时的栈顶所在文件，默认不计入采样结果
+_IDLE_FILES = frozenset(('threading.py', 'queue.py', 'selectors.py', 'thread.py'))
+
+slow_requests_total = metrics.counter('slow_requests_total', '超过SLOW_REQUEST_MS的HTTP请求数', ('route',))
+event_loop_lag = metrics.histogram(
+    'event_loop_lag_seconds', '事件循环调度延迟',
+    buckets=(0.001, 0.005, 0.01, 0.025, 0.05, 0.1, 0.2, 0.5, 1.0, 2.5, 5.0)
+)
+event_loop_stalls_total = metrics.counter('event_loop_stalls_total', '事件循环阻塞超过LOOP_LAG_WARN_MS的次数')
+
+
+class ProfilingMiddleware:
+    """记录每个HTTP请求的span耗时，慢请求写入日志并保留最近的记录（PROFILING_ENABLED时启用）"""
+
+    def __init__(self, app, threshold_ms: int = SLOW_REQUEST_MS):
+        self.app = app
+        self.threshold_ms = threshold_ms
+
+    async def __call__(self, scope, receive, send):
+        if scope['type'] != 'http':
+            await self.app(scope, receive, send)
+            return
+
+        status = [500]
+
+        async def send_wrapper(message):
+            if message['type'] == 'http.response.start':
+                status[0] = message['status']
+            await send(message)
+
+        token = tracing.start_trace(scope['method'], scope['path'])
+        trace = tracing.current_trace()
+        try:
+            await self.app(scope, receive, send_wrapper)
+        finally:
+            tracing.end_trace(token)
+            elapsed_ms = (time.perf_counter() - trace.started) * 1000
+            if elapsed_ms >= self.threshold_ms:
+                route_path = getattr(scope.get('route'), 'path', None) or 'unmatched'
+                _record_slow_request(trace, route_path, status[0], elapsed_ms)
+
+
+slow_requests: Deque[dict] = deque(maxlen=_SLOW_REQUEST_LOG_SIZE)
+
+
+def _record_slow_request(trace: tracing.RequestTrace, route_path: str, status: int, elapsed_ms: float) -> None:
+    spans = trace.breakdown()
+    entry = {
+        "method": trace.method,
+        "route": route_path,
+        "path": trace.path,
+        "status": status,
+        "duration_ms": round(elapsed_ms, 1),
+        "spans": spans,
+        "at": time.time()
+    }
+    slow_requests.append(entry)
+    slow_requests_total.inc(route_path)
+    summary = ' '.join(f"{kind}={span['ms']}ms/{span['count']}" for kind, span in spans.items()) or '无span'
+    logger.warning("[慢请求] %s %s %d 耗时 %.1f ms: %s", trace.method, trace.path, status, elapsed_ms, summary,
+                   extra={"route": route_path, "status": status, "duration_ms": entry["duration_ms"], "spans": spans})
+
+
+def recent_slow_requests(limit: int = _SLOW_REQUEST_LOG_SIZE) -> List[dict]:
+    """最近的慢请求，新的在前"""
+    return list(slow_requests)[::-1][:limit]
+
+
+_profile_lock = threading.Lock()
+_frame_labels: Dict[object, str] = {}
+
+
+def _frame_label(code) -> str:
+    label = _frame_labels.get(code)
+    if label is None:
+        name = getattr(code, 'co_qualname', code.co_name)
+        label = f"{name} ({os.path.basename(code.co_filename)}:{code.co_firstlineno})".replace(';', ':')
+        _frame_labels[code] = label
+    return label
+
+
+def sample_profile(seconds: float, interval: float = 0.005, include_idle: bool = False) -> str:
+    """对所有线程做限时栈采样，返回collapsed stack文本
+
+    每行为 "线程名;外层函数;...;栈顶函数 采样次数"。同一时间只允许一个采样任务，
+    采样期间调用线程一直占用，应在线程池中调用。
+    """
+    if not _profile_lock.acquire(blocking=False):
+        raise HTTPException(status_code=409, detail="已有性能分析正在进行")
+    try:
+        own_ident = threading.get_ident()
+        counts: "_Counter[str]" = _Counter()
+        deadline = time.monotonic() + seconds
+        while time.monotonic() < deadline:
+            names = {thread.ident: thread.name for thread in threading.enumerate()}
+            for ident, frame in sys._current_frames().items():
+                if ident == own_ident:
+                    continue
+                if not include_idle and os.path.basename(frame.f_code.co_filename) in _IDLE_FILES:
+                    continue
+                stack = []
+                while frame is not None:
+                    stack.append(_frame_label(frame.f_code))
+                    frame = frame.f_back
+                stack.append(names.get(ident, f"thread-{ident}").replace(';', ':'))
+                counts[';'.join(reversed(stack))] += 1
+            time.sleep(interval)
+    finally:
+        _profile_lock.release()
+    return ''.join(f"{stack} {count}\n" for stack, count in counts.most_common())
+
+
+def _to_ms(seconds: Optional[float]) -> Optional[float]:
+    if seconds is None or seconds == math.inf:
+        return None
+    return round(seconds * 1000, 2)
+
+
+class LoopLagMonitor:
+    """事件循环延迟监控
+
+    协程按固定间隔sleep，实际唤醒时间与预期的差值即调度延迟，记入直方图；
+    另有一个看门狗线程检查协程的心跳，循环被阻塞超过阈值时立即记录事件循环线程当前的调用栈，
+    这样能看到是哪个回调在阻塞，而不只是事后知道阻塞了多久。
+    """
+
+    def __init__(self, interval_ms: int = LOOP_LAG_INTERVAL_MS, warn_ms: int = LOOP_LAG_WARN_MS):
+        self.interval = interval_ms / 1000
+        self.warn = warn_ms / 1000
+        self._task: Optional[asyncio.Task] = None
+        self._watchdog: Optional[threading.Thread] = None
+        self._stopped = threading.Event()
+        self._loop_ident: Optional[int] = None
+        self._heartbeat = time.monotonic()
+        self.last_lag_ms = 0.0
+        self.max_lag_ms = 0.0
+        self.stalls = 0
+        self.last_stall: Optional[dict] = None
+
+    async def start(self):
+        """启动延迟探测协程和看门狗线程"""
+        if self._task is not None:
+            return
+        self._loop_ident = threading.get_ident()
+        self._heartbeat = time.monotonic()
+        self._task = asyncio.create_task(self._probe_loop())
+        if self.warn > 0:
+            self._stopped.clear()
+            self._watchdog = threading.Thread(target=self._watch, name="loop-lag-watchdog", daemon=True)
+            self._watchdog.start()
+
+    async def stop(self):
+        """停止延迟探测"""
+        if self._task is not None:
+            self._task.cancel()
+            try:
+                await self._task
+            except asyncio.CancelledError:
+                pass
+            self._task = None
+        if self._watchdog is not None:
+            self._stopped.set()
+            self._watchdog.join(timeout=1)
+            self._watchdog = None
+
+    async def _probe_loop(self):
+        while True:
+            expected = time.monotonic() + self.interval
+            await asyncio.sleep(self.interval)
+            now = time.monotonic()
+            self._heartbeat = now
+            lag = max(0.0, now - expected)
+            event_loop_lag.observe(lag)
+            self.last_lag_ms = round(lag * 1000, 1)
+            self.max_lag_ms = max(self.max_lag_ms, self.last_lag_ms)
+            if self.warn > 0 and lag >= self.warn:
+                self.stalls += 1
+                event_loop_stalls_total.inc()
+                logger.warning("[事件循环] 阻塞 %.1f ms", lag * 1000, extra={"lag_ms": self.last_lag_ms})
+
+    def _watch(self):
+        reported_heartbeat = None
+        check_interval = max(self.warn / 4, 0.01)
+        while not self._stopped.wait(check_interval):
+            heartbeat = self._heartbeat
+            blocked = time.monotonic() - heartbeat - self.interval
+            if blocked < self.warn or heartbeat == reported_heartbeat:
+                continue
+            # 每次阻塞只记录一次调用栈
+            reported_heartbeat = heartbeat
+            frame = sys._current_frames().get(self._loop_ident)
+            stack = ''.join(traceback.format_stack(frame)) if frame is not None else ''
+            self.last_stall = {"at": time.time(), "blocked_ms": round(blocked * 1000, 1), "stack": stack}
+            logger.warning("[事件循环] 已阻塞 %.1f ms，当前调用栈:\n%s", blocked * 1000, stack,
+                           extra={"blocked_ms": self.last_stall["blocked_ms"]})
+
+    def stats(self) -> dict:
+        snapshot = event_loop_lag.snapshot()
+        return {
+            "interval_ms": self.interval * 1000,
+            "warn_ms": self.warn * 1000,
+            "running": self._task is not None,
+            "last_lag_ms": self.last_lag_ms,
+            "max_lag_ms": self.max_lag_ms,
+            "stalls": self.stalls,
+            "lag_ms": {"count": snapshot["count"], **{key: _to_ms(snapshot[key]) for key in ("avg", "p50", "p95")}},
+            "last_stall": self.last_stall
+        }
+
+
+# 全局事件循环延迟监控
+loop_lag_monitor = LoopLagMonitor()
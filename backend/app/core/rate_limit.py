@@ -0,0 +1,289 @@
+"""
+令牌桶限流
+
+- 规则按路由类别定义（突发容量 + 补充速率），桶按 "规则:用户名" 或 "规则:IP" 区分
+- 每个桶只存一个浮点数：桶重新装满的时间。取令牌时按当前时间惰性补充，不需要定时任务逐个补充；
+  已经装满的桶与不存在的桶等价，定期直接删除
+- RateLimitMiddleware 用于HTTP接口，超限返回429和Retry-After；WebSocket接收循环通过 rate_limiter.hit() 检查
+- 默认每个进程各自计数（memory）；多worker部署时设置 RATE_LIMIT_BACKEND=sqlite，各进程共用一个SQLite文件中的桶
+"""
+import asyncio
+import json
+import logging
+import math
+import sqlite3
+import threading
+import time
+from typing import Dict, Optional, Tuple
+from app.core.config import RATE_LIMIT_ENABLED, RATE_LIMIT_BACKEND, RATE_LIMIT_DB_PATH, RATE_LIMITS
+from app.core.metrics import metrics
+from app.core.security import decode_access_token
+
+logger = logging.getLogger(__name__)
+
+# 规则名: (突发容量, 装满所需秒数, 按用户还是按IP计数)
+DEFAULT_RULES = {
+    'ws_message': (30, 10, 'user'),        # WebSocket私聊/图片消息
+    'ws_frame': (200, 10, 'user'),         # WebSocket任意帧
+    'upload': (30, 60, 'user'),            # 图片、文件、头像上传和断点续传会话创建
+    'search': (30, 60, 'user'),            # /users/search
+    'password_reset': (10, 600, 'ip'),     # 找回密码邮件、验证码校验、重置密码
+    'signaling_poll': (120, 60, 'user'),   # /signaling/pending
+}
+
+# HTTP接口到规则的对应：(方法, 路径) -> 规则名
+HTTP_ROUTES = {
+    ('GET', '/api/v1/users/search'): 'search',
+    ('POST', '/api/v1/auth/forgot-password'): 'password_reset',
+    ('POST', '/api/v1/auth/verify-reset-code'): 'password_reset',
+    ('POST', '/api/v1/auth/reset-password'): 'password_reset',
+    ('POST', '/api/v1/upload/image'): 'upload',
+    ('POST', '/api/v1/upload/file'): 'upload',
+    ('POST', '/api/v1/upload/sessions'): 'upload',
+    ('POST', '/api/v1/avatar/upload'): 'upload',
+    ('GET', '/api/v1/signaling/pending'): 'signaling_poll',
+}
+
+rate_limited_total = metrics.counter('rate_limited_total', '被限流拒绝的请求和WebSocket帧数', ('rule',))
+
+
+class Rule:
+    __slots__ = ('name', 'capacity', 'rate', 'by')
+
+    def __init__(self, name: str, capacity: float, period: float, by: str):
+        self.name = name
+        self.capacity = capacity
+        self.rate = capacity / period  # 每秒补充的令牌数
+        self.by = by
+
+
+def parse_rules(overrides: str) -> Dict[str, Rule]:
+    """默认规则加上RATE_LIMITS中的覆盖，格式 "search=60/60,upload=10/60"（突发容量/装满秒数）"""
+    rules = {name: Rule(name, capacity, period, by) for name, (capacity, period, by) in DEFAULT_RULES.items()}
+    for item in overrides.split(','):
+        if not item.strip():
+            continue
+        try:
+            name, spec = item.split('=', 1)
+            capacity, period = spec.split('/', 1)
+            name = name.strip()
+            by = rules[name].by if name in rules else 'user'
+            rules[name] = Rule(name, float(capacity), float(period), by)
+        except ValueError:
+            logger.warning("[限流] 忽略无效的限流配置: %s", item)
+    return rules
+
+
+def _take(full_at: Optional[float], now: float, rule: Rule, cost: float) -> Tuple[Optional[float], float]:
+    """在桶上取cost个令牌，返回 (新的装满时间, 需等待秒数)；需等待秒数大于0表示拒绝，桶不变"""
+    # 桶中令牌数 = 容量 - 距离装满还差的时间 × 补充速率
+    if full_at is None or full_at < now:
+        full_at = now
+    tokens = rule.capacity - (full_at - now) * rule.rate
+    if tokens < cost:
+        return full_at, (cost - tokens) / rule.rate
+    return full_at + cost / rule.rate, 0.0
+
+
+class MemoryBucketStore:
+    """进程内的桶：键 -> 装满时间。只在事件循环线程中使用"""
+    name = 'memory'
+
+    def __init__(self):
+        self._buckets: Dict[str, float] = {}
+
+    def take(self, key: str, rule: Rule, cost: float = 1) -> float:
+        now = time.monotonic()
+        full_at, retry_after = _take(self._buckets.get(key), now, rule, cost)
+        if not retry_after:
+            self._buckets[key] = full_at
+        return retry_after
+
+    def purge_idle(self) -> int:
+        now = time.monotonic()
+        idle = [key for key, full_at in self._buckets.items() if full_at <= now]
+        for key in idle:
+            del self._buckets[key]
+        return len(idle)
+
+    def size(self) -> int:
+        return len(self._buckets)
+
+
+class SqliteBucketStore:
+    """多个worker进程共用的桶，存放在独立的SQLite文件中（与业务数据库分开，不占用其写锁）
+
+    每次取令牌是一个 BEGIN IMMEDIATE 事务内的读-改-写，时间使用墙上时钟以便跨进程比较。
+    方法会阻塞，由 RateLimiter 放到线程中调用。
+    """
+    name = 'sqlite'
+
+    def __init__(self, path: str):
+        self.path = path
+        self._local = threading.local()
+        conn = self._conn()
+        conn.execute("PRAGMA journal_mode=WAL")
+        conn.execute("CREATE TABLE IF NOT EXISTS rate_buckets (key TEXT PRIMARY KEY, full_at REAL NOT NULL) WITHOUT ROWID")
+
+    def _conn(self) -> sqlite3.Connection:
+        conn = getattr(self._local, 'conn', None)
+        if conn is None:
+            conn = sqlite3.connect(self.path, timeout=5, isolation_level=None, check_same_thread=False)
+            conn.execute("PRAGMA synchronous=NORMAL")
+            self._local.conn = conn
+        return conn
+
+    def take(self, key: str, rule: Rule, cost: float = 1) -> float:
+        conn = self._conn()
+        conn.execute("BEGIN IMMEDIATE")
+        try:
+            row = conn.execute("SELECT full_at FROM rate_buckets WHERE key = ?", (key,)).fetchone()
+            full_at, retry_after = _take(row[0] if row else None, time.time(), rule, cost)
+            if not retry_after:
+                conn.execute("INSERT INTO rate_buckets (key, full_at) VALUES (?, ?) "
+                             "ON CONFLICT(key) DO UPDATE SET full_at = excluded.full_at", (key, full_at))
+            conn.execute("COMMIT")
+        except Exception:
+            conn.execute("ROLLBACK")
+            raise
+        return retry_after
+
+    def purge_idle(self) -> int:
+        return self._conn().execute("DELETE FROM rate_buckets WHERE full_at <= ?", (time.time(),)).rowcount
+
+    def size(self) -> int:
+        return self._conn().execute("SELECT COUNT(*) FROM rate_buckets").fetchone()[0]
+
+
+class RateLimiter:
+    """按规则和身份取令牌，统计拒绝次数，定期清理已装满的桶"""
+
+    def __init__(self, rules: Dict[str, Rule], store, enabled: bool = True, gc_interval: int = 60):
+        self.rules = rules
+        self.store = store
+        self.enabled = enabled
+        self.gc_interval = gc_interval
+        self._shared = not isinstance(store, MemoryBucketStore)
+        self._gc_task: Optional[asyncio.Task] = None
+
+    async def hit(self, rule_name: str, identity: str, cost: float = 1) -> float:
+        """取令牌，返回需要等待的秒数，0表示放行；共享存储出错时放行"""
+        rule = self.rules.get(rule_name)
+        if not self.enabled or rule is None:
+            return 0.0
+        key = f"{rule_name}:{identity}"
+        if not self._shared:
+            retry_after = self.store.take(key, rule, cost)
+        else:
+            try:
+                retry_after = await asyncio.to_thread(self.store.take, key, rule, cost)
+            except sqlite3.Error as e:
+                logger.error("[限流] 共享限流存储不可用，本次放行: %s", e)
+                return 0.0
+        if retry_after:
+            rate_limited_total.inc(rule_name)
+        return retry_after
+
+    async def _gc_loop(self):
+        while True:
+            await asyncio.sleep(self.gc_interval)
+            try:
+                if self._shared:
+                    await asyncio.to_thread(self.store.purge_idle)
+                else:
+                    self.store.purge_idle()
+            except Exception as e:
+                logger.error("[限流] 清理空闲令牌桶失败: %s", e)
+
+    async def start_gc(self):
+        """启动空闲令牌桶清理任务"""
+        if self.enabled and self._gc_task is None:
+            self._gc_task = asyncio.create_task(self._gc_loop())
+
+    async def stop_gc(self):
+        """停止空闲令牌桶清理任务"""
+        if self._gc_task is not None:
+            self._gc_task.cancel()
+            try:
+                await self._gc_task
+            except asyncio.CancelledError:
+                pass
+            self._gc_task = None
+
+    def stats(self) -> dict:
+        return {
+            "enabled": self.enabled,
+            "backend": self.store.name,
+            "buckets": self.store.size() if not self._shared else None,
+            "rules": {name: {"capacity": rule.capacity, "per_second": round(rule.rate, 4), "by": rule.by}
+                      for name, rule in self.rules.items()}
+        }
+
+
+def _identity(scope, rule: Rule) -> str:
+    """按用户计数的规则使用令牌中的用户名，没有有效令牌时退回按IP计数"""
+    if rule.by == 'user':
+        for name, value in scope.get('headers', ()):
+            if name == b'authorization':
+                scheme, _, token = value.decode('latin-1').partition(' ')
+                if scheme.lower() == 'bearer' and token:
+                    try:
+                        return f"u:{decode_access_token(token)}"
+                    except Exception:
+                        pass
+                break
+    client = scope.get('client')
+    return f"ip:{client[0] if client else 'unknown'}"
+
+
+class RateLimitMiddleware:
+    """对HTTP_ROUTES中的接口限流，超限直接返回429，不进入路由处理"""
+
+    def __init__(self, app, limiter: Optional[RateLimiter] = None, routes: Optional[Dict[Tuple[str, str], str]] = None):
+        self.app = app
+        self.limiter = limiter or rate_limiter
+        self.routes = routes or HTTP_ROUTES
+
+    async def __call__(self, scope, receive, send):
+        if scope['type'] != 'http' or not self.limiter.enabled:
+            await self.app(scope, receive, send)
+            return
+
+        rule_name = self.routes.get((scope['method'], scope['path'].rstrip('/') or '/'))
+        if rule_name is not None:
+            rule = self.limiter.rules[rule_name]
+            retry_after = await self.limiter.hit(rule_name, _identity(scope, rule))
+            if retry_after:
+                logger.warning("[限流] %s %s 超出 %s 限额", scope['method'], scope['path'], rule_name,
+                               extra={"sample": f"rate_limited_{rule_name}"})
+                # 与应用的HTTPException处理器返回相同的错误结构
+                body = json.dumps({
+                    "success": False,
+                    "message": "请求过于频繁，请稍后再试",
+                    "error": "TOO_MANY_REQUESTS"
+                }, ensure_ascii=False).encode()
+                await send({
+                    'type': 'http.response.start',
+                    'status': 429,
+                    'headers': [
+                        (b'content-type', b'application/json'),
+                        (b'content-length', str(len(body)).encode()),
+                        (b'retry-after', str(math.ceil(retry_after)).encode()),
+                    ]
+                })
+                await send({'type': 'http.response.body', 'body': body})
+                return
+        await self.app(scope, receive, send)
+
+
+def _create_store():
+    if RATE_LIMIT_BACKEND == 'sqlite':
+        return SqliteBucketStore(RATE_LIMIT_DB_PATH)
+    if RATE_LIMIT_BACKEND != 'memory':
+        logger.warning("[限流] 未知的RATE_LIMIT_BACKEND=%s，使用memory", RATE_LIMIT_BACKEND)
+    return MemoryBucketStore()
+
+
+# 全局限流器
+rate_limiter = RateLimiter(parse_rules(RATE_LIMITS), _create_store(), enabled=RATE_LIMIT_ENABLED)
+metrics.register_stats('rate_limiter', rate_limiter.stats)
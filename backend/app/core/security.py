@@ -1,13 +1,18 @@
 from passlib.context import CryptContext
 import jwt
+import threading
+import time
+from collections import OrderedDict
 from datetime import datetime, timedelta
-from .config import SECRET_KEY, ALGORITHM, ACCESS_TOKEN_EXPIRE_MINUTES
+from typing import Dict, Optional, Set, Tuple
+from .config import SECRET_KEY, ALGORITHM, ACCESS_TOKEN_EXPIRE_MINUTES, PRINCIPAL_CACHE_SIZE, PRINCIPAL_CACHE_TTL
 from fastapi import Depends, HTTPException, status
 from fastapi.security import OAuth2PasswordBearer
 from jose import JWTError, jwt as jose_jwt
 from app.schemas.user import UserOut
 from app.db.models import User
 from app.db.database import SessionLocal
+from app.core.metrics import metrics
 
 pwd_context = CryptContext(schemes=["bcrypt"], deprecated="auto")
 
@@ -26,21 +31,116 @@ def create_access_token(data: dict) -> str:
 
 oauth2_scheme = OAuth2PasswordBearer(tokenUrl="/api/auth/login")
 
-def decode_access_token(token: str):
+class PrincipalCache:
+    """已认证用户缓存：token -> UserOut
+
+    get_current_user每次都要验签并查询users表，而同一token会在短时间内反复使用。
+    缓存有效期取PRINCIPAL_CACHE_TTL和token剩余有效期中的较小值，超过容量按LRU淘汰；
+    用户头像、密码等信息变化时调用invalidate_user使该用户的所有缓存失效。
+    """
+
+    def __init__(self, max_size: int = PRINCIPAL_CACHE_SIZE, ttl: int = PRINCIPAL_CACHE_TTL):
+        self.max_size = max_size
+        self.ttl = ttl
+        self._entries: "OrderedDict[str, Tuple[float, UserOut]]" = OrderedDict()
+        self._tokens_by_user: Dict[str, Set[str]] = {}
+        self._lock = threading.Lock()
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+        self.invalidations = 0
+
+    def get(self, token: str) -> Optional[UserOut]:
+        now = time.time()
+        with self._lock:
+            entry = self._entries.get(token)
+            if entry is not None and entry[0] > now:
+                self._entries.move_to_end(token)
+                self.hits += 1
+                return entry[1]
+            if entry is not None:
+                self._remove(token)
+            self.misses += 1
+            return None
+
+    def put(self, token: str, user: UserOut, token_exp: Optional[float]) -> None:
+        expires_at = time.time() + self.ttl
+        if token_exp is not None:
+            expires_at = min(expires_at, token_exp)
+        with self._lock:
+            self._remove(token)
+            self._entries[token] = (expires_at, user)
+            self._tokens_by_user.setdefault(user.id, set()).add(token)
+            while len(self._entries) > self.max_size:
+                oldest = next(iter(self._entries))
+                self._remove(oldest)
+                self.evictions += 1
+
+    def _remove(self, token: str) -> None:
+        entry = self._entries.pop(token, None)
+        if entry is None:
+            return
+        tokens = self._tokens_by_user.get(entry[1].id)
+        if tokens is not None:
+            tokens.discard(token)
+            if not tokens:
+                del self._tokens_by_user[entry[1].id]
+
+    def invalidate_user(self, user_id) -> None:
+        """使某个用户的所有缓存失效（头像、密码等变化后调用）"""
+        with self._lock:
+            for token in list(self._tokens_by_user.get(str(user_id), ())):
+                self._remove(token)
+            self.invalidations += 1
+
+    def clear(self) -> None:
+        with self._lock:
+            self._entries.clear()
+            self._tokens_by_user.clear()
+
+    def stats(self) -> dict:
+        with self._lock:
+            lookups = self.hits + self.misses
+            return {
+                "size": len(self._entries),
+                "max_size": self.max_size,
+                "hits": self.hits,
+                "misses": self.misses,
+                "hit_rate": round(self.hits / lookups, 4) if lookups else 0.0,
+                "evictions": self.evictions,
+                "invalidations": self.invalidations
+            }
+
+
+# 全局认证用户缓存
+principal_cache = PrincipalCache()
+metrics.register_stats('principal_cache', principal_cache.stats)
+
+def _decode_token_payload(token: str) -> dict:
     try:
         payload = jose_jwt.decode(token, SECRET_KEY, algorithms=[ALGORITHM])
-        username: str = payload.get("sub")
-        if username is None:
-            raise HTTPException(status_code=status.HTTP_401_UNAUTHORIZED, detail="Token无效")
-        return username
     except JWTError:
         raise HTTPException(status_code=status.HTTP_401_UNAUTHORIZED, detail="Token无效")
+    if payload.get("sub") is None:
+        raise HTTPException(status_code=status.HTTP_401_UNAUTHORIZED, detail="Token无效")
+    return payload
+
+def decode_access_token(token: str):
+    return _decode_token_payload(token)["sub"]
 
 def get_current_user(token: str = Depends(oauth2_scheme)) -> UserOut:
-    username = decode_access_token(token)
+    cached = principal_cache.get(token)
+    if cached is not None:
+        return cached
+
+    payload = _decode_token_payload(token)
+    username = payload["sub"]
     db = SessionLocal()
     user = db.query(User).filter(User.username == username).first()
     db.close()
     if user is None:
         raise HTTPException(status_code=status.HTTP_401_UNAUTHORIZED, detail="用户不存在")
-    return UserOut(id=str(user.id), username=user.username, email=user.email, avatar=user.avatar, created_at=user.created_at)
\ No newline at end of file
+    principal = UserOut(id=str(user.id), username=user.username, email=user.email, avatar=user.avatar, created_at=user.created_at)
+    token_exp = payload.get("exp")
+    principal_cache.put(token, principal, float(token_exp) if token_exp is not None else None)
+    return principal
@@ -0,0 +1,104 @@
+"""
+请求内的耗时分段（span）记录
+
+ProfilingMiddleware 为每个HTTP请求创建一个 RequestTrace，放在 ContextVar 中；
+数据库、加解密、文件读写、WebSocket发送等位置调用 add_span/span 把耗时记到当前请求上。
+没有启用分析中间件时 current_trace() 为 None，这些调用只多一次 ContextVar 读取。
+
+线程池任务需要通过 contextvars.copy_context().run 执行才能记到发起请求上
+（Starlette 的 run_in_threadpool 已经这样做）。
+"""
+import contextvars
+import functools
+import threading
+import time
+from contextlib import contextmanager
+from typing import Dict, Iterator, List, Optional
+
+# span类别
+DB = 'db'
+CRYPTO = 'crypto'
+FILE_IO = 'file_io'
+SEND = 'send'
+IMAGE = 'image'
+
+
+class RequestTrace:
+    """一个请求的各类别累计耗时"""
+
+    __slots__ = ('method', 'path', 'started', '_spans', '_lock')
+
+    def __init__(self, method: str, path: str):
+        self.method = method
+        self.path = path
+        self.started = time.perf_counter()
+        self._spans: Dict[str, List[float]] = {}
+        self._lock = threading.Lock()
+
+    def add(self, kind: str, seconds: float) -> None:
+        # 同一请求的span可能来自多个线程池线程
+        with self._lock:
+            entry = self._spans.get(kind)
+            if entry is None:
+                self._spans[kind] = [seconds, 1]
+            else:
+                entry[0] += seconds
+                entry[1] += 1
+
+    def breakdown(self) -> Dict[str, dict]:
+        """{类别: {"ms": 累计毫秒, "count": 次数}}"""
+        with self._lock:
+            return {kind: {"ms": round(total * 1000, 2), "count": count}
+                    for kind, (total, count) in self._spans.items()}
+
+
+_current_trace: contextvars.ContextVar[Optional[RequestTrace]] = contextvars.ContextVar('request_trace', default=None)
+# 当前上下文中已经打开的span类别，同类别嵌套时只记录最外层，避免重复累计
+_open_kinds: contextvars.ContextVar[frozenset] = contextvars.ContextVar('open_span_kinds', default=frozenset())
+
+
+def start_trace(method: str, path: str) -> contextvars.Token:
+    return _current_trace.set(RequestTrace(method, path))
+
+
+def end_trace(token: contextvars.Token) -> None:
+    _current_trace.reset(token)
+
+
+def current_trace() -> Optional[RequestTrace]:
+    return _current_trace.get()
+
+
+def add_span(kind: str, seconds: float) -> None:
+    """把一段已经测得的耗时记到当前请求上"""
+    trace = _current_trace.get()
+    if trace is not None and kind not in _open_kinds.get():
+        trace.add(kind, seconds)
+
+
+@contextmanager
+def span(kind: str) -> Iterator[None]:
+    """计时上下文管理器：with span(FILE_IO): ..."""
+    trace = _current_trace.get()
+    open_kinds = _open_kinds.get()
+    if trace is None or kind in open_kinds:
+        yield
+        return
+    token = _open_kinds.set(open_kinds | {kind})
+    started = time.perf_counter()
+    try:
+        yield
+    finally:
+        _open_kinds.reset(token)
+        trace.add(kind, time.perf_counter() - started)
+
+
+def traced(kind: str):
+    """span装饰器"""
+    def decorator(func):
+        @functools.wraps(func)
+        def wrapper(*args, **kwargs):
+            with span(kind):
+                return func(*args, **kwargs)
+        return wrapper
+    return decorator
@@ -1,20 +1,194 @@
+import logging
 import os
-from sqlalchemy import create_engine
+import time
+from sqlalchemy import create_engine, event, inspect, text
+from sqlalchemy.engine import Engine, make_url
 from sqlalchemy.orm import sessionmaker, Session
+from sqlalchemy.pool import StaticPool
+from app.core.config import (
+    APP_DIR, DATABASE_URL, DB_POOL_SIZE, DB_MAX_OVERFLOW, DB_POOL_TIMEOUT, DB_POOL_RECYCLE, DB_ECHO,
+    SQLITE_JOURNAL_MODE, SQLITE_SYNCHRONOUS, SQLITE_BUSY_TIMEOUT_MS, SQLITE_CACHE_SIZE_KB, SQLITE_MMAP_SIZE
+)
+from app.core import tracing
+from app.core.metrics import metrics
 from .models import Base
 
-# 使用绝对路径确保数据库文件始终在backend/app目录下
-BASE_DIR = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
-DB_PATH = os.path.join(BASE_DIR, 'chat8.db')
-SQLALCHEMY_DATABASE_URL = f'sqlite:///{DB_PATH}'
+logger = logging.getLogger(__name__)
 
-engine = create_engine(
-    SQLALCHEMY_DATABASE_URL, connect_args={"check_same_thread": False}
-)
+# DATABASE_URL生效之前应用一直使用的数据库文件
+LEGACY_DATABASE_PATH = APP_DIR / "chat8.db"
+
+db_query_seconds = metrics.histogram('db_query_seconds', 'SQL语句执行耗时', ('statement',))
+db_pool_checkouts = metrics.counter('db_pool_checkouts_total', '从连接池取出连接的次数')
+_STATEMENT_KINDS = {'SELECT', 'INSERT', 'UPDATE', 'DELETE', 'PRAGMA', 'BEGIN', 'COMMIT', 'ROLLBACK', 'CREATE', 'DROP', 'ALTER', 'WITH'}
+
+def _sqlite_pragmas() -> list:
+    pragmas = [
+        f"PRAGMA busy_timeout={SQLITE_BUSY_TIMEOUT_MS}",
+        f"PRAGMA synchronous={SQLITE_SYNCHRONOUS}",
+        f"PRAGMA cache_size=-{SQLITE_CACHE_SIZE_KB}",  # 负数表示以KB为单位
+        f"PRAGMA mmap_size={SQLITE_MMAP_SIZE}",
+    ]
+    if SQLITE_JOURNAL_MODE:
+        pragmas.insert(0, f"PRAGMA journal_mode={SQLITE_JOURNAL_MODE}")
+    return pragmas
+
+def create_db_engine(url: str = DATABASE_URL, **kwargs) -> Engine:
+    """
+    创建数据库引擎
+
+    SQLite：每个新连接通过connect事件设置WAL、synchronous、busy_timeout、cache_size、mmap_size，
+    心跳、消息写入、在线状态和安全日志并发访问时读写互不阻塞，写锁冲突时等待而不是立即失败。
+    其他数据库（如PostgreSQL）：使用带pre_ping和定期回收的连接池。
+    kwargs会覆盖默认的create_engine参数。
+    """
+    database_url = make_url(url)
+    options = {"echo": DB_ECHO}
+
+    if database_url.get_backend_name() == "sqlite":
+        options["connect_args"] = {
+            "check_same_thread": False,
+            "timeout": SQLITE_BUSY_TIMEOUT_MS / 1000,
+        }
+        if database_url.database in (None, "", ":memory:"):
+            # 内存数据库只能共享同一个连接
+            options["poolclass"] = StaticPool
+        else:
+            options.update(pool_size=DB_POOL_SIZE, max_overflow=DB_MAX_OVERFLOW, pool_timeout=DB_POOL_TIMEOUT)
+    else:
+        options.update(
+            pool_size=DB_POOL_SIZE,
+            max_overflow=DB_MAX_OVERFLOW,
+            pool_timeout=DB_POOL_TIMEOUT,
+            pool_recycle=DB_POOL_RECYCLE,
+            pool_pre_ping=True,
+        )
+    options.update(kwargs)
+
+    db_engine = create_engine(database_url, **options)
+
+    if database_url.get_backend_name() == "sqlite":
+        pragmas = _sqlite_pragmas()
+
+        @event.listens_for(db_engine, "connect")
+        def _set_sqlite_pragmas(dbapi_connection, connection_record):
+            cursor = dbapi_connection.cursor()
+            try:
+                for pragma in pragmas:
+                    cursor.execute(pragma)
+            finally:
+                cursor.close()
+
+    _instrument_engine(db_engine)
+    return db_engine
+
+def _instrument_engine(db_engine: Engine) -> None:
+    """通过引擎事件统计SQL耗时和连接池取用次数"""
+
+    @event.listens_for(db_engine, "before_cursor_execute")
+    def _before_execute(conn, cursor, statement, parameters, context, executemany):
+        conn.info.setdefault("query_started_at", []).append(time.perf_counter())
+
+    @event.listens_for(db_engine, "after_cursor_execute")
+    def _after_execute(conn, cursor, statement, parameters, context, executemany):
+        elapsed = time.perf_counter() - conn.info["query_started_at"].pop()
+        kind = statement.lstrip()[:8].split(None, 1)[0].upper() if statement.strip() else ''
+        db_query_seconds.observe(elapsed, kind if kind in _STATEMENT_KINDS else 'OTHER')
+        tracing.add_span(tracing.DB, elapsed)
+
+    @event.listens_for(db_engine, "handle_error")
+    def _on_error(exception_context):
+        started_at = exception_context.connection.info.get("query_started_at") if exception_context.connection else None
+        if started_at:
+            started_at.pop()
+
+    @event.listens_for(db_engine, "checkout")
+    def _on_checkout(dbapi_connection, connection_record, connection_proxy):
+        db_pool_checkouts.inc()
+
+def pool_stats() -> dict:
+    """当前全局引擎连接池状态"""
+    pool = engine.pool
+    stats = {}
+    for name in ("size", "checkedin", "checkedout", "overflow"):
+        method = getattr(pool, name, None)
+        if method is not None:
+            stats[name] = method()
+    return stats
+
+engine = create_db_engine()
+metrics.register_stats('db_pool', pool_stats)
 SessionLocal = sessionmaker(autocommit=False, autoflush=False, bind=engine)
 
+def check_database_location(url: str = DATABASE_URL) -> None:
+    """DATABASE_URL指向的SQLite文件不存在、而原来的app/chat8.db存在时告警，避免误用一个新的空库"""
+    database_url = make_url(url)
+    if database_url.get_backend_name() != "sqlite" or database_url.database in (None, "", ":memory:"):
+        return
+    configured = os.path.abspath(database_url.database)
+    if not os.path.exists(configured) and LEGACY_DATABASE_PATH.exists() and configured != str(LEGACY_DATABASE_PATH):
+        logger.warning("[数据库] DATABASE_URL 指向的 %s 不存在，将创建新的空数据库；现有数据在 %s，"
+                       "如需继续使用请把DATABASE_URL改为该文件或去掉该设置", configured, LEGACY_DATABASE_PATH)
+
+# 同一对用户（不分顺序）中id更大的重复记录
+_DUPLICATE_SESSION_KEYS = """
+    FROM session_keys WHERE EXISTS (
+        SELECT 1 FROM session_keys AS other WHERE other.id < session_keys.id AND (
+            (other.user1_id = session_keys.user1_id AND other.user2_id = session_keys.user2_id) OR
+            (other.user1_id = session_keys.user2_id AND other.user2_id = session_keys.user1_id)
+        )
+    )
+"""
+
+def normalize_session_key_pairs(db_engine: Engine = None, dry_run: bool = False) -> dict:
+    """
+    把 session_keys 改为按 (较小用户ID, 较大用户ID) 保存并创建唯一索引 ux_session_keys_pair
+
+    旧版本按调用方顺序写入，已有数据库中可能有反向记录和同一对用户的多条记录：
+    缺少user2加密密钥的反向记录无法交换，直接删除；重复记录保留最早的一条（离线消息用它加密）；
+    其余反向记录交换两列用户ID和两列加密会话密钥。已经规范化的数据库只执行一次计数查询。
+    返回 {'reversed', 'incomplete', 'duplicates'}
+    """
+    db_engine = db_engine or engine
+    with db_engine.begin() as conn:
+        reversed_count = conn.execute(text("SELECT COUNT(*) FROM session_keys WHERE user1_id > user2_id")).scalar()
+        has_index = any(index["name"] == "ux_session_keys_pair" for index in inspect(conn).get_indexes("session_keys"))
+        stats = {"reversed": reversed_count, "incomplete": 0, "duplicates": 0}
+        if not reversed_count and has_index:
+            return stats
+
+        stats["incomplete"] = conn.execute(text(
+            "SELECT COUNT(*) FROM session_keys WHERE user1_id > user2_id AND session_key_encrypted_for_user2 IS NULL"
+        )).scalar()
+        if not dry_run:
+            conn.execute(text(
+                "DELETE FROM session_keys WHERE user1_id > user2_id AND session_key_encrypted_for_user2 IS NULL"
+            ))
+        stats["duplicates"] = conn.execute(text("SELECT COUNT(*)" + _DUPLICATE_SESSION_KEYS)).scalar()
+        if dry_run:
+            return stats
+
+        conn.execute(text("DELETE" + _DUPLICATE_SESSION_KEYS))
+        conn.execute(text("""
+            UPDATE session_keys SET
+                user1_id = user2_id,
+                user2_id = user1_id,
+                session_key_encrypted = session_key_encrypted_for_user2,
+                session_key_encrypted_for_user2 = session_key_encrypted
+            WHERE user1_id > user2_id
+        """))
+        if not has_index:
+            conn.execute(text(
+                "CREATE UNIQUE INDEX IF NOT EXISTS ux_session_keys_pair ON session_keys (user1_id, user2_id)"
+            ))
+    if any(stats.values()):
+        logger.info("[数据库] 会话密钥已规范化：交换 %d 条反向记录，删除 %d 条无法交换的记录和 %d 条重复记录",
+                    stats["reversed"] - stats["incomplete"], stats["incomplete"], stats["duplicates"])
+    return stats
+
 def init_db():
     Base.metadata.create_all(bind=engine)
+    normalize_session_key_pairs()
 
 def get_db() -> Session:
     """获取数据库会话的依赖项"""
@@ -22,4 +196,4 @@ def get_db() -> Session:
     try:
         yield db
     finally:
-        db.close()
\ No newline at end of file
+        db.close()
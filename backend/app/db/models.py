@@ -1,4 +1,4 @@
-from sqlalchemy import Column, Integer, String, Text, DateTime, Boolean, ForeignKey
+from sqlalchemy import Column, Integer, String, Text, DateTime, Boolean, ForeignKey, LargeBinary, Index
 # 兼容所有SQLAlchemy版本的declarative_base导入
 try:
     from sqlalchemy.orm import declarative_base, relationship
@@ -30,6 +30,9 @@ class User(Base):
 
 class Friend(Base):
     __tablename__ = 'friends'
+    __table_args__ = (
+        Index('ux_friends_user_friend', 'user_id', 'friend_id', unique=True),
+    )
     id = Column(Integer, primary_key=True, index=True)
     user_id = Column(Integer, ForeignKey('users.id'))
     friend_id = Column(Integer, ForeignKey('users.id'))
@@ -39,6 +42,10 @@ class Friend(Base):
 
 class Message(Base):
     __tablename__ = 'messages'
+    __table_args__ = (
+        Index('ix_messages_to_timestamp', 'to_id', 'timestamp'),  # 离线消息
+        Index('ix_messages_pair_timestamp', 'from_id', 'to_id', 'timestamp'),  # 聊天记录
+    )
     id = Column(Integer, primary_key=True, index=True)
     from_id = Column(Integer, ForeignKey('users.id'))
     to_id = Column(Integer, ForeignKey('users.id'))
@@ -62,6 +69,9 @@ class Key(Base):
 
 class SignalingMessage(Base):
     __tablename__ = 'signaling_messages'
+    __table_args__ = (
+        Index('ix_signaling_messages_to_handled', 'to_user_id', 'is_handled'),
+    )
     id = Column(Integer, primary_key=True, index=True)
     from_user_id = Column(Integer, ForeignKey('users.id'))
     to_user_id = Column(Integer, ForeignKey('users.id'))
@@ -72,6 +82,10 @@ class SignalingMessage(Base):
 
 class FriendRequest(Base):
     __tablename__ = 'friend_requests'
+    __table_args__ = (
+        Index('ix_friend_requests_to_status', 'to_user_id', 'status'),  # 收到的申请
+        Index('ix_friend_requests_from_status', 'from_user_id', 'status'),  # 发出的申请
+    )
     id = Column(Integer, primary_key=True, index=True)
     from_user_id = Column(Integer, ForeignKey('users.id'), nullable=False)
     to_user_id = Column(Integer, ForeignKey('users.id'), nullable=False)
@@ -123,6 +137,10 @@ class UserProfile(Base):
 
 class SessionKey(Base):
     __tablename__ = 'session_keys'
+    # 每对用户一条记录，user1_id < user2_id（见 encryption_service.canonical_pair）
+    __table_args__ = (
+        Index('ux_session_keys_pair', 'user1_id', 'user2_id', unique=True),
+    )
     id = Column(Integer, primary_key=True, index=True)
     user1_id = Column(Integer, ForeignKey('users.id'), nullable=False)  # 用户1 ID
     user2_id = Column(Integer, ForeignKey('users.id'), nullable=False)  # 用户2 ID
@@ -134,4 +152,21 @@ class SessionKey(Base):
     
     # 关系
     user1 = relationship('User', foreign_keys=[user1_id])
-    user2 = relationship('User', foreign_keys=[user2_id])
\ No newline at end of file
+    user2 = relationship('User', foreign_keys=[user2_id])
+
+class Blob(Base):
+    __tablename__ = 'blobs'
+    sha256 = Column(String(64), primary_key=True)  # 内容哈希，同时决定存储路径
+    size = Column(Integer, nullable=False)
+    ref_count = Column(Integer, default=0, nullable=False)  # 引用该内容的消息数
+    created_at = Column(DateTime, default=china_now)
+    released_at = Column(DateTime, nullable=True)  # 引用数最近一次降为0的时间
+
+class UserKeyMaterial(Base):
+    __tablename__ = 'user_key_material'
+    user_id = Column(Integer, ForeignKey('users.id'), primary_key=True)
+    registration_id = Column(Integer, nullable=True)
+    identity_private_key = Column(LargeBinary, nullable=False)  # 身份私钥原始字节
+    identity_public_key = Column(LargeBinary, nullable=False)  # 身份公钥原始字节
+    prekey_bundle = Column(LargeBinary, nullable=True)  # 预密钥包（紧凑二进制编码，见key_material_store）
+    updated_at = Column(DateTime, default=china_now)
@@ -1,6 +1,9 @@
 from fastapi import FastAPI, WebSocket, Depends
 from contextlib import asynccontextmanager
 import logging
+import time
+import hmac
+import ipaddress
 from dotenv import load_dotenv
 import os
 
@@ -8,7 +11,7 @@ import os
 load_dotenv()
 from app.websocket.manager import ConnectionManager
 from fastapi.middleware.cors import CORSMiddleware
-from app.api.v1.endpoints import friends, messages, keys, auth, signaling, avatar, security, local_storage, upload, user_status, user_profile, encryption, user_keys
+from app.api.v1.endpoints import friends, messages, keys, auth, signaling, avatar, security, local_storage, upload, resumable_upload, user_status, user_profile, encryption, user_keys, profiling
 from app.api import steganography
 from app.websocket.events import websocket_endpoint
 from fastapi.staticfiles import StaticFiles
@@ -17,14 +20,37 @@ from fastapi.requests import Request
 from fastapi.exception_handlers import RequestValidationError
 from fastapi.exceptions import HTTPException
 from starlette.status import HTTP_500_INTERNAL_SERVER_ERROR
+from app.core.logging_config import setup_logging
+from app.core.metrics import metrics, MetricsMiddleware
+from app.core.profiling import ProfilingMiddleware, loop_lag_monitor
+from fastapi.responses import PlainTextResponse
 from app.core.security import decode_access_token
 from app.services.user_states_update import initialize_user_states_service, cleanup_user_states_service
-from app.db.database import SessionLocal
+from app.db.database import init_db, check_database_location
 from app.db.models import User
-from app.core.config import UPLOADS_DIR
+from app.core.config import UPLOADS_DIR, PROFILING_ENABLED, METRICS_ENABLED, METRICS_TOKEN, METRICS_ALLOWED_IPS
+from app.core.rate_limit import RateLimitMiddleware, rate_limiter
+from app.services.resumable_upload_service import resumable_upload_service
+from app.services.blob_store import blob_store
+from app.services.signaling_service import signaling_mailbox
+from app.services.ephemeral_channel import ephemeral_channel
+from app.services.call_registry import call_registry
+from app.services.image_variant_service import image_variant_service
+from app.services.static_file_service import install_access_log_filter
+from app.services.cpu_executor import cpu_executor
+from app.services.db_executor import db_executor
+from app.services.key_setup_service import key_setup_service
+from app.services.user_keys_service import rsa_keypair_pool
+from app.services.encryption_service import encryption_service
+from app.services.warmup_service import warmup_service
+from sqlalchemy.orm import Session
+
+setup_logging()
+logger = logging.getLogger(__name__)
 
 # 创建 ConnectionManager 单例
 connection_manager = ConnectionManager()
+metrics.register_stats('ws', lambda: {"connections": len(connection_manager.active_connections)})
 
 
 
@@ -32,61 +58,110 @@ connection_manager = ConnectionManager()
 def get_connection_manager():
     return connection_manager
 
+def _reset_all_users_offline(db: Session) -> int:
+    count = db.query(User).filter(User.status == 'online').update(
+        {User.status: 'offline'}, synchronize_session=False
+    )
+    db.commit()
+    return count
+
 async def reset_all_users_offline():
     """重置所有用户状态为离线
     
-    在服务器启动时调用，确保数据库中的用户状态正确
+    在服务器启动时调用，确保数据库中的用户状态正确；一条UPDATE语句完成，不加载用户对象
     """
     try:
-        db = SessionLocal()
-        # 将所有用户状态设置为离线
-        online_users = db.query(User).filter(User.status == 'online').all()
-        count = 0
-        for user in online_users:
-            user.status = 'offline'
-            count += 1
-        
-        db.commit()
-        db.close()
-        
-        print(f"[应用启动] 已重置 {count} 个用户状态为离线")
+        count = await db_executor.run_session(_reset_all_users_offline)
+        logger.info("[应用启动] 已重置 %d 个用户状态为离线", count)
     except Exception as e:
-        print(f"[应用启动] 重置用户状态失败: {str(e)}")
-        if 'db' in locals():
-            db.rollback()
-            db.close()
+        logger.error("[应用启动] 重置用户状态失败: %s", e)
 
 @asynccontextmanager
 async def lifespan(app: FastAPI):
-    print("[应用启动] 服务已启动")
+    startup_started_at = time.perf_counter()
+    step_started_at = startup_started_at
+    startup_steps = {}
+    
+    # 尽早开始监控事件循环延迟，启动阶段的阻塞同样会被记录
+    await loop_lag_monitor.start()
+    
+    def mark(step: str):
+        nonlocal step_started_at
+        now = time.perf_counter()
+        startup_steps[step] = round((now - step_started_at) * 1000, 1)
+        step_started_at = now
+    
+    # 创建缺失的数据表（如内容存储的blobs表）；必须在建表之前检查，否则新库文件已被创建
+    check_database_location()
+    await db_executor.run(init_db)
+    mark("init_db")
+    
+    # 重置所有用户状态为离线（服务器重启时），必须在心跳监控启动之前完成
+    await reset_all_users_offline()
+    mark("reset_users")
     
     # 初始化用户状态服务
     try:
         user_states_service = initialize_user_states_service(connection_manager)
         await user_states_service.start_heartbeat_monitor()
-        
-        # 重置所有用户状态为离线（服务器重启时）
-        await reset_all_users_offline()
-        
-        print("[应用启动] 用户状态服务初始化成功")
+        logger.info("[应用启动] 用户状态服务初始化成功")
     except Exception as e:
-        print(f"[应用启动] 用户状态服务初始化失败: {str(e)}")
+        logger.error("[应用启动] 用户状态服务初始化失败: %s", e)
+    
+    # 启动过期上传会话回收和无引用内容回收任务
+    await resumable_upload_service.start_gc()
+    await blob_store.start_gc()
+    
+    # 信令邮箱：在线用户直接推送，过期信令定期清理
+    signaling_mailbox.attach(connection_manager)
+    await signaling_mailbox.start_gc()
+    await call_registry.start_gc()
+    
+    # 临时事件通道：输入状态、截屏提醒、在线状态的节流与合并
+    ephemeral_channel.attach(connection_manager)
+    await ephemeral_channel.start_gc()
+    await rate_limiter.start_gc()
+    
+    # 启动RSA密钥对池的后台补充任务
+    await rsa_keypair_pool.start()
+    mark("background_tasks")
+    
+    # 缓存预热在后台进行，完成前 /api/ready 返回503
+    startup_ms = round((time.perf_counter() - startup_started_at) * 1000, 1)
+    await warmup_service.start(startup_ms)
+    logger.info("[应用启动] 服务已启动，耗时 %s ms，缓存预热在后台进行", startup_ms,
+                extra={"startup_ms": startup_ms, "startup_steps": startup_steps})
     
     yield
     
+    await warmup_service.stop()
+    await rsa_keypair_pool.stop()
+    await rate_limiter.stop_gc()
+    await ephemeral_channel.stop_gc()
+    await call_registry.stop_gc()
+    await signaling_mailbox.stop_gc()
+    await blob_store.stop_gc()
+    await resumable_upload_service.stop_gc()
+    image_variant_service.shutdown()
+    await key_setup_service.shutdown()
+    cpu_executor.shutdown()
+    encryption_service.close()
+    
     # 清理用户状态服务
     try:
         await cleanup_user_states_service()
-        print("[应用关闭] 用户状态服务清理完成")
+        logger.info("[应用关闭] 用户状态服务清理完成")
     except Exception as e:
-        print(f"[应用关闭] 用户状态服务清理失败: {str(e)}")
+        logger.error("[应用关闭] 用户状态服务清理失败: %s", e)
+    db_executor.shutdown()
+    await loop_lag_monitor.stop()
     
-    print("[应用关闭] 服务已关闭")
+    logger.info("[应用关闭] 服务已关闭")
 
 app = FastAPI(lifespan=lifespan)
 
-# 添加禁用图片API日志的中间件
-
+# 不记录图片、文件和头像请求的访问日志
+install_access_log_filter()
 
 # 配置CORS
 origins = [
@@ -100,6 +175,9 @@ origins = [
     "http://127.0.0.1:8083",
 ]
 
+# 令牌桶限流，放在CORS之内，429响应也带CORS头
+app.add_middleware(RateLimitMiddleware)
+
 app.add_middleware(
     CORSMiddleware,
     allow_origins=origins,
@@ -109,6 +187,12 @@ app.add_middleware(
     expose_headers=["*"]
 )
 
+# 按路由统计HTTP请求耗时
+app.add_middleware(MetricsMiddleware)
+if PROFILING_ENABLED:
+    # 按请求记录数据库、加解密、文件读写、发送等span耗时，慢请求写入日志
+    app.add_middleware(ProfilingMiddleware)
+
 # 注册API路由
 app.include_router(auth.router, prefix="/api/v1")
 app.include_router(friends.router, prefix="/api/v1")
@@ -122,6 +206,8 @@ app.include_router(user_status.router, prefix="/api/v1")
 app.include_router(user_profile.router, prefix="/api/v1")
 app.include_router(local_storage.router, prefix="/api/v1")
 app.include_router(upload.router, prefix="/api/v1")
+app.include_router(resumable_upload.router, prefix="/api/v1")
+app.include_router(profiling.router, prefix="/api/v1")
 app.include_router(encryption.router, prefix="/api/v1/encryption")
 app.include_router(steganography.router, prefix="/api/steganography", tags=["steganography"])
 
@@ -131,6 +217,52 @@ app.mount("/static", StaticFiles(directory=str(UPLOADS_DIR)), name="static")
 def ping():
     return {"msg": "pong"}
 
+@app.get("/api/ready")
+def ready():
+    """就绪检查：启动后的缓存预热完成前返回503（/api/ping只表示进程存活）"""
+    status = warmup_service.status()
+    return JSONResponse(
+        status_code=200 if status["ready"] else 503,
+        content={"success": status["ready"], "data": status}
+    )
+
+def _parse_networks(items):
+    networks = []
+    for item in items:
+        try:
+            networks.append(ipaddress.ip_network(item, strict=False))
+        except ValueError:
+            logger.warning("[指标] 忽略无效的METRICS_ALLOWED_IPS项: %s", item)
+    return networks
+
+_metrics_networks = _parse_networks(METRICS_ALLOWED_IPS)
+
+def _metrics_allowed(request: Request) -> bool:
+    """带正确的METRICS_TOKEN，或来源IP在METRICS_ALLOWED_IPS中"""
+    if METRICS_TOKEN:
+        scheme, _, token = request.headers.get("authorization", "").partition(" ")
+        if scheme.lower() == "bearer" and hmac.compare_digest(token.encode(), METRICS_TOKEN.encode()):
+            return True
+    if request.client is None:
+        return False
+    try:
+        client_ip = ipaddress.ip_address(request.client.host)
+    except ValueError:
+        return False
+    return any(client_ip in network for network in _metrics_networks)
+
+@app.get("/metrics", include_in_schema=False)
+def get_metrics(request: Request):
+    """Prometheus文本格式的进程内指标，只对METRICS_TOKEN持有者和METRICS_ALLOWED_IPS开放"""
+    if not METRICS_ENABLED:
+        raise HTTPException(status_code=404, detail="Not Found")
+    if not _metrics_allowed(request):
+        raise HTTPException(status_code=403, detail="无权访问指标接口")
+    return PlainTextResponse(metrics.render(), media_type="text/plain; version=0.0.4; charset=utf-8")
+
+def _user_matches(db: Session, user_id: int, username: str) -> bool:
+    return db.query(User.id).filter(User.username == username, User.id == user_id).first() is not None
+
 @app.websocket("/ws/{user_id}")
 async def websocket_route(websocket: WebSocket, user_id: int, manager: ConnectionManager = Depends(get_connection_manager)):
     # 从query参数获取token进行验证
@@ -144,19 +276,15 @@ async def websocket_route(websocket: WebSocket, user_id: int, manager: Connectio
         await websocket.close(code=1008)
         return
     
-    # 验证用户ID是否匹配
-    db = SessionLocal()
+    # 验证用户ID是否匹配（查询放到数据库线程池，不阻塞事件循环）
     try:
-        user = db.query(User).filter(User.username == username, User.id == user_id).first()
-        if not user:
+        if not await db_executor.run_session(_user_matches, user_id, username):
             await websocket.close(code=1008)
             return
     except Exception as e:
-        print(f"[WebSocket] 用户验证失败: {str(e)}")
+        logger.warning("[WebSocket] 用户验证失败: %s", e)
         await websocket.close(code=1008)
         return
-    finally:
-        db.close()
     
     await websocket_endpoint(websocket, user_id, manager)
 
@@ -164,6 +292,7 @@ ERROR_CODE_MAP = {
     401: "UNAUTHORIZED",
     404: "NOT_FOUND",
     422: "BAD_REQUEST",
+    429: "TOO_MANY_REQUESTS",
     500: "INTERNAL_SERVER_ERROR"
 }
 
@@ -193,12 +322,8 @@ async def validation_exception_handler(request: Request, exc: RequestValidationE
 
 @app.exception_handler(Exception)
 async def global_exception_handler(request: Request, exc: Exception):
-    import traceback
-    error_traceback = traceback.format_exc()
-    print(f"[全局异常处理] 请求路径: {request.url}")
-    print(f"[全局异常处理] 异常类型: {type(exc).__name__}")
-    print(f"[全局异常处理] 异常信息: {str(exc)}")
-    print(f"[全局异常处理] 异常堆栈:\n{error_traceback}")
+    logger.error("[全局异常处理] 请求 %s %s 失败: %s: %s", request.method, request.url.path, type(exc).__name__, exc,
+                 exc_info=exc, extra={"path": request.url.path})
     
     return JSONResponse(
         status_code=HTTP_500_INTERNAL_SERVER_ERROR,
@@ -1,3 +1,4 @@
+from typing import Optional
 from pydantic import BaseModel
 
 class OfferRequest(BaseModel):
@@ -6,4 +7,9 @@ class OfferRequest(BaseModel):
 
 class AnswerRequest(BaseModel):
     targetUserId: int
-    offer: dict 
\ No newline at end of file
+    answer: Optional[dict] = None
+    offer: Optional[dict] = None  # 兼容旧客户端把answer放在offer字段中
+
+class IceCandidateRequest(BaseModel):
+    targetUserId: int
+    candidate: dict
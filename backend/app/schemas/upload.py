@@ -0,0 +1,20 @@
+from pydantic import BaseModel, Field
+from typing import Optional
+
+class UploadSessionCreate(BaseModel):
+    """创建断点续传上传会话"""
+    file_name: str = Field(..., alias="fileName")
+    file_size: int = Field(..., alias="fileSize")
+    to_id: int = Field(..., alias="to")
+    file_type: str = Field(default='file', alias="fileType")  # image, file
+    content_type: Optional[str] = Field(None, alias="contentType")
+    chunk_size: Optional[int] = Field(None, alias="chunkSize")
+    sha256: Optional[str] = None  # 整个文件的SHA-256（可选，完成时校验）
+    content: str = ""
+    encrypted: bool = True
+    method: str = 'Server'
+    destroy_after: Optional[int] = Field(None, alias="destroyAfter")
+    hidding_message: Optional[str] = Field(None, alias="hiddenMessage")
+
+    class Config:
+        populate_by_name = True
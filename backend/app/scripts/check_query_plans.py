@@ -0,0 +1,114 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+"""
+查询计划回归检查：执行服务层的热点查询，用 EXPLAIN QUERY PLAN 确认使用了预期的索引
+
+在内存SQLite中按 models.py 建表，记录每个服务函数实际发出的SELECT语句，
+逐条执行 EXPLAIN QUERY PLAN；目标表被全表扫描或没有用到预期索引时检查失败，脚本以状态码1退出。
+修改 models.py 的索引或服务层查询后运行。
+
+使用方法: python check_query_plans.py
+"""
+
+import sys
+from contextlib import contextmanager
+from pathlib import Path
+
+# 添加项目根目录到Python路径
+project_root = Path(__file__).parent.parent.parent
+sys.path.insert(0, str(project_root))
+
+from sqlalchemy import event, text
+from sqlalchemy.orm import sessionmaker
+from app.db.database import create_db_engine
+from app.db.models import Base, User, Friend, FriendRequest, Message
+from app.services import friend_service, message_service
+
+def setup_database():
+    engine = create_db_engine("sqlite://")
+    Base.metadata.create_all(bind=engine)
+    session_factory = sessionmaker(autocommit=False, autoflush=False, bind=engine)
+    db = session_factory()
+    db.add_all(User(id=i, username=f"user{i}", email=f"user{i}@example.com", password_hash="x") for i in range(1, 4))
+    db.add_all([Friend(user_id=1, friend_id=2), Friend(user_id=2, friend_id=1)])
+    db.add(FriendRequest(from_user_id=3, to_user_id=1, status='pending'))
+    db.add_all(Message(from_id=2, to_id=1, content="hi", encrypted=False) for _ in range(3))
+    db.commit()
+    db.close()
+    return engine, session_factory
+
+@contextmanager
+def capture_selects(engine):
+    statements = []
+
+    def _record(conn, cursor, statement, parameters, context, executemany):
+        if statement.lstrip().upper().startswith("SELECT"):
+            statements.append((statement, parameters))
+
+    event.listen(engine, "before_cursor_execute", _record)
+    try:
+        yield statements
+    finally:
+        event.remove(engine, "before_cursor_execute", _record)
+
+def query_plans(engine, statements):
+    plans = []
+    with engine.connect() as conn:
+        for statement, parameters in statements:
+            rows = conn.exec_driver_sql(f"EXPLAIN QUERY PLAN {statement}", parameters).fetchall()
+            plans.append((statement, [row[-1] for row in rows]))
+    return plans
+
+def check(name, engine, session_factory, func, table, index):
+    """执行func(db)，要求访问table的语句都使用index且没有全表扫描"""
+    db = session_factory()
+    try:
+        with capture_selects(engine) as statements:
+            func(db)
+    finally:
+        db.close()
+
+    failures = []
+    used = False
+    for statement, details in query_plans(engine, statements):
+        for detail in details:
+            if f"SCAN {table}" in detail and "USING" not in detail:
+                failures.append(f"全表扫描: {detail}\n      {statement.strip()}")
+            if index in detail:
+                used = True
+    if not used:
+        failures.append(f"没有使用索引 {index}")
+
+    print(f"{'✅' if not failures else '❌'} {name}")
+    for failure in failures:
+        print(f"    {failure}")
+    return not failures
+
+def main():
+    engine, session_factory = setup_database()
+    checks = [
+        ("离线消息 messages(to_id, timestamp)",
+         lambda db: message_service.get_offline_messages(db, 1),
+         "messages", "ix_messages_to_timestamp"),
+        ("聊天记录 messages(from_id, to_id, timestamp)",
+         lambda db: message_service.get_message_history(db, 1, 2),
+         "messages", "ix_messages_pair_timestamp"),
+        ("添加好友 friends(user_id, friend_id)",
+         lambda db: friend_service.add_friend(db, 1, 2),
+         "friends", "ux_friends_user_friend"),
+        ("发送好友申请 friends(user_id, friend_id)",
+         lambda db: friend_service.send_friend_request(db, 1, 2),
+         "friends", "ux_friends_user_friend"),
+        ("收到的好友申请 friend_requests(to_user_id, status)",
+         lambda db: friend_service.get_friend_requests(db, 1, 'received'),
+         "friend_requests", "ix_friend_requests_to_status"),
+        ("发出的好友申请 friend_requests(from_user_id, status)",
+         lambda db: friend_service.get_friend_requests(db, 3, 'sent'),
+         "friend_requests", "ix_friend_requests_from_status"),
+    ]
+    results = [check(name, engine, session_factory, func, table, index) for name, func, table, index in checks]
+    if not all(results):
+        sys.exit(1)
+
+if __name__ == '__main__':
+    main()
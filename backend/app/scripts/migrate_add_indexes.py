@@ -0,0 +1,100 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+"""
+数据库迁移脚本：为 messages、friends、friend_requests、signaling_messages 表添加复合索引
+
+init_db() 的 create_all 只创建缺失的表，不会给已存在的表补索引，已有数据库需要运行本脚本。
+friends(user_id, friend_id) 为唯一索引，创建前会删除重复的好友记录（保留最早的一条）。
+
+使用方法:
+1. 执行迁移: python migrate_add_indexes.py
+2. 只检查不修改: python migrate_add_indexes.py --dry-run
+3. 删除本脚本创建的索引（回滚）: python migrate_add_indexes.py --downgrade
+"""
+
+import sys
+import argparse
+from pathlib import Path
+
+# 添加项目根目录到Python路径
+project_root = Path(__file__).parent.parent.parent
+sys.path.insert(0, str(project_root))
+
+from sqlalchemy import inspect, text
+from app.db.database import engine
+from app.db.models import Base, Friend, FriendRequest, Message, SignalingMessage
+
+# 本次迁移新增的索引（定义见 models.py 的 __table_args__）
+INDEX_NAMES = {
+    'ix_messages_to_timestamp',
+    'ix_messages_pair_timestamp',
+    'ux_friends_user_friend',
+    'ix_friend_requests_to_status',
+    'ix_friend_requests_from_status',
+    'ix_signaling_messages_to_handled',
+}
+INDEXES = [
+    index
+    for model in (Message, Friend, FriendRequest, SignalingMessage)
+    for index in sorted(model.__table__.indexes, key=lambda index: index.name)
+    if index.name in INDEX_NAMES
+]
+
+DUPLICATE_FRIENDS_SQL = """
+    SELECT COUNT(*) FROM friends WHERE id NOT IN (
+        SELECT MIN(id) FROM friends GROUP BY user_id, friend_id
+    )
+"""
+
+def existing_indexes(table_name):
+    return {index['name'] for index in inspect(engine).get_indexes(table_name)}
+
+def upgrade(dry_run=False):
+    Base.metadata.create_all(bind=engine)
+
+    with engine.begin() as conn:
+        duplicate_count = conn.execute(text(DUPLICATE_FRIENDS_SQL)).scalar()
+        print(f"重复的好友记录: {duplicate_count} 条")
+        if duplicate_count and not dry_run:
+            conn.execute(text("""
+                DELETE FROM friends WHERE id NOT IN (
+                    SELECT MIN(id) FROM friends GROUP BY user_id, friend_id
+                )
+            """))
+
+    for index in INDEXES:
+        if index.name in existing_indexes(index.table.name):
+            print(f"✅ 索引已存在: {index.name}")
+            continue
+        if dry_run:
+            print(f"➕ 需要创建索引: {index.name}")
+            continue
+        index.create(bind=engine)
+        print(f"✅ 已创建索引: {index.name}")
+
+    if not dry_run:
+        # 更新统计信息，帮助SQLite查询规划器选择索引
+        with engine.begin() as conn:
+            if conn.dialect.name == 'sqlite':
+                conn.execute(text("ANALYZE"))
+
+def downgrade():
+    for index in INDEXES:
+        if index.name in existing_indexes(index.table.name):
+            index.drop(bind=engine)
+            print(f"🗑️ 已删除索引: {index.name}")
+
+def main():
+    parser = argparse.ArgumentParser(description='消息/好友表索引迁移工具')
+    parser.add_argument('--dry-run', action='store_true', help='只检查需要创建的索引，不修改数据库')
+    parser.add_argument('--downgrade', action='store_true', help='删除本迁移创建的索引')
+
+    args = parser.parse_args()
+
+    if args.downgrade:
+        downgrade()
+    else:
+        upgrade(args.dry_run)
+
+if __name__ == '__main__':
+    main()
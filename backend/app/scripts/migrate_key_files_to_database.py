@@ -0,0 +1,94 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+"""
+数据迁移脚本：将 user_{id}_keys.json 密钥文件导入 user_key_material 表
+
+使用方法:
+1. 导入默认目录下的所有密钥文件: python migrate_key_files_to_database.py
+2. 指定密钥文件目录: python migrate_key_files_to_database.py --keys-dir /path/to/user_keys
+3. 只检查不写入: python migrate_key_files_to_database.py --dry-run
+
+服务在数据库中找不到某个用户的密钥时也会从 LEGACY_KEYS_DIR 读取并导入，本脚本用于一次性全部导入。
+"""
+
+import os
+import re
+import sys
+import argparse
+import json
+from pathlib import Path
+
+# 添加项目根目录到Python路径
+project_root = Path(__file__).parent.parent.parent
+sys.path.insert(0, str(project_root))
+
+from app.core.config import LEGACY_KEYS_DIR
+from app.db.database import engine
+from app.db.models import Base, UserKeyMaterial
+from app.services.key_material_store import KeyMaterial, key_material_store
+
+# 旧版本保存密钥文件的目录
+DEFAULT_KEYS_DIR = LEGACY_KEYS_DIR
+KEY_FILE_RE = re.compile(r'^user_(\d+)_keys\.json$')
+
+def find_key_files(keys_dir):
+    """查找所有用户的密钥文件"""
+    if not os.path.exists(keys_dir):
+        print(f"密钥文件目录不存在: {keys_dir}")
+        return []
+
+    key_files = []
+    for filename in sorted(os.listdir(keys_dir)):
+        match = KEY_FILE_RE.match(filename)
+        if match:
+            key_files.append((int(match.group(1)), os.path.join(keys_dir, filename)))
+    return key_files
+
+def migrate_key_files(keys_dir, dry_run=False, overwrite=False):
+    """导入密钥文件，返回 (成功数, 跳过数, 失败数)"""
+    key_files = find_key_files(keys_dir)
+    if not key_files:
+        print("没有找到需要导入的密钥文件")
+        return 0, 0, 0
+
+    print(f"找到 {len(key_files)} 个密钥文件")
+
+    # 确保表存在
+    Base.metadata.create_all(bind=engine, tables=[UserKeyMaterial.__table__])
+
+    # 一次查询已存在的用户，默认不覆盖
+    existing = key_material_store.get_many([user_id for user_id, _ in key_files])
+
+    success_count = skipped_count = failed_count = 0
+    for user_id, file_path in key_files:
+        if user_id in existing and not overwrite:
+            skipped_count += 1
+            continue
+        try:
+            with open(file_path, 'r', encoding='utf-8') as f:
+                material = KeyMaterial.from_json(user_id, json.load(f))
+            if not dry_run:
+                key_material_store.put(material)
+            success_count += 1
+        except Exception as e:
+            failed_count += 1
+            print(f"  用户 {user_id} 导入失败: {e}")
+
+    action = "可导入" if dry_run else "导入成功"
+    print(f"{action} {success_count} 个，已存在跳过 {skipped_count} 个，失败 {failed_count} 个")
+    return success_count, skipped_count, failed_count
+
+def main():
+    parser = argparse.ArgumentParser(description='密钥文件迁移工具')
+    parser.add_argument('--keys-dir', default=DEFAULT_KEYS_DIR, help='user_{id}_keys.json 所在目录')
+    parser.add_argument('--dry-run', action='store_true', help='只解析文件，不写入数据库')
+    parser.add_argument('--overwrite', action='store_true', help='覆盖数据库中已存在的密钥')
+
+    args = parser.parse_args()
+
+    _, _, failed_count = migrate_key_files(args.keys_dir, args.dry_run, args.overwrite)
+    if failed_count:
+        sys.exit(1)
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,58 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+"""
+数据迁移脚本：将 session_keys 表改为按 (较小用户ID, 较大用户ID) 保存，并补建好友会话
+
+1. 把 user1_id > user2_id 的记录交换为规范顺序（两列加密会话密钥随之交换）
+2. 删除同一用户对的重复记录，保留最早的一条
+3. 创建唯一索引 ux_session_keys_pair
+4. 为已有好友关系分批补建缺失的会话
+
+服务启动时 init_db 会自动执行第1-3步，本脚本用于预先检查或补建会话。
+
+使用方法:
+1. 执行迁移并补建会话: python migrate_session_key_pairs.py
+2. 只检查不修改: python migrate_session_key_pairs.py --dry-run
+3. 只迁移不补建: python migrate_session_key_pairs.py --skip-backfill
+4. 指定补建批大小: python migrate_session_key_pairs.py --batch-size 500
+"""
+
+import sys
+import argparse
+from pathlib import Path
+
+# 添加项目根目录到Python路径
+project_root = Path(__file__).parent.parent.parent
+sys.path.insert(0, str(project_root))
+
+from app.db.database import engine, normalize_session_key_pairs
+from app.db.models import Base, SessionKey
+from app.services.encryption_service import encryption_service
+
+def migrate_session_keys(dry_run=False):
+    """规范化用户对、去重并创建唯一索引（服务启动时 init_db 也会自动执行）"""
+    Base.metadata.create_all(bind=engine, tables=[SessionKey.__table__])
+    stats = normalize_session_key_pairs(engine, dry_run=dry_run)
+    print(f"需要交换顺序的记录: {stats['reversed'] - stats['incomplete']} 条，无法交换需删除: {stats['incomplete']} 条")
+    print(f"重复的会话记录: {stats['duplicates']} 条")
+    if not dry_run:
+        print("✅ 唯一索引 ux_session_keys_pair 已创建")
+
+def main():
+    parser = argparse.ArgumentParser(description='会话密钥表迁移工具')
+    parser.add_argument('--dry-run', action='store_true', help='只统计需要修改的记录，不写入数据库')
+    parser.add_argument('--skip-backfill', action='store_true', help='不为已有好友关系补建会话')
+    parser.add_argument('--batch-size', type=int, default=200, help='补建会话时每批处理的好友记录数')
+
+    args = parser.parse_args()
+
+    migrate_session_keys(args.dry_run)
+    if args.dry_run or args.skip_backfill:
+        return
+
+    stats = encryption_service.backfill_friend_sessions(args.batch_size)
+    print(f"检查好友关系 {stats['checked']} 条，新建会话 {stats['created']} 个，失败 {stats['failed']} 个")
+    encryption_service.close()
+
+if __name__ == '__main__':
+    main()
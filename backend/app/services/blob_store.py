@@ -0,0 +1,231 @@
+import asyncio
+import logging
+import os
+import re
+import threading
+import time
+import uuid
+from datetime import datetime, timedelta
+from typing import Optional
+from sqlalchemy import func
+from sqlalchemy.exc import IntegrityError
+from sqlalchemy.orm import Session
+from starlette.concurrency import run_in_threadpool
+from app.core import tracing
+from app.core.config import BLOB_GC_INTERVAL, BLOB_GC_GRACE
+from app.db.database import SessionLocal
+from app.db.models import Blob, Message
+from app.services.file_storage_service import BASE_DIR, remove_file_quietly
+from app.services.image_variant_service import remove_variants
+
+logger = logging.getLogger(__name__)
+
+# 内容寻址存储目录：blobs/ab/cd/abcd...（按SHA-256前两级分片，避免单目录文件过多）
+BLOB_DIR = os.path.join(BASE_DIR, "static", "blobs")
+BLOB_TMP_DIR = os.path.join(BLOB_DIR, "tmp")
+os.makedirs(BLOB_TMP_DIR, exist_ok=True)
+
+# 消息中保存的文件名格式：<sha256><扩展名>，例如 3a7bd3...e1.png
+_BLOB_NAME_RE = re.compile(r'^([a-f0-9]{64})(\.[a-zA-Z0-9]+)?$')
+_TMP_MAX_AGE = 3600
+
+
+class BlobStore:
+    """内容寻址的去重存储
+
+    上传内容以SHA-256为键保存一份，消息的file_path保存 <sha256><扩展名>。
+    blobs表记录每份内容被多少条消息引用：
+    - 上传（包括重复内容）时引用数加一，重复内容不会再写一份到磁盘；
+    - 用户删除消息或阅后即焚过期时引用数减一；
+    - 引用数为0且超过宽限期、并且已没有消息的file_path指向它时，由后台任务删除文件。
+
+    注意：消息投递后会从服务器数据库删除（客户端本地库仍保留file_path），
+    这种删除不是“内容不再需要”，因此不会减少引用数。
+    """
+
+    def __init__(self, root: str = BLOB_DIR):
+        self.root = root
+        self.tmp_dir = os.path.join(root, "tmp")
+        # 保护“检查文件是否存在 + 放入文件”与回收删除文件之间的竞争（不跨数据库提交）
+        self._lock = threading.Lock()
+        self._gc_task: Optional[asyncio.Task] = None
+
+    @staticmethod
+    def parse_name(name: Optional[str]) -> Optional[str]:
+        """从 <sha256><扩展名> 形式的文件名中取出哈希，不是内容寻址名称时返回None"""
+        if not name:
+            return None
+        match = _BLOB_NAME_RE.match(name)
+        return match.group(1) if match else None
+
+    @staticmethod
+    def make_name(sha256: str, file_extension: str) -> str:
+        return f"{sha256}{file_extension}"
+
+    def path_for(self, sha256: str) -> str:
+        return os.path.join(self.root, sha256[:2], sha256[2:4], sha256)
+
+    def resolve(self, name: str) -> Optional[str]:
+        """内容寻址文件名对应的磁盘路径"""
+        sha256 = self.parse_name(name)
+        return self.path_for(sha256) if sha256 else None
+
+    def new_temp_path(self) -> str:
+        """上传流先写到这里，算出哈希后再交给ingest"""
+        return os.path.join(self.tmp_dir, uuid.uuid4().hex)
+
+    @staticmethod
+    def _bump(db: Session, sha256: str) -> int:
+        return db.query(Blob).filter(Blob.sha256 == sha256).update(
+            {Blob.ref_count: Blob.ref_count + 1, Blob.released_at: None},
+            synchronize_session=False
+        )
+
+    def _increment(self, db: Session, sha256: str, size: int) -> None:
+        if self._bump(db, sha256):
+            db.commit()
+            return
+        try:
+            db.add(Blob(sha256=sha256, size=size, ref_count=1))
+            db.commit()
+        except IntegrityError:
+            # 相同内容并发首次上传，另一方先插入了记录：改为增加引用数
+            db.rollback()
+            self._bump(db, sha256)
+            db.commit()
+
+    @tracing.traced(tracing.FILE_IO)
+    def ingest(self, tmp_path: str, sha256: str, size: int) -> bool:
+        """把已计算出哈希的临时文件放入存储并增加引用
+
+        先提交引用数，再在锁内放入文件：回收任务只在锁内、且确认记录已不存在时删除文件，
+        所以无论两者以何种顺序执行，引用数大于0的内容文件一定存在。锁不跨数据库提交。
+
+        Returns:
+            bool: 内容已存在（本次上传被去重）时为True
+        """
+        db = SessionLocal()
+        try:
+            self._increment(db, sha256, size)
+        finally:
+            db.close()
+        try:
+            with self._lock:
+                blob_path = self.path_for(sha256)
+                deduplicated = os.path.isfile(blob_path)
+                if deduplicated:
+                    remove_file_quietly(tmp_path)
+                else:
+                    os.makedirs(os.path.dirname(blob_path), exist_ok=True)
+                    os.replace(tmp_path, blob_path)
+        except OSError:
+            self.release_name(sha256)
+            raise
+        return deduplicated
+
+    def release(self, db: Session, name: Optional[str]) -> None:
+        """消息被删除时减少引用数（在调用方的事务中执行，由调用方提交）"""
+        sha256 = self.parse_name(name)
+        if not sha256:
+            return
+        db.query(Blob).filter(Blob.sha256 == sha256, Blob.ref_count > 0).update(
+            {Blob.ref_count: Blob.ref_count - 1}, synchronize_session=False
+        )
+        db.query(Blob).filter(Blob.sha256 == sha256, Blob.ref_count <= 0).update(
+            {Blob.released_at: datetime.utcnow()}, synchronize_session=False
+        )
+
+    def release_name(self, name: Optional[str]) -> None:
+        """使用独立会话减少引用数（用于上传后创建消息失败的回滚）"""
+        db = SessionLocal()
+        try:
+            self.release(db, name)
+            db.commit()
+        finally:
+            db.close()
+
+    def _purge_temp_files(self) -> None:
+        """清理中断上传残留的临时文件"""
+        now = time.time()
+        try:
+            for name in os.listdir(self.tmp_dir):
+                tmp_path = os.path.join(self.tmp_dir, name)
+                try:
+                    if now - os.path.getmtime(tmp_path) > _TMP_MAX_AGE:
+                        remove_file_quietly(tmp_path)
+                except OSError:
+                    pass
+        except FileNotFoundError:
+            pass
+
+    def collect_garbage(self, grace_seconds: int = BLOB_GC_GRACE, batch_size: int = 500) -> int:
+        """删除引用数为0且超过宽限期的内容，返回删除数量"""
+        self._purge_temp_files()
+        removed = 0
+        cutoff = datetime.utcnow() - timedelta(seconds=grace_seconds)
+        db = SessionLocal()
+        try:
+            candidates = [sha256 for (sha256,) in db.query(Blob.sha256).filter(
+                Blob.ref_count <= 0, Blob.released_at != None, Blob.released_at < cutoff
+            ).limit(batch_size).all()]
+            if not candidates:
+                return 0
+
+            # 仍有消息指向的内容修正引用数而不是删除（一次查询统计所有候选）
+            sha_prefix = func.substr(Message.file_path, 1, 64)
+            references = dict(db.query(sha_prefix, func.count()).filter(
+                sha_prefix.in_(candidates)
+            ).group_by(sha_prefix).all())
+            deleted = []
+            for sha256 in candidates:
+                if references.get(sha256):
+                    db.query(Blob).filter(Blob.sha256 == sha256).update(
+                        {Blob.ref_count: references[sha256], Blob.released_at: None}, synchronize_session=False
+                    )
+                    continue
+                # 条件删除：期间有新的上传增加了引用时不删除
+                if db.query(Blob).filter(Blob.sha256 == sha256, Blob.ref_count <= 0).delete(synchronize_session=False):
+                    deleted.append(sha256)
+            db.commit()
+
+            for sha256 in deleted:
+                with self._lock:
+                    # 提交后到加锁前可能有上传重新登记了该内容
+                    if db.query(Blob.sha256).filter(Blob.sha256 == sha256).first() is not None:
+                        continue
+                    remove_file_quietly(self.path_for(sha256))
+                    remove_variants(self.path_for(sha256))
+                removed += 1
+        finally:
+            db.close()
+
+        return removed
+
+    async def _gc_loop(self):
+        while True:
+            await asyncio.sleep(BLOB_GC_INTERVAL)
+            try:
+                removed = await run_in_threadpool(self.collect_garbage)
+                if removed:
+                    logger.info("[内容存储] 回收了 %d 个无引用的文件", removed)
+            except Exception as e:
+                logger.error("[内容存储] 回收无引用文件失败: %s", e)
+
+    async def start_gc(self):
+        """启动无引用内容回收任务"""
+        if self._gc_task is None:
+            self._gc_task = asyncio.create_task(self._gc_loop())
+
+    async def stop_gc(self):
+        """停止无引用内容回收任务"""
+        if self._gc_task is not None:
+            self._gc_task.cancel()
+            try:
+                await self._gc_task
+            except asyncio.CancelledError:
+                pass
+            self._gc_task = None
+
+
+# 全局内容存储实例
+blob_store = BlobStore()
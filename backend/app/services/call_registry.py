@@ -0,0 +1,220 @@
+import asyncio
+import logging
+import math
+import time
+from dataclasses import dataclass, field
+from typing import Dict, List, Optional, Tuple
+from app.core.config import CALL_RING_TIMEOUT, CALL_TOMBSTONE_TTL
+from app.core.metrics import metrics
+
+logger = logging.getLogger(__name__)
+
+RINGING = 'ringing'
+ACTIVE = 'active'
+ENDED = 'ended'
+
+call_setup_seconds = metrics.histogram(
+    'call_setup_seconds', '通话建立耗时（offer到answer、offer到第一个ICE候选）', ('call_type', 'phase'),
+    buckets=(0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0, 30.0)
+)
+
+
+@dataclass
+class CallSession:
+    call_id: str
+    call_type: str
+    caller_id: int
+    callee_id: int
+    state: str
+    created_at: float
+    answered_at: Optional[float] = None
+    first_ice_at: Optional[float] = None
+    ended_at: Optional[float] = None
+    end_reason: Optional[str] = None
+    # 结束后双方发来的ICE候选 (发送方, 信令)，同一对用户重拨时可能先于新offer到达
+    held: List[Tuple[int, dict]] = field(default_factory=list)
+
+    def involves(self, user_id: int) -> bool:
+        return user_id in (self.caller_id, self.callee_id)
+
+    def to_dict(self) -> dict:
+        return {
+            "call_id": self.call_id,
+            "call_type": self.call_type,
+            "caller_id": self.caller_id,
+            "callee_id": self.callee_id,
+            "state": self.state,
+            "end_reason": self.end_reason
+        }
+
+
+# 每个已结束通话最多暂存的ICE候选数
+_MAX_HELD_FRAMES = 32
+
+
+def _pair(a: int, b: int) -> Tuple[int, int]:
+    return (a, b) if a <= b else (b, a)
+
+
+class CallRegistry:
+    """通话会话登记表
+
+    按call_id记录每次通话的参与者、状态和时间点。只有offer带call_id，
+    answer/ICE等后续信令按(双方用户)找到当前通话。
+    通话结束（拒绝、挂断、振铃超时、一方断开）后保留CALL_TOMBSTONE_TTL秒，
+    这期间双方之间的后续信令直接丢弃，只有ICE候选先暂存：同一对用户有新offer时旧记录被替换，
+    offer方暂存的候选随新通话转发（重拨时先于offer到达的候选），其余丢弃。
+    从未登记过的用户对照常转发，兼容先于offer到达的ICE候选。
+    所有方法都在事件循环线程中调用。
+    """
+
+    def __init__(self, ring_timeout: int = CALL_RING_TIMEOUT, tombstone_ttl: int = CALL_TOMBSTONE_TTL):
+        self.ring_timeout = ring_timeout
+        self.tombstone_ttl = tombstone_ttl
+        self._calls: Dict[str, CallSession] = {}
+        self._by_pair: Dict[Tuple[int, int], str] = {}
+        self._gc_task: Optional[asyncio.Task] = None
+        self.started = 0
+        self.answered = 0
+        self.ended: Dict[str, int] = {}
+        self.dropped_frames = 0
+
+    def start_call(self, call_type: str, call_id: Optional[str], caller_id: int, callee_id: int) -> CallSession:
+        """登记新通话（offer），同一对用户之间未结束的旧通话视为被替换
+
+        旧通话已结束时清除其记录，offer方在此之前暂存的ICE候选放入新通话的held，由调用方在offer之后转发。
+        """
+        previous = self.find(caller_id, callee_id)
+        early_frames = []
+        if previous is not None:
+            if previous.state != ENDED:
+                self.end(previous, 'replaced')
+            else:
+                early_frames = [frame for sender_id, frame in previous.held if sender_id == caller_id]
+                self.dropped_frames += len(previous.held) - len(early_frames)
+            self._calls.pop(previous.call_id, None)
+        if not call_id:
+            call_id = f"{caller_id}_{callee_id}_{int(time.time() * 1000)}"
+        call = CallSession(call_id, call_type, caller_id, callee_id, RINGING, time.monotonic(), held=early_frames)
+        self._calls[call_id] = call
+        self._by_pair[_pair(caller_id, callee_id)] = call_id
+        self.started += 1
+        return call
+
+    def find(self, user_a: int, user_b: int) -> Optional[CallSession]:
+        """查找两个用户之间最近的一次通话（包括刚结束的）"""
+        call_id = self._by_pair.get(_pair(user_a, user_b))
+        call = self._calls.get(call_id) if call_id else None
+        if call is not None and self._expire(call, time.monotonic()):
+            return None
+        return call
+
+    def _expire(self, call: CallSession, now: float) -> bool:
+        """处理振铃超时，清理过期的已结束通话；返回通话是否已被移除"""
+        if call.state == RINGING and now - call.created_at > self.ring_timeout:
+            self.end(call, 'timeout')
+        if call.state == ENDED and now - call.ended_at > self.tombstone_ttl:
+            self.dropped_frames += len(call.held)
+            self._calls.pop(call.call_id, None)
+            pair = _pair(call.caller_id, call.callee_id)
+            if self._by_pair.get(pair) == call.call_id:
+                del self._by_pair[pair]
+            return True
+        return False
+
+    def mark_answered(self, call: CallSession) -> None:
+        if call.answered_at is not None:
+            return
+        call.answered_at = time.monotonic()
+        call.state = ACTIVE
+        self.answered += 1
+        call_setup_seconds.observe(call.answered_at - call.created_at, call.call_type, 'answer')
+
+    def mark_ice(self, call: CallSession) -> None:
+        if call.first_ice_at is not None:
+            return
+        call.first_ice_at = time.monotonic()
+        call_setup_seconds.observe(call.first_ice_at - call.created_at, call.call_type, 'first_ice')
+
+    def end(self, call: CallSession, reason: str) -> None:
+        if call.state == ENDED:
+            return
+        call.state = ENDED
+        call.ended_at = time.monotonic()
+        call.end_reason = reason
+        self.ended[reason] = self.ended.get(reason, 0) + 1
+
+    def end_user_calls(self, user_id: int, reason: str = 'disconnected') -> List[CallSession]:
+        """用户断开连接时结束其所有未结束的通话"""
+        ended = [call for call in self._calls.values() if call.state != ENDED and call.involves(user_id)]
+        for call in ended:
+            self.end(call, reason)
+        return ended
+
+    def hold(self, call: CallSession, sender_id: int, frame: dict) -> bool:
+        """暂存已结束通话之后到达的ICE候选，超出上限时返回False（应丢弃）"""
+        if call.state != ENDED or len(call.held) >= _MAX_HELD_FRAMES:
+            return False
+        call.held.append((sender_id, frame))
+        return True
+
+    def drop_frame(self) -> None:
+        self.dropped_frames += 1
+
+    def purge_expired(self) -> None:
+        now = time.monotonic()
+        for call in list(self._calls.values()):
+            self._expire(call, now)
+
+    async def _gc_loop(self):
+        while True:
+            await asyncio.sleep(self.tombstone_ttl)
+            try:
+                self.purge_expired()
+            except Exception as e:
+                logger.error("[通话] 清理过期通话失败: %s", e)
+
+    async def start_gc(self):
+        """启动过期通话清理任务"""
+        if self._gc_task is None:
+            self._gc_task = asyncio.create_task(self._gc_loop())
+
+    async def stop_gc(self):
+        """停止过期通话清理任务"""
+        if self._gc_task is not None:
+            self._gc_task.cancel()
+            try:
+                await self._gc_task
+            except asyncio.CancelledError:
+                pass
+            self._gc_task = None
+
+    def stats(self) -> dict:
+        states: Dict[str, int] = {}
+        for call in self._calls.values():
+            states[call.state] = states.get(call.state, 0) + 1
+        return {
+            "calls": states,
+            "started": self.started,
+            "answered": self.answered,
+            "ended": dict(self.ended),
+            "dropped_frames": self.dropped_frames
+        }
+
+    @staticmethod
+    def setup_latency() -> dict:
+        """各通话类型的建立耗时汇总（毫秒，分位数按直方图桶估算）"""
+        result: Dict[str, dict] = {}
+        for call_type, phase in call_setup_seconds.label_values():
+            snapshot = call_setup_seconds.snapshot(call_type, phase)
+            result.setdefault(call_type, {})[f"offer_to_{phase}"] = {
+                "count": snapshot["count"],
+                **{key: round(snapshot[key] * 1000, 1) if snapshot[key] not in (None, math.inf) else None
+                   for key in ("avg", "p50", "p95")}
+            }
+        return result
+
+
+# 全局通话登记表
+call_registry = CallRegistry()
+metrics.register_stats('call_registry', call_registry.stats)
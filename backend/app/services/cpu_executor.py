@@ -0,0 +1,131 @@
+import asyncio
+import contextvars
+import logging
+import threading
+import time
+from concurrent.futures import Future, ThreadPoolExecutor
+from typing import Callable, Dict, Optional
+from fastapi import HTTPException
+from app.core.config import CPU_POOL_WORKERS, CPU_POOL_MAX_PENDING
+from app.core.metrics import metrics
+
+logger = logging.getLogger(__name__)
+
+
+class _OperationStats:
+    """单个操作的延迟统计（毫秒）"""
+
+    __slots__ = ("count", "errors", "rejected", "total_ms", "max_ms", "total_wait_ms", "max_wait_ms")
+
+    def __init__(self):
+        self.count = 0
+        self.errors = 0
+        self.rejected = 0
+        self.total_ms = 0.0
+        self.max_ms = 0.0
+        self.total_wait_ms = 0.0
+        self.max_wait_ms = 0.0
+
+    def to_dict(self) -> dict:
+        return {
+            "count": self.count,
+            "errors": self.errors,
+            "rejected": self.rejected,
+            "avg_ms": round(self.total_ms / self.count, 2) if self.count else 0.0,
+            "max_ms": round(self.max_ms, 2),
+            "avg_wait_ms": round(self.total_wait_ms / self.count, 2) if self.count else 0.0,
+            "max_wait_ms": round(self.max_wait_ms, 2)
+        }
+
+
+class CpuExecutor:
+    """CPU密集任务（bcrypt、PBKDF2、RSA密钥生成）专用的有界线程池
+
+    这些计算都在C扩展中执行并释放GIL，放在独立的小线程池里既不阻塞事件循环，
+    也不会占满FastAPI处理普通同步接口的默认线程池。
+    排队和执行中的任务超过max_pending时直接返回503（准入控制），
+    避免注册高峰时请求无限排队、延迟不断累积。
+    """
+
+    def __init__(self, workers: int = CPU_POOL_WORKERS, max_pending: int = CPU_POOL_MAX_PENDING):
+        self.workers = workers
+        self.max_pending = max_pending
+        self._executor = ThreadPoolExecutor(max_workers=workers, thread_name_prefix="cpu-task")
+        self._lock = threading.Lock()
+        self._pending = 0
+        self._stats: Dict[str, _OperationStats] = {}
+
+    def _op_stats(self, operation: str) -> _OperationStats:
+        stats = self._stats.get(operation)
+        if stats is None:
+            stats = self._stats.setdefault(operation, _OperationStats())
+        return stats
+
+    def submit(self, operation: str, func: Callable, *args, admit: bool = True, **kwargs) -> Future:
+        """提交任务
+
+        Args:
+            operation: 操作名称，用于统计
+            admit: 为True时队列已满则抛出503；后台任务传False，总是排队执行
+        """
+        with self._lock:
+            if admit and self._pending >= self.max_pending:
+                self._op_stats(operation).rejected += 1
+                raise HTTPException(
+                    status_code=503,
+                    detail="服务器繁忙，请稍后重试",
+                    headers={"Retry-After": "1"}
+                )
+            self._pending += 1
+        submitted_at = time.perf_counter()
+
+        def _run():
+            started_at = time.perf_counter()
+            error = False
+            try:
+                return func(*args, **kwargs)
+            except BaseException:
+                error = True
+                raise
+            finally:
+                finished_at = time.perf_counter()
+                with self._lock:
+                    self._pending -= 1
+                    stats = self._op_stats(operation)
+                    stats.count += 1
+                    stats.errors += error
+                    elapsed_ms = (finished_at - started_at) * 1000
+                    wait_ms = (started_at - submitted_at) * 1000
+                    stats.total_ms += elapsed_ms
+                    stats.max_ms = max(stats.max_ms, elapsed_ms)
+                    stats.total_wait_ms += wait_ms
+                    stats.max_wait_ms = max(stats.max_wait_ms, wait_ms)
+
+        try:
+            # 在提交者的上下文中执行，任务内记录的span归属到发起请求
+            return self._executor.submit(contextvars.copy_context().run, _run)
+        except BaseException:
+            with self._lock:
+                self._pending -= 1
+            raise
+
+    async def run(self, operation: str, func: Callable, *args, **kwargs):
+        """在线程池中执行并等待结果（供异步接口调用）"""
+        return await asyncio.wrap_future(self.submit(operation, func, *args, **kwargs))
+
+    def stats(self) -> dict:
+        with self._lock:
+            return {
+                "workers": self.workers,
+                "max_pending": self.max_pending,
+                "pending": self._pending,
+                "operations": {name: stats.to_dict() for name, stats in self._stats.items()}
+            }
+
+    def shutdown(self, wait: bool = False) -> None:
+        self._executor.shutdown(wait=wait, cancel_futures=not wait)
+
+
+# 全局CPU任务线程池
+cpu_executor = CpuExecutor()
+metrics.register_stats('cpu_executor', cpu_executor.stats)
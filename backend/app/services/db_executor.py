@@ -0,0 +1,102 @@
+import asyncio
+import contextvars
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+from typing import Callable
+from app.core.config import DB_EXECUTOR_WORKERS
+from app.core.metrics import metrics
+from app.db import database
+
+
+class DbExecutor:
+    """异步代码访问同步SQLAlchemy的有界线程池桥接
+
+    WebSocket处理函数和在线状态服务运行在事件循环上，直接调用SessionLocal查询时，
+    每次数据库等待（包括SQLite写锁的busy_timeout）都会阻塞所有连接的消息推送。
+    这里把数据库操作放到固定大小的线程池中执行，事件循环只等待结果；
+    线程数即同时访问数据库的上限，多出的调用在线程池队列中排队。
+    """
+
+    def __init__(self, workers: int = DB_EXECUTOR_WORKERS):
+        self.workers = workers
+        self._executor = ThreadPoolExecutor(max_workers=workers, thread_name_prefix="db-task")
+        self._lock = threading.Lock()
+        self._pending = 0
+        self.calls = 0
+        self.errors = 0
+        self.total_wait_ms = 0.0
+        self.max_wait_ms = 0.0
+        self.total_ms = 0.0
+        self.max_ms = 0.0
+
+    def _instrumented(self, func: Callable, submitted_at: float, *args, **kwargs):
+        started_at = time.perf_counter()
+        error = False
+        try:
+            return func(*args, **kwargs)
+        except BaseException:
+            error = True
+            raise
+        finally:
+            finished_at = time.perf_counter()
+            wait_ms = (started_at - submitted_at) * 1000
+            elapsed_ms = (finished_at - started_at) * 1000
+            with self._lock:
+                self._pending -= 1
+                self.calls += 1
+                self.errors += error
+                self.total_wait_ms += wait_ms
+                self.max_wait_ms = max(self.max_wait_ms, wait_ms)
+                self.total_ms += elapsed_ms
+                self.max_ms = max(self.max_ms, elapsed_ms)
+
+    async def run(self, func: Callable, *args, **kwargs):
+        """在线程池中执行阻塞函数（如按用户的本地消息库读写）"""
+        with self._lock:
+            self._pending += 1
+        loop = asyncio.get_running_loop()
+        try:
+            future = self._executor.submit(contextvars.copy_context().run, self._instrumented,
+                                           func, time.perf_counter(), *args, **kwargs)
+        except BaseException:
+            with self._lock:
+                self._pending -= 1
+            raise
+        return await asyncio.wrap_future(future, loop=loop)
+
+    async def run_session(self, func: Callable, *args, **kwargs):
+        """在线程池中打开一个数据库会话，以 func(db, *args, **kwargs) 执行，出错时回滚"""
+        return await self.run(self._with_session, func, *args, **kwargs)
+
+    @staticmethod
+    def _with_session(func: Callable, *args, **kwargs):
+        db = database.SessionLocal()
+        try:
+            return func(db, *args, **kwargs)
+        except Exception:
+            db.rollback()
+            raise
+        finally:
+            db.close()
+
+    def stats(self) -> dict:
+        with self._lock:
+            return {
+                "workers": self.workers,
+                "pending": self._pending,
+                "calls": self.calls,
+                "errors": self.errors,
+                "avg_wait_ms": round(self.total_wait_ms / self.calls, 2) if self.calls else 0.0,
+                "max_wait_ms": round(self.max_wait_ms, 2),
+                "avg_ms": round(self.total_ms / self.calls, 2) if self.calls else 0.0,
+                "max_ms": round(self.max_ms, 2)
+            }
+
+    def shutdown(self, wait: bool = False) -> None:
+        self._executor.shutdown(wait=wait, cancel_futures=not wait)
+
+
+# 全局数据库线程池
+db_executor = DbExecutor()
+metrics.register_stats('db_executor', db_executor.stats)
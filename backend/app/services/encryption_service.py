@@ -1,326 +1,315 @@
-import os
-import json
 import base64
-from typing import Dict, Optional, Tuple
+import logging
+import secrets
+import threading
+from collections import OrderedDict
+from concurrent.futures import ThreadPoolExecutor
+from typing import Dict, Iterable, List, Optional, Sequence, Tuple
+from sqlalchemy.exc import IntegrityError
 from sqlalchemy.orm import Session
+from cryptography.hazmat.primitives import hashes, serialization
+from cryptography.hazmat.primitives.asymmetric import padding
+from cryptography.hazmat.primitives.asymmetric.ed25519 import Ed25519PrivateKey
+from cryptography.hazmat.primitives.asymmetric.x25519 import X25519PrivateKey
+from app.core.config import (
+    LIBSIGNAL_NODE_PATH, NODE_WORKER_TIMEOUT, DECRYPT_BATCH_PARALLEL_THRESHOLD, DECRYPT_BATCH_WORKERS,
+    SESSION_KEY_CACHE_SIZE
+)
+from app.core import tracing
+from app.core.metrics import metrics, timed
 from app.db.database import SessionLocal
-from app.db.models import User
-import subprocess
-import tempfile
+from app.db.models import Friend, SessionKey, User
+from app.services.cpu_executor import cpu_executor
+from app.services import message_envelope
+from app.services.node_worker import NodeWorker, NodeWorkerError
+from app.services.key_material_store import KeyMaterial, key_material_store
+
+logger = logging.getLogger(__name__)
+
+crypto_op_seconds = metrics.histogram('crypto_op_seconds', '加解密操作耗时', ('operation',))
+crypto_failures = metrics.counter('crypto_failures_total', '加解密失败次数', ('operation',))
+session_key_cache_lookups = metrics.counter('session_key_cache_lookups_total', '会话密钥缓存查询次数', ('result',))
+
+# 预密钥ID为24位
+_MAX_KEY_ID = 16777215
+_OAEP_PADDING = padding.OAEP(mgf=padding.MGF1(algorithm=hashes.SHA256()), algorithm=hashes.SHA256(), label=None)
+_IN_BATCH_SIZE = 500
+# 每个线程池任务处理的用户对数量
+_SESSION_WRAP_CHUNK = 16
+
+
+def _b64(data: bytes) -> str:
+    return base64.b64encode(data).decode()
+
+
+def _random_key_id() -> int:
+    return secrets.randbelow(_MAX_KEY_ID)
+
+
+def canonical_pair(user_a: int, user_b: int) -> Tuple[int, int]:
+    """会话按 (较小ID, 较大ID) 保存，每对用户只有一条记录"""
+    return (user_a, user_b) if user_a < user_b else (user_b, user_a)
+
+
+def _x25519_keypair() -> Tuple[bytes, bytes]:
+    """返回 (私钥32字节, 公钥32字节)"""
+    private_key = X25519PrivateKey.generate()
+    return private_key.private_bytes_raw(), private_key.public_key().public_bytes_raw()
+
 
 class EncryptionService:
     """
     端到端加密服务
-    使用libsignal实现Signal协议的端到端加密
+
+    身份密钥、预密钥和签名预密钥在进程内用cryptography生成：
+    身份密钥为Ed25519（对签名预密钥签名），预密钥和签名预密钥为X25519，均以原始32字节的base64保存。
+    Python端没有的Kyber预密钥交给常驻的Node辅助进程（libsignal）生成，不可用时省略。
     """
     
     def __init__(self):
-        self.libsignal_path = "/Users/tsuki/Desktop/大二下/chat8/libsignal"
-        self.node_path = os.path.join(self.libsignal_path, "node")
-        
-    def _run_node_script(self, script_content: str) -> Dict:
-        """
-        执行Node.js脚本调用libsignal
-        """
-        try:
-            with tempfile.NamedTemporaryFile(mode='w', suffix='.js', delete=False) as f:
-                # 添加libsignal导入
-                full_script = f"""
-const {{ IdentityKeyPair, PrivateKey, PublicKey, PreKeyRecord, SignedPreKeyRecord, 
-         KEMKeyPair, KyberPreKeyRecord, processPreKeyBundle, signalEncrypt, signalDecrypt,
-         signalDecryptPreKey, UsePQRatchet }} = require('{self.node_path}');
-const crypto = require('crypto');
-
-{script_content}
-"""
-                f.write(full_script)
-                f.flush()
-                
-                # 执行脚本
-                result = subprocess.run(
-                    ['node', f.name],
-                    cwd=self.node_path,
-                    capture_output=True,
-                    text=True,
-                    timeout=30
-                )
-                
-                os.unlink(f.name)
-                
-                if result.returncode != 0:
-                    raise Exception(f"Node.js script failed: {result.stderr}")
-                    
-                return json.loads(result.stdout)
-                
-        except Exception as e:
-            raise Exception(f"Failed to run libsignal script: {str(e)}")
+        self.node_path = LIBSIGNAL_NODE_PATH
+        self.node_worker = NodeWorker(self.node_path, timeout=NODE_WORKER_TIMEOUT)
+        self.parallel_threshold = DECRYPT_BATCH_PARALLEL_THRESHOLD
+        self._decrypt_executor: Optional[ThreadPoolExecutor] = None
+        self._executor_lock = threading.Lock()
+        # (用户ID, 对方用户ID) -> get_session_key的成功结果，避免每条消息都做一次RSA解封
+        self._session_key_cache: "OrderedDict[Tuple[int, int], Dict]" = OrderedDict()
+        self._session_key_lock = threading.Lock()
     
     def generate_identity_keypair(self) -> Dict[str, str]:
         """
         生成身份密钥对
         返回: {"private_key": "base64", "public_key": "base64"}
         """
-        script = """
-try {
-    const identityKeyPair = IdentityKeyPair.generate();
-    const result = {
-        private_key: Buffer.from(identityKeyPair.privateKey.serialize()).toString('base64'),
-        public_key: Buffer.from(identityKeyPair.publicKey.serialize()).toString('base64')
-    };
-    console.log(JSON.stringify(result));
-} catch (error) {
-    console.log(JSON.stringify({error: error.message}));
-}
-"""
-        return self._run_node_script(script)
+        try:
+            private_key = Ed25519PrivateKey.generate()
+            return {
+                'private_key': _b64(private_key.private_bytes_raw()),
+                'public_key': _b64(private_key.public_key().public_bytes_raw())
+            }
+        except Exception as e:
+            return {'error': str(e)}
     
-    def generate_prekey_bundle(self, identity_private_key: str, registration_id: int, device_id: int = 1) -> Dict:
+    def generate_signed_prekey(self, identity_private_key: str, signed_prekey_id: Optional[int] = None) -> Dict:
         """
-        生成预密钥包
+        生成签名预密钥（用身份私钥对预密钥公钥签名）
         """
-        script = f"""
-try {{
-    const identityPrivateKey = PrivateKey.deserialize(Buffer.from('{identity_private_key}', 'base64'));
-    const identityPublicKey = identityPrivateKey.getPublicKey();
-    
-    // 生成预密钥
-    const preKeyId = Math.floor(Math.random() * 16777215); // 24-bit
-    const preKeyPrivate = PrivateKey.generate();
-    const preKeyPublic = preKeyPrivate.getPublicKey();
+        identity = Ed25519PrivateKey.from_private_bytes(base64.b64decode(identity_private_key))
+        private_bytes, public_bytes = _x25519_keypair()
+        return {
+            'signed_prekey_id': signed_prekey_id if signed_prekey_id is not None else _random_key_id(),
+            'signed_prekey_public': _b64(public_bytes),
+            'signed_prekey_private': _b64(private_bytes),
+            'signed_prekey_signature': _b64(identity.sign(public_bytes))
+        }
     
-    // 生成签名预密钥
-    const signedPreKeyId = Math.floor(Math.random() * 16777215);
-    const signedPreKeyPrivate = PrivateKey.generate();
-    const signedPreKeyPublic = signedPreKeyPrivate.getPublicKey();
-    const signedPreKeySignature = identityPrivateKey.sign(signedPreKeyPublic.serialize());
-    
-    // 生成Kyber预密钥
-    const kyberPreKeyId = Math.floor(Math.random() * 16777215);
-    const kyberKeyPair = KEMKeyPair.generate();
-    const kyberPublicKey = kyberKeyPair.getPublicKey();
-    const kyberSignature = identityPrivateKey.sign(kyberPublicKey.serialize());
-    
-    const result = {{
-        registration_id: {registration_id},
-        device_id: {device_id},
-        prekey_id: preKeyId,
-        prekey_public: Buffer.from(preKeyPublic.serialize()).toString('base64'),
-        prekey_private: Buffer.from(preKeyPrivate.serialize()).toString('base64'),
-        signed_prekey_id: signedPreKeyId,
-        signed_prekey_public: Buffer.from(signedPreKeyPublic.serialize()).toString('base64'),
-        signed_prekey_private: Buffer.from(signedPreKeyPrivate.serialize()).toString('base64'),
-        signed_prekey_signature: Buffer.from(signedPreKeySignature).toString('base64'),
-        kyber_prekey_id: kyberPreKeyId,
-        kyber_public_key: Buffer.from(kyberPublicKey.serialize()).toString('base64'),
-        kyber_private_key: Buffer.from(kyberKeyPair.getSecretKey().serialize()).toString('base64'),
-        kyber_signature: Buffer.from(kyberSignature).toString('base64'),
-        identity_public_key: Buffer.from(identityPublicKey.serialize()).toString('base64')
-    }};
-    
-    console.log(JSON.stringify(result));
-}} catch (error) {{
-    console.log(JSON.stringify({{error: error.message}}));
-}}
-"""
-        return self._run_node_script(script)
+    def _generate_kyber_prekey(self, identity: Ed25519PrivateKey) -> Dict:
+        """通过Node辅助进程生成Kyber预密钥，libsignal不可用时返回空字段"""
+        empty = {
+            'kyber_prekey_id': None,
+            'kyber_public_key': None,
+            'kyber_private_key': None,
+            'kyber_signature': None
+        }
+        if not self.node_worker.available():
+            return empty
+        try:
+            keypair = self.node_worker.call('kyber_keypair')
+        except NodeWorkerError as e:
+            logger.warning("[加密服务] Kyber预密钥生成失败: %s", e)
+            return empty
+        return {
+            'kyber_prekey_id': _random_key_id(),
+            'kyber_public_key': keypair['public_key'],
+            'kyber_private_key': keypair['secret_key'],
+            'kyber_signature': _b64(identity.sign(base64.b64decode(keypair['public_key'])))
+        }
     
-    def encrypt_message(self, message: str, sender_identity_private: str, 
-                      recipient_prekey_bundle: Dict, sender_address: str, 
-                      recipient_address: str) -> Dict[str, str]:
+    def generate_prekey_bundle(self, identity_private_key: str, registration_id: int, device_id: int = 1) -> Dict:
         """
-        加密消息
+        生成预密钥包
         """
-        script = f"""
-try {{
-    const {{ ProtocolAddress, PreKeyBundle, SessionStore, IdentityKeyStore, 
-             PreKeyStore, SignedPreKeyStore, KyberPreKeyStore }} = require('{self.node_path}');
-    
-    // 简化的内存存储实现
-    class SimpleSessionStore {{
-        constructor() {{
-            this.sessions = new Map();
-        }}
-        
-        async loadSession(address) {{
-            const key = `${{address.name()}}:${{address.deviceId()}}`;
-            return this.sessions.get(key) || null;
-        }}
-        
-        async storeSession(address, record) {{
-            const key = `${{address.name()}}:${{address.deviceId()}}`;
-            this.sessions.set(key, record);
-        }}
-        
-        async getExistingSessions(addresses) {{
-            return addresses.map(addr => this.loadSession(addr)).filter(s => s !== null);
-        }}
-    }}
-    
-    class SimpleIdentityKeyStore {{
-        constructor(identityKeyPair) {{
-            this.identityKeyPair = identityKeyPair;
-            this.trustedKeys = new Map();
-        }}
-        
-        async getIdentityKeyPair() {{
-            return this.identityKeyPair;
-        }}
-        
-        async getLocalRegistrationId() {{
-            return {recipient_prekey_bundle.get('registration_id', 1)};
-        }}
-        
-        async saveIdentity(address, identityKey) {{
-            const key = `${{address.name()}}:${{address.deviceId()}}`;
-            this.trustedKeys.set(key, identityKey);
-            return true;
-        }}
-        
-        async isTrustedIdentity(address, identityKey, direction) {{
-            return true; // 简化实现
-        }}
-        
-        async getIdentity(address) {{
-            const key = `${{address.name()}}:${{address.deviceId()}}`;
-            return this.trustedKeys.get(key) || null;
-        }}
-    }}
-    
-    // 解析密钥
-    const senderPrivateKey = PrivateKey.deserialize(Buffer.from('{sender_identity_private}', 'base64'));
-    const senderPublicKey = senderPrivateKey.getPublicKey();
-    const senderIdentityKeyPair = new IdentityKeyPair(senderPublicKey, senderPrivateKey);
-    
-    // 创建存储
-    const sessionStore = new SimpleSessionStore();
-    const identityStore = new SimpleIdentityKeyStore(senderIdentityKeyPair);
-    
-    // 创建地址
-    const senderAddr = ProtocolAddress.new('{sender_address}', 1);
-    const recipientAddr = ProtocolAddress.new('{recipient_address}', 1);
-    
-    // 创建预密钥包
-    const bundle = PreKeyBundle.new(
-        {recipient_prekey_bundle.get('registration_id', 1)},
-        {recipient_prekey_bundle.get('device_id', 1)},
-        {recipient_prekey_bundle.get('prekey_id')},
-        PublicKey.deserialize(Buffer.from('{recipient_prekey_bundle.get('prekey_public')}', 'base64')),
-        {recipient_prekey_bundle.get('signed_prekey_id')},
-        PublicKey.deserialize(Buffer.from('{recipient_prekey_bundle.get('signed_prekey_public')}', 'base64')),
-        Buffer.from('{recipient_prekey_bundle.get('signed_prekey_signature')}', 'base64'),
-        PublicKey.deserialize(Buffer.from('{recipient_prekey_bundle.get('identity_public_key')}', 'base64')),
-        {recipient_prekey_bundle.get('kyber_prekey_id')},
-        KEMPublicKey.deserialize(Buffer.from('{recipient_prekey_bundle.get('kyber_public_key')}', 'base64')),
-        Buffer.from('{recipient_prekey_bundle.get('kyber_signature')}', 'base64')
-    );
-    
-    // 处理预密钥包建立会话
-    await processPreKeyBundle(bundle, recipientAddr, sessionStore, identityStore, UsePQRatchet.Yes);
-    
-    // 加密消息
-    const messageBytes = Buffer.from('{message}', 'utf8');
-    const ciphertext = await signalEncrypt(messageBytes, recipientAddr, sessionStore, identityStore);
-    
-    const result = {{
-        ciphertext: Buffer.from(ciphertext.serialize()).toString('base64'),
-        type: ciphertext.type()
-    }};
+        try:
+            identity = Ed25519PrivateKey.from_private_bytes(base64.b64decode(identity_private_key))
+            
+            # 生成预密钥
+            prekey_private, prekey_public = _x25519_keypair()
+            
+            bundle = {
+                'registration_id': registration_id,
+                'device_id': device_id,
+                'prekey_id': _random_key_id(),
+                'prekey_public': _b64(prekey_public),
+                'prekey_private': _b64(prekey_private),
+                'identity_public_key': _b64(identity.public_key().public_bytes_raw())
+            }
+            bundle.update(self.generate_signed_prekey(identity_private_key))
+            bundle.update(self._generate_kyber_prekey(identity))
+            return bundle
+        except Exception as e:
+            return {'error': str(e)}
     
-    console.log(JSON.stringify(result));
-}} catch (error) {{
-    console.log(JSON.stringify({{error: error.message, stack: error.stack}}));
-}}
-"""
-        return self._run_node_script(script)
+    def close(self) -> None:
+        """关闭Node辅助进程和批量解密线程池"""
+        self.node_worker.close()
+        with self._executor_lock:
+            executor, self._decrypt_executor = self._decrypt_executor, None
+        if executor is not None:
+            executor.shutdown(wait=False, cancel_futures=True)
     
+    def _session_cipher_params(self, user_id: int, other_user_id: int) -> Tuple[Optional[bytes], int, int, Optional[str]]:
+        """获取会话密钥及信封头中使用的密钥ID/版本"""
+        session_result = self.get_session_key(user_id, other_user_id)
+        if not session_result.get('success'):
+            return None, 0, 0, f'No session key found: {session_result.get("error")}'
+        return (
+            base64.b64decode(session_result['session_key']),
+            session_result['session_id'],
+            session_result.get('key_version') or 1,
+            None
+        )
+
+    @timed(crypto_op_seconds, 'encrypt', span=tracing.CRYPTO)
     def encrypt_message(self, sender_id: int, recipient_id: int, message: str) -> Dict:
         """
-        使用会话密钥加密消息
+        使用会话密钥加密消息（v2信封：AES-256-GCM）
         """
         try:
-            from cryptography.hazmat.primitives.ciphers import Cipher, algorithms, modes
-            from cryptography.hazmat.primitives import padding as sym_padding
-            import secrets
-            
-            # 获取会话密钥
-            session_result = self.get_session_key(sender_id, recipient_id)
-            if not session_result.get('success'):
-                return {'success': False, 'error': f'No session key found: {session_result.get("error")}'}
-            
-            session_key = base64.b64decode(session_result['session_key'])
-            
-            # 生成随机IV
-            iv = secrets.token_bytes(16)
-            
-            # 使用AES-256-CBC加密
-            cipher = Cipher(algorithms.AES(session_key), modes.CBC(iv))
-            encryptor = cipher.encryptor()
-            
-            # 对消息进行PKCS7填充
-            padder = sym_padding.PKCS7(128).padder()
-            padded_data = padder.update(message.encode('utf-8'))
-            padded_data += padder.finalize()
-            
-            # 加密
-            ciphertext = encryptor.update(padded_data) + encryptor.finalize()
-            
-            # 组合IV和密文，并进行base64编码
-            encrypted_data = iv + ciphertext
-            encrypted_message = base64.b64encode(encrypted_data).decode()
+            session_key, key_id, key_version, error = self._session_cipher_params(sender_id, recipient_id)
+            if session_key is None:
+                return {'success': False, 'error': error}
             
             return {
                 'success': True,
-                'encrypted_message': encrypted_message
+                'encrypted_message': message_envelope.encrypt_text(session_key, message, key_id, key_version)
             }
             
         except Exception as e:
+            crypto_failures.inc('encrypt')
             return {'success': False, 'error': str(e)}
     
+    @timed(crypto_op_seconds, 'decrypt', span=tracing.CRYPTO)
     def decrypt_message(self, recipient_id: int, sender_id: int, encrypted_message: str) -> Dict:
         """
-        使用会话密钥解密消息
+        使用会话密钥解密消息，同时兼容旧的AES-CBC密文
         """
         try:
-            from cryptography.hazmat.primitives.ciphers import Cipher, algorithms, modes
-            from cryptography.hazmat.primitives import padding as sym_padding
-            
-            # 获取会话密钥
-            session_result = self.get_session_key(recipient_id, sender_id)
-            if not session_result.get('success'):
-                return {'success': False, 'error': f'No session key found: {session_result.get("error")}'}
+            session_key, _, _, error = self._session_cipher_params(recipient_id, sender_id)
+            if session_key is None:
+                return {'success': False, 'error': error}
             
-            session_key = base64.b64decode(session_result['session_key'])
-            
-            # 解码base64
-            encrypted_data = base64.b64decode(encrypted_message)
-            
-            # 分离IV和密文
-            iv = encrypted_data[:16]
-            ciphertext = encrypted_data[16:]
+            return {
+                'success': True,
+                'decrypted_message': message_envelope.decrypt_text(session_key, encrypted_message)
+            }
             
-            # 使用AES-256-CBC解密
-            cipher = Cipher(algorithms.AES(session_key), modes.CBC(iv))
-            decryptor = cipher.decryptor()
+        except Exception as e:
+            crypto_failures.inc('decrypt')
+            return {'success': False, 'error': str(e)}
+    
+    @timed(crypto_op_seconds, 'encrypt_many', span=tracing.CRYPTO)
+    def encrypt_many(self, sender_id: int, recipient_id: int, messages: List[str]) -> Dict:
+        """
+        批量加密发给同一用户的消息，会话密钥只获取一次
+        """
+        try:
+            session_key, key_id, key_version, error = self._session_cipher_params(sender_id, recipient_id)
+            if session_key is None:
+                return {'success': False, 'error': error}
             
-            # 解密
-            padded_data = decryptor.update(ciphertext) + decryptor.finalize()
+            return {
+                'success': True,
+                'encrypted_messages': message_envelope.encrypt_many(session_key, messages, key_id, key_version)
+            }
             
-            # 去除PKCS7填充
-            unpadder = sym_padding.PKCS7(128).unpadder()
-            data = unpadder.update(padded_data)
-            data += unpadder.finalize()
+        except Exception as e:
+            return {'success': False, 'error': str(e)}
+    
+    @timed(crypto_op_seconds, 'decrypt_many', span=tracing.CRYPTO)
+    def decrypt_many(self, recipient_id: int, sender_id: int, encrypted_messages: List[str]) -> Dict:
+        """
+        批量解密同一发送者的消息，会话密钥只获取一次；单条失败时对应位置为None
+        """
+        try:
+            session_key, _, _, error = self._session_cipher_params(recipient_id, sender_id)
+            if session_key is None:
+                return {'success': False, 'error': error}
             
-            # 转换为字符串
-            decrypted_message = data.decode('utf-8')
+            decrypted = self._decrypt_with_key(session_key, list(encrypted_messages))
             
             return {
                 'success': True,
-                'decrypted_message': decrypted_message
+                'decrypted_messages': decrypted
             }
             
         except Exception as e:
             return {'success': False, 'error': str(e)}
     
+    def _get_decrypt_executor(self) -> ThreadPoolExecutor:
+        with self._executor_lock:
+            if self._decrypt_executor is None:
+                self._decrypt_executor = ThreadPoolExecutor(
+                    max_workers=DECRYPT_BATCH_WORKERS, thread_name_prefix="decrypt-batch"
+                )
+            return self._decrypt_executor
+
+    @staticmethod
+    def _decrypt_chunk(session_key: bytes, encrypted_messages: Sequence[str]) -> List[Optional[str]]:
+        decrypted = []
+        for encrypted_message in encrypted_messages:
+            try:
+                decrypted.append(message_envelope.decrypt_text(session_key, encrypted_message))
+            except Exception:
+                crypto_failures.inc('decrypt')
+                decrypted.append(None)
+        return decrypted
+
+    def _decrypt_with_key(self, session_key: bytes, encrypted_messages: Sequence[str]) -> List[Optional[str]]:
+        """用同一个会话密钥解密，条数超过阈值时分块交给线程池"""
+        count = len(encrypted_messages)
+        if not self.parallel_threshold or count <= self.parallel_threshold:
+            return self._decrypt_chunk(session_key, encrypted_messages)
+        chunk_size = max(self.parallel_threshold // 2, (count + DECRYPT_BATCH_WORKERS - 1) // DECRYPT_BATCH_WORKERS)
+        executor = self._get_decrypt_executor()
+        futures = [
+            executor.submit(self._decrypt_chunk, session_key, encrypted_messages[start:start + chunk_size])
+            for start in range(0, count, chunk_size)
+        ]
+        decrypted = []
+        for future in futures:
+            decrypted.extend(future.result())
+        return decrypted
+
+    @timed(crypto_op_seconds, 'decrypt_batch', span=tracing.CRYPTO)
+    def decrypt_batch(self, user_id: int, rows: Sequence, placeholder: Optional[str] = None) -> List[Optional[str]]:
+        """
+        批量解密一页消息（rows为Message记录），返回与rows一一对应的结果
+
+        按对方用户分组，每个会话的密钥只查询和解封一次，之后逐条做AES解密。
+        非端到端加密的消息原样返回content，解密失败的位置为placeholder。
+        """
+        results: List[Optional[str]] = [row.content for row in rows]
+        groups: Dict[int, List[int]] = {}
+        for index, row in enumerate(rows):
+            if row.encrypted and row.method == 'E2E':
+                peer_id = row.from_id if row.to_id == user_id else row.to_id
+                groups.setdefault(peer_id, []).append(index)
+
+        for peer_id, indexes in groups.items():
+            try:
+                session_key, _, _, error = self._session_cipher_params(user_id, peer_id)
+            except Exception as e:
+                session_key, error = None, str(e)
+            if session_key is None:
+                logger.warning("批量解密失败: 用户 %s 与 %s 的会话密钥不可用: %s", user_id, peer_id, error)
+                for index in indexes:
+                    results[index] = placeholder
+                continue
+            decrypted = self._decrypt_with_key(session_key, [rows[index].content for index in indexes])
+            for index, plaintext in zip(indexes, decrypted):
+                results[index] = plaintext if plaintext is not None else placeholder
+        return results
+    
     def setup_user_encryption(self, user_id: int) -> Dict:
         """
         为用户设置端到端加密
@@ -349,21 +338,16 @@ try {{
                     user.public_key = identity_keys['public_key']
                     db.commit()
                     
-                # 保存完整的密钥信息到文件（实际应用中应该使用安全存储）
-                keys_data = {
-                    'identity_private_key': identity_keys['private_key'],
-                    'identity_public_key': identity_keys['public_key'],
-                    'prekey_bundle': prekey_bundle,
-                    'registration_id': registration_id
-                }
-                
-                # 创建用户密钥目录
-                keys_dir = f"/Users/tsuki/Desktop/大二下/chat8/backend/user_keys"
-                os.makedirs(keys_dir, exist_ok=True)
-                
-                keys_file = os.path.join(keys_dir, f"user_{user_id}_keys.json")
-                with open(keys_file, 'w') as f:
-                    json.dump(keys_data, f, indent=2)
+                # 保存完整的密钥材料到数据库
+                key_material_store.put(KeyMaterial(
+                    user_id=user_id,
+                    identity_private_key=identity_keys['private_key'],
+                    identity_public_key=identity_keys['public_key'],
+                    registration_id=registration_id,
+                    prekey_bundle=prekey_bundle
+                ))
+                # 私钥已更换，之前解封的会话密钥不再对应当前密钥
+                self.invalidate_session_keys(user_id)
                 
                 return {
                     'success': True,
@@ -397,12 +381,8 @@ try {{
         获取用户的预密钥包（用于建立会话）
         """
         try:
-            keys_file = f"/Users/tsuki/Desktop/大二下/chat8/backend/user_keys/user_{user_id}_keys.json"
-            if os.path.exists(keys_file):
-                with open(keys_file, 'r') as f:
-                    keys_data = json.load(f)
-                return keys_data.get('prekey_bundle')
-            return None
+            material = key_material_store.get(user_id)
+            return material.prekey_bundle if material else None
         except Exception:
             return None
     
@@ -411,12 +391,8 @@ try {{
         加载用户的私钥
         """
         try:
-            keys_file = f"/Users/tsuki/Desktop/大二下/chat8/backend/user_keys/user_{user_id}_keys.json"
-            if os.path.exists(keys_file):
-                with open(keys_file, 'r') as f:
-                    keys_data = json.load(f)
-                return keys_data.get('identity_private_key')
-            return None
+            material = key_material_store.get(user_id)
+            return material.identity_private_key if material else None
         except Exception:
             return None
     
@@ -436,16 +412,10 @@ try {{
                 if not public_key:
                     return {'error': 'User has no public key'}
                 
-                # 从文件获取私钥和其他信息
-                keys_file = f"/Users/tsuki/Desktop/大二下/chat8/backend/user_keys/user_{user_id}_keys.json"
-                private_key = None
-                registration_id = None
-                
-                if os.path.exists(keys_file):
-                    with open(keys_file, 'r') as f:
-                        keys_data = json.load(f)
-                    private_key = keys_data.get('identity_private_key')
-                    registration_id = keys_data.get('registration_id')
+                # 从密钥仓库获取私钥和其他信息
+                material = key_material_store.get(user_id)
+                private_key = material.identity_private_key if material else None
+                registration_id = material.registration_id if material else None
                 
                 return {
                     'public_key': public_key,
@@ -460,102 +430,234 @@ try {{
         except Exception as e:
             return {'error': str(e)}
     
-    def establish_session(self, user1_id: int, user2_id: int) -> Dict:
+    @staticmethod
+    def _wrap_session_keys(jobs: List[Tuple[Tuple[int, int], object, object]]) -> List[Tuple[Tuple[int, int], bytes, bytes, bytes]]:
+        """为每个用户对生成会话密钥，并分别用双方公钥做RSA-OAEP加密"""
+        wrapped = []
+        for pair, public_key1, public_key2 in jobs:
+            session_key = secrets.token_bytes(32)
+            wrapped.append((
+                pair,
+                session_key,
+                public_key1.encrypt(session_key, _OAEP_PADDING),
+                public_key2.encrypt(session_key, _OAEP_PADDING)
+            ))
+        return wrapped
+
+    def _load_public_keys(self, db: Session, user_ids: List[int]) -> Tuple[Dict[int, object], Dict[int, str]]:
+        """一次查询加载多个用户的公钥，返回 (公钥对象, 错误原因)"""
+        public_keys: Dict[int, object] = {}
+        errors: Dict[int, str] = {user_id: 'User not found' for user_id in user_ids}
+        for start in range(0, len(user_ids), _IN_BATCH_SIZE):
+            batch = user_ids[start:start + _IN_BATCH_SIZE]
+            for user_id, public_key_pem in db.query(User.id, User.public_key).filter(User.id.in_(batch)):
+                if not public_key_pem:
+                    errors[user_id] = 'User public key not found'
+                    continue
+                try:
+                    public_keys[user_id] = serialization.load_pem_public_key(public_key_pem.encode())
+                    errors.pop(user_id)
+                except ValueError:
+                    errors[user_id] = 'Invalid user public key'
+        return public_keys, errors
+
+    def _existing_session_pairs(self, db: Session, pairs: List[Tuple[int, int]]) -> set:
+        existing = set()
+        wanted = set(pairs)
+        first_ids = sorted({pair[0] for pair in pairs})
+        for start in range(0, len(first_ids), _IN_BATCH_SIZE):
+            batch = first_ids[start:start + _IN_BATCH_SIZE]
+            rows = db.query(SessionKey.user1_id, SessionKey.user2_id).filter(SessionKey.user1_id.in_(batch))
+            existing.update(pair for pair in map(tuple, rows) if pair in wanted)
+        return existing
+
+    @timed(crypto_op_seconds, 'establish_sessions', span=tracing.CRYPTO)
+    def establish_sessions(self, pairs: Iterable[Tuple[int, int]]) -> Dict:
         """
-        为两个用户建立加密会话，生成对称会话密钥
+        批量为用户对建立加密会话
+
+        用户对按 (较小ID, 较大ID) 规范化并去重，已存在的会话跳过；
+        所有公钥一次查询加载，RSA加密按批分块交给CPU线程池并行执行，最后一次提交。
+        返回: {'success', 'created': {pair: {'session_key_id', 'session_key'}}, 'existing': [pair], 'failed': {pair: error}}
         """
+        canonical = list(dict.fromkeys(canonical_pair(a, b) for a, b in pairs if a != b))
+        result = {'success': True, 'created': {}, 'existing': [], 'failed': {}}
+        if not canonical:
+            return result
+
+        db: Session = SessionLocal()
         try:
-            from app.db.models import SessionKey
-            import secrets
-            from cryptography.hazmat.primitives import serialization, hashes
-            from cryptography.hazmat.primitives.asymmetric import rsa, padding
-            
-            db: Session = SessionLocal()
+            existing = self._existing_session_pairs(db, canonical)
+            result['existing'] = [pair for pair in canonical if pair in existing]
+            missing = [pair for pair in canonical if pair not in existing]
+            if not missing:
+                return result
+
+            user_ids = sorted({user_id for pair in missing for user_id in pair})
+            public_keys, key_errors = self._load_public_keys(db, user_ids)
+            jobs = []
+            for pair in missing:
+                error = key_errors.get(pair[0]) or key_errors.get(pair[1])
+                if error:
+                    result['failed'][pair] = error
+                else:
+                    jobs.append((pair, public_keys[pair[0]], public_keys[pair[1]]))
+
+            # 少量用户对直接在当前线程计算，较多时分块并行
+            if len(jobs) <= _SESSION_WRAP_CHUNK:
+                wrapped = self._wrap_session_keys(jobs)
+            else:
+                futures = [
+                    cpu_executor.submit("session_key_wrap", self._wrap_session_keys,
+                                        jobs[start:start + _SESSION_WRAP_CHUNK], admit=False)
+                    for start in range(0, len(jobs), _SESSION_WRAP_CHUNK)
+                ]
+                wrapped = [item for future in futures for item in future.result()]
+
+            records = {}
+            for pair, session_key, encrypted_for_user1, encrypted_for_user2 in wrapped:
+                records[pair] = (session_key, SessionKey(
+                    user1_id=pair[0],
+                    user2_id=pair[1],
+                    session_key_encrypted=_b64(encrypted_for_user1),
+                    session_key_encrypted_for_user2=_b64(encrypted_for_user2)
+                ))
+
             try:
-                # 检查是否已存在会话密钥
-                existing_session = db.query(SessionKey).filter(
-                    ((SessionKey.user1_id == user1_id) & (SessionKey.user2_id == user2_id)) |
-                    ((SessionKey.user1_id == user2_id) & (SessionKey.user2_id == user1_id))
-                ).first()
-                
-                if existing_session:
-                    return {'success': True, 'message': 'Session already exists'}
-                
-                # 获取两个用户的公钥
-                user1 = db.query(User).filter(User.id == user1_id).first()
-                user2 = db.query(User).filter(User.id == user2_id).first()
-                
-                if not user1 or not user2:
-                    return {'success': False, 'error': 'User not found'}
-                
-                if not user1.public_key or not user2.public_key:
-                    return {'success': False, 'error': 'User public key not found'}
-                
-                # 生成32字节的对称会话密钥
-                session_key = secrets.token_bytes(32)
-                session_key_b64 = base64.b64encode(session_key).decode()
-                
-                # 用用户1的公钥加密会话密钥
-                user1_public_key = serialization.load_pem_public_key(user1.public_key.encode())
-                encrypted_for_user1 = user1_public_key.encrypt(
-                    session_key,
-                    padding.OAEP(
-                        mgf=padding.MGF1(algorithm=hashes.SHA256()),
-                        algorithm=hashes.SHA256(),
-                        label=None
-                    )
-                )
-                
-                # 用用户2的公钥加密会话密钥
-                user2_public_key = serialization.load_pem_public_key(user2.public_key.encode())
-                encrypted_for_user2 = user2_public_key.encrypt(
-                    session_key,
-                    padding.OAEP(
-                        mgf=padding.MGF1(algorithm=hashes.SHA256()),
-                        algorithm=hashes.SHA256(),
-                        label=None
-                    )
-                )
-                
-                # 存储到数据库
-                session_key_record = SessionKey(
-                    user1_id=user1_id,
-                    user2_id=user2_id,
-                    session_key_encrypted=base64.b64encode(encrypted_for_user1).decode(),
-                    session_key_encrypted_for_user2=base64.b64encode(encrypted_for_user2).decode()
-                )
-                
-                db.add(session_key_record)
+                db.add_all(record for _, record in records.values())
                 db.commit()
-                
-                return {
-                    'success': True,
-                    'message': 'Session established successfully',
-                    'session_key_id': session_key_record.id,
-                    'session_key': session_key_b64  # 返回明文密钥供客户端使用
+                inserted = records
+            except IntegrityError:
+                # 并发建立了同一会话：逐条重试，冲突的视为已存在
+                db.rollback()
+                inserted = {}
+                for pair, (session_key, record) in records.items():
+                    record = SessionKey(
+                        user1_id=record.user1_id,
+                        user2_id=record.user2_id,
+                        session_key_encrypted=record.session_key_encrypted,
+                        session_key_encrypted_for_user2=record.session_key_encrypted_for_user2
+                    )
+                    try:
+                        db.add(record)
+                        db.commit()
+                        inserted[pair] = (session_key, record)
+                    except IntegrityError:
+                        db.rollback()
+                        result['existing'].append(pair)
+
+            for pair, (session_key, record) in inserted.items():
+                result['created'][pair] = {
+                    'session_key_id': record.id,
+                    'session_key': _b64(session_key)
                 }
-                
+            return result
+        except Exception as e:
+            db.rollback()
+            return {'success': False, 'error': str(e), 'created': {}, 'existing': [], 'failed': {}}
+        finally:
+            db.close()
+
+    def establish_session(self, user1_id: int, user2_id: int) -> Dict:
+        """
+        为两个用户建立加密会话，生成对称会话密钥
+        """
+        if user1_id == user2_id:
+            return {'success': False, 'error': 'Cannot establish session with self'}
+        pair = canonical_pair(user1_id, user2_id)
+        result = self.establish_sessions([pair])
+        if not result.get('success'):
+            return {'success': False, 'error': result.get('error')}
+        if pair in result['failed']:
+            return {'success': False, 'error': result['failed'][pair]}
+        if pair in result['created']:
+            return {
+                'success': True,
+                'message': 'Session established successfully',
+                **result['created'][pair]  # 返回明文密钥供客户端使用
+            }
+        return {'success': True, 'message': 'Session already exists'}
+
+    def backfill_friend_sessions(self, batch_size: int = 200) -> Dict:
+        """
+        为已有好友关系补建缺失的会话，按好友记录ID分批处理
+        返回: {'checked', 'created', 'failed'}
+        """
+        stats = {'checked': 0, 'created': 0, 'failed': 0}
+        last_id = 0
+        while True:
+            db: Session = SessionLocal()
+            try:
+                rows = db.query(Friend.id, Friend.user_id, Friend.friend_id).filter(
+                    Friend.id > last_id
+                ).order_by(Friend.id).limit(batch_size).all()
             finally:
                 db.close()
-                
-        except Exception as e:
-            return {'success': False, 'error': str(e)}
+            if not rows:
+                return stats
+            last_id = rows[-1].id
+
+            pairs = [(row.user_id, row.friend_id) for row in rows if row.user_id and row.friend_id]
+            result = self.establish_sessions(pairs)
+            if not result.get('success'):
+                raise RuntimeError(result.get('error'))
+            stats['checked'] += len(pairs)
+            stats['created'] += len(result['created'])
+            stats['failed'] += len(result['failed'])
+            for pair, error in result['failed'].items():
+                logger.warning("补建会话失败 %s: %s", pair, error)
     
+    def invalidate_session_keys(self, user_id: int) -> None:
+        """清除用户已缓存的会话密钥"""
+        with self._session_key_lock:
+            for cache_key in [cache_key for cache_key in self._session_key_cache if cache_key[0] == user_id]:
+                del self._session_key_cache[cache_key]
+
+    def session_key_cache_size(self) -> int:
+        with self._session_key_lock:
+            return len(self._session_key_cache)
+
+    def warm_session_keys(self, pairs: Iterable[Tuple[int, int]]) -> int:
+        """预先解封用户对双方的会话密钥，返回成功缓存的数量"""
+        warmed = 0
+        for user_a, user_b in pairs:
+            for user_id, other_user_id in ((user_a, user_b), (user_b, user_a)):
+                if self.get_session_key(user_id, other_user_id).get('success'):
+                    warmed += 1
+        return warmed
+
     def get_session_key(self, user_id: int, other_user_id: int) -> Dict:
         """
-        获取与指定用户的会话密钥
+        获取与指定用户的会话密钥（解封结果按用户对缓存）
         """
+        cache_key = (user_id, other_user_id)
+        with self._session_key_lock:
+            cached = self._session_key_cache.get(cache_key)
+            if cached is not None:
+                self._session_key_cache.move_to_end(cache_key)
+                session_key_cache_lookups.inc('hit')
+                return dict(cached)
+        session_key_cache_lookups.inc('miss')
+
+        result = self._load_session_key(user_id, other_user_id)
+        if result.get('success'):
+            with self._session_key_lock:
+                self._session_key_cache[cache_key] = result
+                while len(self._session_key_cache) > SESSION_KEY_CACHE_SIZE:
+                    self._session_key_cache.popitem(last=False)
+            return dict(result)
+        return result
+
+    @timed(crypto_op_seconds, 'session_key_unwrap', span=tracing.CRYPTO)
+    def _load_session_key(self, user_id: int, other_user_id: int) -> Dict:
         try:
-            from app.db.models import SessionKey
-            from cryptography.hazmat.primitives import serialization, hashes
-            from cryptography.hazmat.primitives.asymmetric import padding
-            
             db: Session = SessionLocal()
             try:
-                # 查找会话密钥记录
+                # 查找会话密钥记录（按规范化的用户对命中唯一索引）
+                user1_id, user2_id = canonical_pair(user_id, other_user_id)
                 session_record = db.query(SessionKey).filter(
-                    ((SessionKey.user1_id == user_id) & (SessionKey.user2_id == other_user_id)) |
-                    ((SessionKey.user1_id == other_user_id) & (SessionKey.user2_id == user_id))
+                    SessionKey.user1_id == user1_id,
+                    SessionKey.user2_id == user2_id
                 ).first()
                 
                 if not session_record:
@@ -576,19 +678,13 @@ try {{
                     encrypted_session_key = base64.b64decode(session_record.session_key_encrypted_for_user2)
                 
                 # 解密会话密钥
-                session_key = private_key_obj.decrypt(
-                    encrypted_session_key,
-                    padding.OAEP(
-                        mgf=padding.MGF1(algorithm=hashes.SHA256()),
-                        algorithm=hashes.SHA256(),
-                        label=None
-                    )
-                )
+                session_key = private_key_obj.decrypt(encrypted_session_key, _OAEP_PADDING)
                 
                 return {
                     'success': True,
                     'session_key': base64.b64encode(session_key).decode(),
-                    'session_id': session_record.id
+                    'session_id': session_record.id,
+                    'key_version': session_record.key_version
                 }
                 
             finally:
@@ -598,4 +694,5 @@ try {{
             return {'success': False, 'error': str(e)}
 
 # 全局加密服务实例
-encryption_service = EncryptionService()
\ No newline at end of file
+encryption_service = EncryptionService()
+metrics.register_stats('session_key_cache', lambda: {"size": encryption_service.session_key_cache_size()})
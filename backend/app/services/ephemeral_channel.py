@@ -0,0 +1,146 @@
+import asyncio
+import logging
+import time
+from typing import Dict, Optional, Tuple
+from app.core.config import (
+    TYPING_MIN_INTERVAL_MS, SCREENSHOT_MIN_INTERVAL_MS, PRESENCE_MIN_INTERVAL_MS, EPHEMERAL_IDLE_TTL
+)
+from app.core.metrics import metrics
+
+logger = logging.getLogger(__name__)
+
+TYPING = 'typing'
+SCREENSHOT = 'screenshot'
+PRESENCE = 'presence'
+
+ephemeral_events_total = metrics.counter('ephemeral_events_total', '临时事件的处理结果', ('kind', 'result'))
+
+
+class _Throttle:
+    __slots__ = ('last_sent', 'pending', 'timer')
+
+    def __init__(self):
+        self.last_sent = 0.0
+        self.pending: Optional[str] = None
+        self.timer: Optional[asyncio.TimerHandle] = None
+
+
+class EphemeralChannel:
+    """临时事件通道（正在输入、截屏提醒、在线状态）
+
+    这类事件只有最新状态有意义，丢了也不需要补发：
+    - 按 (发送方, 接收方, 类型) 节流，两次推送至少间隔该类型的最短间隔
+    - 间隔内的新事件只保留最后一条，间隔结束时推送（trailing edge），中间状态直接丢弃
+    - 推送走连接的低优先级队列（MeteredWebSocket.send_ephemeral），不占用聊天消息的发送机会
+    - 接收方不在线时直接丢弃，不排队、不持久化
+    所有方法都在事件循环线程中调用，publish 不等待发送完成。
+    """
+
+    def __init__(self, intervals_ms: Optional[Dict[str, int]] = None, idle_ttl: int = EPHEMERAL_IDLE_TTL):
+        intervals_ms = intervals_ms or {
+            TYPING: TYPING_MIN_INTERVAL_MS,
+            SCREENSHOT: SCREENSHOT_MIN_INTERVAL_MS,
+            PRESENCE: PRESENCE_MIN_INTERVAL_MS
+        }
+        self.intervals = {kind: ms / 1000 for kind, ms in intervals_ms.items()}
+        self.idle_ttl = idle_ttl
+        self.connection_manager = None
+        self._throttles: Dict[Tuple[int, int, str], _Throttle] = {}
+        self._gc_task: Optional[asyncio.Task] = None
+
+    def attach(self, connection_manager) -> None:
+        """关联WebSocket连接管理器"""
+        self.connection_manager = connection_manager
+
+    def publish(self, from_user_id: int, to_user_id: int, kind: str, frame: str) -> str:
+        """发布一条临时事件，返回 'sent'、'deferred'（等待节流窗口结束）、'coalesced'（替换了等待中的事件）或 'offline'"""
+        ws = self.connection_manager.get(to_user_id) if self.connection_manager else None
+        if ws is None:
+            ephemeral_events_total.inc(kind, 'offline')
+            return 'offline'
+
+        key = (from_user_id, to_user_id, kind)
+        state = self._throttles.get(key)
+        if state is None:
+            state = self._throttles[key] = _Throttle()
+        now = time.monotonic()
+        wait = self.intervals.get(kind, 0) - (now - state.last_sent)
+        if state.timer is None and wait <= 0:
+            state.last_sent = now
+            self._deliver(ws, key, frame)
+            return 'sent'
+
+        result = 'coalesced' if state.pending is not None else 'deferred'
+        state.pending = frame
+        if state.timer is None:
+            state.timer = asyncio.get_running_loop().call_later(wait, self._flush, key)
+        ephemeral_events_total.inc(kind, result)
+        return result
+
+    def _deliver(self, ws, key: Tuple[int, int, str], frame: str) -> None:
+        from_user_id, _, kind = key
+        # 接收方连接上同一发送方同一类型的事件也只保留最新一帧
+        ws.send_ephemeral((from_user_id, kind), frame)
+        ephemeral_events_total.inc(kind, 'sent')
+
+    def _flush(self, key: Tuple[int, int, str]) -> None:
+        state = self._throttles.get(key)
+        if state is None:
+            return
+        state.timer = None
+        frame, state.pending = state.pending, None
+        if frame is None:
+            return
+        ws = self.connection_manager.get(key[1]) if self.connection_manager else None
+        if ws is None:
+            ephemeral_events_total.inc(key[2], 'offline')
+            return
+        state.last_sent = time.monotonic()
+        self._deliver(ws, key, frame)
+
+    def purge_idle(self) -> int:
+        """清理闲置的节流状态，返回清理的条数"""
+        cutoff = time.monotonic() - self.idle_ttl
+        idle = [key for key, state in self._throttles.items() if state.timer is None and state.last_sent < cutoff]
+        for key in idle:
+            del self._throttles[key]
+        return len(idle)
+
+    async def _gc_loop(self):
+        while True:
+            await asyncio.sleep(self.idle_ttl)
+            try:
+                self.purge_idle()
+            except Exception as e:
+                logger.error("[临时事件] 清理节流状态失败: %s", e)
+
+    async def start_gc(self):
+        """启动闲置节流状态清理任务"""
+        if self._gc_task is None:
+            self._gc_task = asyncio.create_task(self._gc_loop())
+
+    async def stop_gc(self):
+        """停止清理任务并取消等待中的推送"""
+        if self._gc_task is not None:
+            self._gc_task.cancel()
+            try:
+                await self._gc_task
+            except asyncio.CancelledError:
+                pass
+            self._gc_task = None
+        for state in self._throttles.values():
+            if state.timer is not None:
+                state.timer.cancel()
+        self._throttles.clear()
+
+    def stats(self) -> dict:
+        return {
+            "throttles": len(self._throttles),
+            "pending": sum(1 for state in self._throttles.values() if state.pending is not None),
+            "intervals_ms": {kind: interval * 1000 for kind, interval in self.intervals.items()}
+        }
+
+
+# 全局临时事件通道
+ephemeral_channel = EphemeralChannel()
+metrics.register_stats('ephemeral_channel', ephemeral_channel.stats)
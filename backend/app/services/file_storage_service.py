@@ -0,0 +1,167 @@
+import hashlib
+import os
+import uuid
+from dataclasses import dataclass
+from typing import AsyncIterator, Optional
+from fastapi import HTTPException, UploadFile
+from starlette.concurrency import run_in_threadpool
+from app.core import tracing
+from app.core.config import UPLOAD_CHUNK_SIZE, IMAGE_MAX_SIZE, FILE_MAX_SIZE
+
+# 图片和文件存储目录（backend/app/static 下）
+BASE_DIR = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+IMAGE_UPLOAD_DIR = os.path.join(BASE_DIR, "static", "images")
+FILE_UPLOAD_DIR = os.path.join(BASE_DIR, "static", "files")
+os.makedirs(IMAGE_UPLOAD_DIR, exist_ok=True)
+os.makedirs(FILE_UPLOAD_DIR, exist_ok=True)
+
+ALLOWED_IMAGE_TYPES = ['image/jpeg', 'image/jpg', 'image/png', 'image/gif', 'image/webp']
+ALLOWED_IMAGE_EXTENSIONS = ['.jpg', '.jpeg', '.png', '.gif', '.webp']
+# 禁止上传可执行文件和脚本文件
+FORBIDDEN_FILE_EXTENSIONS = ['.exe', '.bat', '.cmd', '.sh', '.php', '.asp', '.aspx', '.js', '.vbs', '.ps1']
+
+
+@dataclass
+class StoredFile:
+    """流式保存结果"""
+    path: str
+    size: int
+    sha256: str
+
+
+def validate_upload(file_name: str, file_type: str, content_type: Optional[str]) -> str:
+    """校验上传文件名和类型，返回小写扩展名"""
+    file_extension = os.path.splitext(file_name)[1].lower()
+
+    if file_type == "image":
+        # 验证图片文件类型
+        if not content_type or content_type not in ALLOWED_IMAGE_TYPES:
+            raise HTTPException(status_code=400, detail="只支持 JPEG、PNG、GIF、WebP 格式的图片文件")
+
+        # 验证图片文件扩展名
+        if file_extension not in ALLOWED_IMAGE_EXTENSIONS:
+            raise HTTPException(status_code=400, detail="文件扩展名不支持")
+    else:
+        if file_extension in FORBIDDEN_FILE_EXTENSIONS:
+            raise HTTPException(status_code=400, detail="不允许上传可执行文件或脚本文件")
+
+    return file_extension
+
+
+def max_upload_size(file_type: str) -> int:
+    """根据文件类型返回大小限制"""
+    return IMAGE_MAX_SIZE if file_type == "image" else FILE_MAX_SIZE
+
+
+@tracing.traced(tracing.FILE_IO)
+def _write_chunk(fh, hasher, chunk: bytes) -> None:
+    """在线程池中写入并哈希一个数据块（hashlib和文件写入都会释放GIL）"""
+    hasher.update(chunk)
+    fh.write(chunk)
+
+
+@tracing.traced(tracing.FILE_IO)
+def _finish_file(fh) -> None:
+    """刷盘并关闭临时文件"""
+    fh.flush()
+    os.fsync(fh.fileno())
+    fh.close()
+
+
+def _discard_file(fh, tmp_path: str) -> None:
+    """关闭并删除未完成的临时文件"""
+    try:
+        fh.close()
+    except Exception:
+        pass
+    remove_file_quietly(tmp_path)
+
+
+def size_limit_detail(max_size: int) -> str:
+    return f"文件大小不能超过{max_size // (1024 * 1024)}MB"
+
+
+def temp_path_for(dest_path: str) -> str:
+    """目标文件同目录下的临时文件名，保证os.replace是原子操作"""
+    return f"{dest_path}.{uuid.uuid4().hex}.part"
+
+
+async def save_stream(
+    stream: AsyncIterator[bytes],
+    dest_path: str,
+    max_size: int,
+    empty_detail: str = "文件内容为空"
+) -> StoredFile:
+    """把异步字节流保存到磁盘
+
+    边读边校验大小（超限立即中止）、边计算SHA-256，通过线程池写入临时文件，
+    全部成功后原子重命名为目标文件。任何失败都会删除临时文件，
+    目标路径上不会留下半截文件。
+    """
+    os.makedirs(os.path.dirname(dest_path), exist_ok=True)
+    tmp_path = temp_path_for(dest_path)
+    hasher = hashlib.sha256()
+    size = 0
+
+    fh = await run_in_threadpool(open, tmp_path, "wb")
+    try:
+        async for chunk in stream:
+            if not chunk:
+                continue
+            size += len(chunk)
+            if size > max_size:
+                raise HTTPException(status_code=400, detail=size_limit_detail(max_size))
+            await run_in_threadpool(_write_chunk, fh, hasher, chunk)
+
+        if size == 0:
+            raise HTTPException(status_code=400, detail=empty_detail)
+
+        await run_in_threadpool(_finish_file, fh)
+        os.replace(tmp_path, dest_path)
+    except BaseException:
+        await run_in_threadpool(_discard_file, fh, tmp_path)
+        raise
+
+    return StoredFile(path=dest_path, size=size, sha256=hasher.hexdigest())
+
+
+async def _iter_upload(file: UploadFile, chunk_size: int) -> AsyncIterator[bytes]:
+    while True:
+        chunk = await file.read(chunk_size)
+        if not chunk:
+            return
+        yield chunk
+
+
+async def save_upload_stream(
+    file: UploadFile,
+    dest_path: str,
+    max_size: int,
+    chunk_size: int = UPLOAD_CHUNK_SIZE
+) -> StoredFile:
+    """流式保存上传文件
+
+    按固定大小分块读取上传内容并交给save_stream落盘。
+
+    Args:
+        file: 上传文件
+        dest_path: 目标文件绝对路径
+        max_size: 允许的最大字节数
+        chunk_size: 每次读取的块大小
+
+    Returns:
+        StoredFile: 最终路径、文件大小和十六进制SHA-256
+    """
+    # 客户端声明了大小时直接拒绝，无需读取任何内容
+    if file.size is not None and file.size > max_size:
+        raise HTTPException(status_code=400, detail=size_limit_detail(max_size))
+
+    return await save_stream(_iter_upload(file, chunk_size), dest_path, max_size)
+
+
+def remove_file_quietly(path: str) -> None:
+    """删除文件，忽略不存在等错误"""
+    try:
+        os.remove(path)
+    except OSError:
+        pass
@@ -0,0 +1,78 @@
+import threading
+from collections import OrderedDict
+from typing import Dict, Iterable, List, Tuple
+from sqlalchemy.orm import Session
+from app.core.config import FRIEND_GRAPH_CACHE_SIZE
+from app.core.metrics import metrics
+from app.db.models import Friend
+
+_IN_BATCH_SIZE = 500
+
+
+class FriendGraphCache:
+    """好友关系缓存（用户ID -> 好友ID列表）
+
+    上线、下线和心跳超时都要查询好友列表来广播状态，这里按用户LRU缓存。
+    好友关系只在friend_service中增删，修改并提交后调用invalidate()清除双方的缓存。
+    """
+
+    def __init__(self, max_users: int = FRIEND_GRAPH_CACHE_SIZE):
+        self.max_users = max_users
+        self._friends: "OrderedDict[int, Tuple[int, ...]]" = OrderedDict()
+        self._lock = threading.Lock()
+        self.hits = 0
+        self.misses = 0
+
+    def _remember(self, user_id: int, friend_ids: Tuple[int, ...]) -> None:
+        self._friends[user_id] = friend_ids
+        self._friends.move_to_end(user_id)
+        while len(self._friends) > self.max_users:
+            self._friends.popitem(last=False)
+
+    def get_friend_ids(self, db: Session, user_id: int) -> List[int]:
+        with self._lock:
+            friend_ids = self._friends.get(user_id)
+            if friend_ids is not None:
+                self._friends.move_to_end(user_id)
+                self.hits += 1
+                return list(friend_ids)
+            self.misses += 1
+
+        friend_ids = tuple(row.friend_id for row in db.query(Friend.friend_id).filter(Friend.user_id == user_id))
+        with self._lock:
+            self._remember(user_id, friend_ids)
+        return list(friend_ids)
+
+    def warm(self, db: Session, user_ids: Iterable[int]) -> int:
+        """批量加载多个用户的好友列表，返回加载的用户数"""
+        user_ids = list(dict.fromkeys(user_ids))
+        loaded: Dict[int, List[int]] = {user_id: [] for user_id in user_ids}
+        for start in range(0, len(user_ids), _IN_BATCH_SIZE):
+            batch = user_ids[start:start + _IN_BATCH_SIZE]
+            for row in db.query(Friend.user_id, Friend.friend_id).filter(Friend.user_id.in_(batch)):
+                loaded[row.user_id].append(row.friend_id)
+        with self._lock:
+            for user_id, friend_ids in loaded.items():
+                self._remember(user_id, tuple(friend_ids))
+        return len(loaded)
+
+    def invalidate(self, *user_ids: int) -> None:
+        with self._lock:
+            for user_id in user_ids:
+                self._friends.pop(user_id, None)
+
+    def stats(self) -> dict:
+        with self._lock:
+            lookups = self.hits + self.misses
+            return {
+                "users": len(self._friends),
+                "max_users": self.max_users,
+                "hits": self.hits,
+                "misses": self.misses,
+                "hit_rate": round(self.hits / lookups, 4) if lookups else 0.0
+            }
+
+
+# 全局好友关系缓存
+friend_graph = FriendGraphCache()
+metrics.register_stats('friend_graph', friend_graph.stats)
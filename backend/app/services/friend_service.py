@@ -1,12 +1,15 @@
-from sqlalchemy.orm import Session
+import logging
+from sqlalchemy.orm import Session, joinedload
 from app.db import models
 from datetime import datetime
 from sqlalchemy import or_
 from app.services.encryption_service import encryption_service
+from app.services.friend_graph import friend_graph
+
+logger = logging.getLogger(__name__)
 
 def get_friends(db: Session, user_id: int, page: int = 1, limit: int = 50):
     # 使用关联查询获取好友信息
-    from sqlalchemy.orm import joinedload
     query = db.query(models.Friend).options(joinedload(models.Friend.friend_user)).filter(models.Friend.user_id == user_id)
     total = query.count()
     friends = query.offset((page-1)*limit).limit(limit).all()
@@ -57,6 +60,7 @@ def add_friend(db: Session, user_id: int, friend_id: int):
     db.add(friend)
     db.commit()
     db.refresh(friend)
+    friend_graph.invalidate(user_id)
     return friend
 
 def remove_friend(db: Session, user_id: int, friend_id: int):
@@ -86,6 +90,7 @@ def remove_friend(db: Session, user_id: int, friend_id: int):
     
     if deleted:
         db.commit()
+        friend_graph.invalidate(user_id, friend_id)
         return True
     return False
 
@@ -149,14 +154,14 @@ def send_friend_request(db: Session, from_user_id: int, to_user_id: int, message
 def get_friend_requests(db: Session, user_id: int, request_type: str = 'received'):
     """获取好友申请列表"""
     if request_type == 'received':
-        # 获取收到的申请
-        requests = db.query(models.FriendRequest).filter(
+        # 获取收到的申请（同时加载申请人信息，避免逐条查询）
+        requests = db.query(models.FriendRequest).options(joinedload(models.FriendRequest.from_user)).filter(
             models.FriendRequest.to_user_id == user_id,
             models.FriendRequest.status == 'pending'
         ).all()
     elif request_type == 'sent':
         # 获取发送的申请
-        requests = db.query(models.FriendRequest).filter(
+        requests = db.query(models.FriendRequest).options(joinedload(models.FriendRequest.from_user)).filter(
             models.FriendRequest.from_user_id == user_id,
             models.FriendRequest.status == 'pending'
         ).all()
@@ -206,12 +211,11 @@ def handle_friend_request(db: Session, request_id: int, user_id: int, action: st
         db.add(friend2)
         friend_request.status = 'accepted'
         
-        # 为双方建立加密会话
+        # 为双方建立加密会话（会话对双方共用，只需建立一次）
         try:
             encryption_service.establish_session(friend_request.from_user_id, friend_request.to_user_id)
-            encryption_service.establish_session(friend_request.to_user_id, friend_request.from_user_id)
         except Exception as e:
-            print(f"Warning: Failed to establish encryption session: {e}")
+            logger.warning("[好友] 建立加密会话失败: %s", e, extra={"sample": "friend_session_failed"})
     elif action == 'reject':
         # 拒绝申请
         friend_request.status = 'rejected'
@@ -220,4 +224,6 @@ def handle_friend_request(db: Session, request_id: int, user_id: int, action: st
     
     friend_request.updated_at = datetime.utcnow()
     db.commit()
+    if action == 'accept':
+        friend_graph.invalidate(friend_request.from_user_id, friend_request.to_user_id)
     return friend_request
\ No newline at end of file
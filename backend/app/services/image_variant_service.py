@@ -0,0 +1,243 @@
+import asyncio
+import glob
+import logging
+import os
+import threading
+import uuid
+from collections import OrderedDict
+from concurrent.futures import ThreadPoolExecutor
+from typing import Dict, Optional, Tuple
+from PIL import Image, ImageOps
+from app.core import tracing
+from app.core.config import (
+    IMAGE_VARIANT_WIDTHS, IMAGE_VARIANT_QUALITY, IMAGE_VARIANT_WORKERS, IMAGE_PLACEHOLDER_WIDTH
+)
+from app.services.file_storage_service import remove_file_quietly
+
+logger = logging.getLogger(__name__)
+
+VARIANT_FORMATS = {"webp": "WEBP", "jpg": "JPEG"}
+PLACEHOLDER_SUFFIX = ".lqip.webp"
+# 记录原图宽度的条目上限（原图不比目标宽度大时直接返回原图）
+_WIDTH_CACHE_SIZE = 4096
+
+
+def variant_path(source_path: str, width: int, fmt: str) -> str:
+    """缩略图与原图放在同一目录：<原图>.w320.webp"""
+    return f"{source_path}.w{width}.{fmt}"
+
+
+def placeholder_path(source_path: str) -> str:
+    return f"{source_path}{PLACEHOLDER_SUFFIX}"
+
+
+def remove_variants(source_path: str) -> None:
+    """删除原图的所有缩略图和占位图"""
+    for path in glob.glob(glob.escape(source_path) + ".w*.*") + [placeholder_path(source_path)]:
+        remove_file_quietly(path)
+
+
+def nearest_width(requested: int) -> Optional[int]:
+    """不小于请求宽度的最小预设宽度，超过最大预设时返回None（使用原图）"""
+    for width in sorted(IMAGE_VARIANT_WIDTHS):
+        if width >= requested:
+            return width
+    return None
+
+
+# EXIF方向为5-8时图片需要旋转90度，显示宽度是存储的高度
+_ROTATED_ORIENTATIONS = (5, 6, 7, 8)
+
+
+def _open_image(source_path: str, width: int) -> Tuple[Optional[Image.Image], int]:
+    """打开原图并按EXIF方向摆正，返回 (图片, 原图显示宽度)；动图返回 (None, 0)（缩放会丢失动画）
+
+    JPEG会按目标宽度缩小解码，返回的图片可能比原图小，原图宽度要在缩小之前读取。
+    """
+    img = Image.open(source_path)
+    if getattr(img, "is_animated", False):
+        img.close()
+        return None, 0
+    source_width, source_height = img.size
+    if img.getexif().get(0x0112) in _ROTATED_ORIENTATIONS:
+        source_width = source_height
+    # JPEG可以在解码时直接按比例缩小，大图省去大部分解码开销
+    img.draft("RGB", (width, width * 4))
+    transposed = ImageOps.exif_transpose(img)
+    if transposed is not img:
+        img.close()
+    return transposed, source_width
+
+
+def _encode(img: Image.Image, dest_path: str, fmt: str, quality: int) -> None:
+    """编码到同目录临时文件后原子替换，避免读到半截文件"""
+    if fmt == "jpg":
+        if img.mode in ("RGBA", "LA", "P"):
+            rgba = img.convert("RGBA")
+            background = Image.new("RGB", rgba.size, (255, 255, 255))
+            background.paste(rgba, mask=rgba.getchannel("A"))
+            img = background
+        elif img.mode != "RGB":
+            img = img.convert("RGB")
+    elif img.mode not in ("RGB", "RGBA"):
+        img = img.convert("RGBA" if "A" in img.getbands() or img.mode == "P" else "RGB")
+
+    tmp_path = f"{dest_path}.{uuid.uuid4().hex}.part"
+    try:
+        if fmt == "webp":
+            img.save(tmp_path, "WEBP", quality=quality, method=4)
+        else:
+            img.save(tmp_path, "JPEG", quality=quality, optimize=True, progressive=True)
+        os.replace(tmp_path, dest_path)
+    except BaseException:
+        remove_file_quietly(tmp_path)
+        raise
+
+
+def _resized(img: Image.Image, width: int) -> Image.Image:
+    height = max(1, round(img.height * width / img.width))
+    return img.resize((width, height), Image.LANCZOS, reducing_gap=3.0)
+
+
+class ImageVariantService:
+    """聊天图片的缩略图和模糊占位图
+
+    上传后在线程池中预生成各预设宽度的WebP/JPEG缩略图和一张极小的占位图（LQIP），
+    与原图放在同一目录；请求时按 ?w= 选择不小于该宽度的最近预设，缺失时再生成并缓存。
+    Pillow的解码、缩放和编码会释放GIL，线程池即可并行且不阻塞事件循环。
+    """
+
+    def __init__(self, workers: int = IMAGE_VARIANT_WORKERS):
+        self._workers = workers
+        self._executor: Optional[ThreadPoolExecutor] = None
+        self._executor_lock = threading.Lock()
+        # 同一缩略图只生成一次，并发请求等待同一个任务
+        self._inflight: Dict[str, asyncio.Future] = {}
+        self._widths: "OrderedDict[str, int]" = OrderedDict()
+        self._widths_lock = threading.Lock()
+
+    def _get_executor(self) -> ThreadPoolExecutor:
+        with self._executor_lock:
+            if self._executor is None:
+                self._executor = ThreadPoolExecutor(max_workers=self._workers, thread_name_prefix="image-variant")
+            return self._executor
+
+    def _remember_width(self, source_path: str, width: int) -> None:
+        with self._widths_lock:
+            self._widths[source_path] = width
+            self._widths.move_to_end(source_path)
+            while len(self._widths) > _WIDTH_CACHE_SIZE:
+                self._widths.popitem(last=False)
+
+    def _known_width(self, source_path: str) -> Optional[int]:
+        with self._widths_lock:
+            return self._widths.get(source_path)
+
+    def generate_variant(self, source_path: str, width: int, fmt: str) -> Optional[str]:
+        """生成一张缩略图，原图不比目标宽或为动图时返回None（应直接使用原图）"""
+        dest_path = variant_path(source_path, width, fmt)
+        if os.path.isfile(dest_path):
+            return dest_path
+        img, source_width = _open_image(source_path, width)
+        if img is None:
+            self._remember_width(source_path, 0)
+            return None
+        with img:
+            self._remember_width(source_path, source_width)
+            if source_width <= width:
+                return None
+            _encode(_resized(img, width), dest_path, fmt, IMAGE_VARIANT_QUALITY)
+        return dest_path
+
+    def generate_all(self, source_path: str) -> None:
+        """一次解码生成所有预设宽度的缩略图和占位图"""
+        widths = sorted(IMAGE_VARIANT_WIDTHS, reverse=True)
+        img, source_width = _open_image(source_path, widths[0] if widths else IMAGE_PLACEHOLDER_WIDTH)
+        if img is None:
+            self._remember_width(source_path, 0)
+            return
+        with img:
+            self._remember_width(source_path, source_width)
+            # 从大到小逐级缩放，每一级都基于上一级结果，减少重复计算
+            current = img
+            for width in widths:
+                if current.width <= width:
+                    continue
+                current = _resized(current, width)
+                for fmt in VARIANT_FORMATS:
+                    dest_path = variant_path(source_path, width, fmt)
+                    if not os.path.isfile(dest_path):
+                        _encode(current, dest_path, fmt, IMAGE_VARIANT_QUALITY)
+            placeholder = placeholder_path(source_path)
+            if not os.path.isfile(placeholder):
+                _encode(_resized(current, min(IMAGE_PLACEHOLDER_WIDTH, current.width)), placeholder, "webp", 30)
+
+    def generate_placeholder(self, source_path: str) -> Optional[str]:
+        dest_path = placeholder_path(source_path)
+        if os.path.isfile(dest_path):
+            return dest_path
+        img, _ = _open_image(source_path, IMAGE_PLACEHOLDER_WIDTH)
+        if img is None:
+            return None
+        with img:
+            _encode(_resized(img, min(IMAGE_PLACEHOLDER_WIDTH, img.width)), dest_path, "webp", 30)
+        return dest_path
+
+    def schedule(self, source_path: str) -> None:
+        """上传完成后在后台预生成缩略图，不等待结果"""
+        future = self._get_executor().submit(self.generate_all, source_path)
+
+        def _log_error(f):
+            if not f.cancelled() and f.exception() is not None:
+                logger.warning("[缩略图] 预生成失败 %s: %s", source_path, f.exception())
+
+        future.add_done_callback(_log_error)
+
+    async def _run_once(self, key: str, func, *args) -> Optional[str]:
+        future = self._inflight.get(key)
+        if future is None:
+            loop = asyncio.get_running_loop()
+            future = loop.run_in_executor(self._get_executor(), func, *args)
+            self._inflight[key] = future
+            future.add_done_callback(lambda _: self._inflight.pop(key, None))
+        return await asyncio.shield(future)
+
+    async def get_variant(self, source_path: str, requested_width: int, fmt: str) -> Optional[str]:
+        """返回最接近请求宽度的缩略图路径，应使用原图时返回None"""
+        width = nearest_width(requested_width)
+        if width is None:
+            return None
+        dest_path = variant_path(source_path, width, fmt)
+        if os.path.isfile(dest_path):
+            return dest_path
+        known_width = self._known_width(source_path)
+        if known_width is not None and known_width <= width:
+            return None
+        try:
+            with tracing.span(tracing.IMAGE):
+                return await self._run_once(dest_path, self.generate_variant, source_path, width, fmt)
+        except Exception as e:
+            logger.warning("[缩略图] 生成失败 %s: %s", source_path, e)
+            return None
+
+    async def get_placeholder(self, source_path: str) -> Optional[str]:
+        """返回模糊占位图路径，无法生成时返回None"""
+        dest_path = placeholder_path(source_path)
+        if os.path.isfile(dest_path):
+            return dest_path
+        try:
+            with tracing.span(tracing.IMAGE):
+                return await self._run_once(dest_path, self.generate_placeholder, source_path)
+        except Exception as e:
+            logger.warning("[缩略图] 占位图生成失败 %s: %s", source_path, e)
+            return None
+
+    def shutdown(self) -> None:
+        with self._executor_lock:
+            if self._executor is not None:
+                self._executor.shutdown(wait=False, cancel_futures=True)
+                self._executor = None
+
+
+# 全局缩略图服务实例
+image_variant_service = ImageVariantService()
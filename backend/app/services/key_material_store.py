@@ -0,0 +1,280 @@
+import base64
+import json
+import logging
+import os
+import struct
+import threading
+from abc import ABC, abstractmethod
+from collections import OrderedDict
+from dataclasses import dataclass
+from typing import Dict, Iterable, List, Optional
+from app.core.config import KEY_MATERIAL_CACHE_SIZE, LEGACY_KEYS_DIR
+from app.core.metrics import metrics
+from app.db.database import SessionLocal
+from app.db.models import UserKeyMaterial, china_now
+
+logger = logging.getLogger(__name__)
+
+# 预密钥包二进制编码：版本(1字节) + 字段存在位图(2字节) + 按顺序排列的存在字段
+# 整数字段为4字节无符号整数，字节字段为2字节长度 + 原始字节（JSON中为base64）
+_BUNDLE_FORMAT_VERSION = 1
+_BUNDLE_FIELDS = (
+    ('registration_id', int),
+    ('device_id', int),
+    ('prekey_id', int),
+    ('prekey_public', bytes),
+    ('prekey_private', bytes),
+    ('signed_prekey_id', int),
+    ('signed_prekey_public', bytes),
+    ('signed_prekey_private', bytes),
+    ('signed_prekey_signature', bytes),
+    ('identity_public_key', bytes),
+    ('kyber_prekey_id', int),
+    ('kyber_public_key', bytes),
+    ('kyber_private_key', bytes),
+    ('kyber_signature', bytes),
+)
+_IN_BATCH_SIZE = 500
+
+
+def encode_bundle(bundle: Dict) -> bytes:
+    """把预密钥包编码为紧凑的二进制格式"""
+    present = 0
+    parts = []
+    for index, (name, kind) in enumerate(_BUNDLE_FIELDS):
+        value = bundle.get(name)
+        if value is None:
+            continue
+        present |= 1 << index
+        if kind is int:
+            parts.append(struct.pack('>I', int(value)))
+        else:
+            raw = base64.b64decode(value)
+            parts.append(struct.pack('>H', len(raw)))
+            parts.append(raw)
+    return struct.pack('>BH', _BUNDLE_FORMAT_VERSION, present) + b''.join(parts)
+
+
+def decode_bundle(data: bytes) -> Dict:
+    """解码预密钥包，返回与原JSON文件相同结构的字典"""
+    version, present = struct.unpack_from('>BH', data, 0)
+    if version != _BUNDLE_FORMAT_VERSION:
+        raise ValueError(f"不支持的预密钥包格式版本: {version}")
+    offset = 3
+    bundle = {}
+    for index, (name, kind) in enumerate(_BUNDLE_FIELDS):
+        if not present & (1 << index):
+            bundle[name] = None
+            continue
+        if kind is int:
+            bundle[name] = struct.unpack_from('>I', data, offset)[0]
+            offset += 4
+        else:
+            length = struct.unpack_from('>H', data, offset)[0]
+            offset += 2
+            bundle[name] = base64.b64encode(data[offset:offset + length]).decode()
+            offset += length
+    return bundle
+
+
+@dataclass
+class KeyMaterial:
+    """用户的端到端加密密钥材料（密钥字段均为base64字符串）"""
+    user_id: int
+    identity_private_key: str
+    identity_public_key: str
+    registration_id: Optional[int] = None
+    prekey_bundle: Optional[Dict] = None
+
+    @classmethod
+    def from_json(cls, user_id: int, keys_data: Dict) -> "KeyMaterial":
+        """从旧的 user_{id}_keys.json 内容构造"""
+        return cls(
+            user_id=user_id,
+            identity_private_key=keys_data['identity_private_key'],
+            identity_public_key=keys_data['identity_public_key'],
+            registration_id=keys_data.get('registration_id'),
+            prekey_bundle=keys_data.get('prekey_bundle')
+        )
+
+
+class KeyMaterialBackend(ABC):
+    """密钥材料存储后端接口"""
+
+    @abstractmethod
+    def get_many(self, user_ids: List[int]) -> Dict[int, KeyMaterial]:
+        """批量读取，不存在的用户不出现在结果中"""
+
+    @abstractmethod
+    def put(self, material: KeyMaterial) -> None:
+        """新增或覆盖一个用户的密钥材料"""
+
+
+class JsonFileKeyMaterialBackend(KeyMaterialBackend):
+    """旧版本的存储方式：每个用户一个 user_{id}_keys.json 文件"""
+
+    def __init__(self, keys_dir: str):
+        self.keys_dir = keys_dir
+
+    def _path(self, user_id: int) -> str:
+        return os.path.join(self.keys_dir, f"user_{user_id}_keys.json")
+
+    def get_many(self, user_ids: List[int]) -> Dict[int, KeyMaterial]:
+        result = {}
+        for user_id in user_ids:
+            try:
+                with open(self._path(user_id), 'r', encoding='utf-8') as f:
+                    result[user_id] = KeyMaterial.from_json(user_id, json.load(f))
+            except FileNotFoundError:
+                continue
+            except (OSError, ValueError, KeyError) as e:
+                logger.warning("[密钥] 读取旧密钥文件失败 user_id=%s: %s", user_id, e)
+        return result
+
+    def put(self, material: KeyMaterial) -> None:
+        os.makedirs(self.keys_dir, exist_ok=True)
+        with open(self._path(material.user_id), 'w', encoding='utf-8') as f:
+            json.dump({
+                'identity_private_key': material.identity_private_key,
+                'identity_public_key': material.identity_public_key,
+                'prekey_bundle': material.prekey_bundle,
+                'registration_id': material.registration_id
+            }, f, indent=2)
+
+
+class SqlKeyMaterialBackend(KeyMaterialBackend):
+    """保存在 user_key_material 表中，按主键读取，密钥和预密钥包以二进制保存"""
+
+    def __init__(self, session_factory=SessionLocal):
+        self.session_factory = session_factory
+
+    @staticmethod
+    def _to_material(row: UserKeyMaterial) -> KeyMaterial:
+        return KeyMaterial(
+            user_id=row.user_id,
+            identity_private_key=base64.b64encode(row.identity_private_key).decode(),
+            identity_public_key=base64.b64encode(row.identity_public_key).decode(),
+            registration_id=row.registration_id,
+            prekey_bundle=decode_bundle(row.prekey_bundle) if row.prekey_bundle else None
+        )
+
+    def get_many(self, user_ids: List[int]) -> Dict[int, KeyMaterial]:
+        db = self.session_factory()
+        try:
+            result = {}
+            # 分批查询，避免超过SQLite的参数个数限制
+            for start in range(0, len(user_ids), _IN_BATCH_SIZE):
+                batch = user_ids[start:start + _IN_BATCH_SIZE]
+                for row in db.query(UserKeyMaterial).filter(UserKeyMaterial.user_id.in_(batch)):
+                    result[row.user_id] = self._to_material(row)
+            return result
+        finally:
+            db.close()
+
+    def put(self, material: KeyMaterial) -> None:
+        db = self.session_factory()
+        try:
+            row = db.query(UserKeyMaterial).filter(UserKeyMaterial.user_id == material.user_id).first()
+            if row is None:
+                row = UserKeyMaterial(user_id=material.user_id)
+                db.add(row)
+            row.registration_id = material.registration_id
+            row.identity_private_key = base64.b64decode(material.identity_private_key)
+            row.identity_public_key = base64.b64decode(material.identity_public_key)
+            row.prekey_bundle = encode_bundle(material.prekey_bundle) if material.prekey_bundle else None
+            row.updated_at = china_now()
+            db.commit()
+        except Exception:
+            db.rollback()
+            raise
+        finally:
+            db.close()
+
+
+class KeyMaterialStore:
+    """用户密钥材料仓库
+
+    替代每个用户一个JSON文件、每次访问都完整解析的做法：后端按主键读取，
+    结果在进程内按LRU缓存，get_many一次查询批量获取多个用户。
+    后端中没有的用户再从legacy（旧的JSON密钥文件）读取，读到后写入后端，
+    未运行迁移脚本的已有用户也能正常加解密。
+    """
+
+    def __init__(self, backend: KeyMaterialBackend, cache_size: int = KEY_MATERIAL_CACHE_SIZE,
+                 legacy: Optional[KeyMaterialBackend] = None):
+        self.backend = backend
+        self.legacy = legacy
+        self.cache_size = cache_size
+        self._cache: "OrderedDict[int, KeyMaterial]" = OrderedDict()
+        self._lock = threading.Lock()
+        self.hits = 0
+        self.misses = 0
+
+    def _remember(self, material: KeyMaterial) -> None:
+        self._cache[material.user_id] = material
+        self._cache.move_to_end(material.user_id)
+        while len(self._cache) > self.cache_size:
+            self._cache.popitem(last=False)
+
+    def get(self, user_id: int) -> Optional[KeyMaterial]:
+        return self.get_many([user_id]).get(user_id)
+
+    def get_many(self, user_ids: Iterable[int]) -> Dict[int, KeyMaterial]:
+        """批量获取，缓存未命中的用户合并为一次后端查询"""
+        result: Dict[int, KeyMaterial] = {}
+        missing = []
+        with self._lock:
+            for user_id in dict.fromkeys(user_ids):
+                material = self._cache.get(user_id)
+                if material is not None:
+                    self._cache.move_to_end(user_id)
+                    result[user_id] = material
+                else:
+                    missing.append(user_id)
+            self.hits += len(result)
+            self.misses += len(missing)
+        if missing:
+            loaded = self.backend.get_many(missing)
+            if self.legacy is not None and len(loaded) < len(missing):
+                loaded.update(self._import_legacy([user_id for user_id in missing if user_id not in loaded]))
+            with self._lock:
+                for material in loaded.values():
+                    self._remember(material)
+            result.update(loaded)
+        return result
+
+    def _import_legacy(self, user_ids: List[int]) -> Dict[int, KeyMaterial]:
+        """从旧密钥文件读取并写入后端；写入失败（如并发导入）不影响本次读取"""
+        imported = self.legacy.get_many(user_ids)
+        for material in imported.values():
+            try:
+                self.backend.put(material)
+                logger.info("[密钥] 已从旧密钥文件导入 user_id=%s", material.user_id)
+            except Exception as e:
+                logger.warning("[密钥] 导入旧密钥文件失败 user_id=%s: %s", material.user_id, e)
+        return imported
+
+    def put(self, material: KeyMaterial) -> None:
+        self.backend.put(material)
+        with self._lock:
+            self._remember(material)
+
+    def invalidate(self, user_id: int) -> None:
+        with self._lock:
+            self._cache.pop(user_id, None)
+
+    def stats(self) -> dict:
+        with self._lock:
+            lookups = self.hits + self.misses
+            return {
+                "size": len(self._cache),
+                "max_size": self.cache_size,
+                "hits": self.hits,
+                "misses": self.misses,
+                "hit_rate": round(self.hits / lookups, 4) if lookups else 0.0
+            }
+
+
+# 全局密钥材料仓库
+key_material_store = KeyMaterialStore(SqlKeyMaterialBackend(), legacy=JsonFileKeyMaterialBackend(LEGACY_KEYS_DIR))
+metrics.register_stats('key_material_cache', key_material_store.stats)
@@ -0,0 +1,174 @@
+import asyncio
+import logging
+import time
+import uuid
+from dataclasses import dataclass, field
+from typing import Dict, Optional, Set
+from starlette.concurrency import run_in_threadpool
+from app.core.config import KEY_SETUP_JOB_TTL
+from app.db.database import SessionLocal
+from app.db.models import User, UserKeys
+from app.services.cpu_executor import cpu_executor
+from app.services.encryption_service import encryption_service
+from app.services.key_material_store import key_material_store
+from app.services.user_keys_service import UserKeysService
+
+logger = logging.getLogger(__name__)
+
+
+@dataclass
+class KeySetupJob:
+    """新用户密钥生成任务"""
+    job_id: str
+    user_id: int
+    status: str = "pending"  # pending, running, succeeded, failed
+    error: Optional[str] = None
+    public_key: Optional[str] = None
+    key_version: Optional[int] = None
+    encryption_ready: bool = False
+    created_at: float = field(default_factory=time.time)
+    finished_at: Optional[float] = None
+
+    def to_dict(self) -> dict:
+        data = {
+            "job_id": self.job_id,
+            "status": self.status,
+            "encryption_ready": self.encryption_ready
+        }
+        if self.error:
+            data["error"] = self.error
+        if self.status == "succeeded":
+            # 与原注册接口返回的keys字段一致（不包含私钥）
+            data["keys"] = {
+                "public_key": self.public_key,
+                "key_version": self.key_version,
+                "has_private_key": True
+            }
+        return data
+
+
+def _store_public_key(user_id: int, public_key: str) -> None:
+    """把RSA公钥写回users表（setup_user_encryption会先写入身份公钥，这里保持原注册流程的最终结果）"""
+    db = SessionLocal()
+    try:
+        user = db.query(User).filter(User.id == user_id).first()
+        if user:
+            user.public_key = public_key
+            db.commit()
+    finally:
+        db.close()
+
+
+def _missing_steps(user_id: int) -> tuple:
+    """(是否缺少RSA密钥, 是否缺少端到端加密密钥材料)"""
+    db = SessionLocal()
+    try:
+        has_keys = db.query(UserKeys.id).filter(UserKeys.user_id == user_id).first() is not None
+    finally:
+        db.close()
+    return not has_keys, key_material_store.get(user_id) is None
+
+
+def _existing_public_key(user_id: int) -> tuple:
+    db = SessionLocal()
+    try:
+        return db.query(UserKeys.public_key, UserKeys.key_version).filter(UserKeys.user_id == user_id).first()
+    finally:
+        db.close()
+
+
+class KeySetupService:
+    """注册后在后台生成用户密钥
+
+    注册接口在用户记录写入后立即返回，RSA密钥生成和私钥加密（PBKDF2）在CPU线程池中执行，
+    端到端加密初始化（调用Node子进程，主要是等待I/O）在普通线程池中执行。
+    客户端通过任务ID查询进度，任务状态在结束后保留KEY_SETUP_JOB_TTL秒。
+    任务只在内存中，且需要明文密码；服务器在任务完成前重启时，由下次登录通过 resume_if_incomplete 补做缺少的步骤。
+    """
+
+    def __init__(self):
+        self._jobs: Dict[str, KeySetupJob] = {}
+        self._tasks: Set[asyncio.Task] = set()
+
+    def _prune(self) -> None:
+        cutoff = time.time() - KEY_SETUP_JOB_TTL
+        for job_id in [job_id for job_id, job in self._jobs.items() if job.finished_at and job.finished_at < cutoff]:
+            del self._jobs[job_id]
+
+    def submit(self, user_id: int, password: str) -> KeySetupJob:
+        """创建密钥生成任务（必须在事件循环中调用）"""
+        self._prune()
+        job = KeySetupJob(job_id=uuid.uuid4().hex, user_id=user_id)
+        self._jobs[job.job_id] = job
+        task = asyncio.create_task(self._run(job, password))
+        self._tasks.add(task)
+        task.add_done_callback(self._tasks.discard)
+        return job
+
+    def active_job(self, user_id: int) -> Optional[KeySetupJob]:
+        """该用户尚未结束的任务"""
+        for job in self._jobs.values():
+            if job.user_id == user_id and job.finished_at is None:
+                return job
+        return None
+
+    async def resume_if_incomplete(self, user_id: int, password: str) -> Optional[KeySetupJob]:
+        """登录时检查：密钥或端到端加密材料缺失（注册后的任务失败或被重启中断）时重新提交任务"""
+        job = self.active_job(user_id)
+        if job is not None:
+            return job
+        missing_keys, missing_material = await run_in_threadpool(_missing_steps, user_id)
+        if not missing_keys and not missing_material:
+            return None
+        logger.info("[密钥生成] 用户 %s 的密钥设置未完成，重新执行", user_id)
+        return self.submit(user_id, password)
+
+    def get(self, job_id: str, user_id: int) -> Optional[KeySetupJob]:
+        job = self._jobs.get(job_id)
+        if job is None or job.user_id != user_id:
+            return None
+        return job
+
+    async def _run(self, job: KeySetupJob, password: str) -> None:
+        job.status = "running"
+        try:
+            missing_keys, missing_material = await run_in_threadpool(_missing_steps, job.user_id)
+            if missing_keys:
+                # 后台任务不受准入控制限制，只是排队等待
+                keys_result = await cpu_executor.run(
+                    "create_user_keys", UserKeysService.create_user_keys, job.user_id, password, admit=False
+                )
+                if not keys_result.get('success'):
+                    raise Exception(keys_result.get('message'))
+                job.public_key = keys_result['data']['public_key']
+                job.key_version = keys_result['data']['key_version']
+            else:
+                # 之前的任务已生成密钥，只补做后面的步骤
+                job.public_key, job.key_version = await run_in_threadpool(_existing_public_key, job.user_id)
+
+            if missing_keys or missing_material:
+                # 为新用户设置端到端加密（保持原有逻辑）
+                encryption_result = await run_in_threadpool(encryption_service.setup_user_encryption, job.user_id)
+                if encryption_result.get('success'):
+                    job.encryption_ready = True
+                else:
+                    logger.warning("[密钥生成] 用户 %s 端到端加密初始化失败: %s", job.user_id, encryption_result.get('error'))
+                await run_in_threadpool(_store_public_key, job.user_id, job.public_key)
+            else:
+                job.encryption_ready = True
+            job.status = "succeeded"
+        except Exception as e:
+            job.status = "failed"
+            job.error = getattr(e, "detail", None) or str(e)
+            logger.error("[密钥生成] 用户 %s 密钥生成失败: %s", job.user_id, job.error)
+        finally:
+            job.finished_at = time.time()
+
+    async def shutdown(self) -> None:
+        """等待进行中的任务结束"""
+        if self._tasks:
+            await asyncio.gather(*list(self._tasks), return_exceptions=True)
+
+
+# 全局密钥生成任务服务
+key_setup_service = KeySetupService()
@@ -0,0 +1,132 @@
+import asyncio
+import logging
+import threading
+from collections import deque
+from typing import Callable, Deque, Optional, Tuple
+from app.core.config import KEYPAIR_POOL_SIZE, KEYPAIR_POOL_LOW_WATER
+from app.services.cpu_executor import cpu_executor
+
+logger = logging.getLogger(__name__)
+
+_REFILL_RETRY_DELAY = 5
+
+
+class KeypairPool:
+    """预生成的密钥对池
+
+    RSA-2048密钥生成（寻找大素数）是注册和更新密钥中最慢的一步。
+    后台任务在CPU线程池中逐个生成密钥对，使池中保持size个现成的密钥对；
+    take()直接取出一个并唤醒后台任务补充，池为空时同步生成，保证调用方总能拿到密钥。
+    池中数量低于low_water时记录告警，说明补充速度跟不上消耗。
+
+    take()会在线程池中被调用，内部状态由线程锁保护；唤醒后台任务通过call_soon_threadsafe。
+    """
+
+    def __init__(self, generate: Callable[[], Tuple[str, str]], size: int = KEYPAIR_POOL_SIZE,
+                 low_water: int = KEYPAIR_POOL_LOW_WATER, name: str = "rsa"):
+        self._generate = generate
+        self.size = size
+        self.low_water = low_water
+        self.name = name
+        self._pairs: Deque[Tuple[str, str]] = deque()
+        self._lock = threading.Lock()
+        self._loop: Optional[asyncio.AbstractEventLoop] = None
+        self._wakeup: Optional[asyncio.Event] = None
+        self._task: Optional[asyncio.Task] = None
+        self._below_low_water = False
+        self.hits = 0
+        self.misses = 0
+        self.generated = 0
+        self.low_water_alarms = 0
+
+    def available(self) -> int:
+        with self._lock:
+            return len(self._pairs)
+
+    def take(self) -> Tuple[str, str]:
+        """取出一个密钥对 (public_pem, private_pem)，池为空时同步生成"""
+        with self._lock:
+            pair = self._pairs.popleft() if self._pairs else None
+            remaining = len(self._pairs)
+            if pair is not None:
+                self.hits += 1
+            else:
+                self.misses += 1
+            alarm = self._task is not None and remaining < self.low_water and not self._below_low_water
+            if alarm:
+                self._below_low_water = True
+                self.low_water_alarms += 1
+
+        if alarm:
+            logger.warning("[密钥池] %s 密钥对剩余 %d 个，低于告警线 %d", self.name, remaining, self.low_water)
+        self._notify()
+
+        if pair is None:
+            if self._task is not None:
+                logger.warning("[密钥池] %s 密钥池已空，同步生成密钥对", self.name)
+            pair = self._generate()
+        return pair
+
+    def _notify(self) -> None:
+        if self._loop is not None and self._wakeup is not None:
+            try:
+                self._loop.call_soon_threadsafe(self._wakeup.set)
+            except RuntimeError:
+                # 事件循环已关闭
+                pass
+
+    def _put(self, pair: Tuple[str, str]) -> None:
+        with self._lock:
+            self._pairs.append(pair)
+            self.generated += 1
+            if len(self._pairs) >= self.low_water:
+                self._below_low_water = False
+
+    async def _refill_loop(self):
+        while True:
+            # 先清除再检查数量，补充期间的take()会重新唤醒，不会漏掉
+            self._wakeup.clear()
+            try:
+                while self.available() < self.size:
+                    pair = await cpu_executor.run(f"{self.name}_keypair_pool", self._generate, admit=False)
+                    self._put(pair)
+            except asyncio.CancelledError:
+                raise
+            except Exception as e:
+                logger.error("[密钥池] %s 生成密钥对失败: %s", self.name, e)
+                await asyncio.sleep(_REFILL_RETRY_DELAY)
+                continue
+            await self._wakeup.wait()
+
+    async def start(self):
+        """启动后台补充任务"""
+        if self._task is None and self.size > 0:
+            self._loop = asyncio.get_running_loop()
+            self._wakeup = asyncio.Event()
+            self._task = asyncio.create_task(self._refill_loop())
+
+    async def stop(self):
+        """停止后台补充任务"""
+        if self._task is not None:
+            self._task.cancel()
+            try:
+                await self._task
+            except asyncio.CancelledError:
+                pass
+            self._task = None
+            self._loop = None
+            self._wakeup = None
+
+    def stats(self) -> dict:
+        with self._lock:
+            taken = self.hits + self.misses
+            return {
+                "available": len(self._pairs),
+                "size": self.size,
+                "low_water": self.low_water,
+                "hits": self.hits,
+                "misses": self.misses,
+                "hit_rate": round(self.hits / taken, 4) if taken else 0.0,
+                "generated": self.generated,
+                "low_water_alarms": self.low_water_alarms
+            }
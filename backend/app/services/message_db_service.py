@@ -2,9 +2,12 @@ import sqlite3
 import os
 import json
 import time
+import logging
 from datetime import datetime, timezone, timedelta
 from typing import List, Dict, Optional, Tuple
 from contextlib import contextmanager
+from app.core import tracing
+from app.core.metrics import metrics, timed
 
 # 中国时区
 CHINA_TZ = timezone(timedelta(hours=8))
@@ -16,6 +19,10 @@ app_dir = pathlib.Path(__file__).parent.parent
 DB_STORAGE_DIR = os.path.join(app_dir, 'local_storage', 'messages')
 os.makedirs(DB_STORAGE_DIR, exist_ok=True)
 
+logger = logging.getLogger(__name__)
+
+message_db_seconds = metrics.histogram('message_db_seconds', '本地消息数据库操作耗时', ('operation',))
+
 class MessageDBService:
     """消息数据库服务类"""
     
@@ -148,6 +155,7 @@ class MessageDBService:
             conn.commit()
     
     @staticmethod
+    @timed(message_db_seconds, 'add_message', span=tracing.DB)
     def add_message(user_id: int, message_data: Dict) -> bool:
         """添加消息到数据库"""
         try:
@@ -198,10 +206,11 @@ class MessageDBService:
                 return True
                 
         except Exception as e:
-            print(f"添加消息失败: {e}")
+            logger.error("添加消息失败: %s", e)
             return False
     
     @staticmethod
+    @timed(message_db_seconds, 'clean_expired_messages', span=tracing.DB)
     def clean_expired_messages(user_id: int):
         """清理过期的阅后即焚消息"""
         try:
@@ -222,12 +231,13 @@ class MessageDBService:
                 conn.commit()
                 
                 if deleted_count > 0:
-                    print(f"清理了 {deleted_count} 条过期的阅后即焚消息")
+                    logger.info("清理了 %d 条过期的阅后即焚消息", deleted_count)
                 
         except Exception as e:
-            print(f"清理过期消息时出错: {e}")
+            logger.error("清理过期消息时出错: %s", e)
     
     @staticmethod
+    @timed(message_db_seconds, 'get_messages_with_friend', span=tracing.DB)
     def get_messages_with_friend(
         user_id: int, 
         friend_id: int, 
@@ -326,10 +336,11 @@ class MessageDBService:
                 return messages, total_count, has_more
                 
         except Exception as e:
-            print(f"获取消息失败: {e}")
+            logger.error("获取消息失败: %s", e)
             return [], 0, False
     
     @staticmethod
+    @timed(message_db_seconds, 'mark_message_as_read', span=tracing.DB)
     def mark_message_as_read(user_id: int, message_id: str) -> bool:
         """标记消息为已读"""
         try:
@@ -351,10 +362,11 @@ class MessageDBService:
                 return cursor.rowcount > 0
                 
         except Exception as e:
-            print(f"标记消息已读失败: {e}")
+            logger.error("标记消息已读失败: %s", e)
             return False
     
     @staticmethod
+    @timed(message_db_seconds, 'update_message_field', span=tracing.DB)
     def update_message_field(user_id: int, message_id: str, field_name: str, field_value: any) -> bool:
         """更新消息的特定字段"""
         try:
@@ -371,7 +383,7 @@ class MessageDBService:
                         cursor.execute(f'ALTER TABLE messages ADD COLUMN {field_name} TEXT DEFAULT NULL')
                         conn.commit()
                     except sqlite3.OperationalError as e:
-                        print(f"添加字段失败: {e}")
+                        logger.error("添加字段失败: %s", e)
                         return False
                 
                 # 更新字段值
@@ -391,10 +403,11 @@ class MessageDBService:
                 return cursor.rowcount > 0
                 
         except Exception as e:
-            print(f"更新消息字段失败: {e}")
+            logger.error("更新消息字段失败: %s", e)
             return False
     
     @staticmethod
+    @timed(message_db_seconds, 'delete_message', span=tracing.DB)
     def delete_message(user_id: int, message_id: str) -> bool:
         """删除消息（软删除）"""
         try:
@@ -416,10 +429,11 @@ class MessageDBService:
                 return cursor.rowcount > 0
                 
         except Exception as e:
-            print(f"删除消息失败: {e}")
+            logger.error("删除消息失败: %s", e)
             return False
     
     @staticmethod
+    @timed(message_db_seconds, 'clear_all_messages', span=tracing.DB)
     def clear_all_messages(user_id: int) -> bool:
         """清空用户的所有消息"""
         try:
@@ -430,7 +444,7 @@ class MessageDBService:
                 return True
                 
         except Exception as e:
-            print(f"清空消息失败: {e}")
+            logger.error("清空消息失败: %s", e)
             return False
     
     @staticmethod
@@ -461,7 +475,7 @@ class MessageDBService:
                 }
                 
         except Exception as e:
-            print(f"获取数据库状态失败: {e}")
+            logger.error("获取数据库状态失败: %s", e)
             return {
                 "exists": False,
                 "message_count": 0,
@@ -498,10 +512,10 @@ class MessageDBService:
             # 备份原JSON文件
             backup_path = json_file_path + '.backup'
             os.rename(json_file_path, backup_path)
-            print(f"原JSON文件已备份到: {backup_path}")
+            logger.info("原JSON文件已备份到: %s", backup_path)
             
             return True
             
         except Exception as e:
-            print(f"迁移失败: {e}")
+            logger.error("迁移失败: %s", e)
             return False
\ No newline at end of file
@@ -0,0 +1,114 @@
+"""
+消息密文信封
+
+v2（当前格式），base64编码前的字节布局：
+    版本(1字节, 0x02) | 会话密钥ID(4字节) | 密钥版本(2字节) | nonce(12字节) | AES-GCM密文+16字节认证标签
+前7字节作为附加认证数据（AAD），篡改版本或密钥ID同样会导致解密失败。
+
+v1（旧格式）：IV(16字节) | AES-256-CBC密文（PKCS7填充），没有版本字节和完整性校验，只用于解密。
+"""
+import base64
+import os
+import struct
+import threading
+from collections import OrderedDict
+from typing import Iterable, List
+from cryptography.exceptions import InvalidTag
+from cryptography.hazmat.primitives import padding as sym_padding
+from cryptography.hazmat.primitives.ciphers import Cipher, algorithms, modes
+from cryptography.hazmat.primitives.ciphers.aead import AESGCM
+
+ENVELOPE_VERSION = 2
+_HEADER = struct.Struct('>BIH')
+_NONCE_SIZE = 12
+_TAG_SIZE = 16
+_LEGACY_IV_SIZE = 16
+_CIPHER_CACHE_SIZE = 1024
+
+
+class EnvelopeError(Exception):
+    pass
+
+
+_cipher_cache: "OrderedDict[bytes, AESGCM]" = OrderedDict()
+_cipher_cache_lock = threading.Lock()
+
+
+def _aesgcm(key: bytes) -> AESGCM:
+    """按会话密钥缓存AESGCM实例，避免每条消息重新初始化密钥"""
+    with _cipher_cache_lock:
+        cipher = _cipher_cache.get(key)
+        if cipher is not None:
+            _cipher_cache.move_to_end(key)
+            return cipher
+    cipher = AESGCM(key)
+    with _cipher_cache_lock:
+        _cipher_cache[key] = cipher
+        while len(_cipher_cache) > _CIPHER_CACHE_SIZE:
+            _cipher_cache.popitem(last=False)
+    return cipher
+
+
+def seal(key: bytes, plaintext: bytes, key_id: int = 0, key_version: int = 1) -> bytes:
+    """生成v2信封"""
+    header = _HEADER.pack(ENVELOPE_VERSION, key_id & 0xFFFFFFFF, key_version & 0xFFFF)
+    nonce = os.urandom(_NONCE_SIZE)
+    return header + nonce + _aesgcm(key).encrypt(nonce, plaintext, header)
+
+
+def _open_v2(key: bytes, data: bytes) -> bytes:
+    header = data[:_HEADER.size]
+    nonce = data[_HEADER.size:_HEADER.size + _NONCE_SIZE]
+    return _aesgcm(key).decrypt(nonce, data[_HEADER.size + _NONCE_SIZE:], header)
+
+
+def _open_legacy(key: bytes, data: bytes) -> bytes:
+    iv, ciphertext = data[:_LEGACY_IV_SIZE], data[_LEGACY_IV_SIZE:]
+    decryptor = Cipher(algorithms.AES(key), modes.CBC(iv)).decryptor()
+    padded = decryptor.update(ciphertext) + decryptor.finalize()
+    unpadder = sym_padding.PKCS7(128).unpadder()
+    return unpadder.update(padded) + unpadder.finalize()
+
+
+def open_envelope(key: bytes, data: bytes) -> bytes:
+    """解密v2或旧格式信封"""
+    if len(data) >= _HEADER.size + _NONCE_SIZE + _TAG_SIZE and data[0] == ENVELOPE_VERSION:
+        try:
+            return _open_v2(key, data)
+        except InvalidTag:
+            # 旧格式的随机IV首字节恰好为0x02时才会走到这里
+            if len(data) % 16 != 0:
+                raise EnvelopeError("消息认证失败")
+    if len(data) < 2 * _LEGACY_IV_SIZE or len(data) % 16 != 0:
+        raise EnvelopeError("无效的密文格式")
+    try:
+        return _open_legacy(key, data)
+    except ValueError:
+        raise EnvelopeError("消息解密失败")
+
+
+def encrypt_text(key: bytes, message: str, key_id: int = 0, key_version: int = 1) -> str:
+    return base64.b64encode(seal(key, message.encode('utf-8'), key_id, key_version)).decode()
+
+
+def decrypt_text(key: bytes, encrypted_message: str) -> str:
+    return open_envelope(key, base64.b64decode(encrypted_message)).decode('utf-8')
+
+
+def encrypt_many(key: bytes, messages: Iterable[str], key_id: int = 0, key_version: int = 1) -> List[str]:
+    """用同一个会话密钥批量加密"""
+    return [encrypt_text(key, message, key_id, key_version) for message in messages]
+
+
+def decrypt_many(key: bytes, encrypted_messages: Iterable[str]) -> List[str]:
+    """用同一个会话密钥批量解密，任何一条失败都会抛出异常"""
+    return [decrypt_text(key, encrypted_message) for encrypted_message in encrypted_messages]
+
+
+def legacy_encrypt_text(key: bytes, message: str) -> str:
+    """生成旧格式（AES-CBC）密文，仅用于兼容性验证和性能对比"""
+    iv = os.urandom(_LEGACY_IV_SIZE)
+    padder = sym_padding.PKCS7(128).padder()
+    padded = padder.update(message.encode('utf-8')) + padder.finalize()
+    encryptor = Cipher(algorithms.AES(key), modes.CBC(iv)).encryptor()
+    return base64.b64encode(iv + encryptor.update(padded) + encryptor.finalize()).decode()
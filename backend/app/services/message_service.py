@@ -1,13 +1,21 @@
+from sqlalchemy import func
 from sqlalchemy.orm import Session
-from app.db import models
+from app.db import models, database
+from app.core.metrics import metrics
+import logging
 from datetime import datetime, timedelta, timezone
 from typing import List
 from app.services.message_db_service import MessageDBService
 from app.services.encryption_service import encryption_service
+from app.services.blob_store import blob_store
 
 # 中国时区
 CHINA_TZ = timezone(timedelta(hours=8))
 
+logger = logging.getLogger(__name__)
+
+DECRYPT_FAILED_TEXT = "[解密失败的消息]"
+
 def send_message(db: Session, from_id: int, to_id: int, content: str, encrypted: bool = True, method: str = 'E2E', destroy_after: int = None, message_type: str = 'text', file_path: str = None, file_name: str = None, hidding_message: str = None, recipient_online: bool = False):
     # 服务器数据库只作为临时暂存，只有在接收方不在线时才保存
     china_now = datetime.now(CHINA_TZ)
@@ -24,12 +32,12 @@ def send_message(db: Session, from_id: int, to_id: int, content: str, encrypted:
             if encryption_result.get('success'):
                 encrypted_content = encryption_result['encrypted_message']
             else:
-                print(f"Warning: Failed to encrypt message: {encryption_result.get('error')}")
+                logger.warning("[消息] 加密失败，改为明文保存: %s", encryption_result.get('error'), extra={"sample": "message_encrypt_failed"})
                 # 如果加密失败，回退到明文传输
                 encrypted = False
                 method = 'Server'
         except Exception as e:
-            print(f"Warning: Encryption error: {e}")
+            logger.warning("[消息] 加密异常，改为明文保存: %s", e, extra={"sample": "message_encrypt_error"})
             encrypted = False
             method = 'Server'
     
@@ -99,11 +107,11 @@ def decrypt_message_content(user_id: int, from_id: int, encrypted_content: str)
         if decryption_result.get('success'):
             return decryption_result['decrypted_message']
         else:
-            print(f"Warning: Failed to decrypt message: {decryption_result.get('error')}")
-            return "[解密失败的消息]"
+            logger.warning("[消息] 解密失败: %s", decryption_result.get('error'), extra={"sample": "message_decrypt_failed"})
+            return DECRYPT_FAILED_TEXT
     except Exception as e:
-        print(f"Warning: Decryption error: {e}")
-        return "[解密失败的消息]"
+        logger.warning("[消息] 解密异常: %s", e, extra={"sample": "message_decrypt_error"})
+        return DECRYPT_FAILED_TEXT
 
 def delete_server_message(db: Session, message_id: int):
     """删除服务器数据库中的消息（消息发送成功后调用）"""
@@ -121,6 +129,20 @@ def delete_server_message(db: Session, message_id: int):
         # 删除服务器消息失败
         return False
 
+def delete_server_messages(db: Session, message_ids: List[int]) -> int:
+    """批量删除服务器数据库中已送达的消息"""
+    if not message_ids:
+        return 0
+    try:
+        count = db.query(models.Message).filter(
+            models.Message.id.in_(message_ids)
+        ).delete(synchronize_session=False)
+        db.commit()
+        return count
+    except Exception as e:
+        db.rollback()
+        return 0
+
 def get_offline_messages(db: Session, user_id: int):
     """获取用户的离线消息"""
     try:
@@ -129,14 +151,10 @@ def get_offline_messages(db: Session, user_id: int):
             models.Message.to_id == user_id
         ).order_by(models.Message.timestamp.asc()).all()
         
-        # 解密加密的消息
-        for msg in offline_messages:
-            if msg.encrypted and msg.method == 'E2E':
-                try:
-                    decrypted_content = decrypt_message_content(user_id, msg.from_id, msg.content)
-                    msg.content = decrypted_content
-                except Exception as e:
-                    print(f"Warning: Failed to decrypt offline message {msg.id}: {e}")
+        # 批量解密加密的消息：每个发送者的会话密钥只解封一次
+        decrypted_contents = encryption_service.decrypt_batch(user_id, offline_messages, DECRYPT_FAILED_TEXT)
+        for msg, content in zip(offline_messages, decrypted_contents):
+            msg.content = content
         
         # 获取到离线消息
         return offline_messages
@@ -144,46 +162,41 @@ def get_offline_messages(db: Session, user_id: int):
         # 获取离线消息失败
         return []
 
+def _conversation_filter(user_id: int, peer_id: int):
+    """两个用户之间的消息，每个分支都能使用 ix_messages_pair_timestamp 索引"""
+    return ((models.Message.from_id == user_id) & (models.Message.to_id == peer_id)) | \
+        ((models.Message.from_id == peer_id) & (models.Message.to_id == user_id))
+
 def get_message_history(db: Session, user_id: int, peer_id: int, page: int = 1, limit: int = 50):
     now = datetime.now(CHINA_TZ)
-    query = db.query(models.Message).filter(
-        ((models.Message.from_id == user_id) & (models.Message.to_id == peer_id)) |
-        ((models.Message.from_id == peer_id) & (models.Message.to_id == user_id))
-    ).order_by(models.Message.timestamp.desc())
-    # 阅后即焚：删除已过期消息
+    # 阅后即焚：删除已过期消息（只检查destroy_after大于0的消息，不再逐条遍历整个会话）
+    burn_msgs = db.query(models.Message).filter(
+        _conversation_filter(user_id, peer_id),
+        models.Message.destroy_after > 0
+    ).all()
     expired_msgs = []
-    for m in query:
-        if m.destroy_after:
-            expire_time = m.timestamp + timedelta(seconds=m.destroy_after)
-            if now > expire_time:
-                expired_msgs.append(m)
+    for m in burn_msgs:
+        # SQLite读出的时间不带时区，按北京时间处理
+        timestamp = m.timestamp if m.timestamp.tzinfo else m.timestamp.replace(tzinfo=CHINA_TZ)
+        expire_time = timestamp + timedelta(seconds=m.destroy_after)
+        if now > expire_time:
+            expired_msgs.append(m)
     for m in expired_msgs:
+        blob_store.release(db, m.file_path)
         db.delete(m)
     if expired_msgs:
         db.commit()
-    # 重新查询未过期消息
+    # 查询未过期消息
     query = db.query(models.Message).filter(
-        ((models.Message.from_id == user_id) & (models.Message.to_id == peer_id)) |
-        ((models.Message.from_id == peer_id) & (models.Message.to_id == user_id))
+        _conversation_filter(user_id, peer_id)
     ).order_by(models.Message.timestamp.desc())
     total = query.count()
     messages = query.offset((page-1)*limit).limit(limit).all()
     
-    # 转换消息格式以符合API规范，并解密加密的消息
+    # 转换消息格式以符合API规范；整页消息属于同一会话，会话密钥只解封一次
+    decrypted_contents = encryption_service.decrypt_batch(user_id, messages, DECRYPT_FAILED_TEXT)
     formatted_messages = []
-    for msg in messages:
-        content = msg.content
-        # 如果消息是加密的，需要解密
-        if msg.encrypted and msg.method == 'E2E':
-            try:
-                # 确定解密时使用的用户ID（接收方ID）
-                decrypt_user_id = user_id if msg.to_id == user_id else user_id
-                sender_id = msg.from_id if msg.to_id == user_id else msg.to_id
-                content = decrypt_message_content(decrypt_user_id, sender_id, msg.content)
-            except Exception as e:
-                print(f"Warning: Failed to decrypt message {msg.id}: {e}")
-                content = "[解密失败的消息]"
-        
+    for msg, content in zip(messages, decrypted_contents):
         formatted_msg = {
             "id": str(msg.id),
             "from": str(msg.from_id),
@@ -221,6 +234,20 @@ def delete_message(db: Session, user_id: int, message_id: int):
     # 只有发送者或接收者可以删除
     if msg.from_id != user_id and msg.to_id != user_id:
         return False, "无权限删除该消息"
+    blob_store.release(db, msg.file_path)
     db.delete(msg)
     db.commit()
-    return True, None
\ No newline at end of file
+    return True, None
+
+def offline_backlog_stats() -> dict:
+    """服务器暂存的离线消息数量（只在导出指标时查询）"""
+    db = database.SessionLocal()
+    try:
+        return {
+            "messages": db.query(func.count(models.Message.id)).scalar() or 0,
+            "recipients": db.query(func.count(func.distinct(models.Message.to_id))).scalar() or 0
+        }
+    finally:
+        db.close()
+
+metrics.register_stats('offline_backlog', offline_backlog_stats)
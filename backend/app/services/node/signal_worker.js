@@ -0,0 +1,41 @@
+// 常驻的libsignal辅助进程：每行读入一个JSON请求，每行输出一个JSON响应
+// 请求: {"id": 1, "op": "kyber_keypair", "params": {}}
+// 响应: {"id": 1, "result": {...}} 或 {"id": 1, "error": "..."}
+const readline = require('readline');
+
+const modulePath = process.argv[2];
+const signal = require(modulePath);
+
+const b64 = (bytes) => Buffer.from(bytes).toString('base64');
+
+const handlers = {
+    ping() {
+        return { ok: true };
+    },
+    kyber_keypair() {
+        const keyPair = signal.KEMKeyPair.generate();
+        return {
+            public_key: b64(keyPair.getPublicKey().serialize()),
+            secret_key: b64(keyPair.getSecretKey().serialize())
+        };
+    }
+};
+
+const rl = readline.createInterface({ input: process.stdin, terminal: false });
+
+rl.on('line', (line) => {
+    let request = null;
+    try {
+        request = JSON.parse(line);
+        const handler = handlers[request.op];
+        if (!handler) {
+            throw new Error(`unknown op: ${request.op}`);
+        }
+        const result = handler(request.params || {});
+        process.stdout.write(JSON.stringify({ id: request.id, result }) + '\n');
+    } catch (error) {
+        process.stdout.write(JSON.stringify({ id: request && request.id, error: error.message }) + '\n');
+    }
+});
+
+rl.on('close', () => process.exit(0));
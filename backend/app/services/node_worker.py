@@ -0,0 +1,107 @@
+import itertools
+import json
+import logging
+import os
+import shutil
+import subprocess
+import threading
+from concurrent.futures import Future
+from typing import Dict, Optional
+
+logger = logging.getLogger(__name__)
+
+WORKER_SCRIPT = os.path.join(os.path.dirname(os.path.abspath(__file__)), "node", "signal_worker.js")
+
+
+class NodeWorkerError(Exception):
+    pass
+
+
+class NodeWorker:
+    """常驻的Node.js子进程
+
+    只用于必须留在Node中完成的操作（例如Python端没有实现的Kyber密钥生成）。
+    进程只启动一次，请求和响应都是单行JSON（参数不会拼进JS源码），
+    按请求id匹配响应，进程退出后下次调用时自动重启。
+    """
+
+    def __init__(self, module_path: str, script_path: str = WORKER_SCRIPT, timeout: float = 10.0):
+        self.module_path = module_path
+        self.script_path = script_path
+        self.timeout = timeout
+        self._process: Optional[subprocess.Popen] = None
+        self._pending: Dict[int, Future] = {}
+        self._ids = itertools.count(1)
+        self._lock = threading.Lock()
+
+    def available(self) -> bool:
+        """本机是否有node和libsignal模块"""
+        return shutil.which("node") is not None and os.path.exists(self.module_path)
+
+    def _ensure_started(self) -> subprocess.Popen:
+        if self._process is not None and self._process.poll() is None:
+            return self._process
+        self._process = subprocess.Popen(
+            ["node", self.script_path, self.module_path],
+            cwd=self.module_path,
+            stdin=subprocess.PIPE,
+            stdout=subprocess.PIPE,
+            stderr=subprocess.DEVNULL,
+            text=True,
+            bufsize=1
+        )
+        reader = threading.Thread(target=self._read_responses, args=(self._process,), daemon=True)
+        reader.start()
+        logger.info("[Node辅助进程] 已启动 pid=%s", self._process.pid)
+        return self._process
+
+    def _read_responses(self, process: subprocess.Popen) -> None:
+        for line in process.stdout:
+            try:
+                response = json.loads(line)
+            except ValueError:
+                continue
+            with self._lock:
+                future = self._pending.pop(response.get("id"), None)
+            if future is None:
+                continue
+            if "error" in response:
+                future.set_exception(NodeWorkerError(response["error"]))
+            else:
+                future.set_result(response.get("result"))
+
+        # 进程退出：让等待中的请求立即失败
+        with self._lock:
+            pending, self._pending = self._pending, {}
+        for future in pending.values():
+            future.set_exception(NodeWorkerError("Node辅助进程已退出"))
+
+    def call(self, op: str, **params) -> Dict:
+        """发送一个请求并等待结果"""
+        future: Future = Future()
+        with self._lock:
+            process = self._ensure_started()
+            request_id = next(self._ids)
+            self._pending[request_id] = future
+            try:
+                process.stdin.write(json.dumps({"id": request_id, "op": op, "params": params}) + "\n")
+                process.stdin.flush()
+            except (BrokenPipeError, OSError) as e:
+                self._pending.pop(request_id, None)
+                raise NodeWorkerError(f"Node辅助进程不可用: {e}")
+        try:
+            return future.result(timeout=self.timeout)
+        except TimeoutError:
+            with self._lock:
+                self._pending.pop(request_id, None)
+            raise NodeWorkerError(f"Node辅助进程响应超时: {op}")
+
+    def close(self) -> None:
+        with self._lock:
+            process, self._process = self._process, None
+        if process is not None and process.poll() is None:
+            process.stdin.close()
+            try:
+                process.wait(timeout=2)
+            except subprocess.TimeoutExpired:
+                process.kill()
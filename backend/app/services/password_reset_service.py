@@ -1,7 +1,7 @@
 from sqlalchemy.orm import Session
 from app.db.database import SessionLocal
 from app.db.models import User
-from app.core.security import hash_password
+from app.core.security import hash_password, principal_cache
 from app.core.email_config import send_verification_email
 from app.services.verification_service import VerificationCodeService
 from fastapi import HTTPException
@@ -102,6 +102,7 @@ class PasswordResetService:
             hashed_password = hash_password(new_password)
             user.password_hash = hashed_password
             db.commit()
+            principal_cache.invalidate_user(user.id)
             
             # 密码重置成功后删除验证码
             VerificationCodeService.clear_code(email)
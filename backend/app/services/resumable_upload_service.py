@@ -0,0 +1,507 @@
+import asyncio
+import errno
+import hashlib
+import json
+import logging
+import os
+import re
+import shutil
+import time
+import uuid
+from dataclasses import dataclass, field, asdict
+from typing import AsyncIterator, Dict, List, Optional
+from fastapi import HTTPException
+from starlette.concurrency import run_in_threadpool
+from app.core import tracing
+from app.core.config import (
+    IMAGE_MAX_SIZE, RESUMABLE_FILE_MAX_SIZE, RESUMABLE_DEFAULT_CHUNK_SIZE, RESUMABLE_MAX_CHUNK_SIZE,
+    RESUMABLE_SESSION_TTL, RESUMABLE_GC_INTERVAL, RESUMABLE_MAX_SESSIONS_PER_USER
+)
+from app.db.database import SessionLocal
+from app.services import message_service
+from app.services.blob_store import blob_store
+from app.services.image_variant_service import image_variant_service
+from app.services.file_storage_service import (
+    BASE_DIR, validate_upload, save_stream, temp_path_for, remove_file_quietly
+)
+
+logger = logging.getLogger(__name__)
+
+# 未完成的上传会话：每个会话一个目录，包含 session.json 和已收到的分片
+SESSIONS_DIR = os.path.join(BASE_DIR, "static", "upload_sessions")
+os.makedirs(SESSIONS_DIR, exist_ok=True)
+
+MIN_CHUNK_SIZE = 64 * 1024
+_UPLOAD_ID_RE = re.compile(r'^[a-f0-9]{32}$')
+_SHA256_RE = re.compile(r'^[a-f0-9]{64}$')
+# copy_file_range/sendfile不可用时回退到普通读写的错误码
+_FALLBACK_ERRNOS = {errno.EXDEV, errno.ENOSYS, errno.EINVAL, errno.EOPNOTSUPP, errno.EBADF}
+_COPY_BLOCK_SIZE = 1024 * 1024
+
+
+@dataclass
+class UploadSession:
+    """一个断点续传上传会话"""
+    upload_id: str
+    user_id: int
+    to_id: int
+    file_name: str
+    file_type: str
+    file_extension: str
+    file_size: int
+    chunk_size: int
+    sha256: Optional[str]
+    message: Dict  # content, encrypted, method, destroy_after, hidding_message
+    chunks: Dict[int, str] = field(default_factory=dict)  # 分片序号 -> 分片SHA-256
+    created_at: float = field(default_factory=time.time)
+    updated_at: float = field(default_factory=time.time)
+
+    @property
+    def total_chunks(self) -> int:
+        return (self.file_size + self.chunk_size - 1) // self.chunk_size
+
+    def expected_chunk_length(self, index: int) -> int:
+        if index == self.total_chunks - 1:
+            return self.file_size - self.chunk_size * index
+        return self.chunk_size
+
+    def missing_chunks(self) -> List[int]:
+        return [i for i in range(self.total_chunks) if i not in self.chunks]
+
+    def received_ranges(self) -> List[List[int]]:
+        """已收到的字节区间 [start, end)，相邻分片合并"""
+        ranges: List[List[int]] = []
+        for index in sorted(self.chunks):
+            start = index * self.chunk_size
+            end = start + self.expected_chunk_length(index)
+            if ranges and ranges[-1][1] == start:
+                ranges[-1][1] = end
+            else:
+                ranges.append([start, end])
+        return ranges
+
+    def to_status(self) -> Dict:
+        return {
+            "uploadId": self.upload_id,
+            "fileName": self.file_name,
+            "fileSize": self.file_size,
+            "chunkSize": self.chunk_size,
+            "totalChunks": self.total_chunks,
+            "receivedChunks": sorted(self.chunks),
+            "receivedRanges": self.received_ranges(),
+            "missingChunks": self.missing_chunks(),
+            "complete": len(self.chunks) == self.total_chunks,
+            "expiresAt": int(self.updated_at + RESUMABLE_SESSION_TTL)
+        }
+
+    def to_json(self) -> str:
+        data = asdict(self)
+        data["chunks"] = {str(k): v for k, v in self.chunks.items()}
+        return json.dumps(data)
+
+    @classmethod
+    def from_json(cls, raw: str) -> "UploadSession":
+        data = json.loads(raw)
+        data["chunks"] = {int(k): v for k, v in data.get("chunks", {}).items()}
+        return cls(**data)
+
+
+def _copy_loop(copy_fn, src_fd: int, dst_fd: int, count: int) -> int:
+    """循环调用零拷贝函数直到复制count字节，返回已复制字节数"""
+    copied = 0
+    while copied < count:
+        n = copy_fn(src_fd, dst_fd, count - copied)
+        if n == 0:
+            raise OSError(errno.EIO, "分片文件意外结束")
+        copied += n
+    return copied
+
+
+def _read_write(src_fd: int, dst_fd: int, count: int) -> int:
+    data = os.read(src_fd, min(count, _COPY_BLOCK_SIZE))
+    view = memoryview(data)
+    while view:
+        written = os.write(dst_fd, view)
+        view = view[written:]
+    return len(data)
+
+
+def _copy_file_range(src_fd: int, dst_fd: int, count: int) -> int:
+    return os.copy_file_range(src_fd, dst_fd, count)
+
+
+def _sendfile(src_fd: int, dst_fd: int, count: int) -> int:
+    return os.sendfile(dst_fd, src_fd, None, count)
+
+
+def _append_file(src_fd: int, dst_fd: int, count: int) -> None:
+    """把src的全部内容追加到dst
+
+    优先使用内核内复制（copy_file_range，其次sendfile），数据不经过用户态；
+    两者都不可用时回退为分块读写。只有在一个字节都没复制时才回退，避免重复写入。
+    """
+    copiers = []
+    if hasattr(os, "copy_file_range"):
+        copiers.append(_copy_file_range)
+    if hasattr(os, "sendfile"):
+        copiers.append(_sendfile)
+    for copier in copiers:
+        start = os.lseek(dst_fd, 0, os.SEEK_CUR)
+        try:
+            _copy_loop(copier, src_fd, dst_fd, count)
+            return
+        except OSError as e:
+            if e.errno not in _FALLBACK_ERRNOS or os.lseek(dst_fd, 0, os.SEEK_CUR) != start:
+                raise
+    _copy_loop(_read_write, src_fd, dst_fd, count)
+
+
+def _hash_file(path: str, hasher) -> None:
+    with open(path, "rb") as f:
+        while True:
+            block = f.read(_COPY_BLOCK_SIZE)
+            if not block:
+                break
+            hasher.update(block)
+
+
+@tracing.traced(tracing.FILE_IO)
+def _assemble_chunks(chunk_paths: List[str], dest_path: str) -> str:
+    """按顺序把分片拼接为最终文件，返回整个文件的SHA-256"""
+    os.makedirs(os.path.dirname(dest_path), exist_ok=True)
+    tmp_path = temp_path_for(dest_path)
+    hasher = hashlib.sha256()
+    try:
+        with open(tmp_path, "wb") as dst:
+            for chunk_path in chunk_paths:
+                # 分片刚写入不久，哈希读取基本命中页缓存
+                _hash_file(chunk_path, hasher)
+                with open(chunk_path, "rb") as src:
+                    _append_file(src.fileno(), dst.fileno(), os.fstat(src.fileno()).st_size)
+            dst.flush()
+            os.fsync(dst.fileno())
+        os.replace(tmp_path, dest_path)
+    except BaseException:
+        remove_file_quietly(tmp_path)
+        raise
+    return hasher.hexdigest()
+
+
+def _create_file_message(session: UploadSession, relative_file_path: str):
+    """通过message_service创建文件消息（与普通上传一致，始终保存到服务器数据库）"""
+    content = session.message.get("content")
+    if not content:
+        if session.file_type == "image":
+            content = f"发送了图片: {session.file_name}"
+        else:
+            content = f"发送了文件: {session.file_name}"
+
+    db = SessionLocal()
+    try:
+        return message_service.send_message(
+            db=db,
+            from_id=session.user_id,
+            to_id=session.to_id,
+            content=content,
+            message_type=session.file_type,
+            file_path=relative_file_path,
+            file_name=session.file_name,
+            encrypted=session.message.get("encrypted", True),
+            method=session.message.get("method", "Server"),
+            destroy_after=session.message.get("destroy_after"),
+            hidding_message=session.message.get("hidding_message"),
+            recipient_online=False
+        )
+    finally:
+        db.close()
+
+
+class ResumableUploadService:
+    """断点续传上传服务
+
+    协议：创建会话 -> 以任意顺序PUT带校验和的分片（幂等）-> 查询已收到的区间 -> 完成。
+    分片直接落盘，内存占用只与单个分片读取块大小有关，和文件总大小无关。
+    会话元数据持久化在会话目录中，服务重启后仍可继续上传；
+    长时间无活动的会话由后台任务回收。会话状态只在事件循环线程中修改，
+    修改分片记录、完成、取消和回收都持有该会话的锁。
+    """
+
+    def __init__(self, sessions_dir: str = SESSIONS_DIR):
+        self.sessions_dir = sessions_dir
+        self._sessions: Dict[str, UploadSession] = {}
+        self._locks: Dict[str, asyncio.Lock] = {}
+        # 磁盘上所有会话的创建者（包括重启前创建、尚未加载到内存的会话），用于每个用户的会话数上限
+        self._owners: Dict[str, int] = {}
+        self._gc_task: Optional[asyncio.Task] = None
+
+    def _session_dir(self, upload_id: str) -> str:
+        return os.path.join(self.sessions_dir, upload_id)
+
+    def _meta_path(self, upload_id: str) -> str:
+        return os.path.join(self._session_dir(upload_id), "session.json")
+
+    def _chunk_path(self, upload_id: str, index: int) -> str:
+        return os.path.join(self._session_dir(upload_id), f"{index}.chunk")
+
+    def _lock(self, upload_id: str) -> asyncio.Lock:
+        lock = self._locks.get(upload_id)
+        if lock is None:
+            lock = self._locks[upload_id] = asyncio.Lock()
+        return lock
+
+    @tracing.traced(tracing.FILE_IO)
+    def _persist(self, session: UploadSession) -> None:
+        meta_path = self._meta_path(session.upload_id)
+        tmp_path = temp_path_for(meta_path)
+        with open(tmp_path, "w") as f:
+            f.write(session.to_json())
+        os.replace(tmp_path, meta_path)
+
+    @tracing.traced(tracing.FILE_IO)
+    def _load(self, upload_id: str) -> Optional[UploadSession]:
+        try:
+            with open(self._meta_path(upload_id), "r") as f:
+                return UploadSession.from_json(f.read())
+        except (OSError, ValueError, TypeError):
+            return None
+
+    async def _forget(self, upload_id: str) -> None:
+        """删除会话（调用方持有该会话的锁）"""
+        self._sessions.pop(upload_id, None)
+        self._locks.pop(upload_id, None)
+        self._owners.pop(upload_id, None)
+        await run_in_threadpool(shutil.rmtree, self._session_dir(upload_id), ignore_errors=True)
+
+    def _scan(self) -> Dict[str, tuple]:
+        """读取磁盘上的所有会话：upload_id -> (创建者, 最后活动时间)，元数据损坏时创建者为None"""
+        persisted = {}
+        try:
+            upload_ids = os.listdir(self.sessions_dir)
+        except FileNotFoundError:
+            return persisted
+        for upload_id in upload_ids:
+            if not _UPLOAD_ID_RE.match(upload_id):
+                continue
+            session = self._load(upload_id)
+            if session is not None:
+                persisted[upload_id] = (session.user_id, session.updated_at)
+                continue
+            try:
+                persisted[upload_id] = (None, os.path.getmtime(self._session_dir(upload_id)))
+            except OSError:
+                continue
+        return persisted
+
+    async def create_session(self, user_id: int, file_name: str, file_size: int, to_id: int,
+                             file_type: str = "file", content_type: Optional[str] = None,
+                             chunk_size: Optional[int] = None, sha256: Optional[str] = None,
+                             message: Optional[Dict] = None) -> UploadSession:
+        """创建上传会话"""
+        if not file_name:
+            raise HTTPException(status_code=400, detail="请选择要上传的文件")
+        if file_type not in ("image", "file"):
+            raise HTTPException(status_code=400, detail="无效的文件类型")
+        file_extension = validate_upload(file_name, file_type, content_type)
+
+        max_size = IMAGE_MAX_SIZE if file_type == "image" else RESUMABLE_FILE_MAX_SIZE
+        if file_size <= 0:
+            raise HTTPException(status_code=400, detail="文件内容为空")
+        if file_size > max_size:
+            raise HTTPException(status_code=400, detail=f"文件大小不能超过{max_size // (1024*1024)}MB")
+        if sha256 is not None and not _SHA256_RE.match(sha256.lower()):
+            raise HTTPException(status_code=400, detail="无效的SHA-256校验和")
+
+        active = sum(1 for owner in self._owners.values() if owner == user_id)
+        if active >= RESUMABLE_MAX_SESSIONS_PER_USER:
+            raise HTTPException(status_code=429, detail="未完成的上传会话过多")
+
+        chunk_size = min(max(chunk_size or RESUMABLE_DEFAULT_CHUNK_SIZE, MIN_CHUNK_SIZE), RESUMABLE_MAX_CHUNK_SIZE)
+        session = UploadSession(
+            upload_id=uuid.uuid4().hex,
+            user_id=user_id,
+            to_id=to_id,
+            file_name=file_name,
+            file_type=file_type,
+            file_extension=file_extension,
+            file_size=file_size,
+            chunk_size=chunk_size,
+            sha256=sha256.lower() if sha256 else None,
+            message=message or {}
+        )
+        os.makedirs(self._session_dir(session.upload_id), exist_ok=True)
+        await run_in_threadpool(self._persist, session)
+        self._sessions[session.upload_id] = session
+        self._owners[session.upload_id] = user_id
+        return session
+
+    async def get_session(self, upload_id: str, user_id: int) -> UploadSession:
+        """获取会话（内存中没有时从磁盘恢复），只允许创建者访问"""
+        if not _UPLOAD_ID_RE.match(upload_id):
+            raise HTTPException(status_code=400, detail="无效的上传会话ID")
+        session = self._sessions.get(upload_id)
+        if session is None:
+            session = await run_in_threadpool(self._load, upload_id)
+            if session is not None:
+                self._sessions[upload_id] = session
+                self._owners[upload_id] = session.user_id
+        if session is None or session.user_id != user_id:
+            raise HTTPException(status_code=404, detail="上传会话不存在或已过期")
+        return session
+
+    async def put_chunk(self, upload_id: str, user_id: int, index: int,
+                        stream: AsyncIterator[bytes], checksum: str) -> UploadSession:
+        """保存一个分片
+
+        幂等：同一分片以相同校验和重复上传直接返回成功；校验和不同则拒绝。
+        分片可以乱序到达。内容先写入临时文件，持有会话锁重新检查后才放到分片位置，
+        同一分片的并发上传只有一个生效。
+        """
+        session = await self.get_session(upload_id, user_id)
+        if index < 0 or index >= session.total_chunks:
+            raise HTTPException(status_code=400, detail="分片序号超出范围")
+        checksum = (checksum or "").lower()
+        if not _SHA256_RE.match(checksum):
+            raise HTTPException(status_code=400, detail="无效的分片校验和")
+
+        existing = session.chunks.get(index)
+        if existing is not None:
+            if existing != checksum:
+                raise HTTPException(status_code=409, detail="分片已存在且校验和不一致")
+            return session
+
+        # 分片写入期间视为有活动，避免被回收任务当作过期会话删除
+        session.updated_at = time.time()
+        expected_length = session.expected_chunk_length(index)
+        chunk_path = self._chunk_path(upload_id, index)
+        staged_path = temp_path_for(chunk_path)
+        stored = await save_stream(stream, staged_path, expected_length, empty_detail="分片内容为空")
+        if stored.size != expected_length:
+            remove_file_quietly(staged_path)
+            raise HTTPException(status_code=400, detail="分片大小不正确")
+        if stored.sha256 != checksum:
+            remove_file_quietly(staged_path)
+            raise HTTPException(status_code=400, detail="分片校验和不匹配")
+
+        async with self._lock(upload_id):
+            if self._sessions.get(upload_id) is not session:
+                # 写入分片期间会话已被取消或回收
+                remove_file_quietly(staged_path)
+                raise HTTPException(status_code=404, detail="上传会话不存在或已过期")
+            existing = session.chunks.get(index)
+            if existing is not None:
+                # 同一分片的并发上传已先完成
+                remove_file_quietly(staged_path)
+                if existing != checksum:
+                    raise HTTPException(status_code=409, detail="分片已存在且校验和不一致")
+                return session
+            os.replace(staged_path, chunk_path)
+            session.chunks[index] = checksum
+            session.updated_at = time.time()
+            await run_in_threadpool(self._persist, session)
+        return session
+
+    async def complete(self, upload_id: str, user_id: int):
+        """拼接所有分片并创建文件消息，返回消息对象"""
+        session = await self.get_session(upload_id, user_id)
+        async with self._lock(upload_id):
+            if self._sessions.get(upload_id) is not session:
+                raise HTTPException(status_code=404, detail="上传会话不存在或已过期")
+            missing = session.missing_chunks()
+            if missing:
+                raise HTTPException(status_code=400, detail=f"仍有{len(missing)}个分片未上传")
+
+            # 拼接到内容存储的临时文件，校验通过后按哈希放入存储（相同内容只保留一份）
+            file_path = blob_store.new_temp_path()
+            chunk_paths = [self._chunk_path(upload_id, i) for i in range(session.total_chunks)]
+            try:
+                sha256 = await run_in_threadpool(_assemble_chunks, chunk_paths, file_path)
+            except Exception as e:
+                raise HTTPException(status_code=500, detail=f"文件保存失败: {str(e)}")
+
+            if session.sha256 and sha256 != session.sha256:
+                remove_file_quietly(file_path)
+                raise HTTPException(status_code=400, detail="文件校验和不匹配")
+
+            try:
+                deduplicated = await run_in_threadpool(blob_store.ingest, file_path, sha256, session.file_size)
+            except Exception as e:
+                remove_file_quietly(file_path)
+                raise HTTPException(status_code=500, detail=f"文件保存失败: {str(e)}")
+            if session.file_type == "image" and not deduplicated:
+                image_variant_service.schedule(blob_store.path_for(sha256))
+            relative_file_path = blob_store.make_name(sha256, session.file_extension)
+
+            try:
+                message = await run_in_threadpool(_create_file_message, session, relative_file_path)
+            except Exception as e:
+                await run_in_threadpool(blob_store.release_name, relative_file_path)
+                raise HTTPException(status_code=500, detail=f"保存消息失败: {str(e)}")
+
+            await self._forget(upload_id)
+            return message
+
+    async def abort(self, upload_id: str, user_id: int) -> None:
+        """取消上传并删除已收到的分片"""
+        session = await self.get_session(upload_id, user_id)
+        async with self._lock(upload_id):
+            if self._sessions.get(upload_id) is session:
+                await self._forget(upload_id)
+
+    async def collect_garbage(self, now: Optional[float] = None) -> int:
+        """删除超过TTL没有活动的会话，返回删除数量
+
+        在事件循环中执行，只有扫描磁盘放到线程池；删除前持有会话的锁并重新确认已过期，
+        不会与正在进行的分片写入或完成操作冲突。
+        """
+        now = now or time.time()
+        persisted = await run_in_threadpool(self._scan)
+        for upload_id, (owner, _) in persisted.items():
+            if owner is not None:
+                self._owners.setdefault(upload_id, owner)
+
+        removed = 0
+        for upload_id, (_, last_active) in persisted.items():
+            session = self._sessions.get(upload_id)
+            if now - (session.updated_at if session is not None else last_active) <= RESUMABLE_SESSION_TTL:
+                continue
+            async with self._lock(upload_id):
+                # 等待锁期间会话可能刚有活动、已完成或已被加载
+                session = self._sessions.get(upload_id)
+                if session is not None and now - session.updated_at <= RESUMABLE_SESSION_TTL:
+                    continue
+                await self._forget(upload_id)
+                removed += 1
+        return removed
+
+    async def _collect_and_log(self):
+        try:
+            removed = await self.collect_garbage()
+            if removed:
+                logger.info("[断点续传] 回收了 %d 个过期上传会话", removed)
+        except Exception as e:
+            logger.error("[断点续传] 回收过期上传会话失败: %s", e)
+
+    async def _gc_loop(self):
+        while True:
+            await asyncio.sleep(RESUMABLE_GC_INTERVAL)
+            await self._collect_and_log()
+
+    async def start_gc(self):
+        """回收一次过期会话（同时登记重启前的会话创建者），然后启动定期回收任务"""
+        if self._gc_task is None:
+            await self._collect_and_log()
+            self._gc_task = asyncio.create_task(self._gc_loop())
+
+    async def stop_gc(self):
+        """停止过期会话回收任务"""
+        if self._gc_task is not None:
+            self._gc_task.cancel()
+            try:
+                await self._gc_task
+            except asyncio.CancelledError:
+                pass
+            self._gc_task = None
+
+
+# 全局断点续传服务实例
+resumable_upload_service = ResumableUploadService()
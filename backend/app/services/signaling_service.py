@@ -1,36 +1,174 @@
-from app.db.database import SessionLocal
-from app.db.models import SignalingMessage
-from datetime import datetime
+import asyncio
+import itertools
 import json
+import logging
+import time
+from collections import deque
+from datetime import datetime
+from typing import Deque, Dict, List, Optional, Set
+from app.core.config import SIGNALING_TTL, SIGNALING_MAILBOX_SIZE, SIGNALING_LONG_POLL_MAX
+from app.core.metrics import metrics
+
+logger = logging.getLogger(__name__)
+
+ICE_CANDIDATE = 'ice-candidate'
+ICE_CANDIDATES = 'ice-candidates'
+
+
+class SignalingMailbox:
+    """内存中的信令中转（替代signaling_messages表）
+
+    信令只在通话建立的几秒内有意义，不需要持久化：
+    - 接收方有WebSocket连接时直接推送 {"type": "signaling", "data": 信令}
+    - 否则放入接收方的有界队列，每条信令SIGNALING_TTL秒后过期，队列满时丢弃最早的
+    - 同一发送方连续排队的ICE候选合并为一条 ice-candidates，data为候选列表
+    - REST客户端通过 take()/wait() 取走，wait() 在没有信令时最多等待timeout秒（长轮询）
+    所有方法都在事件循环线程中调用。
+    """
+
+    def __init__(self, max_entries: int = SIGNALING_MAILBOX_SIZE, ttl: int = SIGNALING_TTL):
+        self.max_entries = max_entries
+        self.ttl = ttl
+        self.connection_manager = None
+        self._boxes: Dict[int, Deque[dict]] = {}
+        self._waiters: Dict[int, Set[asyncio.Event]] = {}
+        self._ids = itertools.count(1)
+        self._gc_task: Optional[asyncio.Task] = None
+        self.delivered_ws = 0
+        self.queued = 0
+        self.coalesced = 0
+        self.expired = 0
+        self.dropped = 0
+
+    def attach(self, connection_manager) -> None:
+        """关联WebSocket连接管理器，用于直接推送"""
+        self.connection_manager = connection_manager
+
+    def _entry(self, from_user_id: int, msg_type: str, data) -> dict:
+        return {
+            "id": next(self._ids),
+            "type": msg_type,
+            "fromUserId": from_user_id,
+            "data": data,
+            "timestamp": datetime.utcnow().isoformat()
+        }
+
+    async def post(self, from_user_id: int, to_user_id: int, msg_type: str, data) -> str:
+        """投递一条信令，返回 'websocket' 或 'queued'"""
+        ws = self.connection_manager.get(to_user_id) if self.connection_manager else None
+        if ws is not None:
+            try:
+                await ws.send_text(json.dumps({"type": "signaling", "data": self._entry(from_user_id, msg_type, data)}))
+                self.delivered_ws += 1
+                return 'websocket'
+            except Exception as e:
+                logger.warning("[信令] 推送给用户 %s 失败，改为排队: %s", to_user_id, e)
+
+        box = self._boxes.get(to_user_id)
+        if box is None:
+            box = self._boxes[to_user_id] = deque()
+        self._purge(box)
+
+        last = box[-1][1] if box else None
+        if (msg_type == ICE_CANDIDATE and last is not None
+                and last["type"] == ICE_CANDIDATES and last["fromUserId"] == from_user_id):
+            last["data"].append(data)
+            self.coalesced += 1
+        else:
+            if msg_type == ICE_CANDIDATE:
+                entry = self._entry(from_user_id, ICE_CANDIDATES, [data])
+            else:
+                entry = self._entry(from_user_id, msg_type, data)
+            if len(box) >= self.max_entries:
+                box.popleft()
+                self.dropped += 1
+            box.append((time.monotonic() + self.ttl, entry))
+        self.queued += 1
+
+        for waiter in self._waiters.get(to_user_id, ()):
+            waiter.set()
+        return 'queued'
+
+    def _purge(self, box: Deque) -> None:
+        now = time.monotonic()
+        while box and box[0][0] <= now:
+            box.popleft()
+            self.expired += 1
+
+    def take(self, user_id: int) -> List[dict]:
+        """取走用户所有未过期的信令"""
+        box = self._boxes.pop(user_id, None)
+        if not box:
+            return []
+        self._purge(box)
+        return [entry for _, entry in box]
+
+    async def wait(self, user_id: int, timeout: float) -> List[dict]:
+        """长轮询：有信令立即返回，否则最多等待timeout秒"""
+        entries = self.take(user_id)
+        timeout = min(max(timeout, 0), SIGNALING_LONG_POLL_MAX)
+        if entries or timeout <= 0:
+            return entries
+
+        waiter = asyncio.Event()
+        self._waiters.setdefault(user_id, set()).add(waiter)
+        try:
+            await asyncio.wait_for(waiter.wait(), timeout)
+        except asyncio.TimeoutError:
+            pass
+        finally:
+            waiters = self._waiters.get(user_id)
+            if waiters is not None:
+                waiters.discard(waiter)
+                if not waiters:
+                    del self._waiters[user_id]
+        return self.take(user_id)
+
+    def purge_expired(self) -> int:
+        """清理所有过期信令和空队列，返回清理的条数"""
+        before = self.expired
+        for user_id in list(self._boxes):
+            box = self._boxes[user_id]
+            self._purge(box)
+            if not box:
+                del self._boxes[user_id]
+        return self.expired - before
+
+    async def _gc_loop(self):
+        while True:
+            await asyncio.sleep(self.ttl)
+            try:
+                self.purge_expired()
+            except Exception as e:
+                logger.error("[信令] 清理过期信令失败: %s", e)
+
+    async def start_gc(self):
+        """启动过期信令清理任务"""
+        if self._gc_task is None:
+            self._gc_task = asyncio.create_task(self._gc_loop())
+
+    async def stop_gc(self):
+        """停止过期信令清理任务"""
+        if self._gc_task is not None:
+            self._gc_task.cancel()
+            try:
+                await self._gc_task
+            except asyncio.CancelledError:
+                pass
+            self._gc_task = None
+
+    def stats(self) -> dict:
+        return {
+            "users": len(self._boxes),
+            "queued_entries": sum(len(box) for box in self._boxes.values()),
+            "delivered_ws": self.delivered_ws,
+            "queued": self.queued,
+            "coalesced": self.coalesced,
+            "expired": self.expired,
+            "dropped": self.dropped
+        }
+
 
-def save_signaling_message(from_user_id: int, to_user_id: int, msg_type: str, data: dict):
-    db = SessionLocal()
-    msg = SignalingMessage(
-        from_user_id=from_user_id,
-        to_user_id=to_user_id,
-        msg_type=msg_type,
-        data=json.dumps(data),
-        timestamp=datetime.utcnow(),
-        is_handled=False
-    )
-    db.add(msg)
-    db.commit()
-    db.close()
-    return True
-
-def get_pending_signaling(user_id: int):
-    db = SessionLocal()
-    msgs = db.query(SignalingMessage).filter_by(to_user_id=user_id, is_handled=False).all()
-    result = []
-    for m in msgs:
-        result.append({
-            "id": m.id,
-            "type": m.msg_type,
-            "fromUserId": m.from_user_id,
-            "data": json.loads(m.data),
-            "timestamp": m.timestamp
-        })
-        m.is_handled = True
-    db.commit()
-    db.close()
-    return result
\ No newline at end of file
+# 全局信令邮箱
+signaling_mailbox = SignalingMailbox()
+metrics.register_stats('signaling_mailbox', signaling_mailbox.stats)
@@ -0,0 +1,153 @@
+import logging
+import os
+import stat
+import threading
+import time
+from collections import OrderedDict
+from email.utils import formatdate, parsedate_to_datetime
+from typing import Dict, Optional
+from fastapi import Request
+from fastapi.responses import FileResponse, Response
+
+# 内容寻址文件名永不复用，可以让浏览器和CDN永久缓存
+IMMUTABLE_CACHE_CONTROL = "public, max-age=31536000, immutable"
+DEFAULT_CACHE_CONTROL = "public, max-age=3600"
+
+# stat结果缓存：热点文件（聊天列表里的图片、头像）不必每次请求都访问文件系统
+_STAT_CACHE_TTL = 5.0
+_STAT_CACHE_SIZE = 4096
+
+# 这些路径的访问日志量大且没有排查价值
+_QUIET_ACCESS_PREFIXES = ("/api/v1/images/", "/api/v1/files/", "/api/v1/avatar/")
+
+
+class _StatCache:
+    """按路径缓存os.stat结果（LRU + 短TTL），文件被删除或替换后最多延迟TTL秒生效"""
+
+    def __init__(self, ttl: float = _STAT_CACHE_TTL, max_size: int = _STAT_CACHE_SIZE):
+        self.ttl = ttl
+        self.max_size = max_size
+        self._entries: "OrderedDict[str, tuple]" = OrderedDict()
+        self._lock = threading.Lock()
+
+    def get(self, path: str) -> Optional[os.stat_result]:
+        now = time.monotonic()
+        with self._lock:
+            entry = self._entries.get(path)
+            if entry is not None and entry[0] > now:
+                self._entries.move_to_end(path)
+                return entry[1]
+        try:
+            result = os.stat(path)
+        except OSError:
+            self.invalidate(path)
+            return None
+        if not stat.S_ISREG(result.st_mode):
+            return None
+        with self._lock:
+            self._entries[path] = (now + self.ttl, result)
+            self._entries.move_to_end(path)
+            while len(self._entries) > self.max_size:
+                self._entries.popitem(last=False)
+        return result
+
+    def invalidate(self, path: str) -> None:
+        with self._lock:
+            self._entries.pop(path, None)
+
+
+stat_cache = _StatCache()
+
+
+def stat_file(path: str) -> Optional[os.stat_result]:
+    """返回普通文件的stat结果，不存在或不是文件时返回None"""
+    return stat_cache.get(path)
+
+
+def stat_etag(stat_result: os.stat_result) -> str:
+    """没有内容哈希的文件（旧格式上传、头像）用修改时间和大小生成ETag"""
+    return f'"{stat_result.st_mtime_ns:x}-{stat_result.st_size:x}"'
+
+
+def _etag_matches(if_none_match: str, etag: str) -> bool:
+    if if_none_match.strip() == "*":
+        return True
+    # If-None-Match使用弱比较
+    target = etag[2:] if etag.startswith("W/") else etag
+    for candidate in if_none_match.split(","):
+        candidate = candidate.strip()
+        if candidate.startswith("W/"):
+            candidate = candidate[2:]
+        if candidate == target:
+            return True
+    return False
+
+
+def _not_modified_since(if_modified_since: str, stat_result: os.stat_result) -> bool:
+    try:
+        since = parsedate_to_datetime(if_modified_since)
+    except (TypeError, ValueError):
+        return False
+    return since is not None and int(stat_result.st_mtime) <= since.timestamp()
+
+
+def file_response(
+    request: Request,
+    path: str,
+    stat_result: os.stat_result,
+    media_type: str,
+    etag: Optional[str] = None,
+    immutable: bool = False,
+    headers: Optional[Dict[str, str]] = None
+) -> Response:
+    """返回支持条件请求和Range请求的文件响应
+
+    - 带ETag和Last-Modified，If-None-Match / If-Modified-Since 命中时返回304；
+    - Range / If-Range 由Starlette的FileResponse处理，支持断点续传下载；
+    - 传入stat结果，FileResponse不再重复stat。
+    """
+    etag = etag or stat_etag(stat_result)
+    response_headers = {
+        "ETag": etag,
+        "Last-Modified": formatdate(stat_result.st_mtime, usegmt=True),
+        "Cache-Control": IMMUTABLE_CACHE_CONTROL if immutable else DEFAULT_CACHE_CONTROL,
+    }
+    if headers:
+        response_headers.update(headers)
+
+    if_none_match = request.headers.get("if-none-match")
+    if if_none_match is not None:
+        not_modified = _etag_matches(if_none_match, etag)
+    else:
+        if_modified_since = request.headers.get("if-modified-since")
+        not_modified = if_modified_since is not None and _not_modified_since(if_modified_since, stat_result)
+    if not_modified:
+        # 304只需要带缓存相关的头
+        return Response(status_code=304, headers={
+            key: value for key, value in response_headers.items()
+            if key in ("ETag", "Last-Modified", "Cache-Control", "Vary")
+        })
+
+    return FileResponse(path, media_type=media_type, headers=response_headers, stat_result=stat_result)
+
+
+class QuietAccessLogFilter(logging.Filter):
+    """过滤图片、文件和头像请求的访问日志
+
+    替代原来每个请求临时调高uvicorn.access日志级别的做法：那样会影响同时处理的其他请求，
+    而且访问日志在响应结束后才输出，恢复级别后实际并不生效。
+    """
+
+    def filter(self, record: logging.LogRecord) -> bool:
+        args = record.args
+        # uvicorn访问日志的参数为 (client_addr, method, full_path, http_version, status_code)
+        if isinstance(args, tuple) and len(args) >= 3 and isinstance(args[2], str):
+            return not args[2].startswith(_QUIET_ACCESS_PREFIXES)
+        return True
+
+
+def install_access_log_filter() -> None:
+    """为uvicorn.access安装一次访问日志过滤器"""
+    access_logger = logging.getLogger("uvicorn.access")
+    if not any(isinstance(f, QuietAccessLogFilter) for f in access_logger.filters):
+        access_logger.addFilter(QuietAccessLogFilter())
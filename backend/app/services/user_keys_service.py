@@ -10,6 +10,8 @@ from cryptography.hazmat.primitives import hashes, serialization
 from cryptography.hazmat.primitives.asymmetric import rsa
 from cryptography.hazmat.primitives.kdf.pbkdf2 import PBKDF2HMAC
 from cryptography.fernet import Fernet
+from app.services.keypair_pool import KeypairPool
+from app.core.metrics import metrics
 
 class UserKeysService:
     """用户密钥管理服务"""
@@ -78,8 +80,8 @@ class UserKeysService:
                 db.close()
                 raise HTTPException(status_code=400, detail="用户密钥已存在")
             
-            # 生成RSA密钥对
-            public_key, private_key = UserKeysService.generate_rsa_keypair()
+            # 从预生成的密钥池中取出RSA密钥对（池为空时同步生成）
+            public_key, private_key = rsa_keypair_pool.take()
             
             # 加密私钥
             encrypted_private_key, salt = UserKeysService._encrypt_private_key(private_key, password)
@@ -193,8 +195,8 @@ class UserKeysService:
                     "message": "用户密钥不存在"
                 }
             
-            # 生成新的密钥对
-            public_key, private_key = UserKeysService.generate_rsa_keypair()
+            # 从预生成的密钥池中取出新的密钥对（池为空时同步生成）
+            public_key, private_key = rsa_keypair_pool.take()
             encrypted_private_key, salt = UserKeysService._encrypt_private_key(private_key, password)
             
             # 更新密钥
@@ -246,4 +248,9 @@ class UserKeysService:
             db.rollback()
             raise HTTPException(status_code=500, detail=f"密钥删除失败: {str(e)}")
         finally:
-            db.close()
\ No newline at end of file
+            db.close()
+
+
+# 全局RSA密钥对池
+rsa_keypair_pool = KeypairPool(UserKeysService.generate_rsa_keypair, name="rsa")
+metrics.register_stats('rsa_keypair_pool', rsa_keypair_pool.stats)
@@ -1,3 +1,4 @@
+from sqlalchemy.exc import IntegrityError
 from sqlalchemy.orm import Session
 from app.db.models import User
 from app.core.security import hash_password, verify_password, create_access_token
@@ -5,79 +6,72 @@ from app.schemas.user import UserCreate, UserLogin, UserOut, TokenData
 from app.db.database import SessionLocal
 from fastapi import HTTPException
 from datetime import datetime
-from app.services.encryption_service import encryption_service
-from app.services.user_keys_service import UserKeysService
+from starlette.concurrency import run_in_threadpool
+from app.services.cpu_executor import cpu_executor
+from app.services.key_setup_service import key_setup_service
 
-def register_user(user: UserCreate):
+def _find_existing_user(username: str, email: str) -> bool:
     db: Session = SessionLocal()
     try:
-        # 检查用户是否已存在
-        db_user = db.query(User).filter((User.username == user.username) | (User.email == user.email)).first()
-        if db_user:
-            db.close()
-            raise HTTPException(status_code=400, detail="用户名或邮箱已存在")
-        
-        # 创建用户
-        hashed_password = hash_password(user.password)
-        db_user = User(username=user.username, password_hash=hashed_password, email=user.email, public_key=None)
+        return db.query(User.id).filter((User.username == username) | (User.email == email)).first() is not None
+    finally:
+        db.close()
+
+def _create_user(username: str, email: str, password_hash: str) -> UserOut:
+    db: Session = SessionLocal()
+    try:
+        db_user = User(username=username, password_hash=password_hash, email=email, public_key=None)
         db.add(db_user)
         db.commit()
         db.refresh(db_user)
-        
-        # 为新用户创建密钥对
-        keys_result = UserKeysService.create_user_keys(db_user.id, user.password)
-        if not keys_result.get('success'):
-            print(f"Warning: Failed to create keys for user {db_user.id}: {keys_result.get('message')}")
-        
-        # 为新用户设置端到端加密（保持原有逻辑）
-        encryption_result = encryption_service.setup_user_encryption(db_user.id)
-        if not encryption_result.get('success'):
-            print(f"Warning: Failed to setup encryption for user {db_user.id}: {encryption_result.get('error')}")
-        
-        # 更新用户的public_key字段（使用新生成的密钥）
-        if keys_result.get('success'):
-            db_user.public_key = keys_result['data']['public_key']
-            db.commit()
-        
-        user_out = UserOut(
+        return UserOut(
             id=str(db_user.id),
             username=str(db_user.username),
             email=str(db_user.email),
             avatar=db_user.avatar,
             created_at=db_user.created_at
         )
-        token = create_access_token({"sub": db_user.username})
-        
-        response_data = {"user": user_out, "token": token}
-        
-        # 添加密钥信息到响应（不包含私钥，私钥应该保密）
-        if keys_result.get('success'):
-            response_data["keys"] = {
-                "public_key": keys_result['data']['public_key'],
-                "key_version": keys_result['data']['key_version'],
-                "has_private_key": True
-            }
-        
-        # 添加原有加密信息
-        if encryption_result.get('success'):
-            response_data["encryption"] = {
-                "public_key": encryption_result['public_key'],
-                "registration_id": encryption_result['registration_id']
-            }
-        
-        return {"success": True, "message": "注册成功", "data": response_data}
-        
-    except Exception as e:
+    except IntegrityError:
+        # 查重与写入之间有同名用户并发注册，由唯一约束拦下
+        db.rollback()
+        raise HTTPException(status_code=400, detail="用户名或邮箱已存在")
+    except Exception:
         db.rollback()
-        raise e
+        raise
     finally:
         db.close()
 
-def authenticate_user(user: UserLogin):
+def _get_user_by_username(username: str):
     db: Session = SessionLocal()
-    db_user = db.query(User).filter(User.username == user.username).first()
-    if not db_user or not verify_password(user.password, str(db_user.password_hash)):
+    try:
+        return db.query(User).filter(User.username == username).first()
+    finally:
         db.close()
+
+async def register_user(user: UserCreate):
+    """注册用户
+
+    密码哈希在CPU线程池中执行；用户记录写入后立即返回，
+    密钥生成作为后台任务继续执行，客户端通过key_setup.job_id查询进度。
+    """
+    # 检查用户是否已存在
+    if await run_in_threadpool(_find_existing_user, user.username, user.email):
+        raise HTTPException(status_code=400, detail="用户名或邮箱已存在")
+    
+    # 创建用户
+    hashed_password = await cpu_executor.run("bcrypt_hash", hash_password, user.password)
+    user_out = await run_in_threadpool(_create_user, user.username, user.email, hashed_password)
+    
+    # 在后台为新用户创建密钥对并设置端到端加密
+    job = key_setup_service.submit(int(user_out.id), user.password)
+    
+    token = create_access_token({"sub": user_out.username})
+    response_data = {"user": user_out, "token": token, "key_setup": job.to_dict()}
+    return {"success": True, "message": "注册成功", "data": response_data}
+
+async def authenticate_user(user: UserLogin):
+    db_user = await run_in_threadpool(_get_user_by_username, user.username)
+    if not db_user or not await cpu_executor.run("bcrypt_verify", verify_password, user.password, str(db_user.password_hash)):
         raise HTTPException(status_code=401, detail="用户名或密码错误")
     user_out = UserOut(
         id=str(db_user.id),
@@ -87,8 +81,12 @@ def authenticate_user(user: UserLogin):
         created_at=db_user.created_at
     )
     token = create_access_token({"sub": db_user.username})
-    db.close()
-    return {"success": True, "message": "登录成功", "data": {"user": user_out, "token": token}}
+    data = {"user": user_out, "token": token}
+    # 注册后的密钥生成未完成（失败或服务器重启中断）时，借本次登录的密码重新执行
+    job = await key_setup_service.resume_if_incomplete(int(db_user.id), user.password)
+    if job is not None:
+        data["key_setup"] = job.to_dict()
+    return {"success": True, "message": "登录成功", "data": data}
 
 def search_users(query: str, page: int = 1, limit: int = 20):
     db: Session = SessionLocal()
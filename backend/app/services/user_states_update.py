@@ -3,14 +3,15 @@ from sqlalchemy import Column, Integer, String, Text, DateTime, Boolean, Foreign
 from app.db.database import SessionLocal
 from app.db.models import User, Friend
 from app.websocket.manager import ConnectionManager
+from app.services.db_executor import db_executor
+from app.services.friend_graph import friend_graph
+from app.services.ephemeral_channel import ephemeral_channel, PRESENCE
 from datetime import datetime, timedelta
 import json
 import asyncio
 from typing import List, Optional
 import logging
 
-# 配置日志
-logging.basicConfig(level=logging.INFO)
 logger = logging.getLogger(__name__)
 
 class UserStatesUpdateService:
@@ -47,44 +48,34 @@ class UserStatesUpdateService:
         Returns:
             dict: 包含操作结果和在线好友列表
         """
-        db = self.get_db()
         try:
-            # 1. 更新用户状态为online
-            user = db.query(User).filter(User.id == user_id).first()
-            if not user:
+            # 1-2. 更新用户状态并查询好友（在数据库线程池中执行，不阻塞其他连接）
+            login_info = await db_executor.run_session(self._mark_online, user_id)
+            if login_info is None:
                 return {"success": False, "message": "用户不存在"}
-                
-            user.status = 'online'
-            user.last_seen = datetime.utcnow()
-            db.commit()
+            username, friends = login_info
             
             # 记录用户心跳时间
             self.user_last_heartbeat[user_id] = datetime.utcnow()
             
-            logger.info(f"[状态更新] 用户 {user.username}({user_id}) 已设置为在线状态")
-            
-            # 2. 获取用户的所有好友
-            friends_query = db.query(Friend).filter(Friend.user_id == user_id)
-            friends = friends_query.all()
+            logger.info("[状态更新] 用户 %s(%s) 已设置为在线状态", username, user_id)
             
             online_friends = []
             friend_ids = []
             
-            for friend_relation in friends:
-                friend = db.query(User).filter(User.id == friend_relation.friend_id).first()
-                if friend:
-                    friend_ids.append(friend.id)
-                    # 检查好友是否在线（既在数据库中标记为online，又在WebSocket连接中）
-                    if (friend.status == 'online' and 
-                        self.connection_manager.get(friend.id) is not None):
-                        online_friends.append({
-                            "user_id": friend.id,
-                            "username": friend.username,
-                            "status": "online",
-                            "last_seen": friend.last_seen.isoformat() if friend.last_seen else None
-                        })
-            
-            logger.info(f"[状态更新] 用户 {user.username} 共有 {len(friend_ids)} 个好友，其中 {len(online_friends)} 个在线")
+            for friend in friends:
+                friend_ids.append(friend["user_id"])
+                # 检查好友是否在线（既在数据库中标记为online，又在WebSocket连接中）
+                if (friend["status"] == 'online' and 
+                    self.connection_manager.get(friend["user_id"]) is not None):
+                    online_friends.append({
+                        "user_id": friend["user_id"],
+                        "username": friend["username"],
+                        "status": "online",
+                        "last_seen": friend["last_seen"]
+                    })
+            
+            logger.info("[状态更新] 用户 %s 共有 %s 个好友，其中 %s 个在线", username, len(friend_ids), len(online_friends))
             
             # 3. 向用户发送在线好友信息
             if online_friends:
@@ -95,16 +86,16 @@ class UserStatesUpdateService:
                     }
                 }
                 await self._send_to_user(user_id, json.dumps(friends_message))
-                logger.info(f"[状态更新] 已向用户 {user.username} 发送 {len(online_friends)} 个在线好友信息")
+                logger.info("[状态更新] 已向用户 %s 发送 %s 个在线好友信息", username, len(online_friends))
             else:
-                logger.info(f"[状态更新] 用户 {user.username} 没有在线好友")
+                logger.info("[状态更新] 用户 %s 没有在线好友", username)
             
             # 4. 向所有好友广播用户上线消息
             user_online_message = {
                 "type": "user_status_change",
                 "data": {
                     "user_id": user_id,
-                    "username": user.username,
+                    "username": username,
                     "status": "online",
                     "timestamp": datetime.utcnow().isoformat()
                 }
@@ -112,21 +103,17 @@ class UserStatesUpdateService:
             
             online_friend_count = 0
             total_friends = len(friend_ids)
-            logger.info(f"[状态更新] 开始向 {total_friends} 个好友广播用户 {user.username} 上线消息")
+            logger.info("[状态更新] 开始向 %s 个好友广播用户 %s 上线消息", total_friends, username)
             
+            # 在线状态是临时事件：经临时事件通道低优先级推送，短时间内反复上下线只推最后的状态
+            frame = json.dumps(user_online_message)
             for friend_id in friend_ids:
-                friend_connection = self.connection_manager.get(friend_id)
-                if friend_connection is not None:
-                    try:
-                        await self._send_to_user(friend_id, json.dumps(user_online_message))
-                        online_friend_count += 1
-                        logger.debug(f"[状态更新] 成功向好友 {friend_id} 发送上线消息")
-                    except Exception as e:
-                        logger.error(f"[状态更新] 向好友 {friend_id} 发送上线消息失败: {str(e)}")
+                if ephemeral_channel.publish(user_id, friend_id, PRESENCE, frame) != 'offline':
+                    online_friend_count += 1
                 else:
-                    logger.debug(f"[状态更新] 好友 {friend_id} 不在线，跳过广播")
+                    logger.debug("[状态更新] 好友 %s 不在线，跳过广播", friend_id)
             
-            logger.info(f"[状态更新] 已向 {online_friend_count}/{total_friends} 个在线好友广播用户 {user.username} 上线消息")
+            logger.info("[状态更新] 已向 %s/%s 个在线好友广播用户 %s 上线消息", online_friend_count, total_friends, username)
             
             return {
                 "success": True,
@@ -136,11 +123,34 @@ class UserStatesUpdateService:
             }
             
         except Exception as e:
-            db.rollback()
-            logger.error(f"[状态更新] 用户登录处理失败: {str(e)}")
+            logger.error("[状态更新] 用户登录处理失败: %s", e)
             return {"success": False, "message": f"状态更新失败: {str(e)}"}
-        finally:
-            db.close()
+    
+    @staticmethod
+    def _mark_online(db: Session, user_id: int):
+        """设置为在线并返回 (用户名, 好友列表)，用户不存在时返回None"""
+        user = db.query(User).filter(User.id == user_id).first()
+        if not user:
+            return None
+        user.status = 'online'
+        user.last_seen = datetime.utcnow()
+        db.commit()
+        
+        # 好友列表来自缓存，再一次查询好友的在线状态
+        friend_ids = friend_graph.get_friend_ids(db, user_id)
+        rows = db.query(User.id, User.username, User.status, User.last_seen).filter(
+            User.id.in_(friend_ids)
+        ).all() if friend_ids else []
+        friends = [
+            {
+                "user_id": row.id,
+                "username": row.username,
+                "status": row.status,
+                "last_seen": row.last_seen.isoformat() if row.last_seen else None
+            }
+            for row in rows
+        ]
+        return user.username, friends
     
     async def user_logout(self, user_id: int) -> dict:
         """用户退出处理
@@ -154,56 +164,43 @@ class UserStatesUpdateService:
         Returns:
             dict: 包含操作结果
         """
-        db = self.get_db()
         try:
-            # 1. 更新用户状态为offline
-            user = db.query(User).filter(User.id == user_id).first()
-            if not user:
+            # 1-2. 更新用户状态并查询好友（在数据库线程池中执行）
+            logout_info = await db_executor.run_session(self._mark_offline, user_id)
+            if logout_info is None:
                 return {"success": False, "message": "用户不存在"}
-                
-            user.status = 'offline'
-            user.last_seen = datetime.utcnow()
-            db.commit()
+            username, friend_ids = logout_info
             
             # 移除心跳记录
             if user_id in self.user_last_heartbeat:
                 del self.user_last_heartbeat[user_id]
             
-            logger.info(f"[状态更新] 用户 {user.username}({user_id}) 已设置为离线状态")
-            
-            # 2. 获取用户的所有好友
-            friends_query = db.query(Friend).filter(Friend.user_id == user_id)
-            friends = friends_query.all()
+            logger.info("[状态更新] 用户 %s(%s) 已设置为离线状态", username, user_id)
             
             # 3. 向所有在线好友广播用户离线消息
             user_offline_message = {
                 "type": "user_status_change",
                 "data": {
                     "user_id": user_id,
-                    "username": user.username,
+                    "username": username,
                     "status": "offline",
                     "timestamp": datetime.utcnow().isoformat()
                 }
             }
             
             notified_friend_count = 0
-            total_friends = len(friends)
-            logger.info(f"[状态更新] 开始向 {total_friends} 个好友广播用户 {user.username} 离线消息")
-            
-            for friend_relation in friends:
-                friend_id = friend_relation.friend_id
-                friend_connection = self.connection_manager.get(friend_id)
-                if friend_connection is not None:
-                    try:
-                        await self._send_to_user(friend_id, json.dumps(user_offline_message))
-                        notified_friend_count += 1
-                        logger.debug(f"[状态更新] 成功向好友 {friend_id} 发送离线消息")
-                    except Exception as e:
-                        logger.error(f"[状态更新] 向好友 {friend_id} 发送离线消息失败: {str(e)}")
+            total_friends = len(friend_ids)
+            logger.info("[状态更新] 开始向 %s 个好友广播用户 %s 离线消息", total_friends, username)
+            
+            # 在线状态是临时事件：经临时事件通道低优先级推送，短时间内反复上下线只推最后的状态
+            frame = json.dumps(user_offline_message)
+            for friend_id in friend_ids:
+                if ephemeral_channel.publish(user_id, friend_id, PRESENCE, frame) != 'offline':
+                    notified_friend_count += 1
                 else:
-                    logger.debug(f"[状态更新] 好友 {friend_id} 不在线，跳过广播")
+                    logger.debug("[状态更新] 好友 %s 不在线，跳过广播", friend_id)
             
-            logger.info(f"[状态更新] 已向 {notified_friend_count}/{total_friends} 个在线好友广播用户 {user.username} 离线消息")
+            logger.info("[状态更新] 已向 %s/%s 个在线好友广播用户 %s 离线消息", notified_friend_count, total_friends, username)
             
             return {
                 "success": True,
@@ -212,11 +209,20 @@ class UserStatesUpdateService:
             }
             
         except Exception as e:
-            db.rollback()
-            logger.error(f"[状态更新] 用户退出处理失败: {str(e)}")
+            logger.error("[状态更新] 用户退出处理失败: %s", e)
             return {"success": False, "message": f"状态更新失败: {str(e)}"}
-        finally:
-            db.close()
+    
+    @staticmethod
+    def _mark_offline(db: Session, user_id: int):
+        """设置为离线并返回 (用户名, 好友ID列表)，用户不存在时返回None"""
+        user = db.query(User).filter(User.id == user_id).first()
+        if not user:
+            return None
+        user.status = 'offline'
+        user.last_seen = datetime.utcnow()
+        db.commit()
+        
+        return user.username, friend_graph.get_friend_ids(db, user_id)
     
     async def update_user_heartbeat(self, user_id: int) -> dict:
         """更新用户心跳时间
@@ -227,36 +233,37 @@ class UserStatesUpdateService:
         Returns:
             dict: 包含操作结果
         """
-        db = self.get_db()
         try:
             # 更新内存中的心跳时间
             current_time = datetime.utcnow()
             self.user_last_heartbeat[user_id] = current_time
             
-            # 更新数据库中的用户状态
-            user = db.query(User).filter(User.id == user_id).first()
-            if user:
-                # 确保用户状态为在线
-                if user.status != 'online':
-                    user.status = 'online'
-                    logger.info(f"[心跳] 用户 {user.username}({user_id}) 状态已更新为在线")
-                
-                # 更新最后活跃时间
-                user.last_seen = current_time
-                db.commit()
-                
-                logger.debug(f"[心跳] 用户 {user.username}({user_id}) 心跳时间和数据库状态已更新")
-            else:
-                logger.warning(f"[心跳] 用户 {user_id} 不存在")
+            # 更新数据库中的用户状态（在数据库线程池中执行）
+            if not await db_executor.run_session(self._touch_user, user_id, current_time):
+                logger.warning("[心跳] 用户 %s 不存在", user_id)
                 return {"success": False, "message": "用户不存在"}
             
             return {"success": True, "message": "心跳更新成功"}
         except Exception as e:
-            db.rollback()
-            logger.error(f"[心跳] 更新用户 {user_id} 心跳失败: {str(e)}")
+            logger.error("[心跳] 更新用户 %s 心跳失败: %s", user_id, e)
             return {"success": False, "message": f"心跳更新失败: {str(e)}"}
-        finally:
-            db.close()
+    
+    @staticmethod
+    def _touch_user(db: Session, user_id: int, current_time: datetime) -> bool:
+        user = db.query(User).filter(User.id == user_id).first()
+        if not user:
+            return False
+        # 确保用户状态为在线
+        if user.status != 'online':
+            user.status = 'online'
+            logger.info("[心跳] 用户 %s(%s) 状态已更新为在线", user.username, user_id)
+        
+        # 更新最后活跃时间
+        user.last_seen = current_time
+        db.commit()
+        
+        logger.debug("[心跳] 用户 %s(%s) 心跳时间和数据库状态已更新", user.username, user_id)
+        return True
     
     async def check_heartbeat_timeouts(self) -> dict:
         """检查心跳超时的用户
@@ -266,13 +273,14 @@ class UserStatesUpdateService:
         Returns:
             dict: 包含检查结果
         """
-        db = self.get_db()
         try:
             current_time = datetime.utcnow()
             timeout_threshold = current_time - timedelta(seconds=self.heartbeat_timeout)
             
             # 获取所有标记为在线的用户
-            online_users = db.query(User).filter(User.status == 'online').all()
+            online_users = await db_executor.run_session(
+                lambda db: db.query(User.id, User.username).filter(User.status == 'online').all()
+            )
             
             timeout_users = []
             
@@ -290,7 +298,7 @@ class UserStatesUpdateService:
                 # 如果没有连接或心跳超时，则认为用户离线
                 if not has_connection or heartbeat_timeout:
                     timeout_users.append(user)
-                    logger.info(f"[心跳检测] 用户 {user.username}({user_id}) 心跳超时或连接断开")
+                    logger.info("[心跳检测] 用户 %s(%s) 心跳超时或连接断开", user.username, user_id)
             
             # 处理超时用户
             processed_count = 0
@@ -299,7 +307,7 @@ class UserStatesUpdateService:
                 if result["success"]:
                     processed_count += 1
             
-            logger.info(f"[心跳检测] 检查了 {len(online_users)} 个在线用户，处理了 {processed_count} 个超时用户")
+            logger.info("[心跳检测] 检查了 %s 个在线用户，处理了 %s 个超时用户", len(online_users), processed_count)
             
             return {
                 "success": True,
@@ -310,10 +318,8 @@ class UserStatesUpdateService:
             }
             
         except Exception as e:
-            logger.error(f"[心跳检测] 检查心跳超时失败: {str(e)}")
+            logger.error("[心跳检测] 检查心跳超时失败: %s", e)
             return {"success": False, "message": f"心跳检测失败: {str(e)}"}
-        finally:
-            db.close()
     
     async def start_heartbeat_monitor(self):
         """启动心跳监控任务"""
@@ -321,7 +327,7 @@ class UserStatesUpdateService:
             logger.warning("[心跳监控] 心跳监控任务已在运行")
             return
             
-        logger.info(f"[心跳监控] 启动心跳监控，检测间隔: {self.heartbeat_interval}秒")
+        logger.info("[心跳监控] 启动心跳监控，检测间隔: %s秒", self.heartbeat_interval)
         self.heartbeat_task = asyncio.create_task(self._heartbeat_monitor_loop())
     
     async def stop_heartbeat_monitor(self):
@@ -345,7 +351,7 @@ class UserStatesUpdateService:
             logger.info("[心跳监控] 心跳监控循环已取消")
             raise
         except Exception as e:
-            logger.error(f"[心跳监控] 心跳监控循环异常: {str(e)}")
+            logger.error("[心跳监控] 心跳监控循环异常: %s", e)
     
     async def _send_to_user(self, user_id: int, message: str):
         """向指定用户发送消息
@@ -357,13 +363,13 @@ class UserStatesUpdateService:
         try:
             websocket = self.connection_manager.get(user_id)
             if websocket:
-                logger.debug(f"[消息发送] 准备向用户 {user_id} 发送消息: {message[:100]}...")
+                logger.debug("[消息发送] 准备向用户 %s 发送消息: %s...", user_id, message[:100])
                 await websocket.send_text(message)
-                logger.debug(f"[消息发送] 成功向用户 {user_id} 发送消息")
+                logger.debug("[消息发送] 成功向用户 %s 发送消息", user_id)
             else:
-                logger.debug(f"[消息发送] 用户 {user_id} 不在线，无法发送消息")
+                logger.debug("[消息发送] 用户 %s 不在线，无法发送消息", user_id)
         except Exception as e:
-            logger.error(f"[消息发送] 向用户 {user_id} 发送消息失败: {str(e)}")
+            logger.error("[消息发送] 向用户 %s 发送消息失败: %s", user_id, e)
     
     def get_online_users_count(self) -> int:
         """获取在线用户数量"""
@@ -382,9 +388,10 @@ class UserStatesUpdateService:
         Returns:
             dict: 用户状态信息
         """
-        db = self.get_db()
         try:
-            user = db.query(User).filter(User.id == user_id).first()
+            user = await db_executor.run_session(
+                lambda db: db.query(User.username, User.status, User.last_seen).filter(User.id == user_id).first()
+            )
             if not user:
                 return {"success": False, "message": "用户不存在"}
             
@@ -403,10 +410,8 @@ class UserStatesUpdateService:
                 }
             }
         except Exception as e:
-            logger.error(f"[状态查询] 获取用户 {user_id} 状态失败: {str(e)}")
+            logger.error("[状态查询] 获取用户 %s 状态失败: %s", user_id, e)
             return {"success": False, "message": f"状态查询失败: {str(e)}"}
-        finally:
-            db.close()
 
 # 全局服务实例
 _user_states_service: Optional[UserStatesUpdateService] = None
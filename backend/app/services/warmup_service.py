@@ -0,0 +1,119 @@
+import asyncio
+import logging
+import time
+from datetime import datetime, timedelta
+from typing import Dict, List, Optional, Tuple
+from sqlalchemy import func
+from sqlalchemy.orm import Session
+from app.core.config import WARMUP_RECENT_DAYS, WARMUP_MAX_USERS, WARMUP_MAX_PAIRS
+from app.db.models import Friend, Message, User
+from app.services.db_executor import db_executor
+from app.services.encryption_service import encryption_service, canonical_pair
+from app.services.friend_graph import friend_graph
+from app.services.key_material_store import key_material_store
+
+logger = logging.getLogger(__name__)
+
+
+def _recent_user_ids(db: Session, since: datetime) -> List[int]:
+    rows = db.query(User.id).filter(User.last_seen >= since).order_by(User.last_seen.desc()).limit(WARMUP_MAX_USERS)
+    return [row.id for row in rows]
+
+
+def _recent_pairs(db: Session, since: datetime, user_ids: List[int]) -> List[Tuple[int, int]]:
+    """最近有消息往来的用户对，加上最近活跃用户之间的好友对"""
+    pairs = []
+    message_rows = db.query(Message.from_id, Message.to_id).filter(
+        Message.timestamp >= since
+    ).group_by(Message.from_id, Message.to_id).order_by(func.max(Message.timestamp).desc()).limit(WARMUP_MAX_PAIRS)
+    pairs.extend(canonical_pair(row.from_id, row.to_id) for row in message_rows if row.from_id != row.to_id)
+
+    active = set(user_ids)
+    for user_id in user_ids:
+        if len(pairs) >= WARMUP_MAX_PAIRS:
+            break
+        pairs.extend(
+            (user_id, friend_id) for friend_id in friend_graph.get_friend_ids(db, user_id)
+            if friend_id in active and user_id < friend_id
+        )
+    return list(dict.fromkeys(pairs))[:WARMUP_MAX_PAIRS]
+
+
+class WarmupService:
+    """启动后的后台预热
+
+    服务先开始接受连接，同时并发预热：最近活跃用户的好友关系和密钥材料，
+    以及最近活跃用户对的会话密钥（RSA解封结果）。全部完成后ready置为True，
+    /api/ready 据此返回200，负载均衡器可以在此之前不转发流量。单个步骤失败不影响就绪。
+    """
+
+    def __init__(self):
+        self.ready = False
+        self.startup_ms: Optional[float] = None
+        self.started_at: Optional[float] = None
+        self.duration_ms: Optional[float] = None
+        self.steps: Dict[str, Dict] = {}
+        self._task: Optional[asyncio.Task] = None
+
+    async def _step(self, name: str, func, *args):
+        """在数据库线程池中执行 func(db, *args)，记录数量和耗时"""
+        started_at = time.perf_counter()
+        try:
+            count = await db_executor.run_session(func, *args)
+            self.steps[name] = {"count": count, "ms": round((time.perf_counter() - started_at) * 1000, 1)}
+        except Exception as e:
+            logger.error("[预热] %s 失败: %s", name, e)
+            self.steps[name] = {"error": str(e), "ms": round((time.perf_counter() - started_at) * 1000, 1)}
+
+    async def _run(self):
+        self.started_at = time.perf_counter()
+        since = datetime.utcnow() - timedelta(days=WARMUP_RECENT_DAYS)
+        try:
+            user_ids = await db_executor.run_session(_recent_user_ids, since)
+            await asyncio.gather(
+                self._step("friend_graph", friend_graph.warm, user_ids),
+                self._step("key_material", lambda db: len(key_material_store.get_many(user_ids))),
+            )
+            # 会话密钥预热依赖好友关系缓存
+            await self._step("session_keys", self._warm_session_keys, since, user_ids)
+        except Exception as e:
+            logger.error("[预热] 预热失败: %s", e)
+        finally:
+            self.duration_ms = round((time.perf_counter() - self.started_at) * 1000, 1)
+            self.ready = True
+            logger.info("[预热] 完成，耗时 %.1f ms: %s", self.duration_ms, self.steps)
+
+    @staticmethod
+    def _warm_session_keys(db: Session, since: datetime, user_ids: List[int]) -> int:
+        pairs = _recent_pairs(db, since, user_ids)
+        db.close()
+        return encryption_service.warm_session_keys(pairs)
+
+    async def start(self, startup_ms: Optional[float] = None):
+        """启动后台预热任务"""
+        self.startup_ms = startup_ms
+        if self._task is None:
+            self._task = asyncio.create_task(self._run())
+
+    async def stop(self):
+        if self._task is not None:
+            self._task.cancel()
+            try:
+                await self._task
+            except asyncio.CancelledError:
+                pass
+            self._task = None
+
+    def status(self) -> dict:
+        return {
+            "ready": self.ready,
+            "startup_ms": self.startup_ms,
+            "warmup_ms": self.duration_ms,
+            "steps": self.steps,
+            "friend_graph": friend_graph.stats(),
+            "session_keys_cached": encryption_service.session_key_cache_size()
+        }
+
+
+# 全局预热服务
+warmup_service = WarmupService()
@@ -1,20 +1,49 @@
 from fastapi import WebSocket
 from fastapi.websockets import WebSocketDisconnect
-from .manager import ConnectionManager
-from app.db.database import SessionLocal
+from .manager import ConnectionManager, MeteredWebSocket
 from app.db import models
 from app.core.security import decode_access_token
 from datetime import datetime
 import json
+import math
 import asyncio
 import time
+import logging
 from sqlalchemy.orm import Session
+from app.services import message_service
+from app.services.db_executor import db_executor
+from app.services.message_db_service import MessageDBService
 from app.services.user_states_update import get_user_states_service
+from app.services.call_registry import call_registry, ENDED
+from app.services.ephemeral_channel import ephemeral_channel, TYPING, SCREENSHOT
+from app.core.config import CALL_SIGNALING_PROTOCOL
+from app.core.rate_limit import rate_limiter
+from app.core.metrics import metrics
+
+logger = logging.getLogger(__name__)
+
+ws_frames_in = metrics.counter('ws_frames_in_total', 'WebSocket收到的帧数', ('type',))
+message_delivery_seconds = metrics.histogram(
+    'message_delivery_seconds', '消息从收到（或用户上线）到推送完成的耗时', ('path',)
+)
+
+# 客户端可能发送的消息类型，其余类型统计为other，避免标签数量不受控
+_KNOWN_FRAME_TYPES = {
+    'private_message', 'image_message', 'typing_start', 'typing_stop', 'screenshot_reminder',
+    'webrtc_offer', 'webrtc_answer', 'webrtc_ice_candidate',
+    'voice_call_offer', 'voice_call_answer', 'voice_call_ice_candidate', 'voice_call_rejected', 'voice_call_ended',
+    'video_call_offer', 'video_call_answer', 'video_call_ice_candidate', 'video_call_rejected', 'video_call_ended',
+    'video_call_toggle', 'heartbeat', 'heartbeat_response'
+}
+# 聊天消息另受ws_message限额；心跳不限流，避免被误判为掉线
+_CHAT_FRAME_TYPES = {'private_message', 'image_message'}
+_UNLIMITED_FRAME_TYPES = {'heartbeat', 'heartbeat_response'}
 
 
 
 async def websocket_endpoint(websocket: WebSocket, user_id: int, manager: ConnectionManager):
     await websocket.accept()
+    websocket = MeteredWebSocket(websocket)
     manager.connect(user_id, websocket)
     
     # 用户登录状态处理
@@ -22,11 +51,11 @@ async def websocket_endpoint(websocket: WebSocket, user_id: int, manager: Connec
         user_states_service = get_user_states_service()
         login_result = await user_states_service.user_login(user_id)
         if login_result["success"]:
-            print(f"[WebSocket] 用户 {user_id} 登录状态处理成功")
+            logger.debug("[WebSocket] 用户 %s 登录状态处理成功", user_id)
         else:
-            print(f"[WebSocket] 用户 {user_id} 登录状态处理失败: {login_result['message']}")
+            logger.warning("[WebSocket] 用户 %s 登录状态处理失败: %s", user_id, login_result['message'])
     except Exception as e:
-        print(f"[WebSocket] 用户 {user_id} 登录状态处理异常: {str(e)}")
+        logger.error("[WebSocket] 用户 %s 登录状态处理异常: %s", user_id, e)
     
     # 发送离线消息
     await send_offline_messages(user_id, websocket)
@@ -35,6 +64,21 @@ async def websocket_endpoint(websocket: WebSocket, user_id: int, manager: Connec
         while True:
             data = await websocket.receive_text()
             message = json.loads(data)
+            frame_type = message.get('type')
+            ws_frames_in.inc(frame_type if frame_type in _KNOWN_FRAME_TYPES else 'other')
+            
+            if frame_type not in _UNLIMITED_FRAME_TYPES:
+                retry_after = await _frame_retry_after(user_id, frame_type)
+                if retry_after:
+                    await websocket.send_text(json.dumps({
+                        'type': 'rate_limited',
+                        'data': {
+                            'frame_type': frame_type,
+                            'to_id': message.get('to_id'),
+                            'retry_after_ms': math.ceil(retry_after * 1000)
+                        }
+                    }))
+                    continue
             
             # 根据消息类型处理
             if message.get('type') == 'private_message':
@@ -42,11 +86,11 @@ async def websocket_endpoint(websocket: WebSocket, user_id: int, manager: Connec
             elif message.get('type') == 'image_message':
                 await handle_image_message(user_id, message, manager)
             elif message.get('type') == 'typing_start':
-                await handle_typing_status(message, user_id, manager, True)
+                await handle_typing(user_id, message, True, manager)
             elif message.get('type') == 'typing_stop':
-                await handle_typing_status(message, user_id, manager, False)
+                await handle_typing(user_id, message, False, manager)
             elif message.get('type') == 'screenshot_reminder':
-                await handle_screenshot_reminder(message, user_id, manager)
+                await handle_screenshot_alert(user_id, message, manager)
             elif message.get('type') in ['webrtc_offer', 'webrtc_answer', 'webrtc_ice_candidate']:
                 await handle_webrtc_signaling(message, user_id, manager)
             elif message.get('type') in ['voice_call_offer', 'voice_call_answer', 'voice_call_ice_candidate', 'voice_call_rejected', 'voice_call_ended']:
@@ -59,7 +103,7 @@ async def websocket_endpoint(websocket: WebSocket, user_id: int, manager: Connec
                     user_states_service = get_user_states_service()
                     await user_states_service.update_user_heartbeat(user_id)
                 except Exception as e:
-                    print(f"[WebSocket] 更新用户 {user_id} 心跳失败: {str(e)}")
+                    logger.warning("[WebSocket] 更新用户 %s 心跳失败: %s", user_id, e)
                 
                 await websocket.send_text(json.dumps({
                     'type': 'heartbeat_response',
@@ -71,114 +115,122 @@ async def websocket_endpoint(websocket: WebSocket, user_id: int, manager: Connec
                     user_states_service = get_user_states_service()
                     await user_states_service.update_user_heartbeat(user_id)
                 except Exception as e:
-                    print(f"[WebSocket] 更新用户 {user_id} 心跳失败: {str(e)}")
+                    logger.warning("[WebSocket] 更新用户 %s 心跳失败: %s", user_id, e)
                 
     except WebSocketDisconnect:
         manager.disconnect(user_id)
+        call_registry.end_user_calls(user_id)
         
         # 用户离线状态处理
         try:
             user_states_service = get_user_states_service()
             logout_result = await user_states_service.user_logout(user_id)
             if logout_result["success"]:
-                print(f"[WebSocket] 用户 {user_id} 离线状态处理成功")
+                logger.debug("[WebSocket] 用户 %s 离线状态处理成功", user_id)
             else:
-                print(f"[WebSocket] 用户 {user_id} 离线状态处理失败: {logout_result['message']}")
+                logger.warning("[WebSocket] 用户 %s 离线状态处理失败: %s", user_id, logout_result['message'])
         except Exception as e:
-            print(f"[WebSocket] 用户 {user_id} 离线状态处理异常: {str(e)}")
+            logger.error("[WebSocket] 用户 %s 离线状态处理异常: %s", user_id, e)
+
+async def _frame_retry_after(user_id, frame_type) -> float:
+    """按用户检查WebSocket帧限额，返回需要等待的秒数，0表示放行"""
+    retry_after = await rate_limiter.hit('ws_frame', f"u:{user_id}")
+    if not retry_after and frame_type in _CHAT_FRAME_TYPES:
+        retry_after = await rate_limiter.hit('ws_message', f"u:{user_id}")
+    if retry_after:
+        logger.warning("[WebSocket] 用户 %s 发送 %s 过于频繁", user_id, frame_type, extra={"sample": "ws_rate_limited"})
+    return retry_after
 
 async def handle_private_message(from_id, msg, manager: ConnectionManager):
     to_id = msg.get("to_id")
     content = msg.get("content")
     message_type = msg.get("message_type", "text")
+    received_at = time.perf_counter()
     # 收到私聊消息
     
     # 检查接收方是否在线
     recipient_online = manager.get(to_id) is not None
     # 检查接收方在线状态
     
-    # 保存消息到数据库（只有接收方不在线时才保存到服务器数据库）
-    db = SessionLocal()
+    # 保存消息到数据库（只有接收方不在线时才保存到服务器数据库），在数据库线程池中执行
+    saved_msg, push_content = await db_executor.run_session(
+        _save_message,
+        from_id=from_id,
+        to_id=to_id,
+        content=content,
+        message_type=message_type,
+        file_path=msg.get("file_path"),
+        file_name=msg.get("file_name"),
+        encrypted=msg.get("encrypted", True),
+        method=msg.get("method", "Server"),
+        destroy_after=msg.get("destroy_after"),
+        hidding_message=msg.get("hidding_message"),
+        recipient_online=recipient_online
+    )
+    
+    message_data = {
+        "id": saved_msg.id if saved_msg else f"{from_id}_{to_id}_{int(datetime.now().timestamp())}",
+        "from": from_id,
+        "to": to_id,
+        "content": push_content,  # 推送明文内容
+        "messageType": message_type,
+        "timestamp": saved_msg.timestamp.isoformat() if saved_msg else datetime.utcnow().isoformat(),
+        "encrypted": msg.get("encrypted", True),
+        "method": msg.get("method", "Server")
+    }
+    
+    # 添加可选字段
+    if msg.get("file_path"):
+        message_data["filePath"] = msg.get("file_path")
+    if msg.get("file_name"):
+        message_data["fileName"] = msg.get("file_name")
+    if msg.get("destroy_after"):
+        message_data["destroyAfter"] = msg.get("destroy_after")
+    if msg.get("hidding_message"):
+        message_data["hiddenMessage"] = msg.get("hidding_message")
+    if msg.get("imageUrl"):
+        message_data["imageUrl"] = msg.get("imageUrl")
+    
+    # 尝试推送给在线用户
+    ws = manager.get(to_id)
+    if ws:
+        # 推送消息给用户
+        await ws.send_text(json.dumps({
+            "type": "message",
+            "data": message_data
+        }))
+        message_delivery_seconds.observe(time.perf_counter() - received_at, 'online')
+        
+        # 消息发送成功：删除服务器暂存的消息并保存到接收方的本地数据库
+        await db_executor.run_session(_after_delivered, saved_msg.id if saved_msg else None, to_id, message_data)
+    else:
+        # 用户不在线，消息已暂存到服务器数据库
+        pass
+
+def _save_message(db: Session, from_id, to_id, content, **kwargs):
+    """保存消息并解密出推送给接收方的明文（在数据库线程池中执行）"""
+    saved_msg = message_service.send_message(db, from_id=from_id, to_id=to_id, content=content, **kwargs)
+    
+    # 构建推送消息数据 - 推送给在线用户时使用明文内容
+    push_content = content
+    # 如果消息被加密了，需要为接收方解密
+    if saved_msg and saved_msg.encrypted and saved_msg.method == 'E2E':
+        push_content = message_service.decrypt_message_content(to_id, from_id, saved_msg.content)
+    return saved_msg, push_content
+
+def _after_delivered(db: Session, saved_msg_id, to_id, message_data):
+    """消息已推送：删除服务器暂存的消息，保存到接收方本地数据库（在数据库线程池中执行）"""
+    if saved_msg_id:
+        message_service.delete_server_message(db, saved_msg_id)
     try:
-        from services import message_service
-        saved_msg = message_service.send_message(
-            db,
-            from_id=from_id,
-            to_id=to_id,
-            content=content,
-            message_type=message_type,
-            file_path=msg.get("file_path"),
-            file_name=msg.get("file_name"),
-            encrypted=msg.get("encrypted", True),
-            method=msg.get("method", "Server"),
-            destroy_after=msg.get("destroy_after"),
-            hidding_message=msg.get("hidding_message"),
-            recipient_online=recipient_online
+        MessageDBService.add_message(
+            user_id=to_id,
+            message_data=message_data
         )
-        
-        # 构建推送消息数据 - 推送给在线用户时使用明文内容
-        push_content = content
-        # 如果消息被加密了，需要为接收方解密
-        if saved_msg and saved_msg.encrypted and saved_msg.method == 'E2E':
-            try:
-                from services import message_service
-                push_content = message_service.decrypt_message_content(to_id, from_id, saved_msg.content)
-            except Exception as e:
-                print(f"Warning: Failed to decrypt message for push: {e}")
-                push_content = "[解密失败的消息]"
-        
-        message_data = {
-            "id": saved_msg.id if saved_msg else f"{from_id}_{to_id}_{int(datetime.now().timestamp())}",
-            "from": from_id,
-            "to": to_id,
-            "content": push_content,  # 推送明文内容
-            "messageType": message_type,
-            "timestamp": saved_msg.timestamp.isoformat() if saved_msg else datetime.utcnow().isoformat(),
-            "encrypted": msg.get("encrypted", True),
-            "method": msg.get("method", "Server")
-        }
-        
-        # 添加可选字段
-        if msg.get("file_path"):
-            message_data["filePath"] = msg.get("file_path")
-        if msg.get("file_name"):
-            message_data["fileName"] = msg.get("file_name")
-        if msg.get("destroy_after"):
-            message_data["destroyAfter"] = msg.get("destroy_after")
-        if msg.get("hidding_message"):
-            message_data["hiddenMessage"] = msg.get("hidding_message")
-        if msg.get("imageUrl"):
-            message_data["imageUrl"] = msg.get("imageUrl")
-        
-        # 尝试推送给在线用户
-        ws = manager.get(to_id)
-        if ws:
-            # 推送消息给用户
-            await ws.send_text(json.dumps({
-                "type": "message",
-                "data": message_data
-            }))
-            
-            # 消息发送成功，如果之前保存到了服务器数据库，现在删除它
-            if saved_msg:
-                message_service.delete_server_message(db, saved_msg.id)
-                
-            # 保存到接收方的本地数据库
-            try:
-                from services.message_db_service import MessageDBService
-                MessageDBService.add_message(
-                    user_id=to_id,
-                    message_data=message_data
-                )
-                # 消息已保存到接收方本地数据库
-            except Exception as e:
-                # 保存到接收方本地数据库失败
-                pass
-        else:
-            # 用户不在线，消息已暂存到服务器数据库
-            pass
-    finally:
-        db.close()
+        # 消息已保存到接收方本地数据库
+    except Exception as e:
+        # 保存到接收方本地数据库失败
+        pass
 
 async def handle_image_message(from_id, msg, manager: ConnectionManager):
     """专门处理图片消息的WebSocket传输"""
@@ -186,6 +238,7 @@ async def handle_image_message(from_id, msg, manager: ConnectionManager):
     file_path = msg.get("file_path")
     file_name = msg.get("file_name")
     content = msg.get("content", f"发送了图片: {file_name}")
+    received_at = time.perf_counter()
     
     # 收到图片消息
     
@@ -198,12 +251,10 @@ async def handle_image_message(from_id, msg, manager: ConnectionManager):
     recipient_online = manager.get(to_id) is not None
     # 检查接收方在线状态
     
-    # 保存消息到数据库（只有接收方不在线时才保存到服务器数据库）
-    db = SessionLocal()
     try:
-        from services import message_service
-        saved_msg = message_service.send_message(
-            db,
+        # 保存消息到数据库（只有接收方不在线时才保存到服务器数据库），在数据库线程池中执行
+        saved_msg, push_content = await db_executor.run_session(
+            _save_message,
             from_id=from_id,
             to_id=to_id,
             content=content,
@@ -217,17 +268,6 @@ async def handle_image_message(from_id, msg, manager: ConnectionManager):
             recipient_online=recipient_online
         )
         
-        # 构建推送消息数据 - 推送给在线用户时使用明文内容
-        push_content = content
-        # 如果消息被加密了，需要为接收方解密
-        if saved_msg and saved_msg.encrypted and saved_msg.method == 'E2E':
-            try:
-                from services import message_service
-                push_content = message_service.decrypt_message_content(to_id, from_id, saved_msg.content)
-            except Exception as e:
-                print(f"Warning: Failed to decrypt image message for push: {e}")
-                push_content = "[解密失败的图片消息]"
-        
         message_data = {
             "id": saved_msg.id if saved_msg else f"{from_id}_{to_id}_{int(datetime.now().timestamp())}",
             "from": from_id,
@@ -255,22 +295,10 @@ async def handle_image_message(from_id, msg, manager: ConnectionManager):
                 "type": "message",
                 "data": message_data
             }))
+            message_delivery_seconds.observe(time.perf_counter() - received_at, 'online')
             
-            # 消息发送成功，如果之前保存到了服务器数据库，现在删除它
-            if saved_msg:
-                message_service.delete_server_message(db, saved_msg.id)
-                
-            # 保存到接收方的本地数据库
-            try:
-                from services.message_db_service import MessageDBService
-                MessageDBService.add_message(
-                    user_id=to_id,
-                    message_data=message_data
-                )
-                # 图片消息已保存到接收方本地数据库
-            except Exception as e:
-                # 保存图片消息到接收方本地数据库失败
-                pass
+            # 消息发送成功：删除服务器暂存的消息并保存到接收方的本地数据库
+            await db_executor.run_session(_after_delivered, saved_msg.id if saved_msg else None, to_id, message_data)
         else:
             # 用户不在线，图片消息已暂存到服务器数据库
             pass
@@ -278,106 +306,106 @@ async def handle_image_message(from_id, msg, manager: ConnectionManager):
     except Exception as e:
         # 处理图片消息失败
         pass
-    finally:
-        db.close()
 
 # update_user_status函数已删除 - 用户状态只在登录时设置为online
 
 async def send_offline_messages(user_id: int, websocket: WebSocket):
     """发送用户离线期间收到的消息"""
-    db = SessionLocal()
+    started = time.perf_counter()
     try:
-        from services import message_service
-        # 获取用户的离线消息
-        offline_messages = message_service.get_offline_messages(db, user_id)
+        # 获取用户的离线消息（在数据库线程池中查询和解密）
+        offline_messages = await db_executor.run_session(_load_offline_messages, user_id)
         
         if offline_messages:
             # 发送离线消息给用户
             
-            sent_message_ids = []
+            delivered = []
             
-            for msg in offline_messages:
-                message_data = {
-                    "id": msg.id,
-                    "from": msg.from_id,
-                    "to": msg.to_id,
-                    "content": msg.content,
-                    "messageType": msg.message_type,
-                    "timestamp": msg.timestamp.isoformat(),
-                    "encrypted": msg.encrypted,
-                    "method": msg.method
-                }
-                
-                # 添加可选字段
-                if msg.file_path:
-                    message_data["filePath"] = msg.file_path
-                if msg.file_name:
-                    message_data["fileName"] = msg.file_name
-                if msg.destroy_after:
-                    message_data["destroyAfter"] = msg.destroy_after
-                if msg.hidding_message:
-                    message_data["hiddenMessage"] = msg.hidding_message
-                
+            for message_data in offline_messages:
                 try:
                     await websocket.send_text(json.dumps({
                         "type": "message",
                         "data": message_data
                     }))
                     
-                    # 消息发送成功，记录ID用于后续删除
-                    sent_message_ids.append(msg.id)
-                    
-                    # 保存到接收方的本地数据库
-                    try:
-                        from services.message_db_service import MessageDBService
-                        MessageDBService.add_message(
-                            user_id=user_id,
-                            message_data=message_data
-                        )
-                        # 离线消息已保存到接收方本地数据库
-                    except Exception as e:
-                        # 保存离线消息到本地数据库失败
-                        pass
-                        
+                    # 消息发送成功，记录下来用于后续删除
+                    delivered.append(message_data)
+                    message_delivery_seconds.observe(time.perf_counter() - started, 'offline')
                 except Exception as e:
                     # 发送离线消息失败
                     pass
             
-            # 删除已成功发送的离线消息
-            for msg_id in sent_message_ids:
-                message_service.delete_server_message(db, msg_id)
-                
-            # 已删除已发送的离线消息
+            # 删除已成功发送的离线消息，并保存到接收方的本地数据库
+            if delivered:
+                await db_executor.run_session(_after_offline_delivered, user_id, delivered)
     except Exception as e:
         # 发送离线消息失败
         pass
-    finally:
-        db.close()
+
+def _load_offline_messages(db: Session, user_id: int) -> list:
+    """查询并解密离线消息，转换为推送格式（在数据库线程池中执行）"""
+    offline_messages = []
+    for msg in message_service.get_offline_messages(db, user_id):
+        message_data = {
+            "id": msg.id,
+            "from": msg.from_id,
+            "to": msg.to_id,
+            "content": msg.content,
+            "messageType": msg.message_type,
+            "timestamp": msg.timestamp.isoformat(),
+            "encrypted": msg.encrypted,
+            "method": msg.method
+        }
+        
+        # 添加可选字段
+        if msg.file_path:
+            message_data["filePath"] = msg.file_path
+        if msg.file_name:
+            message_data["fileName"] = msg.file_name
+        if msg.destroy_after:
+            message_data["destroyAfter"] = msg.destroy_after
+        if msg.hidding_message:
+            message_data["hiddenMessage"] = msg.hidding_message
+        offline_messages.append(message_data)
+    # get_offline_messages把解密后的明文写回了content，不能提交到数据库
+    db.rollback()
+    return offline_messages
+
+def _after_offline_delivered(db: Session, user_id: int, delivered: list):
+    """删除已送达的离线消息，保存到接收方本地数据库（在数据库线程池中执行）"""
+    message_service.delete_server_messages(db, [message_data["id"] for message_data in delivered])
+    for message_data in delivered:
+        try:
+            MessageDBService.add_message(
+                user_id=user_id,
+                message_data=message_data
+            )
+            # 离线消息已保存到接收方本地数据库
+        except Exception as e:
+            # 保存离线消息到本地数据库失败
+            pass
 
 async def handle_typing(from_id, msg, is_start, manager: ConnectionManager):
+    # 输入状态只推最新的，经临时事件通道节流，不等待发送
     to_id = msg.get("to_id")
-    ws = manager.get(to_id)
-    if ws:
-        await ws.send_text(json.dumps({
-            "type": "typing",
-            "data": {
-                "from": from_id,
-                "to": to_id,
-                "isTyping": is_start
-            }
-        }))
+    ephemeral_channel.publish(from_id, to_id, TYPING, json.dumps({
+        "type": "typing",
+        "data": {
+            "from": from_id,
+            "to": to_id,
+            "isTyping": is_start
+        }
+    }))
 
 async def handle_screenshot_alert(from_id, msg, manager: ConnectionManager):
     to_id = msg.get("to_id")
-    ws = manager.get(to_id)
-    if ws:
-        await ws.send_text(json.dumps({
-            "type": "screenshot_alert",
-            "data": {
-                "from": from_id,
-                "to": to_id
-            }
-        }))
+    ephemeral_channel.publish(from_id, to_id, SCREENSHOT, json.dumps({
+        "type": "screenshot_alert",
+        "data": {
+            "from": from_id,
+            "to": to_id
+        }
+    }))
 
 async def handle_webrtc_signaling(msg, from_id, manager: ConnectionManager):
     to_id = msg.get("to_id")
@@ -390,84 +418,86 @@ async def handle_webrtc_signaling(msg, from_id, manager: ConnectionManager):
             "payload": msg.get("payload")
         }
         
-        print(f"[WebRTC] 转发信令 {msg['type']} 从用户 {from_id} 到用户 {to_id}")
+        logger.debug("[WebRTC] 转发信令 %s 从用户 %s 到用户 %s", msg['type'], from_id, to_id, extra={"sample": "webrtc_relay"})
         await ws.send_text(json.dumps(forward_msg))
     else:
-        print(f"[WebRTC] 目标用户 {to_id} 不在线，无法转发信令 {msg['type']}")
+        logger.debug("[WebRTC] 目标用户 %s 不在线，无法转发信令 %s", to_id, msg['type'], extra={"sample": "webrtc_unreachable"})
 
 async def handle_voice_call_signaling(msg, from_id, manager: ConnectionManager):
     """处理语音通话信令消息"""
-    to_id = msg.get("to_id")
-    ws = manager.get(to_id)
-    if ws:
-        # 构建转发给目标客户端的消息，保持与前端期望的格式一致
-        forward_msg = {
-            "type": msg["type"],
-            "from_id": from_id,
-            "to_id": to_id
-        }
-        
-        # 根据消息类型添加相应的数据
-        if msg["type"] == "voice_call_offer":
-            forward_msg["call_id"] = msg.get("call_id")
-            forward_msg["payload"] = msg.get("payload")
-            forward_msg["offer"] = msg.get("payload")  # 兼容性字段
-            forward_msg["fromUserId"] = from_id
-            forward_msg["toUserId"] = to_id
-        elif msg["type"] == "voice_call_answer":
-            forward_msg["payload"] = msg.get("payload")
-            forward_msg["answer"] = msg.get("payload")  # 兼容性字段
-        elif msg["type"] == "voice_call_ice_candidate":
-            forward_msg["payload"] = msg.get("payload")
-            forward_msg["candidate"] = msg.get("payload")  # 兼容性字段
-        elif msg["type"] in ["voice_call_rejected", "voice_call_ended"]:
-            forward_msg["reason"] = msg.get("reason", "")
-            forward_msg["payload"] = msg.get("payload")
-        
-        print(f"[语音通话] 转发信令 {msg['type']} 从用户 {from_id} 到用户 {to_id}")
-        print(f"[语音通话] 转发消息内容: {forward_msg}")
-        await ws.send_text(json.dumps(forward_msg))
-    else:
-        print(f"[语音通话] 目标用户 {to_id} 不在线，无法转发信令 {msg['type']}")
+    await _relay_call_signaling('voice', msg, from_id, manager)
 
 async def handle_video_call_signaling(msg, from_id, manager: ConnectionManager):
     """处理视频通话信令消息"""
-    to_id = msg.get("to_id")
-    ws = manager.get(to_id)
-    if ws:
-        # 构建转发给目标客户端的消息，保持与前端期望的格式一致
-        forward_msg = {
-            "type": msg["type"],
-            "from_id": from_id,
-            "to_id": to_id
-        }
-        
-        # 根据消息类型添加相应的数据
-        if msg["type"] == "video_call_offer":
-            forward_msg["call_id"] = msg.get("call_id")
-            forward_msg["payload"] = msg.get("payload")
-            forward_msg["offer"] = msg.get("payload")  # 兼容性字段
+    await _relay_call_signaling('video', msg, from_id, manager)
+
+# 协议版本1中与payload重复的兼容字段
+_COMPAT_FIELDS = {'offer': 'offer', 'answer': 'answer', 'ice_candidate': 'candidate'}
+_CALL_LOG_PREFIX = {'voice': '[语音通话]', 'video': '[视频通话]'}
+
+def _call_forward_frame(kind, msg, from_id, to_id, call):
+    """构建转发给目标客户端的通话信令，保持与前端期望的格式一致"""
+    forward_msg = {
+        "type": msg["type"],
+        "from_id": from_id,
+        "to_id": to_id,
+        "payload": msg.get("payload")
+    }
+    if call is not None:
+        forward_msg["call_id"] = call.call_id
+    if kind == 'offer' and msg.get("encryption_key"):
+        forward_msg["encryption_key"] = msg.get("encryption_key")
+    elif kind in ('rejected', 'ended'):
+        forward_msg["reason"] = msg.get("reason", "")
+    if CALL_SIGNALING_PROTOCOL < 2:
+        if kind in _COMPAT_FIELDS:
+            forward_msg[_COMPAT_FIELDS[kind]] = msg.get("payload")
+        if kind == 'offer':
             forward_msg["fromUserId"] = from_id
             forward_msg["toUserId"] = to_id
-            # 添加加密密钥支持
-            if msg.get("encryption_key"):
-                forward_msg["encryption_key"] = msg.get("encryption_key")
-        elif msg["type"] == "video_call_answer":
-            forward_msg["payload"] = msg.get("payload")
-            forward_msg["answer"] = msg.get("payload")  # 兼容性字段
-        elif msg["type"] == "video_call_ice_candidate":
-            forward_msg["payload"] = msg.get("payload")
-            forward_msg["candidate"] = msg.get("payload")  # 兼容性字段
-        elif msg["type"] in ["video_call_rejected", "video_call_ended"]:
-            forward_msg["reason"] = msg.get("reason", "")
-            forward_msg["payload"] = msg.get("payload")
-        elif msg["type"] == "video_call_toggle":
-            forward_msg["payload"] = msg.get("payload")
-        
-        print(f"[视频通话] 转发信令 {msg['type']} 从用户 {from_id} 到用户 {to_id}")
-        print(f"[视频通话] 转发消息内容: {forward_msg}")
-        await ws.send_text(json.dumps(forward_msg))
+    return forward_msg
+
+async def _relay_call_signaling(call_type, msg, from_id, manager: ConnectionManager):
+    """按通话登记表转发通话信令，已结束通话的后续信令丢弃（ICE候选暂存到重拨的offer之后转发）"""
+    to_id = msg.get("to_id")
+    kind = msg["type"][len(f"{call_type}_call_"):]
+    log_prefix = _CALL_LOG_PREFIX[call_type]
+    if not isinstance(to_id, int) or isinstance(to_id, bool):
+        logger.debug("%s 信令 %s 缺少有效的to_id，已丢弃", log_prefix, msg['type'], extra={"sample": "call_invalid_target"})
+        return
+    
+    if kind == 'offer':
+        call = call_registry.start_call(call_type, msg.get("call_id"), from_id, to_id)
     else:
-        print(f"[视频通话] 目标用户 {to_id} 不在线，无法转发信令 {msg['type']}")
+        call = call_registry.find(from_id, to_id)
+        if call is not None and call.state == ENDED:
+            if kind != 'ice_candidate' or not call_registry.hold(call, from_id, msg):
+                call_registry.drop_frame()
+            return
+    
+    ws = manager.get(to_id)
+    if not ws:
+        logger.debug("%s 目标用户 %s 不在线，无法转发信令 %s", log_prefix, to_id, msg['type'], extra={"sample": "call_unreachable"})
+        if call is not None and kind == 'offer':
+            call_registry.end(call, 'unreachable')
+        return
+    
+    await ws.send_text(json.dumps(_call_forward_frame(kind, msg, from_id, to_id, call)))
+    
+    if call is None:
+        return
+    if kind == 'offer' and call.held:
+        # 重拨时先于offer到达的ICE候选
+        early_frames, call.held = call.held, []
+        for frame in early_frames:
+            await ws.send_text(json.dumps(_call_forward_frame('ice_candidate', frame, from_id, to_id, call)))
+    if kind == 'answer':
+        call_registry.mark_answered(call)
+    elif kind == 'ice_candidate':
+        call_registry.mark_ice(call)
+    elif kind in ('rejected', 'ended'):
+        call_registry.end(call, kind)
+    if kind in ('offer', 'answer', 'rejected', 'ended'):
+        logger.info("%s 转发信令 %s 从用户 %s 到用户 %s，通话 %s", log_prefix, msg['type'], from_id, to_id, call.call_id)
 
 # 状态管理服务已删除
\ No newline at end of file
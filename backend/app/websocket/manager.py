@@ -1,3 +1,97 @@
+import asyncio
+import re
+from app.core import tracing
+from app.core.config import EPHEMERAL_QUEUE_SIZE
+from app.core.metrics import metrics
+
+# json.dumps生成的推送消息以 {"type": "..." 开头，只看开头即可得到类型，不需要解析整帧
+_FRAME_TYPE_RE = re.compile(r'\{"type": ?"([A-Za-z0-9_\-]{1,48})"')
+
+ws_frames_out = metrics.counter('ws_frames_out_total', 'WebSocket发出的帧数', ('type',))
+ws_send_inflight = metrics.gauge('ws_send_inflight', '正在等待发送完成的WebSocket帧数（发送队列深度）')
+ws_send_errors = metrics.counter('ws_send_errors_total', 'WebSocket发送失败次数')
+ws_ephemeral_pending = metrics.gauge('ws_ephemeral_pending', '各连接低优先级队列中等待发送的临时事件数')
+ws_ephemeral_total = metrics.counter('ws_ephemeral_total', '临时事件在连接队列中的处理结果', ('result',))
+
+
+class MeteredWebSocket:
+    """包装WebSocket，统计发出的帧数和正在发送的帧数，其余属性直接转发
+
+    send_text 为普通优先级；send_ephemeral 为低优先级的临时事件（正在输入、截屏提醒、在线状态），
+    按key只保留最新一帧，只在没有普通帧等待发送时才发出，连接断开或队列满时直接丢弃。
+    """
+    __slots__ = ('_websocket', '_urgent', '_ephemeral', '_flush_task')
+
+    def __init__(self, websocket):
+        self._websocket = websocket
+        self._urgent = 0
+        self._ephemeral = {}
+        self._flush_task = None
+
+    def __getattr__(self, name):
+        return getattr(self._websocket, name)
+
+    async def _send(self, data: str):
+        match = _FRAME_TYPE_RE.match(data)
+        ws_frames_out.inc(match.group(1) if match else 'other')
+        ws_send_inflight.inc()
+        try:
+            with tracing.span(tracing.SEND):
+                await self._websocket.send_text(data)
+        except Exception:
+            ws_send_errors.inc()
+            raise
+        finally:
+            ws_send_inflight.dec()
+
+    async def send_text(self, data: str):
+        self._urgent += 1
+        try:
+            await self._send(data)
+        finally:
+            self._urgent -= 1
+            if not self._urgent and self._ephemeral:
+                self._schedule_flush()
+
+    def send_ephemeral(self, key, data: str) -> bool:
+        """放入低优先级队列，同key尚未发出的旧帧被替换；返回是否替换了旧帧"""
+        replaced = key in self._ephemeral
+        if replaced:
+            ws_ephemeral_total.inc('coalesced')
+        else:
+            if len(self._ephemeral) >= EPHEMERAL_QUEUE_SIZE:
+                del self._ephemeral[next(iter(self._ephemeral))]
+                ws_ephemeral_pending.dec()
+                ws_ephemeral_total.inc('dropped')
+            ws_ephemeral_pending.inc()
+        self._ephemeral[key] = data
+        if not self._urgent:
+            self._schedule_flush()
+        return replaced
+
+    def _schedule_flush(self):
+        if self._flush_task is None:
+            self._flush_task = asyncio.get_running_loop().create_task(self._flush_ephemeral())
+
+    async def _flush_ephemeral(self):
+        try:
+            # 有普通帧开始发送时让出，由最后一个普通帧发送完成后重新调度
+            while self._ephemeral and not self._urgent:
+                key = next(iter(self._ephemeral))
+                data = self._ephemeral.pop(key)
+                ws_ephemeral_pending.dec()
+                try:
+                    await self._send(data)
+                    ws_ephemeral_total.inc('sent')
+                except Exception:
+                    # 尽力而为：连接已不可用，剩余的临时事件一并丢弃
+                    ws_ephemeral_total.inc('dropped', amount=len(self._ephemeral) + 1)
+                    ws_ephemeral_pending.dec(amount=len(self._ephemeral))
+                    self._ephemeral.clear()
+        finally:
+            self._flush_task = None
+
+
 class ConnectionManager:
     def __init__(self):
         self.active_connections = {}  # user_id: websocket
@@ -22,4 +116,4 @@ class ConnectionManager:
 
     async def broadcast(self, message):
         for ws in self.active_connections.values():
-            await ws.send_text(message) 
\ No newline at end of file
+            await ws.send_text(message)
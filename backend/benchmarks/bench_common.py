@@ -0,0 +1,63 @@
+# -*- coding: utf-8 -*-
+"""
+基准脚本共用的统计和结果输出
+
+结果JSON的结构固定为 {"benchmark", "started_at", "environment", "config", "results"}，
+同一基准的多次结果可以直接按字段比较，用于回归跟踪。
+"""
+
+import json
+import os
+import platform
+import subprocess
+import sys
+import time
+from pathlib import Path
+
+def percentile(values, q):
+    values = sorted(values)
+    return values[min(len(values) - 1, int(len(values) * q))] if values else 0.0
+
+def summarize(values, digits=3):
+    """次数、平均值、p50/p90/p99和最大值"""
+    if not values:
+        return {"count": 0}
+    values = sorted(values)
+    return {
+        "count": len(values),
+        "mean": round(sum(values) / len(values), digits),
+        "p50": round(percentile(values, 0.5), digits),
+        "p90": round(percentile(values, 0.9), digits),
+        "p99": round(percentile(values, 0.99), digits),
+        "max": round(values[-1], digits)
+    }
+
+def _git_commit():
+    try:
+        return subprocess.run(
+            ["git", "rev-parse", "--short", "HEAD"], cwd=Path(__file__).parent,
+            capture_output=True, text=True, timeout=5
+        ).stdout.strip() or None
+    except (OSError, subprocess.SubprocessError):
+        return None
+
+def write_results(path, benchmark, config, results, started_at=None):
+    """把结果写为JSON文件，path为 '-' 时输出到标准输出"""
+    document = {
+        "benchmark": benchmark,
+        "started_at": started_at or time.time(),
+        "environment": {
+            "python": platform.python_version(),
+            "platform": platform.platform(),
+            "cpus": os.cpu_count(),
+            "commit": _git_commit()
+        },
+        "config": config,
+        "results": results
+    }
+    text = json.dumps(document, ensure_ascii=False, indent=2)
+    if path == '-':
+        sys.stdout.write(text + "\n")
+    else:
+        Path(path).write_text(text + "\n", encoding="utf-8")
+    return document
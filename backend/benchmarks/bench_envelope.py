@@ -0,0 +1,58 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+"""
+消息信封加解密微基准：比较 v2（AES-256-GCM）与旧格式（AES-256-CBC）每秒可处理的消息数
+
+使用方法:
+1. 默认参数运行: python bench_envelope.py
+2. 指定消息条数和消息长度: python bench_envelope.py --count 50000 --sizes 32 256 4096
+"""
+
+import os
+import sys
+import time
+import argparse
+from pathlib import Path
+
+# 添加项目根目录到Python路径
+project_root = Path(__file__).parent.parent
+sys.path.insert(0, str(project_root))
+
+from app.services import message_envelope
+
+def measure(func, count):
+    """返回每秒处理的消息数"""
+    start = time.perf_counter()
+    func()
+    elapsed = time.perf_counter() - start
+    return count / elapsed if elapsed > 0 else float('inf')
+
+def run(count, sizes):
+    key = os.urandom(32)
+    print(f"{'格式':<10}{'消息长度':>10}{'加密 msg/s':>16}{'解密 msg/s':>16}")
+    for size in sizes:
+        messages = ['x' * size] * count
+
+        v2_ciphertexts = []
+        v2_encrypt = measure(lambda: v2_ciphertexts.extend(message_envelope.encrypt_many(key, messages, 1, 1)), count)
+        v2_decrypt = measure(lambda: message_envelope.decrypt_many(key, v2_ciphertexts), count)
+
+        legacy_ciphertexts = []
+        legacy_encrypt = measure(
+            lambda: legacy_ciphertexts.extend(message_envelope.legacy_encrypt_text(key, m) for m in messages), count
+        )
+        legacy_decrypt = measure(lambda: message_envelope.decrypt_many(key, legacy_ciphertexts), count)
+
+        print(f"{'v2-gcm':<10}{size:>10}{v2_encrypt:>16,.0f}{v2_decrypt:>16,.0f}")
+        print(f"{'v1-cbc':<10}{size:>10}{legacy_encrypt:>16,.0f}{legacy_decrypt:>16,.0f}")
+
+def main():
+    parser = argparse.ArgumentParser(description='消息信封加解密微基准')
+    parser.add_argument('--count', type=int, default=20000, help='每种消息长度的消息条数')
+    parser.add_argument('--sizes', type=int, nargs='+', default=[32, 256, 4096], help='消息长度（字符）')
+
+    args = parser.parse_args()
+    run(args.count, args.sizes)
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,123 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+"""
+逐帧日志开销测试：转发一帧WebRTC信令时，日志本身在事件循环线程上花费多少时间
+
+比较以下几种写法（每帧一条日志，单位为每帧微秒）：
+  print：改造前的写法，print整条转发消息（含SDP）到文件
+  file：logging直接写JSON文件（同步I/O）
+  queue：QueueHandler入队，由后台线程写JSON文件（当前实现）
+  queue_sampled：同上，带 extra={"sample": ...}，每N条只记录1条
+  disabled：级别未开启的 logger.debug（参数不格式化）
+
+使用方法:
+1. 默认参数运行: python bench_logging.py
+2. 指定帧数和采样间隔: python bench_logging.py --frames 50000 --sample-every 100
+"""
+
+import os
+import sys
+import json
+import time
+import logging
+import argparse
+import tempfile
+import contextlib
+import logging.handlers
+import queue
+from pathlib import Path
+
+# 添加项目根目录到Python路径
+project_root = Path(__file__).parent.parent
+sys.path.insert(0, str(project_root))
+
+from app.core.logging_config import JsonFormatter, LazyQueueHandler, SamplingFilter
+
+SDP = "v=0\r\no=- 4611731400430051336 2 IN IP4 127.0.0.1\r\n" + "a=candidate:1 1 udp 2122260223 192.168.1.2 54321 typ host\r\n" * 30
+
+def make_frame(i):
+    return {"type": "video_call_offer", "from_id": 1, "to_id": 2, "call_id": f"c{i}", "payload": {"type": "offer", "sdp": SDP}}
+
+def make_logger(name, handler, level=logging.INFO):
+    logger = logging.getLogger(f"bench.{name}")
+    logger.handlers[:] = [handler]
+    logger.propagate = False
+    logger.setLevel(level)
+    return logger
+
+def run_print(frames, path):
+    with open(path, "w", encoding="utf-8") as f, contextlib.redirect_stdout(f):
+        started = time.perf_counter()
+        for i in range(frames):
+            forward_msg = make_frame(i)
+            print(f"[视频通话] 转发信令 {forward_msg['type']} 从用户 1 到用户 2")
+            print(f"[视频通话] 转发消息内容: {forward_msg}")
+        return time.perf_counter() - started
+
+def run_logger(frames, logger, level=logging.INFO, extra=None, flush=None):
+    started = time.perf_counter()
+    for i in range(frames):
+        forward_msg = make_frame(i)
+        logger.log(level, "[视频通话] 转发信令 %s 从用户 %s 到用户 %s，通话 %s",
+                   forward_msg["type"], 1, 2, forward_msg["call_id"], extra=extra)
+    elapsed = time.perf_counter() - started
+    if flush:
+        flush()
+    return elapsed
+
+def run_baseline(frames):
+    started = time.perf_counter()
+    for i in range(frames):
+        make_frame(i)
+    return time.perf_counter() - started
+
+def queue_logger(name, path, sample_every=None):
+    file_handler = logging.FileHandler(path, encoding="utf-8")
+    file_handler.setFormatter(JsonFormatter())
+    log_queue = queue.SimpleQueue()
+    handler = LazyQueueHandler(log_queue)
+    if sample_every:
+        handler.addFilter(SamplingFilter(sample_every))
+    listener = logging.handlers.QueueListener(log_queue, file_handler)
+    listener.start()
+    return make_logger(name, handler), listener
+
+def main():
+    parser = argparse.ArgumentParser(description='逐帧日志开销测试')
+    parser.add_argument('--frames', type=int, default=20000, help='每种写法记录的帧数')
+    parser.add_argument('--sample-every', type=int, default=100, help='queue_sampled模式的采样间隔')
+
+    args = parser.parse_args()
+
+    with tempfile.TemporaryDirectory() as tmpdir:
+        baseline = run_baseline(args.frames)
+        results = {}
+        results["print"] = run_print(args.frames, os.path.join(tmpdir, "print.log"))
+
+        file_handler = logging.FileHandler(os.path.join(tmpdir, "file.jsonl"), encoding="utf-8")
+        file_handler.setFormatter(JsonFormatter())
+        results["file"] = run_logger(args.frames, make_logger("file", file_handler))
+        file_handler.close()
+
+        logger, listener = queue_logger("queue", os.path.join(tmpdir, "queue.jsonl"))
+        results["queue"] = run_logger(args.frames, logger)
+        listener.stop()
+
+        logger, listener = queue_logger("sampled", os.path.join(tmpdir, "sampled.jsonl"), args.sample_every)
+        results["queue_sampled"] = run_logger(args.frames, logger, extra={"sample": "call_relay"})
+        listener.stop()
+        with open(os.path.join(tmpdir, "sampled.jsonl"), encoding="utf-8") as f:
+            sampled_lines = sum(1 for _ in f)
+
+        logger, listener = queue_logger("disabled", os.path.join(tmpdir, "disabled.jsonl"))
+        results["disabled"] = run_logger(args.frames, logger, level=logging.DEBUG)
+        listener.stop()
+
+        print(f"帧数 {args.frames}，构造转发消息本身 {baseline / args.frames * 1e6:.2f} us/帧（已从下表扣除）")
+        print(f"{'写法':<16}{'us/帧':>10}")
+        for mode, elapsed in results.items():
+            print(f"{mode:<16}{(elapsed - baseline) / args.frames * 1e6:>10.2f}")
+        print(f"queue_sampled 实际写出 {sampled_lines} 行")
+
+if __name__ == '__main__':
+    main()
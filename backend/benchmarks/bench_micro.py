@@ -0,0 +1,201 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+"""
+服务层微基准：本地消息库写入、消息加解密、图片隐写
+
+  message_db：MessageDBService.add_message 逐条写入接收方本地消息库
+  encryption：EncryptionService 的 encrypt_message / decrypt_message / decrypt_many，
+              以及会话密钥缓存未命中时的一次RSA-OAEP解封
+  steganography：embed / extract 处理一张随机内容的PNG
+
+数据库和本地消息目录使用临时文件，不影响现有数据。
+
+使用方法:
+1. 运行全部: python bench_micro.py
+2. 只运行部分并输出JSON: python bench_micro.py --only message_db encryption --json micro.json
+3. 指定次数和图片尺寸: python bench_micro.py --count 2000 --image-size 1024 --stego-count 3
+"""
+
+import io
+import os
+import sys
+import time
+import base64
+import argparse
+import tempfile
+import contextlib
+from datetime import datetime
+from pathlib import Path
+
+# 添加项目根目录到Python路径
+project_root = Path(__file__).parent.parent
+sys.path.insert(0, str(project_root))
+
+from bench_common import summarize, write_results
+
+BENCHMARKS = ("message_db", "encryption", "steganography")
+
+def measure(func, count):
+    """逐次计时，返回吞吐量和单次耗时分布"""
+    samples = []
+    for index in range(count):
+        started = time.perf_counter()
+        func(index)
+        samples.append((time.perf_counter() - started) * 1000)
+    total = sum(samples) / 1000
+    return {
+        "ops": count,
+        "ops_per_s": round(count / total, 1) if total > 0 else None,
+        "latency_ms": summarize(samples, 4)
+    }
+
+def bench_message_db(count, message_size):
+    from app.services.message_db_service import MessageDBService
+
+    content = "x" * message_size
+    timestamp = datetime.now().isoformat()
+
+    def add(index):
+        MessageDBService.add_message(user_id=1, message_data={
+            "id": f"bench_{index}", "from": 2, "to": 1, "content": content,
+            "timestamp": timestamp, "method": "Server", "encrypted": False
+        })
+
+    return {"add_message": measure(add, count)}
+
+def _create_users_with_rsa_keys():
+    """创建两个用户并写入RSA公钥，返回 {用户ID: 私钥对象}"""
+    from cryptography.hazmat.primitives import serialization
+    from cryptography.hazmat.primitives.asymmetric import rsa
+    from app.db import database
+    from app.db.models import User
+
+    private_keys = {}
+    db = database.SessionLocal()
+    try:
+        for user_id in (1, 2):
+            private_key = rsa.generate_private_key(public_exponent=65537, key_size=2048)
+            public_pem = private_key.public_key().public_bytes(
+                serialization.Encoding.PEM, serialization.PublicFormat.SubjectPublicKeyInfo
+            ).decode()
+            db.merge(User(id=user_id, username=f"bench_user_{user_id}", email=f"bench_user_{user_id}@bench.local",
+                          password_hash="x", public_key=public_pem))
+            private_keys[user_id] = private_key
+        db.commit()
+    finally:
+        db.close()
+    return private_keys
+
+def bench_encryption(count, message_size, batch_size):
+    from app.db import database
+    from app.db.models import SessionKey
+    from app.services.encryption_service import encryption_service, _OAEP_PADDING
+
+    private_keys = _create_users_with_rsa_keys()
+    established = encryption_service.establish_session(1, 2)
+    if not established.get('success') or 'session_key' not in established:
+        raise RuntimeError(f"建立会话失败: {established.get('error')}")
+
+    db = database.SessionLocal()
+    try:
+        record = db.query(SessionKey).filter(SessionKey.user1_id == 1, SessionKey.user2_id == 2).first()
+        session_id, key_version, wrapped = record.id, record.key_version, base64.b64decode(record.session_key_encrypted)
+    finally:
+        db.close()
+
+    # 预热后的常态是会话密钥已在缓存中，这里直接用建立会话时得到的明文密钥填充缓存，
+    # 只测量加解密本身；缓存未命中的代价单独用RSA-OAEP解封测量
+    for pair in ((1, 2), (2, 1)):
+        encryption_service._session_key_cache[pair] = {
+            'success': True, 'session_key': established['session_key'],
+            'session_id': session_id, 'key_version': key_version
+        }
+
+    message = "x" * message_size
+    ciphertexts = []
+
+    def encrypt(_):
+        ciphertexts.append(encryption_service.encrypt_message(1, 2, message)['encrypted_message'])
+
+    results = {"encrypt": measure(encrypt, count)}
+    results["decrypt"] = measure(lambda index: encryption_service.decrypt_message(2, 1, ciphertexts[index]), count)
+
+    batch = ciphertexts[:batch_size]
+    batch_result = measure(lambda _: encryption_service.decrypt_many(2, 1, batch), max(1, count // batch_size))
+    batch_result["batch_size"] = len(batch)
+    results["decrypt_many"] = batch_result
+
+    unwrap_count = max(1, count // 100)
+    results["session_key_unwrap"] = measure(lambda _: private_keys[1].decrypt(wrapped, _OAEP_PADDING), unwrap_count)
+    return results
+
+def bench_steganography(count, image_size, message_size, workdir):
+    from PIL import Image
+    from app.services.steganography import embed, extract
+
+    source_path = os.path.join(workdir, "stego_source.png")
+    output_path = os.path.join(workdir, "stego_output.png")
+    Image.frombytes("RGB", (image_size, image_size), os.urandom(image_size * image_size * 3)).save(source_path)
+    secret = "s" * message_size
+
+    # 隐写实现会逐步打印进度，计时期间丢弃输出
+    with contextlib.redirect_stdout(io.StringIO()):
+        results = {"embed": measure(lambda _: embed(source_path, secret, "bench-password", output_path), count)}
+        results["extract"] = measure(lambda _: extract(output_path, "bench-password"), count)
+        # 提取失败时走的是另一条更短的路径，结果没有比较意义
+        results["verified"] = extract(output_path, "bench-password") == secret
+    results["image_size"] = image_size
+    return results
+
+def print_results(results):
+    print(f"{'基准':<36}{'次数':>8}{'ops/s':>14}{'p50 ms':>12}{'p99 ms':>12}")
+    for group, items in results.items():
+        for name, result in items.items():
+            if not isinstance(result, dict):
+                continue
+            latency = result["latency_ms"]
+            print(f"{group + '.' + name:<36}{result['ops']:>8}{result['ops_per_s'] or 0:>14,.1f}"
+                  f"{latency['p50']:>12.4f}{latency['p99']:>12.4f}")
+
+def main():
+    parser = argparse.ArgumentParser(description='服务层微基准')
+    parser.add_argument('--only', nargs='+', choices=BENCHMARKS, default=list(BENCHMARKS), help='要运行的基准')
+    parser.add_argument('--count', type=int, default=1000, help='消息库写入和加解密的次数')
+    parser.add_argument('--message-size', type=int, default=256, help='消息长度（字符）')
+    parser.add_argument('--batch-size', type=int, default=100, help='decrypt_many每批的消息数')
+    parser.add_argument('--stego-count', type=int, default=3, help='隐写嵌入和提取的次数')
+    parser.add_argument('--image-size', type=int, default=512, help='隐写测试图片的边长（像素）')
+    parser.add_argument('--stego-message-size', type=int, default=64, help='隐写信息长度（字符）')
+    parser.add_argument('--json', help='把结果写入JSON文件（- 表示标准输出）')
+
+    args = parser.parse_args()
+    started_at = time.time()
+
+    with tempfile.TemporaryDirectory() as tmpdir:
+        # 必须在导入应用模块之前设置：数据库指向临时文件，不写JSON日志文件
+        os.environ["DATABASE_URL"] = f"sqlite:///{os.path.join(tmpdir, 'bench.db')}"
+        os.environ.setdefault("LOG_JSON_FILE", "")
+        from app.db.database import init_db
+        from app.services import message_db_service
+
+        init_db()
+        message_db_service.DB_STORAGE_DIR = os.path.join(tmpdir, "messages")
+        os.makedirs(message_db_service.DB_STORAGE_DIR, exist_ok=True)
+
+        results = {}
+        if "message_db" in args.only:
+            results["message_db"] = bench_message_db(args.count, args.message_size)
+        if "encryption" in args.only:
+            results["encryption"] = bench_encryption(args.count, args.message_size, args.batch_size)
+        if "steganography" in args.only:
+            results["steganography"] = bench_steganography(
+                args.stego_count, args.image_size, args.stego_message_size, tmpdir
+            )
+
+    print_results(results)
+    if args.json:
+        config = {key: value for key, value in vars(args).items() if key != 'json'}
+        write_results(args.json, "micro", config, results, started_at)
+
+if __name__ == '__main__':
+    main()
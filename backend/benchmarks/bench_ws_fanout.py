@@ -0,0 +1,127 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+"""
+WebSocket推送延迟负载测试：数据库变慢时，推送给在线连接的延迟是否随之升高
+
+模拟N个在线连接，每隔固定间隔向所有连接广播一帧（推送延迟 = 计划时间到广播完成的时间），
+同时并发执行心跳更新（写users表）。通过在每条SQL前sleep注入数据库延迟，比较两种模式：
+  inline：在事件循环上直接执行数据库操作（改造前的行为）
+  bridge：通过db_executor线程池执行（当前实现）
+bridge模式下推送延迟的p99应基本不随数据库延迟变化。
+
+使用方法:
+1. 默认参数运行: python bench_ws_fanout.py
+2. 指定数据库延迟和持续时间: python bench_ws_fanout.py --db-latency-ms 0 5 20 --duration 3
+"""
+
+import os
+import sys
+import time
+import random
+import asyncio
+import argparse
+import tempfile
+from pathlib import Path
+
+# 添加项目根目录到Python路径
+project_root = Path(__file__).parent.parent
+sys.path.insert(0, str(project_root))
+
+from sqlalchemy import event
+from sqlalchemy.orm import sessionmaker
+from app.db import database
+from app.db.models import Base, User, Friend
+from app.services.db_executor import db_executor
+from app.services.user_states_update import UserStatesUpdateService
+from app.websocket.manager import ConnectionManager
+
+class FakeWebSocket:
+    async def send_text(self, message):
+        pass
+
+def setup_database(path, users):
+    """创建临时数据库，users个用户，每个用户与下一个用户互为好友"""
+    engine = database.create_db_engine(f"sqlite:///{path}")
+    Base.metadata.create_all(bind=engine)
+    session_factory = sessionmaker(autocommit=False, autoflush=False, bind=engine)
+    db = session_factory()
+    db.add_all(User(id=i, username=f"user{i}", email=f"user{i}@example.com", password_hash="x") for i in range(1, users + 1))
+    for i in range(1, users + 1):
+        peer = i % users + 1
+        db.add_all([Friend(user_id=i, friend_id=peer), Friend(user_id=peer, friend_id=i)])
+    db.commit()
+    db.close()
+    database.SessionLocal = session_factory
+    return engine
+
+def percentile(values, q):
+    values = sorted(values)
+    return values[min(len(values) - 1, int(len(values) * q))] if values else 0.0
+
+async def fanout_probe(manager, interval, stop_at, samples):
+    """每隔interval广播一帧，记录从计划时间到广播完成的毫秒数"""
+    next_tick = time.perf_counter()
+    frame = '{"type":"ping"}'
+    while next_tick < stop_at:
+        next_tick += interval
+        await asyncio.sleep(max(0.0, next_tick - time.perf_counter()))
+        for ws in manager.active_connections.values():
+            await ws.send_text(frame)
+        samples.append((time.perf_counter() - next_tick) * 1000)
+
+async def heartbeat_load(service, users, stop_at):
+    while time.perf_counter() < stop_at:
+        await service.update_user_heartbeat(random.randint(1, users))
+        # 模拟等待下一帧WebSocket数据，让出事件循环
+        await asyncio.sleep(0.001)
+
+async def run_case(users, concurrency, duration, interval):
+    manager = ConnectionManager()
+    for user_id in range(1, users + 1):
+        manager.connect(user_id, FakeWebSocket())
+    service = UserStatesUpdateService(manager)
+    samples = []
+    stop_at = time.perf_counter() + duration
+    await asyncio.gather(
+        fanout_probe(manager, interval, stop_at, samples),
+        *(heartbeat_load(service, users, stop_at) for _ in range(concurrency))
+    )
+    return samples
+
+async def inline_run(func, *args, **kwargs):
+    return func(*args, **kwargs)
+
+def main():
+    parser = argparse.ArgumentParser(description='WebSocket推送延迟负载测试')
+    parser.add_argument('--users', type=int, default=500, help='在线连接数')
+    parser.add_argument('--concurrency', type=int, default=8, help='并发心跳数')
+    parser.add_argument('--duration', type=float, default=2.0, help='每种情况持续的秒数')
+    parser.add_argument('--interval-ms', type=float, default=10.0, help='广播间隔（毫秒）')
+    parser.add_argument('--db-latency-ms', type=float, nargs='+', default=[0, 2, 10], help='注入的每条SQL延迟（毫秒）')
+
+    args = parser.parse_args()
+
+    with tempfile.TemporaryDirectory() as tmpdir:
+        engine = setup_database(os.path.join(tmpdir, "bench.db"), args.users)
+        latency = {"seconds": 0.0}
+
+        @event.listens_for(engine, "before_cursor_execute")
+        def _inject_latency(conn, cursor, statement, parameters, context, executemany):
+            if latency["seconds"]:
+                time.sleep(latency["seconds"])
+
+        bridge_run = db_executor.run
+        print(f"{'模式':<8}{'SQL延迟ms':>10}{'推送p50 ms':>12}{'推送p99 ms':>12}{'推送max ms':>12}")
+        for mode in ("inline", "bridge"):
+            db_executor.run = inline_run if mode == "inline" else bridge_run
+            for latency_ms in args.db_latency_ms:
+                latency["seconds"] = latency_ms / 1000
+                samples = asyncio.run(run_case(args.users, args.concurrency, args.duration, args.interval_ms / 1000))
+                print(f"{mode:<8}{latency_ms:>10g}{percentile(samples, 0.5):>12.2f}"
+                      f"{percentile(samples, 0.99):>12.2f}{max(samples, default=0):>12.2f}")
+        db_executor.run = bridge_run
+        db_executor.shutdown(wait=True)
+        engine.dispose()
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,550 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+"""
+WebSocket负载测试：模拟N个用户同时在线收发消息，测量送达延迟、吞吐量和离线消息重放耗时
+
+每个用户：登录获取token → 连接 /ws/{user_id} → 按间隔发送heartbeat，按设定速率（泊松到达）
+向环上的下一个用户发送 private_message、image_message 和 typing_start/typing_stop。
+消息内容带唯一标记，接收方据此计算端到端送达延迟（发送前到收到推送帧）。
+负载阶段结束后做离线重放测试：一部分用户断开，由前一个用户给它们各发M条消息，
+再同时重新连接，测量从发起连接到收齐全部离线消息的耗时。
+
+默认在进程内启动应用（临时数据库和本地消息目录，不影响现有数据），通过ASGI接口直接收发，
+不经过网络；指定 --url 时对运行中的服务测试，用户不存在时自动注册（需要安装 websockets）。
+
+使用方法:
+1. 进程内，默认参数: python bench_ws_load.py
+2. 200个用户、每人每秒2条私聊、持续30秒并输出JSON: python bench_ws_load.py --users 200 --message-rate 2 --duration 30 --json ws_load.json
+3. 对运行中的服务测试: python bench_ws_load.py --url http://localhost:8000 --users 50
+"""
+
+import os
+import sys
+import json
+import time
+import random
+import asyncio
+import argparse
+import tempfile
+import itertools
+import urllib.error
+import urllib.request
+from collections import Counter, deque
+from pathlib import Path
+
+# 添加项目根目录到Python路径
+project_root = Path(__file__).parent.parent
+sys.path.insert(0, str(project_root))
+
+from bench_common import summarize, write_results
+
+MARKER_PREFIX = "bench:"
+IMAGE_FILE_NAME = "bench.png"
+
+class AsgiWebSocket:
+    """进程内的WebSocket客户端，直接与ASGI应用交换消息"""
+
+    def __init__(self, app, path, query):
+        self._to_app = asyncio.Queue()
+        self._from_app = asyncio.Queue()
+        scope = {
+            "type": "websocket", "asgi": {"version": "3.0"}, "scheme": "ws", "http_version": "1.1",
+            "path": path, "raw_path": path.encode(), "root_path": "", "query_string": query.encode(),
+            "headers": [(b"host", b"bench")], "client": ("127.0.0.1", 0), "server": ("bench", 80),
+            "subprotocols": []
+        }
+        self._task = asyncio.create_task(app(scope, self._to_app.get, self._from_app.put))
+        # 应用结束（正常关闭或异常）后不能让recv一直等待
+        self._task.add_done_callback(lambda _: self._from_app.put_nowait({"type": "websocket.close"}))
+
+    async def accept(self):
+        await self._to_app.put({"type": "websocket.connect"})
+        message = await self._from_app.get()
+        if message["type"] != "websocket.accept":
+            raise ConnectionRefusedError(f"连接被拒绝: {message}")
+
+    async def send(self, text):
+        await self._to_app.put({"type": "websocket.receive", "text": text})
+
+    async def recv(self):
+        message = await self._from_app.get()
+        if message["type"] != "websocket.send":
+            return None
+        return message.get("text") if message.get("text") is not None else message.get("bytes", b"").decode()
+
+    async def close(self):
+        await self._to_app.put({"type": "websocket.disconnect", "code": 1000})
+        try:
+            await asyncio.wait_for(self._task, timeout=5)
+        except Exception:
+            pass
+
+class AsgiTransport:
+    """进程内调用应用"""
+
+    def __init__(self, app):
+        self.app = app
+
+    async def request(self, method, path, body=None):
+        payload = json.dumps(body).encode() if body is not None else b""
+        scope = {
+            "type": "http", "asgi": {"version": "3.0"}, "http_version": "1.1", "method": method,
+            "scheme": "http", "path": path, "raw_path": path.encode(), "root_path": "", "query_string": b"",
+            "headers": [(b"host", b"bench"), (b"content-type", b"application/json"),
+                        (b"content-length", str(len(payload)).encode())],
+            "client": ("127.0.0.1", 0), "server": ("bench", 80)
+        }
+        request_sent = False
+        status = [0]
+        chunks = []
+
+        async def receive():
+            nonlocal request_sent
+            if not request_sent:
+                request_sent = True
+                return {"type": "http.request", "body": payload, "more_body": False}
+            # 响应完成前客户端不会断开
+            await asyncio.Event().wait()
+
+        async def send(message):
+            if message["type"] == "http.response.start":
+                status[0] = message["status"]
+            elif message["type"] == "http.response.body":
+                chunks.append(message.get("body", b""))
+
+        await self.app(scope, receive, send)
+        body = b"".join(chunks)
+        try:
+            return status[0], json.loads(body) if body else None
+        except ValueError:
+            return status[0], None
+
+    async def connect(self, path):
+        path, _, query = path.partition("?")
+        ws = AsgiWebSocket(self.app, path, query)
+        await ws.accept()
+        return ws
+
+class RemoteWebSocket:
+    def __init__(self, ws, closed_error):
+        self._ws = ws
+        self._closed_error = closed_error
+
+    async def send(self, text):
+        await self._ws.send(text)
+
+    async def recv(self):
+        try:
+            return await self._ws.recv()
+        except self._closed_error:
+            return None
+
+    async def close(self):
+        await self._ws.close()
+
+class UrlTransport:
+    """通过网络访问运行中的服务"""
+
+    def __init__(self, base_url):
+        try:
+            import websockets
+            from websockets.exceptions import ConnectionClosed
+        except ImportError:
+            sys.exit("--url 模式需要安装 websockets: pip install websockets")
+        self._connect = websockets.connect
+        self._closed_error = ConnectionClosed
+        self.base_url = base_url.rstrip("/")
+        self.ws_base_url = "ws" + self.base_url[len("http"):] if self.base_url.startswith("http") else self.base_url
+
+    def _request_sync(self, method, path, body):
+        data = json.dumps(body).encode() if body is not None else None
+        request = urllib.request.Request(self.base_url + path, data=data, method=method,
+                                         headers={"Content-Type": "application/json"})
+        try:
+            with urllib.request.urlopen(request, timeout=30) as response:
+                status, raw = response.status, response.read()
+        except urllib.error.HTTPError as e:
+            status, raw = e.code, e.read()
+        try:
+            return status, json.loads(raw) if raw else None
+        except ValueError:
+            return status, None
+
+    async def request(self, method, path, body=None):
+        return await asyncio.to_thread(self._request_sync, method, path, body)
+
+    async def connect(self, path):
+        ws = await self._connect(self.ws_base_url + path, max_size=None)
+        return RemoteWebSocket(ws, self._closed_error)
+
+class LoadStats:
+    """所有模拟用户共享的统计"""
+
+    def __init__(self):
+        self.pending = {}  # 标记 -> (类型, 发送时间)
+        self.latency_ms = {"private_message": [], "image_message": []}
+        self.sent = Counter()
+        self.delivered = Counter()
+        self.errors = Counter()
+        self.login_ms = []
+        self.connect_ms = []
+        self.heartbeat_rtt_ms = []
+        self.other_frames = Counter()
+        self._markers = itertools.count(1)
+
+    def new_marker(self, kind):
+        marker = f"{MARKER_PREFIX}{next(self._markers)}"
+        self.pending[marker] = (kind, time.perf_counter())
+        self.sent[kind] += 1
+        return marker
+
+class SimUser:
+    def __init__(self, transport, stats, user_id, token, peer_id, message_size):
+        self.transport = transport
+        self.stats = stats
+        self.user_id = user_id
+        self.token = token
+        self.peer_id = peer_id
+        self.padding = "x" * max(0, message_size)
+        self.ws = None
+        self.reader = None
+        self.offline_received = 0
+        self.offline_expected = 0
+        self.offline_done = asyncio.Event()
+        self._heartbeats = deque()
+        self._heartbeat_acked = asyncio.Event()
+
+    async def connect(self):
+        started = time.perf_counter()
+        self.ws = await self.transport.connect(f"/ws/{self.user_id}?token={self.token}")
+        self.stats.connect_ms.append((time.perf_counter() - started) * 1000)
+        self.reader = asyncio.create_task(self._read())
+
+    async def disconnect(self):
+        if self.ws is not None:
+            await self.ws.close()
+            self.ws = None
+        if self.reader is not None:
+            await asyncio.gather(self.reader, return_exceptions=True)
+            self.reader = None
+
+    async def _read(self):
+        while True:
+            text = await self.ws.recv()
+            if text is None:
+                return
+            received_at = time.perf_counter()
+            frame = json.loads(text)
+            frame_type = frame.get("type")
+            if frame_type == "message":
+                self._on_message(frame.get("data") or {}, received_at)
+            elif frame_type == "typing":
+                self.stats.delivered["typing"] += 1
+            elif frame_type == "heartbeat_response":
+                if self._heartbeats:
+                    self.stats.heartbeat_rtt_ms.append((received_at - self._heartbeats.popleft()) * 1000)
+                self._heartbeat_acked.set()
+            else:
+                self.stats.other_frames[frame_type] += 1
+
+    def _on_message(self, data, received_at):
+        marker = str(data.get("content") or "").split(" ", 1)[0]
+        kind, sent_at = self.stats.pending.pop(marker, (None, None))
+        if kind is None:
+            self.stats.other_frames["message"] += 1
+            return
+        self.stats.delivered[kind] += 1
+        if kind == "offline":
+            self.offline_received += 1
+            if self.offline_received >= self.offline_expected:
+                self.offline_done.set()
+        else:
+            self.stats.latency_ms[kind].append((received_at - sent_at) * 1000)
+
+    async def _send(self, frame):
+        try:
+            await self.ws.send(json.dumps(frame))
+        except Exception as e:
+            self.stats.errors[f"send_{type(e).__name__}"] += 1
+
+    async def send_private(self, kind="private_message", to_id=None):
+        content = f"{self.stats.new_marker(kind)} {self.padding}"
+        await self._send({"type": "private_message", "to_id": to_id or self.peer_id, "content": content,
+                          "message_type": "text", "encrypted": False, "method": "Server"})
+
+    async def send_image(self):
+        content = f"{self.stats.new_marker('image_message')} {self.padding}"
+        await self._send({"type": "image_message", "to_id": self.peer_id, "content": content,
+                          "file_path": f"/uploads/{IMAGE_FILE_NAME}", "file_name": IMAGE_FILE_NAME,
+                          "encrypted": False, "method": "Server"})
+
+    async def send_typing(self):
+        self.stats.sent["typing"] += 2
+        await self._send({"type": "typing_start", "to_id": self.peer_id})
+        await self._send({"type": "typing_stop", "to_id": self.peer_id})
+
+    async def heartbeat(self):
+        self._heartbeat_acked.clear()
+        self._heartbeats.append(time.perf_counter())
+        await self._send({"type": "heartbeat"})
+
+    async def sync(self, timeout=30):
+        """发送一次心跳并等待回复；同一连接按顺序处理，回复到达说明之前的帧都已处理完"""
+        await self.heartbeat()
+        await asyncio.wait_for(self._heartbeat_acked.wait(), timeout)
+
+async def sleep_until_or_stop(delay, stop_at):
+    """等待delay秒，会超过stop_at时只等到stop_at并返回False"""
+    remaining = stop_at - time.perf_counter()
+    if delay >= remaining:
+        await asyncio.sleep(max(0.0, remaining))
+        return False
+    await asyncio.sleep(delay)
+    return True
+
+async def poisson_loop(rate, stop_at, action):
+    """按泊松过程（平均每秒rate次）执行action，直到stop_at"""
+    if rate <= 0:
+        return
+    while await sleep_until_or_stop(random.expovariate(rate), stop_at):
+        await action()
+
+async def heartbeat_loop(user, interval, stop_at):
+    if interval <= 0:
+        return
+    # 错开各用户的第一次心跳
+    delay = random.uniform(0, interval)
+    while await sleep_until_or_stop(delay, stop_at):
+        await user.heartbeat()
+        delay = interval
+
+async def login(transport, stats, username, password, register):
+    """登录，返回 (user_id, token)；register为True时用户不存在则先注册"""
+    started = time.perf_counter()
+    status, body = await transport.request("POST", "/api/v1/auth/login", {"username": username, "password": password})
+    if status == 401 and register:
+        status, body = await transport.request("POST", "/api/v1/auth/register", {
+            "username": username, "email": f"{username}@bench.local", "password": password
+        })
+    if status != 200 or not body or not body.get("success"):
+        stats.errors[f"login_{status}"] += 1
+        return None
+    stats.login_ms.append((time.perf_counter() - started) * 1000)
+    user = body["data"]["user"]
+    return int(user.get("userId") or user.get("id")), body["data"]["token"]
+
+async def wait_ready(transport, timeout=60):
+    deadline = time.perf_counter() + timeout
+    while time.perf_counter() < deadline:
+        status, _ = await transport.request("GET", "/api/ready")
+        if status == 200:
+            return
+        await asyncio.sleep(0.2)
+    raise TimeoutError("服务未在规定时间内就绪")
+
+async def drain(stats, kinds, timeout):
+    """等待已发送的消息送达，超时后剩余的计为丢失"""
+    deadline = time.perf_counter() + timeout
+    while time.perf_counter() < deadline and any(kind in kinds for kind, _ in stats.pending.values()):
+        await asyncio.sleep(0.05)
+
+async def offline_replay(users, stats, offline_users, messages_per_user, timeout):
+    """断开部分用户，由前一个用户给它们发消息，再重新连接并测量收齐离线消息的耗时"""
+    # 选偶数位置的用户离线，它们的前一个用户保持在线负责发送
+    targets = [users[index] for index in range(1, len(users), 2)][:offline_users]
+    if not targets or messages_per_user <= 0:
+        return {"users": 0}
+    senders = {user.user_id: users[users.index(user) - 1] for user in targets}
+
+    await asyncio.gather(*(user.disconnect() for user in targets))
+    # 等服务器处理完断开（离线状态写库），否则消息可能仍按在线推送
+    await asyncio.sleep(0.5)
+    for user in targets:
+        user.offline_received = 0
+        user.offline_expected = messages_per_user
+        user.offline_done.clear()
+
+    async def send_batch(target):
+        sender = senders[target.user_id]
+        for _ in range(messages_per_user):
+            await sender.send_private("offline", to_id=target.user_id)
+        await sender.sync()
+
+    await asyncio.gather(*(send_batch(target) for target in targets))
+
+    async def reconnect(target):
+        started = time.perf_counter()
+        await target.connect()
+        try:
+            await asyncio.wait_for(target.offline_done.wait(), timeout)
+        except asyncio.TimeoutError:
+            stats.errors["offline_replay_timeout"] += 1
+        return (time.perf_counter() - started) * 1000
+
+    started = time.perf_counter()
+    replay_ms = await asyncio.gather(*(reconnect(target) for target in targets))
+    elapsed = time.perf_counter() - started
+    received = sum(target.offline_received for target in targets)
+    return {
+        "users": len(targets),
+        "messages_per_user": messages_per_user,
+        "replay_ms": summarize(replay_ms),
+        "messages_per_s": round(received / elapsed, 1) if elapsed > 0 else 0.0,
+        "missing": len(targets) * messages_per_user - received
+    }
+
+async def run_load(transport, args, register):
+    stats = LoadStats()
+    usernames = [f"{args.user_prefix}{i}" for i in range(1, args.users + 1)]
+
+    # 登录（限制并发，避免密码校验排队触发CPU线程池的准入限制）
+    semaphore = asyncio.Semaphore(args.login_concurrency)
+
+    async def limited_login(username):
+        async with semaphore:
+            return await login(transport, stats, username, args.password, register)
+
+    credentials = [c for c in await asyncio.gather(*(limited_login(name) for name in usernames)) if c]
+    if len(credentials) < 2:
+        raise RuntimeError(f"登录成功的用户不足2个: {dict(stats.errors)}")
+
+    users = []
+    for index, (user_id, token) in enumerate(credentials):
+        peer_id = credentials[(index + 1) % len(credentials)][0]
+        users.append(SimUser(transport, stats, user_id, token, peer_id, args.message_size))
+    await asyncio.gather(*(user.connect() for user in users))
+    # 连接时推送的离线消息、上线状态广播等不计入
+    await asyncio.sleep(args.warmup)
+
+    started = time.perf_counter()
+    stop_at = started + args.duration
+    tasks = []
+    for user in users:
+        tasks.append(heartbeat_loop(user, args.heartbeat_interval, stop_at))
+        tasks.append(poisson_loop(args.message_rate, stop_at, user.send_private))
+        tasks.append(poisson_loop(args.image_rate, stop_at, user.send_image))
+        tasks.append(poisson_loop(args.typing_rate, stop_at, user.send_typing))
+    await asyncio.gather(*tasks)
+    await drain(stats, ("private_message", "image_message"), args.drain)
+    elapsed = time.perf_counter() - started
+
+    lost = Counter(kind for kind, _ in stats.pending.values())
+    stats.pending.clear()
+    load_results = {
+        "users": len(users),
+        "elapsed_s": round(elapsed, 3),
+        "login_ms": summarize(stats.login_ms),
+        "connect_ms": summarize(stats.connect_ms),
+        "delivery_ms": {kind: summarize(samples) for kind, samples in stats.latency_ms.items()},
+        "heartbeat_rtt_ms": summarize(stats.heartbeat_rtt_ms),
+        "sent": dict(stats.sent),
+        "delivered": dict(stats.delivered),
+        "lost": dict(lost),
+        "throughput": {
+            "sent_per_s": round(sum(stats.sent.values()) / args.duration, 1),
+            "delivered_per_s": round(sum(stats.delivered.values()) / elapsed, 1)
+        }
+    }
+
+    load_results["offline_replay"] = await offline_replay(
+        users, stats, min(args.offline_users, len(users) // 2), args.offline_messages, args.drain + 30
+    )
+    load_results["errors"] = dict(stats.errors)
+    load_results["other_frames"] = dict(stats.other_frames)
+    await asyncio.gather(*(user.disconnect() for user in users))
+    return load_results
+
+def seed_users(count, prefix, password):
+    """在临时数据库中创建用户（所有用户共用一个密码哈希，省去逐个bcrypt）"""
+    from app.core.security import hash_password
+    from app.db import database
+    from app.db.models import User
+
+    password_hash = hash_password(password)
+    db = database.SessionLocal()
+    try:
+        db.add_all(User(username=f"{prefix}{i}", email=f"{prefix}{i}@bench.local", password_hash=password_hash)
+                   for i in range(1, count + 1))
+        db.commit()
+    finally:
+        db.close()
+
+async def run_in_process(args):
+    with tempfile.TemporaryDirectory() as tmpdir:
+        # 必须在导入应用之前设置：数据库指向临时文件，不写JSON日志文件
+        os.environ["DATABASE_URL"] = f"sqlite:///{os.path.join(tmpdir, 'bench.db')}"
+        os.environ.setdefault("LOG_JSON_FILE", "")
+        os.environ.setdefault("LOG_LEVEL", "WARNING")
+        # 负载测试测的是服务能力，进程内运行时默认关闭限流（被拒绝的帧计入 other_frames 的 rate_limited）
+        os.environ.setdefault("RATE_LIMIT_ENABLED", "false")
+        from app.main import app
+        from app.services import message_db_service
+
+        # 接收方本地消息库写到临时目录
+        message_db_service.DB_STORAGE_DIR = os.path.join(tmpdir, "messages")
+        os.makedirs(message_db_service.DB_STORAGE_DIR, exist_ok=True)
+
+        async with app.router.lifespan_context(app):
+            transport = AsgiTransport(app)
+            await wait_ready(transport)
+            await asyncio.to_thread(seed_users, args.users, args.user_prefix, args.password)
+            return await run_load(transport, args, register=False)
+
+def print_results(results):
+    print(f"用户数 {results['users']}，耗时 {results['elapsed_s']} s")
+    print(f"{'指标':<24}{'次数':>8}{'p50 ms':>10}{'p90 ms':>10}{'p99 ms':>10}{'max ms':>10}")
+    rows = [("login", results["login_ms"]), ("connect", results["connect_ms"]),
+            ("heartbeat_rtt", results["heartbeat_rtt_ms"])]
+    rows += [(f"delivery.{kind}", summary) for kind, summary in results["delivery_ms"].items()]
+    replay = results["offline_replay"]
+    if replay.get("users"):
+        rows.append(("offline_replay", replay["replay_ms"]))
+    for name, summary in rows:
+        if summary.get("count"):
+            print(f"{name:<24}{summary['count']:>8}{summary['p50']:>10.2f}{summary['p90']:>10.2f}"
+                  f"{summary['p99']:>10.2f}{summary['max']:>10.2f}")
+    print(f"发送 {results['throughput']['sent_per_s']} 帧/s，送达 {results['throughput']['delivered_per_s']} 帧/s，"
+          f"丢失 {results['lost'] or 0}")
+    if replay.get("users"):
+        print(f"离线重放: {replay['users']} 个用户各 {replay['messages_per_user']} 条，"
+              f"{replay['messages_per_s']} 条/s，缺失 {replay['missing']}")
+    if results["errors"]:
+        print(f"错误: {results['errors']}")
+
+def main():
+    parser = argparse.ArgumentParser(description='WebSocket负载测试')
+    parser.add_argument('--url', help='运行中服务的地址，例如 http://localhost:8000；不指定则在进程内启动应用')
+    parser.add_argument('--users', type=int, default=50, help='模拟用户数')
+    parser.add_argument('--duration', type=float, default=10.0, help='负载阶段持续秒数')
+    parser.add_argument('--message-rate', type=float, default=1.0, help='每个用户每秒发送的私聊消息数')
+    parser.add_argument('--image-rate', type=float, default=0.1, help='每个用户每秒发送的图片消息数')
+    parser.add_argument('--typing-rate', type=float, default=0.5, help='每个用户每秒发送的输入状态次数（start+stop）')
+    parser.add_argument('--heartbeat-interval', type=float, default=5.0, help='心跳间隔秒数，0表示不发送')
+    parser.add_argument('--message-size', type=int, default=64, help='消息内容除标记外的填充长度')
+    parser.add_argument('--offline-users', type=int, default=10, help='离线重放测试的用户数')
+    parser.add_argument('--offline-messages', type=int, default=50, help='每个离线用户收到的消息数')
+    parser.add_argument('--warmup', type=float, default=1.0, help='连接建立后开始计时前等待的秒数')
+    parser.add_argument('--drain', type=float, default=5.0, help='负载结束后等待未送达消息的秒数')
+    parser.add_argument('--login-concurrency', type=int, default=8, help='同时进行的登录请求数')
+    parser.add_argument('--user-prefix', default='bench_user_', help='模拟用户的用户名前缀')
+    parser.add_argument('--password', default='bench-password', help='模拟用户的密码')
+    parser.add_argument('--seed', type=int, default=None, help='随机数种子')
+    parser.add_argument('--json', help='把结果写入JSON文件（- 表示标准输出）')
+
+    args = parser.parse_args()
+    random.seed(args.seed)
+
+    started_at = time.time()
+    if args.url:
+        results = asyncio.run(run_load(UrlTransport(args.url), args, register=True))
+    else:
+        results = asyncio.run(run_in_process(args))
+
+    print_results(results)
+    if args.json:
+        config = {key: value for key, value in vars(args).items() if key not in ('json', 'password')}
+        config["mode"] = "url" if args.url else "in_process"
+        write_results(args.json, "ws_load", config, results, started_at)
+
+if __name__ == '__main__':
+    main()
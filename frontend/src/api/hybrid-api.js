@@ -54,7 +54,22 @@ export const authAPI = {
   getUserInfo: () => api.get('/v1/auth/me'),
   
   // 获取用户加密密钥
-  getUserKeys: (userId) => api.get(`/v1/encryption/my-keys`)
+  getUserKeys: (userId) => api.get(`/v1/encryption/my-keys`),
+  
+  // 查询注册（或登录补做）后后台密钥生成任务的状态
+  getKeySetupStatus: (jobId) => api.get(`/v1/auth/key-setup/${jobId}`)
+};
+
+// 轮询后台密钥生成任务直到结束，返回任务状态；超时后返回最后一次查询到的状态
+export const waitForKeySetup = async (keySetup, { interval = 500, timeout = 60000 } = {}) => {
+  let job = keySetup;
+  const deadline = Date.now() + timeout;
+  while (job && (job.status === 'pending' || job.status === 'running') && Date.now() < deadline) {
+    await new Promise((resolve) => setTimeout(resolve, interval));
+    const response = await authAPI.getKeySetupStatus(job.job_id);
+    job = response.data.data;
+  }
+  return job;
 };
 
 // 联系人相关API